@@ -0,0 +1,322 @@
+"""Non-blocking DynamoDB client
+
+Issues DynamoDB JSON-over-HTTP API calls on the reactor, via a persistent
+HTTP connection pool, rather than with boto3 in a thread pool. Requests are
+signed (SigV4) with botocore and credentials are resolved via botocore's
+usual provider chain.
+
+Responses (and errors) mirror boto3's: items are (de)serialized with the
+boto3 Table resource's type conversions and failures (including timed out
+requests and connection failures) raise
+:exc:`botocore.exceptions.ClientError`, so callers may share handling
+between the two.
+
+"""
+import base64
+import json
+import os
+import random
+from StringIO import StringIO
+
+import botocore.session
+from boto3.dynamodb.types import Binary, TypeDeserializer, TypeSerializer
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+from botocore.exceptions import ClientError
+from typing import Any, Dict, List, Optional  # noqa
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, TimeoutError  # noqa
+from twisted.internet.error import ConnectError
+from twisted.internet.task import deferLater
+from twisted.python.failure import Failure
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    RequestTransmissionFailed,
+    ResponseFailed,
+    ResponseNeverReceived,
+    readBody,
+)
+from twisted.web.http_headers import Headers
+
+from autopush.exceptions import InvalidConfig
+from autopush.http import QuietClientFactory
+
+API_VERSION = "DynamoDB_20120810"
+CONTENT_TYPE = "application/x-amz-json-1.0"
+
+# Request parameters mapping names to typed values
+_ITEM_PARAMS = ("Key", "Item", "ExclusiveStartKey",
+                "ExpressionAttributeValues")
+# Response fields mapping names to typed values
+_ITEM_FIELDS = ("Item", "Attributes", "LastEvaluatedKey")
+
+# Errors retried after backing off (as boto3 does), along with any 5xx
+RETRYABLE_ERRORS = frozenset([
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+])
+# Error codes of the ClientErrors raised for timed out attempts and
+# connection failures (e.g. a pooled connection closed by DynamoDB)
+TIMEOUT_ERROR = "RequestTimeout"
+CONNECTION_ERROR = "ConnectionError"
+CONNECTION_ERRORS = (ConnectError, RequestTransmissionFailed,
+                     ResponseFailed, ResponseNeverReceived)
+# Max seconds before the first retry, doubling per retry (boto3's)
+RETRY_BASE_DELAY = 0.025
+
+
+class _Serializer(TypeSerializer):
+    """TypeSerializer producing JSON safe (base64) binary values"""
+    def _serialize_b(self, value):
+        if isinstance(value, Binary):
+            value = value.value
+        return base64.b64encode(value)
+
+    def _serialize_bs(self, value):
+        return [self._serialize_b(v) for v in value]
+
+
+class _Deserializer(TypeDeserializer):
+    """TypeDeserializer decoding JSON (base64) binary values"""
+    def _deserialize_b(self, value):
+        return Binary(base64.b64decode(value))
+
+    def _deserialize_bs(self, value):
+        return set(self._deserialize_b(v) for v in value)
+
+
+_serializer = _Serializer()
+_deserializer = _Deserializer()
+
+
+def serialize_item(item):
+    # type: (Dict[str, Any]) -> Dict[str, Dict[str, Any]]
+    return {k: _serializer.serialize(v) for k, v in item.iteritems()}
+
+
+def deserialize_item(item):
+    # type: (Dict[str, Dict[str, Any]]) -> Dict[str, Any]
+    return {k: _deserializer.deserialize(v) for k, v in item.iteritems()}
+
+
+def _convert_requests(request_items, convert):
+    """Convert the items of BatchWriteItem's per table write requests"""
+    converted = {}
+    for tablename, requests in request_items.iteritems():
+        converted[tablename] = [
+            {"PutRequest": {"Item": convert(req["PutRequest"]["Item"])}}
+            if "PutRequest" in req else
+            {"DeleteRequest": {"Key": convert(req["DeleteRequest"]["Key"])}}
+            for req in requests
+        ]
+    return converted
+
+
+class AsyncDynamoDBClient(object):
+    """Calls the DynamoDB API on the reactor
+
+    Calls failing due to throttling, a server error, a timeout or a
+    connection failure are retried up to ``max_retries`` times with
+    (jittered) exponential backoff. Each attempt times out after
+    ``request_timeout`` seconds (0 waits forever): a call whose final
+    attempt timed out or lost its connection fails with a
+    ``RequestTimeout`` or ``ConnectionError`` :exc:`ClientError`.
+
+    """
+
+    def __init__(self,
+                 region_name=None,    # type: Optional[str]
+                 endpoint_url=None,   # type: Optional[str]
+                 credentials=None,    # type: Optional[Credentials]
+                 max_connections=50,  # type: int
+                 connect_timeout=1,   # type: float
+                 request_timeout=5,   # type: float
+                 max_retries=3,       # type: int
+                 reactor=reactor,
+                 ):
+        # type: (...) -> None
+        region_name = region_name or os.getenv("AWS_DEFAULT_REGION",
+                                               "us-east-1")
+        if not endpoint_url and os.getenv("AWS_LOCAL_DYNAMODB"):
+            endpoint_url = os.getenv("AWS_LOCAL_DYNAMODB")
+            credentials = credentials or Credentials("Bogus", "Bogus")
+        if not credentials:
+            credentials = botocore.session.get_session().get_credentials()
+            if not credentials:
+                raise InvalidConfig("No AWS credentials found for the async "
+                                    "DynamoDB client")
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url or (
+            "https://dynamodb.%s.amazonaws.com" % region_name)
+        self.credentials = credentials
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self._reactor = reactor
+        pool = HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = max_connections
+        pool._factory = QuietClientFactory
+        self.agent = Agent(reactor, connectTimeout=connect_timeout,
+                           pool=pool)
+
+    def close(self):
+        # type: () -> Deferred
+        return self.agent._pool.closeCachedConnections()
+
+    def table(self, tablename):
+        # type: (str) -> AsyncDynamoDBTable
+        return AsyncDynamoDBTable(self, tablename)
+
+    def batch_write_item(self, RequestItems):
+        # type: (Dict[str, List[Dict[str, Any]]]) -> Deferred
+        """Call BatchWriteItem with the resource's (Python typed) items
+
+        ``UnprocessedItems`` in the response are likewise deserialized.
+
+        """
+        d = self.call("BatchWriteItem",
+                      RequestItems=_convert_requests(RequestItems,
+                                                     serialize_item))
+
+        def deserialize(result):
+            result["UnprocessedItems"] = _convert_requests(
+                result.get("UnprocessedItems", {}), deserialize_item)
+            return result
+        d.addCallback(deserialize)
+        return d
+
+    def call(self, operation, **params):
+        # type: (str, **Any) -> Deferred
+        """Call a DynamoDB API operation with low level (typed) params
+
+        Returns a Deferred firing with the decoded response, including a
+        boto3 style ``ResponseMetadata``.
+
+        """
+        return self._call(operation, json.dumps(params), 0)
+
+    def _call(self, operation, body, retries):
+        # type: (str, str, int) -> Deferred
+        # Signed per attempt (signatures are timestamped)
+        request = AWSRequest(
+            method="POST",
+            url=self.endpoint_url,
+            data=body,
+            headers={
+                "Content-Type": CONTENT_TYPE,
+                "X-Amz-Target": "%s.%s" % (API_VERSION, operation),
+            },
+        )
+        SigV4Auth(self.credentials.get_frozen_credentials(), "dynamodb",
+                  self.region_name).add_auth(request)
+        headers = Headers({k: [v] for k, v in request.headers.items()})
+        d = self.agent.request(
+            "POST",
+            self.endpoint_url.encode("utf8"),
+            headers,
+            FileBodyProducer(StringIO(body)),
+        )
+        d.addCallback(self._read_response, operation)
+        if self.request_timeout:
+            d.addTimeout(self.request_timeout, self._reactor)
+        d.addErrback(self._retry, operation, body, retries)
+        return d
+
+    def _retry(self, fail, operation, body, retries):
+        if fail.check(TimeoutError):
+            fail = self._client_error(
+                operation, TIMEOUT_ERROR, 504,
+                "No response within %ss" % self.request_timeout)
+        elif fail.check(*CONNECTION_ERRORS):
+            fail = self._client_error(operation, CONNECTION_ERROR, 503,
+                                      repr(fail.value))
+        fail.trap(ClientError)
+        response = fail.value.response
+        if retries >= self.max_retries or not (
+                response["Error"]["Code"] in RETRYABLE_ERRORS or
+                response["ResponseMetadata"]["HTTPStatusCode"] >= 500):
+            return fail
+        delay = random.random() * RETRY_BASE_DELAY * 2 ** retries
+        return deferLater(self._reactor, delay, self._call, operation, body,
+                          retries + 1)
+
+    def _client_error(self, operation, code, status, message):
+        # type: (str, str, int, str) -> Failure
+        """A ClientError failure for a request that got no response"""
+        return Failure(ClientError(
+            {
+                "Error": {"Code": code, "Message": message},
+                "ResponseMetadata": {"HTTPStatusCode": status},
+            },
+            operation
+        ))
+
+    def _read_response(self, response, operation):
+        d = readBody(response)
+        d.addCallback(self._decode_response, response.code, operation)
+        return d
+
+    def _decode_response(self, body, code, operation):
+        try:
+            result = json.loads(body) if body else {}
+        except ValueError:
+            result = {"message": body}
+        if code != 200:
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": result.get("__type", "").split("#")[-1],
+                        "Message": result.get("message",
+                                              result.get("Message", "")),
+                    },
+                    "ResponseMetadata": {"HTTPStatusCode": code},
+                },
+                operation
+            )
+        result["ResponseMetadata"] = {"HTTPStatusCode": code}
+        return result
+
+
+class AsyncDynamoDBTable(object):
+    """A subset of the boto3 Table resource's methods, returning Deferreds
+
+    Parameters and results use the resource's (Python typed) item format.
+    Condition objects (``boto3.dynamodb.conditions``) aren't supported:
+    pass expressions as strings.
+
+    """
+
+    def __init__(self, client, tablename):
+        # type: (AsyncDynamoDBClient, str) -> None
+        self.client = client
+        self.name = tablename
+
+    def get_item(self, **kwargs):
+        return self._call("GetItem", kwargs)
+
+    def put_item(self, **kwargs):
+        return self._call("PutItem", kwargs)
+
+    def update_item(self, **kwargs):
+        return self._call("UpdateItem", kwargs)
+
+    def delete_item(self, **kwargs):
+        return self._call("DeleteItem", kwargs)
+
+    def _call(self, operation, params):
+        params["TableName"] = self.name
+        for name in _ITEM_PARAMS:
+            if name in params:
+                params[name] = serialize_item(params[name])
+        d = self.client.call(operation, **params)
+        d.addCallback(self._deserialize)
+        return d
+
+    def _deserialize(self, result):
+        for name in _ITEM_FIELDS:
+            if name in result:
+                result[name] = deserialize_item(result[name])
+        return result
@@ -0,0 +1,275 @@
+"""Bounded in-process caches"""
+import threading
+import time
+from collections import OrderedDict
+
+from typing import (  # noqa
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Optional,
+    Tuple,
+)
+
+from autopush.metrics import IMetrics, make_tags  # noqa
+
+
+class TTLCache(object):
+    """A thread-safe, bounded LRU mapping whose entries expire
+
+    Entries are dropped once they're older than ``ttl`` seconds, or when the
+    cache exceeds ``max_size`` entries (least recently used first). If a
+    ``weigher`` is supplied, the summed weight of all entries is also kept
+    under ``max_weight`` (e.g. to bound approximate memory use).
+
+    Lookups emit ``cache.hit``/``cache.miss`` and size based removals emit
+    ``cache.eviction`` metrics, all tagged with the cache's ``name``.
+
+    A value read from its source (e.g. on another thread) while the key is
+    invalidated is stale: pass the :meth:`generation` taken before the read
+    to :meth:`set`, which then skips storing values invalidated since.
+
+    """
+    def __init__(self,
+                 max_size,             # type: int
+                 ttl,                  # type: float
+                 metrics=None,         # type: Optional[IMetrics]
+                 name="cache",         # type: str
+                 timer=time.time,      # type: Callable[[], float]
+                 max_weight=0,         # type: int
+                 weigher=None,         # type: Optional[Callable[[Any], int]]
+                 ):
+        # type: (...) -> None
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigher = weigher
+        self.weight = 0
+        self.metrics = metrics
+        self.name = name
+        self._timer = timer
+        self._tags = make_tags(cache=name)
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # type: OrderedDict
+        # Generation of each recently invalidated key (up to max_size of
+        # them), and the latest generation of those forgotten since
+        self._generation = 0
+        self._invalidated = OrderedDict()  # type: OrderedDict
+        self._forgotten = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        entry = self._items.get(key)
+        return entry is not None and entry[0] > self._timer()
+
+    def _emit(self, metric):
+        if self.metrics:
+            self.metrics.increment("cache." + metric, tags=self._tags)
+
+    def get(self, key, default=None):
+        # type: (Hashable, Any) -> Any
+        """Return the unexpired value for key, or default"""
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if entry is not None:
+                expires, value, weight = entry
+                if expires > self._timer():
+                    # Re-insert to mark as most recently used
+                    self._items[key] = entry
+                    self._emit("hit")
+                    return value
+                self.weight -= weight
+        self._emit("miss")
+        return default
+
+    def generation(self):
+        # type: () -> int
+        """Return the current generation, to pass to :meth:`set` for a
+        value about to be read"""
+        return self._generation
+
+    def set(self, key, value, ttl=None, generation=None):
+        # type: (Hashable, Any, Optional[float], Optional[int]) -> None
+        """Store value for key, evicting the oldest entries if full
+
+        :param ttl: Optional override of the cache wide ``ttl``
+        :param generation: Optional :meth:`generation` taken before value
+            was read, the value isn't stored if key's been invalidated
+            since
+
+        """
+        if self.max_size <= 0:
+            return
+        weight = 0
+        if self.weigher:
+            weight = self.weigher(value)
+            if self.max_weight and weight > self.max_weight:
+                # Would evict everything else and still not fit
+                self.invalidate(key)
+                return
+        expires = self._timer() + (self.ttl if ttl is None else ttl)
+        evicted = 0
+        with self._lock:
+            if generation is not None and (
+                    generation < self._forgotten or
+                    self._invalidated.get(key, -1) > generation):
+                return
+            self._discard(key)
+            self._items[key] = (expires, value, weight)
+            self.weight += weight
+            while (len(self._items) > self.max_size or
+                   (self.max_weight and self.weight > self.max_weight)):
+                _, (_, _, old_weight) = self._items.popitem(last=False)
+                self.weight -= old_weight
+                evicted += 1
+        if evicted and self.metrics:
+            self.metrics.increment("cache.eviction", count=evicted,
+                                   tags=self._tags)
+
+    def invalidate(self, key):
+        # type: (Hashable) -> None
+        """Drop any entry for key"""
+        with self._lock:
+            self._discard(key)
+            self._generation += 1
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = self._generation
+            while len(self._invalidated) > max(self.max_size, 1):
+                _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        # type: () -> None
+        """Drop all entries"""
+        with self._lock:
+            self._items.clear()
+            self.weight = 0
+            self._generation += 1
+            self._invalidated.clear()
+            self._forgotten = self._generation
+
+    def _discard(self, key):
+        # Caller must hold the lock
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+
+class VapidCache(object):
+    """Caches for the WebPush VAPID validation path
+
+    ``keys`` holds loaded public key objects, keyed by their raw key bytes,
+    sparing their reconstruction per request. ``claims`` holds the claims
+    of verified JWTs keyed by (token, key) until the JWT's ``exp`` (but at
+    most ``jwt_cache_ttl`` seconds), sparing their signature verification.
+
+    """
+    # Loaded keys never go stale, they're only bounded by size
+    KEY_TTL = 24 * 60 * 60
+
+    def __init__(self,
+                 key_cache_size,     # type: int
+                 jwt_cache_size,     # type: int
+                 jwt_cache_ttl,      # type: float
+                 metrics=None,       # type: Optional[IMetrics]
+                 timer=time.time,    # type: Callable[[], float]
+                 ):
+        # type: (...) -> None
+        self.keys = TTLCache(key_cache_size, self.KEY_TTL, metrics=metrics,
+                             name="vapid_key", timer=timer)
+        self.claims = TTLCache(jwt_cache_size, jwt_cache_ttl,
+                               metrics=metrics, name="vapid_jwt",
+                               timer=timer)
+        self._timer = timer
+
+    def public_key(self, key, loader):
+        # type: (str, Callable[[str], Any]) -> Any
+        """Return the loaded public key for the raw key, loading on a miss
+
+        Failures to load (invalid keys) propagate and aren't cached.
+
+        """
+        pkey = self.keys.get(key)
+        if pkey is None:
+            pkey = loader(key)
+            self.keys.set(key, pkey)
+        return pkey
+
+    def get_claims(self, token, key):
+        # type: (str, str) -> Optional[Dict[str, Any]]
+        """Return a copy of a verified token's cached claims"""
+        claims = self.claims.get((token, key))
+        return None if claims is None else dict(claims)
+
+    def set_claims(self, token, key, claims):
+        # type: (str, str, Dict[str, Any]) -> None
+        """Cache a verified token's claims until its expiration
+
+        Tokens lacking a valid, future ``exp`` aren't cached (they'll
+        fail validation regardless).
+
+        """
+        try:
+            remaining = int(claims["exp"]) - self._timer()
+        except (KeyError, TypeError, ValueError):
+            return
+        if remaining <= 0:
+            return
+        self.claims.set((token, key), dict(claims),
+                        ttl=min(remaining, self.claims.ttl))
+
+
+class DeadTokenCache(object):
+    """Bridge tokens a bridge reported as no longer registered
+
+    Maps (router type, token) to the errno the bridge's subscriptions are
+    rejected with, sparing further bridge requests for them until the
+    entry expires or the token's registered again. Entries also record
+    their UAID so a token registered anew (under a new UAID, possibly via
+    another node) isn't rejected by a stale entry.
+
+    """
+    def __init__(self,
+                 max_size,           # type: int
+                 ttl,                # type: float
+                 metrics=None,       # type: Optional[IMetrics]
+                 timer=time.time,    # type: Callable[[], float]
+                 ):
+        # type: (...) -> None
+        self.tokens = TTLCache(max_size, ttl, metrics=metrics,
+                               name="dead_token", timer=timer)
+
+    @staticmethod
+    def _key(router_type, router_data):
+        # type: (str, Dict[str, Any]) -> Optional[Tuple[str, str]]
+        token = router_data.get("token")
+        return (router_type, token) if token else None
+
+    def get(self, user_data):
+        # type: (Dict[str, Any]) -> Optional[int]
+        """Return the errno of a user's dead token (None if alive)"""
+        key = self._key(user_data.get("router_type"),
+                        user_data.get("router_data", {}))
+        if key is None:
+            return None
+        entry = self.tokens.get(key)
+        if entry is None or entry[0] != user_data.get("uaid"):
+            return None
+        return entry[1]
+
+    def add(self, user_data, errno):
+        # type: (Dict[str, Any], int) -> None
+        """Record a user's token as dead"""
+        key = self._key(user_data.get("router_type"),
+                        user_data.get("router_data", {}))
+        if key is not None:
+            self.tokens.set(key, (user_data.get("uaid"), errno))
+
+    def discard(self, router_type, router_data):
+        # type: (str, Dict[str, Any]) -> None
+        """Forget a (re-registered) token"""
+        key = self._key(router_type, router_data)
+        if key is not None:
+            self.tokens.invalidate(key)
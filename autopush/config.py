@@ -17,10 +17,11 @@ from attr import (
     attrib,
     Factory
 )
-from cryptography.fernet import Fernet, MultiFernet
+from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import constant_time
 
 import autopush.db as db
+from autopush.cache import TTLCache  # noqa
 from autopush.exceptions import (
     InvalidConfig,
     InvalidTokenException,
@@ -30,6 +31,7 @@ from autopush.ssl import AutopushSSLContextFactory
 from autopush.types import JSONDict  # noqa
 from autopush.utils import (
     CLIENT_SHA256_RE,
+    KeyIdFernet,
     canonical_url,
     get_amid,
     resolve_ip,
@@ -100,9 +102,11 @@ class AutopushConfig(object):
 
     debug = attrib(default=False)  # type: bool
 
-    fernet = attrib(init=False)  # type: MultiFernet
+    fernet = attrib(init=False)  # type: KeyIdFernet
     _crypto_key = attrib(
         convert=_init_crypto_key, default=None)  # type: List[str]
+    # Tag new tokens with their key's id (both formats are always accepted)
+    key_id_tokens = attrib(default=False)  # type: bool
 
     bear_hash_key = attrib(default=Factory(list))  # type: List[str]
     human_logs = attrib(default=True)  # type: bool
@@ -155,6 +159,15 @@ class AutopushConfig(object):
 
     router_conf = attrib(default=Factory(dict))  # type: JSONDict
 
+    # Bridges' (GCM/FCM/APNs) adaptive concurrency limit per credential
+    # (0 disables limiting), the latency above which the limit shrinks,
+    # the consecutive failures opening its circuit and the seconds it
+    # stays open
+    bridge_max_concurrency = attrib(default=0)  # type: int
+    bridge_target_latency = attrib(default=1.0)  # type: float
+    bridge_failure_threshold = attrib(default=5)  # type: int
+    bridge_reset_timeout = attrib(default=30)  # type: float
+
     # twisted Agent's connectTimeout
     connect_timeout = attrib(default=0.5)  # type: float
     max_data = attrib(default=4096)  # type: int
@@ -165,11 +178,28 @@ class AutopushConfig(object):
     hello_timeout = attrib(default=0)  # type: int
     # Force timeout in idle seconds
     msg_limit = attrib(default=100)  # type: int
+    # Stored messages fetched per query, and the number of (timestamped
+    # message) pages to read ahead of delivery (0 disables)
+    msg_fetch_size = attrib(default=10)  # type: int
+    msg_prefetch_window = attrib(default=0)  # type: int
+
+    # Parsed User-Agents cached for new connections (0 disables)
+    user_agent_cache_size = attrib(default=10000)  # type: int
+
+    # Hellos admitted per second (0 disables admission control), bursts
+    # of up to hello_admission_burst and the longest a hello may wait
+    hello_admission_rate = attrib(default=0)  # type: float
+    hello_admission_burst = attrib(default=100)  # type: int
+    hello_admission_max_wait = attrib(default=8)  # type: float
     auto_ping_interval = attrib(default=None)  # type: Optional[int]
     auto_ping_timeout = attrib(default=None)  # type: Optional[int]
     max_connections = attrib(default=None)  # type: Optional[int]
     close_handshake_timeout = attrib(default=None)  # type: Optional[int]
 
+    # Resolution (seconds) of the timer wheel scheduling connections'
+    # hello/idle timeouts (0 schedules them on the reactor)
+    timer_wheel_tick = attrib(default=0)  # type: float
+
     # Generate messages per legacy rules, only used for testing to
     # generate legacy data.
     _notification_legacy = attrib(default=False)  # type: bool
@@ -188,6 +218,66 @@ class AutopushConfig(object):
 
     allow_table_rotation = attrib(default=True)  # type: bool
 
+    # In process router record cache (0 disables)
+    router_cache_size = attrib(default=0)  # type: int
+    router_cache_ttl = attrib(default=5)  # type: int
+
+    # In process cache of channel sets per uaid (0 disables)
+    channel_cache_size = attrib(default=0)  # type: int
+    channel_cache_ttl = attrib(default=15)  # type: int
+    channel_cache_max_bytes = attrib(default=16 * 1024 * 1024)  # type: int
+
+    # In process caches of loaded VAPID public keys and verified VAPID JWTs
+    # (0 disables), the latter valid until the JWT's exp but at most ttl
+    vapid_key_cache_size = attrib(default=1000)  # type: int
+    vapid_jwt_cache_size = attrib(default=10000)  # type: int
+    vapid_jwt_cache_ttl = attrib(default=3600)  # type: int
+
+    # In process cache of decrypted endpoint tokens (0 disables)
+    endpoint_token_cache_size = attrib(default=10000)  # type: int
+
+    # In process cache of bridge tokens the bridge reported as no longer
+    # registered (0 disables)
+    dead_token_cache_size = attrib(default=10000)  # type: int
+    dead_token_cache_ttl = attrib(default=300)  # type: int
+
+    # Serve HTTP/2 (via ALPN or prior knowledge) on the endpoint ports, the
+    # max concurrent streams per connection and each stream's initial flow
+    # control window
+    http2 = attrib(default=False)  # type: bool
+    http2_max_concurrent_streams = attrib(default=100)  # type: int
+    http2_initial_window_size = attrib(default=65535)  # type: int
+
+    # Generate compact (AES-GCM, binary) rather than Fernet message-ids
+    compact_message_ids = attrib(default=False)  # type: bool
+
+    # Send connection nodes each notification's WebSocket message
+    # pre-encoded, alongside (so duplicating) its serialized fields
+    preencode_frames = attrib(default=False)  # type: bool
+
+    # Seconds to coalesce notifications bound for the same connection node
+    # into one request (0 disables), and the max notifications per request
+    push_batch_delay = attrib(default=0)  # type: float
+    push_batch_size = attrib(default=100)  # type: int
+
+    # Seconds to buffer stored notifications, to write them with
+    # BatchWriteItem (0 disables)
+    message_batch_delay = attrib(default=0)  # type: float
+
+    # Use the non-blocking DynamoDB client where supported, its per request
+    # timeout (0 waits forever) and max retries of throttled requests
+    async_dynamodb = attrib(default=False)  # type: bool
+    async_dynamodb_timeout = attrib(default=5)  # type: float
+    async_dynamodb_retries = attrib(default=3)  # type: int
+
+    # Port of the persistent node to node transport (None disables)
+    node_transport_port = attrib(default=None)  # type: Optional[int]
+    # Seconds to wait for a node transport response (0 waits forever)
+    node_transport_timeout = attrib(default=5)  # type: float
+
+    # JSON implementation for WebSocket messages and internal routing
+    json_codec = attrib(default="auto")  # type: str
+
     def __attrs_post_init__(self):
         """Initialize the Settings object"""
         # Setup hosts/ports/urls
@@ -218,7 +308,8 @@ class AutopushConfig(object):
             self.port
         )
 
-        self.fernet = MultiFernet([Fernet(key) for key in self._crypto_key])
+        self.fernet = KeyIdFernet(self._crypto_key,
+                                  tag_key_id=self.key_id_tokens)
 
     @property
     def enable_tls_auth(self):
@@ -257,7 +348,10 @@ class AutopushConfig(object):
                                   "dryrun": ns.gcm_dryrun,
                                   "max_data": ns.max_data,
                                   "collapsekey": ns.gcm_collapsekey,
-                                  "senderIDs": sender_ids}
+                                  "senderIDs": sender_ids,
+                                  "async": ns.gcm_async,
+                                  "max_connections": ns.gcm_max_connections,
+                                  "timeout": ns.gcm_timeout}
 
         client_certs = None
         # endpoint only
@@ -294,7 +388,10 @@ class AutopushConfig(object):
                                   "max_data": ns.max_data,
                                   "collapsekey": ns.fcm_collapsekey,
                                   "auth": ns.fcm_auth,
-                                  "senderid": ns.fcm_senderid}
+                                  "senderID": ns.fcm_senderid,
+                                  "async": ns.fcm_async,
+                                  "max_connections": ns.fcm_max_connections,
+                                  "timeout": ns.fcm_timeout}
 
         ami_id = None
         # Not a fan of double negatives, but this makes more
@@ -305,6 +402,7 @@ class AutopushConfig(object):
         allow_table_rotation = not ns.no_table_rotation
         return cls(
             crypto_key=ns.crypto_key,
+            key_id_tokens=ns.key_id_tokens,
             datadog_api_key=ns.datadog_api_key,
             datadog_app_key=ns.datadog_app_key,
             datadog_flush_interval=ns.datadog_flush_interval,
@@ -312,14 +410,22 @@ class AutopushConfig(object):
             statsd_host=ns.statsd_host,
             statsd_port=ns.statsd_port,
             router_conf=router_conf,
+            bridge_max_concurrency=ns.bridge_max_concurrency,
+            bridge_target_latency=ns.bridge_target_latency,
+            bridge_failure_threshold=ns.bridge_failure_threshold,
+            bridge_reset_timeout=ns.bridge_reset_timeout,
             resolve_hostname=ns.resolve_hostname,
             ami_id=ami_id,
             client_certs=client_certs,
             msg_limit=ns.msg_limit,
             connect_timeout=ns.connection_timeout,
             memusage_port=ns.memusage_port,
+            node_transport_port=ns.node_transport_port,
+            node_transport_timeout=ns.node_transport_timeout,
+            message_batch_delay=ns.message_batch_delay,
             use_cryptography=ns.use_cryptography,
             no_sslcontext_cache=ns._no_sslcontext_cache,
+            json_codec=ns.json_codec,
             router_table=dict(
                 tablename=ns.router_tablename,
                 read_throughput=ns.router_read_throughput,
@@ -347,6 +453,9 @@ class AutopushConfig(object):
         v1 is the uaid + chid
         v2 is the uaid + chid + sha256(key).bytes
 
+        With ``key_id_tokens``, tokens are tagged with the id of the key
+        encrypting them (see :class:`autopush.utils.KeyIdFernet`).
+
         :param uaid: User Agent Identifier
         :param chid: Channel or Subscription ID
         :param key: Optional Base64 URL-encoded application server key
@@ -364,8 +473,21 @@ class AutopushConfig(object):
         ep = self.fernet.encrypt(base + sha256(raw_key).digest()).strip('=')
         return root + 'v2/' + ep
 
+    def decrypt_endpoint_token(self, token, cache=None):
+        # type: (str, Optional[TTLCache]) -> str
+        """Decrypt an endpoint token, via an optional cache of decrypted
+        tokens"""
+        if cache is not None:
+            decrypted = cache.get(token)
+            if decrypted is not None:
+                return decrypted
+        decrypted = self.fernet.decrypt(repad(token).encode('utf8'))
+        if cache is not None:
+            cache.set(token, decrypted)
+        return decrypted
+
     def parse_endpoint(self, metrics, token, version="v1", ckey_header=None,
-                       auth_header=None):
+                       auth_header=None, token_cache=None):
         """Parse an endpoint into component elements of UAID, CHID and optional
         key hash if v2
 
@@ -374,13 +496,14 @@ class AutopushConfig(object):
         :param ckey_header: the Crypto-Key header bearing the public key
             (from Crypto-Key: p256ecdsa=)
         :param auth_header: The Authorization header bearing the VAPID info
+        :param token_cache: Optional cache of decrypted tokens
 
         :raises ValueError: In the case of a malformed endpoint.
 
         :returns: a dict containing (uaid=UAID, chid=CHID, public_key=KEY)
 
         """
-        token = self.fernet.decrypt(repad(token).encode('utf8'))
+        token = self.decrypt_endpoint_token(token, cache=token_cache)
         public_key = None
         if ckey_header:
             try:
@@ -34,9 +34,11 @@ from __future__ import absolute_import
 import datetime
 import os
 import random
+import sys
 import threading
 import time
 import uuid
+from collections import OrderedDict
 from functools import wraps
 
 from attr import (
@@ -58,6 +60,7 @@ from typing import (  # noqa
     Any,
     Callable,
     Dict,
+    FrozenSet,
     Generator,
     Iterable,
     List,
@@ -67,11 +70,19 @@ from typing import (  # noqa
     Tuple,
     Union,
 )
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (  # noqa
+    Deferred,
+    DeferredList,
+    inlineCallbacks,
+    returnValue,
+    succeed,
+)
+from twisted.internet import reactor
 from twisted.internet.threads import deferToThread
 
 import autopush.metrics
 from autopush import constants
+from autopush.cache import TTLCache
 from autopush.exceptions import AutopushException, ItemNotFound
 from autopush.metrics import IMetrics  # noqa
 from autopush.utils import (
@@ -81,6 +92,7 @@ from autopush.utils import (
 )
 
 if TYPE_CHECKING:  # pragma: nocover
+    from autopush.async_dynamodb import AsyncDynamoDBClient  # noqa
     from autopush.config import AutopushConfig, DDBTableConfig  # noqa
 
 
@@ -97,6 +109,16 @@ DB_CALLS = []
 
 MAX_DDB_SESSIONS = constants.THREAD_POOL_SIZE
 
+# Max items per BatchWriteItem request
+MAX_BATCH_WRITE = 25
+# Max keys per BatchGetItem request
+MAX_BATCH_GET = 100
+# Max seconds a cached channel set's trusted. Channels are mostly
+# unregistered via connection nodes, whose invalidations don't reach the
+# endpoints' caches, so this bounds how long an endpoint may accept
+# notifications for an unregistered channel (rather than returning 410)
+MAX_CHANNEL_CACHE_TTL = 60
+
 
 def get_month(delta=0):
     # type: (int) -> datetime.date
@@ -522,21 +544,221 @@ class DynamoDBTable(threading.local):
         return getattr(self._table, name)
 
 
+class MessageBatchWriter(object):
+    """Write-behind aggregation of message puts into BatchWriteItem calls
+
+    Puts queued within ``delay`` seconds of each other (across all message
+    tables) are written together, up to :data:`MAX_BATCH_WRITE` items per
+    request. Unprocessed items are retried with exponential backoff, up to
+    ``max_retries`` times before failing with a
+    ``ProvisionedThroughputExceededException`` :exc:`ClientError`.
+
+    Puts of the same key are coalesced (the last put wins, firing every
+    put's Deferred once written), and held back while an earlier write of
+    that key (or its retry) is outstanding, so writes of a key are never
+    reordered.
+
+    """
+    def __init__(self,
+                 resource,           # type: DynamoDBResource
+                 metrics,            # type: IMetrics
+                 async_client=None,  # type: Optional[AsyncDynamoDBClient]
+                 delay=0.01,         # type: float
+                 max_retries=5,      # type: int
+                 retry_delay=0.05,   # type: float
+                 clock=reactor,
+                 ):
+        # type: (...) -> None
+        self.resource = resource
+        self.metrics = metrics
+        self.async_client = async_client
+        self.delay = delay
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.clock = clock
+        # key: [tablename, item, Deferreds, attempts]
+        self._queue = OrderedDict()  # type: OrderedDict
+        # Entries being written (or awaiting a retry) per key
+        self._writing = {}  # type: Dict[Tuple[str, str, str], List]
+        # Queued keys not being written
+        self._ready = 0
+        self._timer = None
+
+    def put(self, tablename, item):
+        # type: (str, Dict[str, Any]) -> Deferred
+        """Queue an item to be put in tablename
+
+        Returns a Deferred firing once it's been written.
+
+        """
+        d = Deferred()
+        key = self._key(tablename, item)
+        entry = self._queue.get(key)
+        if entry is not None:
+            # Superseded before it was written
+            entry[1] = item
+            entry[2].append(d)
+            entry[3] = 0
+            return d
+        self._queue[key] = [tablename, item, [d], 0]
+        if key not in self._writing:
+            self._ready += 1
+            self._schedule()
+        return d
+
+    def drain(self):
+        # type: () -> Deferred
+        """Write all queued items
+
+        Returns a Deferred firing once every queued and outstanding write
+        (including retries) has completed.
+
+        """
+        ds = [d for entries in (self._queue.itervalues(),
+                                self._writing.itervalues())
+              for entry in entries for d in entry[2]]
+        self.flush()
+        return DeferredList(ds, consumeErrors=True)
+
+    def _schedule(self):
+        if self._ready >= MAX_BATCH_WRITE:
+            self.flush()
+        elif self._ready and self._timer is None:
+            self._timer = self.clock.callLater(self.delay, self.flush)
+
+    def flush(self):
+        # type: () -> None
+        """Write all queued items not already being written"""
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        batch = []
+        for key in [key for key in self._queue if key not in self._writing]:
+            entry = self._writing[key] = self._queue.pop(key)
+            batch.append(entry)
+            if len(batch) == MAX_BATCH_WRITE:
+                self._write(batch)
+                batch = []
+        self._ready = 0
+        if batch:
+            self._write(batch)
+
+    @staticmethod
+    def _key(tablename, item):
+        return tablename, item["uaid"], item["chidmessageid"]
+
+    def _write(self, batch):
+        request_items = {}  # type: Dict[str, List[Dict[str, Any]]]
+        for tablename, item, _, _ in batch:
+            request_items.setdefault(tablename, []).append(
+                {"PutRequest": {"Item": item}})
+        self.metrics.increment("notification.message.batch_write")
+        if self.async_client is not None:
+            d = self.async_client.batch_write_item(RequestItems=request_items)
+        else:
+            d = deferToThread(self.resource.batch_write_item,
+                              RequestItems=request_items)
+        d.addCallbacks(self._written, self._failed,
+                       callbackArgs=(batch,), errbackArgs=(batch,))
+
+    def _written(self, result, batch):
+        unprocessed = set(
+            self._key(tablename, req["PutRequest"]["Item"])
+            for tablename, requests in
+            result.get("UnprocessedItems", {}).iteritems()
+            for req in requests
+        )
+        retry = []
+        for entry in batch:
+            tablename, item, ds, attempts = entry
+            key = self._key(tablename, item)
+            if key not in unprocessed:
+                self._release(key)
+                for d in ds:
+                    d.callback(None)
+            elif attempts >= self.max_retries:
+                self._release(key)
+                for d in ds:
+                    d.errback(ClientError(
+                        {'Error': {
+                            'Code': 'ProvisionedThroughputExceededException',
+                            'Message': 'Unprocessed after %d retries' % (
+                                attempts),
+                        }},
+                        'BatchWriteItem'
+                    ))
+            else:
+                retry.append(key)
+                queued = self._queue.get(key)
+                if queued is None:
+                    self._queue[key] = [tablename, item, ds, attempts + 1]
+                else:
+                    # Superseded by a later put: written along with it
+                    queued[2][:0] = ds
+        if retry:
+            self.metrics.increment("notification.message.batch_retry",
+                                   len(retry))
+            attempts = max(self._queue[key][3] for key in retry)
+            self.clock.callLater(self.retry_delay * 2 ** (attempts - 1),
+                                 self._retry, retry)
+        self._schedule()
+
+    def _failed(self, fail, batch):
+        for tablename, item, ds, _ in batch:
+            self._release(self._key(tablename, item))
+            for d in ds:
+                d.errback(fail)
+        self._schedule()
+
+    def _retry(self, keys):
+        for key in keys:
+            self._release(key)
+        self._schedule()
+
+    def _release(self, key):
+        """Allow key's queued write (if any), its earlier one completed"""
+        del self._writing[key]
+        if key in self._queue:
+            self._ready += 1
+
+
 class Message(object):
     """Create a Message table abstraction on top of a DynamoDB Table object"""
-    def __init__(self, tablename, boto_resource=None,
-                 max_ttl=MAX_EXPIRY):
-        # type: (str, DynamoDBResource, int) -> None
+    def __init__(self,
+                 tablename,            # type: str
+                 boto_resource=None,   # type: DynamoDBResource
+                 max_ttl=MAX_EXPIRY,   # type: int
+                 channel_cache=None,   # type: Optional[TTLCache]
+                 async_client=None,    # type: Optional[AsyncDynamoDBClient]
+                 batch_writer=None,    # type: Optional[MessageBatchWriter]
+                 ):
+        # type: (...) -> None
         """Create a new Message object
 
         :param tablename: name of the table.
         :param boto_resource: DynamoDBResource for thread
+        :param channel_cache: Optional cache of normalized channel sets,
+                              shared between Message instances
+        :param async_client: Optional non-blocking client, used by the
+                             ``*_async`` methods.
+        :param batch_writer: Optional write-behind batcher, used by
+                             :meth:`store_message_async`.
 
         """
         self._max_ttl = max_ttl
         self.resource = boto_resource
         self.table = DynamoDBTable(self.resource, tablename)
         self.tablename = tablename
+        self.channel_cache = channel_cache
+        self.async_table = None
+        if async_client is not None:
+            self.async_table = async_client.table(tablename)
+        self.batch_writer = batch_writer
+
+    def _invalidate_channels(self, uaid):
+        # type: (str) -> None
+        if self.channel_cache is not None:
+            self.channel_cache.invalidate((self.tablename, uaid))
 
     def table_status(self):
         return self.table.table_status
@@ -560,6 +782,7 @@ class Message(object):
                 ":expiry": _expiry(ttl)
             },
         )
+        self._invalidate_channels(uaid)
         return True
 
     @track_provisioned
@@ -580,6 +803,7 @@ class Message(object):
             },
             ReturnValues="UPDATED_OLD",
         )
+        self._invalidate_channels(uaid)
         chids = response.get('Attributes', {}).get('chids', {})
         if chids:
             try:
@@ -610,6 +834,39 @@ class Message(object):
             return False, set([])
         return True, result['Item'].get("chids", set([]))
 
+    def has_channel(self, uaid, channel_id):
+        # type: (str, str) -> bool
+        """Determine if a channel is registered for a given uaid
+
+        Consults the channel cache (if any) before reading the channel set
+        from the table. Only a positive cached answer is trusted: a channel
+        missing from a cached set may have been registered by another node
+        since, so the set is re-read in that case.
+
+        A channel unregistered by another node (typically a connection
+        node) remains cached, so it's considered registered for up to the
+        cache's ttl (at most :data:`MAX_CHANNEL_CACHE_TTL`): notifications
+        to it are accepted (then discarded by the client) rather than
+        rejected with a 410 meanwhile.
+
+        """
+        chid = normalize_id(channel_id)
+        key = (self.tablename, uaid)
+        cache = self.channel_cache
+        generation = None
+        if cache is not None:
+            chids = cache.get(key)
+            if chids is not None and chid in chids:
+                return True
+            generation = cache.generation()
+        exists, chans = self.all_channels(uaid)
+        if not exists:
+            return False
+        chids = frozenset(normalize_id(x) for x in chans)
+        if cache is not None:
+            cache.set(key, chids, generation=generation)
+        return chid in chids
+
     @track_provisioned
     def save_channels(self, uaid, channels):
         # type: (str, Set[str]) -> None
@@ -622,11 +879,34 @@ class Message(object):
                 'expiry': _expiry(self._max_ttl),
             },
         )
+        self._invalidate_channels(uaid)
 
     @track_provisioned
     def store_message(self, notification):
         # type: (WebPushNotification) -> None
         """Stores a WebPushNotification in the message table"""
+        self.table.put_item(Item=self._message_item(notification))
+
+    def store_message_async(self, notification):
+        # type: (WebPushNotification) -> Deferred
+        """Stores a WebPushNotification in the message table without
+        blocking
+
+        Uses the batch writer or non-blocking client when configured,
+        otherwise :meth:`store_message` in a thread.
+
+        """
+        if self.batch_writer is not None:
+            return self.batch_writer.put(self.tablename,
+                                         self._message_item(notification))
+        if self.async_table is None:
+            return deferToThread(self.store_message,
+                                 notification=notification)
+        return self.async_table.put_item(
+            Item=self._message_item(notification))
+
+    def _message_item(self, notification):
+        # type: (WebPushNotification) -> Dict[str, Any]
         item = dict(
             uaid=hasher(notification.uaid.hex),
             chidmessageid=notification.sort_key,
@@ -640,7 +920,7 @@ class Message(object):
         )
         if notification.data:
             item['data'] = notification.data
-        self.table.put_item(Item=item)
+        return item
 
     @track_provisioned
     def delete_message(self, notification):
@@ -764,14 +1044,26 @@ class Message(object):
 
 class Router(object):
     """Create a Router table abstraction on top of a DynamoDB Table object"""
-    def __init__(self, conf, metrics, resource=None):
-        # type: (DDBTableConfig, IMetrics, DynamoDBResource) -> None
+    def __init__(self,
+                 conf,               # type: DDBTableConfig
+                 metrics,            # type: IMetrics
+                 resource=None,      # type: Optional[DynamoDBResource]
+                 cache_size=0,       # type: int
+                 cache_ttl=5,        # type: int
+                 async_client=None,  # type: Optional[AsyncDynamoDBClient]
+                 ):
+        # type: (...) -> None
         """Create a new Router object
 
         :param conf: configuration data.
         :param metrics: Metrics object that implements the
                         :class:`autopush.metrics.IMetrics` interface.
         :param resource: Boto3 resource handle
+        :param cache_size: Max number of router records to cache in
+                           process (0 disables the cache).
+        :param cache_ttl: Seconds a cached router record remains valid.
+        :param async_client: Optional non-blocking client, used by the
+                             ``*_async`` methods.
 
         """
         self.conf = conf
@@ -782,34 +1074,57 @@ class Router(object):
             tablename=self.conf.tablename,
             boto_resource=self._resource
         )
+        self.cache = None  # type: Optional[TTLCache]
+        if cache_size > 0:
+            self.cache = TTLCache(cache_size, cache_ttl, metrics=metrics,
+                                  name="router")
+        self.async_table = None
+        if async_client is not None:
+            self.async_table = async_client.table(self.conf.tablename)
 
     def table_status(self):
         return self.table.table_status
 
-    def get_uaid(self, uaid):
-        # type: (str) -> Dict[str, Any]
+    def _invalidate(self, db_key):
+        # type: (str) -> None
+        """Drop a cached router record by its (hashed) table key"""
+        if self.cache is not None:
+            self.cache.invalidate(db_key)
+
+    def _cache_generation(self):
+        # type: () -> Optional[int]
+        """The cache's generation before reading records to cache"""
+        return self.cache.generation() if self.cache is not None else None
+
+    def get_uaid(self, uaid, use_cache=True):
+        # type: (str, bool) -> Dict[str, Any]
         """Get the database record for the UAID
 
+        Records are served from the in-process cache when it's enabled and
+        ``use_cache`` is set. Fresh records always repopulate the cache.
+
         :raises:
             :exc:`ItemNotFound` if there is no record for this UAID.
             :exc:`ProvisionedThroughputExceededException` if dynamodb table
             exceeds throughput.
 
         """
+        db_key = hasher(uaid)
+        if self.cache is not None and use_cache:
+            item = self.cache.get(db_key)
+            if item is not None:
+                # Callers modify the record, hand out a copy
+                return dict(item)
+        generation = self._cache_generation()
         try:
-            item = self.table.get_item(
+            result = self.table.get_item(
                 Key={
-                    'uaid': hasher(uaid)
+                    'uaid': db_key
                 },
                 ConsistentRead=True,
             )
-
-            if item.get('ResponseMetadata').get('HTTPStatusCode') != 200:
-                raise ItemNotFound('uaid not found')
-            item = item.get('Item')
+            item = self._uaid_item(db_key, result, generation)
             if item is None:
-                raise ItemNotFound("uaid not found")
-            if item.keys() == ['uaid']:
                 # Incomplete record, drop it.
                 self.drop_user(uaid)
                 raise ItemNotFound("uaid not found")
@@ -822,6 +1137,127 @@ class Router(object):
             # correct ItemNotFound exception
             raise ItemNotFound("uaid not found")
 
+    def get_uaids(self, uaids, use_cache=True):
+        # type: (Iterable[str], bool) -> Dict[str, Dict[str, Any]]
+        """Get the database records of many UAIDs, via BatchGetItem
+
+        Returns the found (complete) records keyed by their UAID. As with
+        :meth:`get_uaid`, incomplete records are dropped. Keys left
+        unprocessed by DynamoDB are fetched individually.
+
+        """
+        records = {}  # type: Dict[str, Dict[str, Any]]
+        pending = {}  # type: Dict[str, str]
+        for uaid in set(uaids):
+            db_key = hasher(uaid)
+            item = self.cache.get(db_key) if (
+                self.cache is not None and use_cache) else None
+            if item is not None:
+                records[uaid] = dict(item)
+            else:
+                pending[db_key] = uaid
+        keys = list(pending)
+        generation = self._cache_generation()
+        for i in range(0, len(keys), MAX_BATCH_GET):
+            self.metrics.increment("database.router.batch_get")
+            result = self._resource.batch_get_item(RequestItems={
+                self.table.table_name: dict(
+                    Keys=[dict(uaid=key) for key in keys[i:i + MAX_BATCH_GET]],
+                    ConsistentRead=True,
+                )
+            })
+            for item in result.get("Responses", {}).get(
+                    self.table.table_name, []):
+                uaid = pending.pop(item["uaid"], None)
+                if uaid is None:
+                    continue
+                if item.keys() == ['uaid']:
+                    self.drop_user(uaid)
+                    continue
+                if self.cache is not None:
+                    self.cache.set(item["uaid"], dict(item),
+                                   generation=generation)
+                records[uaid] = item
+            unprocessed = result.get("UnprocessedKeys", {}).get(
+                self.table.table_name, {}).get("Keys", [])
+            for key in unprocessed:
+                uaid = pending.pop(key["uaid"], None)
+                if uaid is None:
+                    continue
+                try:
+                    records[uaid] = self.get_uaid(uaid, use_cache=False)
+                except ItemNotFound:
+                    pass
+        return records
+
+    def get_uaid_async(self, uaid, use_cache=True):
+        # type: (str, bool) -> Deferred
+        """Get the database record for the UAID without blocking
+
+        Uses the non-blocking client when configured, otherwise
+        :meth:`get_uaid` in a thread. Errors match :meth:`get_uaid`'s.
+
+        """
+        if self.async_table is None:
+            return deferToThread(self.get_uaid, uaid, use_cache=use_cache)
+        db_key = hasher(uaid)
+        if self.cache is not None and use_cache:
+            item = self.cache.get(db_key)
+            if item is not None:
+                return succeed(dict(item))
+        generation = self._cache_generation()
+        d = self.async_table.get_item(
+            Key={
+                'uaid': db_key
+            },
+            ConsistentRead=True,
+        )
+        d.addCallback(self._check_uaid_item, db_key, generation)
+        d.addErrback(self._trap_missing_table)
+        return d
+
+    @staticmethod
+    def _trap_missing_table(fail):
+        """Raise ItemNotFound for a missing table, as get_uaid does"""
+        fail.trap(ClientError)
+        if (fail.value.response["Error"]["Code"] !=
+                "ResourceNotFoundException"):
+            return fail
+        raise ItemNotFound("uaid not found")
+
+    def _check_uaid_item(self, result, db_key, generation):
+        item = self._uaid_item(db_key, result, generation)
+        if item is not None:
+            return item
+        # Incomplete record, drop it.
+        self._invalidate(db_key)
+        d = self.async_table.delete_item(Key={'uaid': db_key})
+
+        def not_found(_):
+            raise ItemNotFound("uaid not found")
+        d.addBoth(not_found)
+        return d
+
+    def _uaid_item(self, db_key, result, generation):
+        # type: (str, Dict[str, Any], Optional[int]) -> Optional[Dict[str, Any]]  # noqa
+        """Extract (and cache) a record from a get_item response
+
+        Returns None for an incomplete record, which should be dropped. The
+        record isn't cached if it was invalidated since the cache's
+        ``generation`` (taken before the read).
+
+        """
+        if result.get('ResponseMetadata').get('HTTPStatusCode') != 200:
+            raise ItemNotFound('uaid not found')
+        item = result.get('Item')
+        if item is None:
+            raise ItemNotFound("uaid not found")
+        if item.keys() == ['uaid']:
+            return None
+        if self.cache is not None:
+            self.cache.set(db_key, dict(item), generation=generation)
+        return item
+
     @track_provisioned
     def register_user(self, data):
         # type: (Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]
@@ -880,11 +1316,15 @@ class Router(object):
                     'ConditionalCheckFailedException':
                 return (False, {})
             raise
+        finally:
+            self._invalidate(db_key["uaid"])
 
     @track_provisioned
     def drop_user(self, uaid):
         # type: (str) -> bool
         """Drops a user record"""
+        # Whatever the outcome, any cached copy is now suspect
+        self._invalidate(hasher(uaid))
         # The following hack ensures that only uaids that exist and are
         # deleted return true.
         try:
@@ -900,6 +1340,7 @@ class Router(object):
             pass
         result = self.table.delete_item(
             Key={'uaid': hasher(uaid)})
+        self._invalidate(hasher(uaid))
         return result['ResponseMetadata']['HTTPStatusCode'] == 200
 
     def delete_uaids(self, uaids):
@@ -986,6 +1427,7 @@ class Router(object):
             UpdateExpression=expr,
             ExpressionAttributeValues=expr_values,
         )
+        self._invalidate(db_key["uaid"])
         return True
 
     @track_provisioned
@@ -1023,6 +1465,15 @@ class Router(object):
                 raise
             # UAID not found.
             return False
+        finally:
+            # Router items carry their (already hashed) table key
+            self._invalidate(item["uaid"])
+
+
+def _channel_set_size(chids):
+    # type: (FrozenSet[str]) -> int
+    """Approximate the memory used by a cached channel set"""
+    return sys.getsizeof(chids) + sum(sys.getsizeof(x) for x in chids)
 
 
 @attrs
@@ -1040,6 +1491,15 @@ class DatabaseManager(object):
     current_month = attrib(init=False)              # type: Optional[int]
     _message = attrib(default=None)                 # type: Optional[Message]
     allow_table_rotation = attrib(default=True)     # type: Optional[bool]
+    router_cache_size = attrib(default=0)           # type: int
+    router_cache_ttl = attrib(default=5)            # type: int
+    channel_cache_size = attrib(default=0)          # type: int
+    channel_cache_ttl = attrib(default=15)          # type: int
+    channel_cache_max_bytes = attrib(default=16 * 1024 * 1024)  # type: int
+    channel_cache = attrib(init=False)              # type: Optional[TTLCache]
+    async_client = attrib(default=None)  # type: Optional[AsyncDynamoDBClient]
+    message_batch_delay = attrib(default=0)         # type: float
+    batch_writer = attrib(init=False)  # type: Optional[MessageBatchWriter]
     # for testing:
 
     def __attrs_post_init__(self):
@@ -1063,6 +1523,26 @@ class DatabaseManager(object):
         if not self.resource:
             self.resource = DynamoDBResource()
 
+        self.channel_cache = None
+        if self.channel_cache_size > 0:
+            self.channel_cache = TTLCache(
+                self.channel_cache_size,
+                min(self.channel_cache_ttl, MAX_CHANNEL_CACHE_TTL),
+                metrics=self.metrics,
+                name="channels",
+                max_weight=self.channel_cache_max_bytes,
+                weigher=_channel_set_size,
+            )
+
+        self.batch_writer = None
+        if self.message_batch_delay > 0:
+            self.batch_writer = MessageBatchWriter(
+                self.resource,
+                self.metrics,
+                async_client=self.async_client,
+                delay=self.message_batch_delay,
+            )
+
     @classmethod
     def from_config(cls,
                     conf,           # type: AutopushConfig
@@ -1080,6 +1560,12 @@ class DatabaseManager(object):
             metrics=metrics,
             resource=resource,
             allow_table_rotation=conf.allow_table_rotation,
+            router_cache_size=conf.router_cache_size,
+            router_cache_ttl=conf.router_cache_ttl,
+            channel_cache_size=conf.channel_cache_size,
+            channel_cache_ttl=conf.channel_cache_ttl,
+            channel_cache_max_bytes=conf.channel_cache_max_bytes,
+            message_batch_delay=conf.message_batch_delay,
             **kwargs
         )
 
@@ -1095,7 +1581,10 @@ class DatabaseManager(object):
         self.router = Router(
             conf=self._router_conf,
             metrics=self.metrics,
-            resource=self.resource)
+            resource=self.resource,
+            cache_size=self.router_cache_size,
+            cache_ttl=self.router_cache_ttl,
+            async_client=self.async_client)
         # Used to determine whether a connection is out of date with current
         # db objects. There are three noteworty cases:
         # 1 "Last Month" the table requires a rollover.
@@ -1105,8 +1594,7 @@ class DatabaseManager(object):
         #   table is present before the switchover is the main reason for this,
         #   just in case some nodes do switch sooner.
         self.create_initial_message_tables()
-        self._message = Message(self.current_msg_month,
-                                boto_resource=self.resource)
+        self._message = self.message_table(self.current_msg_month)
 
     @property
     def message(self):
@@ -1117,7 +1605,10 @@ class DatabaseManager(object):
         return self._message
 
     def message_table(self, tablename):
-        return Message(tablename, boto_resource=self.resource)
+        return Message(tablename, boto_resource=self.resource,
+                       channel_cache=self.channel_cache,
+                       async_client=self.async_client,
+                       batch_writer=self.batch_writer)
 
     def _tomorrow(self):
         # type: () -> datetime.date
@@ -38,6 +38,11 @@ class MessageOverloadException(Exception):
     pass
 
 
+class AdmissionRejectedException(Exception):
+    """Too many hellos already waiting for admission"""
+    pass
+
+
 class RouterException(AutopushException):
     """Exception if routing has failed, may include a custom status_code and
     body to write to the response.
@@ -18,17 +18,20 @@ from twisted.web.client import (
 )
 
 from autopush.base import BaseHandler
+from autopush.cache import DeadTokenCache, TTLCache, VapidCache
 from autopush.config import AutopushConfig  # noqa
 from autopush.db import DatabaseManager
 from autopush.router import routers_from_config
 from autopush.router.interface import IRouter  # noqa
 from autopush.ssl import AutopushSSLContextFactory  # noqa
+from autopush.ssl import ALPN_PROTOCOLS
 from autopush.web.health import (
     HealthHandler,
     MemUsageHandler,
     StatusHandler
 )
 from autopush.web.base import NotFoundHandler
+from autopush.web.h2connection import NegotiatingHTTPConnection
 from autopush.web.limitedhttpconnection import LimitedHTTPConnection
 from autopush.web.log_check import LogCheckHandler
 from autopush.web.message import MessageHandler
@@ -38,8 +41,12 @@ from autopush.web.registration import (
     SubRegistrationHandler,
     UaidRegistrationHandler,
 )
-from autopush.web.webpush import WebPushHandler
+from autopush.web.webpush import (
+    WebPushBatchHandler,
+    WebPushHandler,
+)
 from autopush.websocket import (
+    BatchRouterHandler,
     NotificationHandler,
     RouterHandler,
 )
@@ -48,6 +55,9 @@ from autopush.websocket import PushServerProtocol  # noqa
 APHandlers = Sequence[Tuple[str, Type[BaseHandler]]]
 CycloneLogger = Callable[[BaseHandler], None]
 
+# Decrypted endpoint tokens never go stale, they're only bounded by size
+ENDPOINT_TOKEN_CACHE_TTL = 24 * 60 * 60
+
 
 def skip_request_logging(handler):
     # type: (cyclone.web.RequestHandler) -> None
@@ -132,6 +142,7 @@ class BaseHTTPFactory(cyclone.web.Application):
 class EndpointHTTPFactory(BaseHTTPFactory):
 
     ap_handlers = (
+        (r"/wpush/batch", WebPushBatchHandler),
         (r"/wpush/(?:(?P<api_ver>v\d+)\/)?(?P<token>[^\/]+)",
          WebPushHandler),
         (r"/m/(?P<message_id>[^\/]+)", MessageHandler),
@@ -160,17 +171,39 @@ class EndpointHTTPFactory(BaseHTTPFactory):
         # type: (...) -> None
         self.ap_handlers = tuple(self.ap_handlers)
         BaseHTTPFactory.__init__(self, conf, db=db, **kwargs)
+        if conf.http2:
+            self.protocol = NegotiatingHTTPConnection
         self.routers = routers
+        self.vapid_cache = VapidCache(
+            conf.vapid_key_cache_size,
+            conf.vapid_jwt_cache_size,
+            conf.vapid_jwt_cache_ttl,
+            metrics=db.metrics if db else None
+        )
+        self.dead_token_cache = DeadTokenCache(
+            conf.dead_token_cache_size,
+            conf.dead_token_cache_ttl,
+            metrics=db.metrics if db else None
+        )
+        self.endpoint_token_cache = TTLCache(
+            conf.endpoint_token_cache_size,
+            ENDPOINT_TOKEN_CACHE_TTL,
+            metrics=db.metrics if db else None,
+            name="endpoint_token"
+        )
 
     def ssl_cf(self):
         # type: () -> Optional[AutopushSSLContextFactory]
         """Build our SSL Factory (if configured).
 
         Configured from the ssl_key/cert/dh_param and client_cert
-        values.
+        values. Offers HTTP/2 via ALPN when enabled.
 
         """
         conf = self.conf
+        if conf.http2:
+            return conf.ssl.cf(require_peer_certs=conf.enable_tls_auth,
+                               alpn_protocols=ALPN_PROTOCOLS)
         return conf.ssl.cf(require_peer_certs=conf.enable_tls_auth)
 
     @classmethod
@@ -188,6 +221,7 @@ class InternalRouterHTTPFactory(BaseHTTPFactory):
 
     ap_handlers = (
         (r"/push/([^\/]+)", RouterHandler),
+        (r"/push_batch", BatchRouterHandler),
         (r"/notif/([^\/]+)(?:/(\d+))?", NotificationHandler),
     )
 
@@ -0,0 +1,89 @@
+"""JSON codec for the hot (WebSocket and internal routing) paths
+
+Every WebSocket message and every notification routed between nodes is
+JSON encoded and decoded, so these use the fastest available
+implementation, selected at startup via :func:`select`:
+
+``ujson``
+    :mod:`ujson`, when installed
+
+``simplejson``
+    :mod:`simplejson`'s C decoder (typically ~2x the stdlib's on Python
+    2), paired with the stdlib encoder (which outpaces simplejson's)
+
+``json``
+    The standard library's
+
+``auto`` (the default) picks the first of these available. Use the
+module's :func:`dumps`/:func:`loads` via the module (not ``from
+autopush.jsoncodec import dumps``) so the selection applies.
+
+"""
+import json
+
+from attr import attrs, attrib
+from typing import Any, Callable, Dict  # noqa
+
+try:
+    import ujson
+except ImportError:  # pragma: nocover
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:  # pragma: nocover
+    simplejson = None
+
+
+@attrs(slots=True, frozen=True)
+class Codec(object):
+    """A JSON implementation's encoder and decoder"""
+    name = attrib()  # type: str
+    dumps = attrib()  # type: Callable[[Any], str]
+    loads = attrib()  # type: Callable[[str], Any]
+
+
+CODECS = {
+    "json": Codec("json", json.dumps, json.loads),
+}  # type: Dict[str, Codec]
+if simplejson is not None:
+    CODECS["simplejson"] = Codec("simplejson", json.dumps, simplejson.loads)
+if ujson is not None:  # pragma: nocover
+    CODECS["ujson"] = Codec("ujson", ujson.dumps, ujson.loads)
+
+CODEC_CHOICES = ["auto", "ujson", "simplejson", "json"]
+
+codec = CODECS["json"]  # type: Codec
+
+
+def select(name="auto"):
+    # type: (str) -> Codec
+    """Select the codec used by :func:`dumps` and :func:`loads`
+
+    ``auto`` selects the fastest available. Raises a :exc:`ValueError` for
+    an unknown or unavailable codec.
+
+    """
+    global codec
+    if name == "auto":
+        name = next(choice for choice in CODEC_CHOICES[1:]
+                    if choice in CODECS)
+    if name not in CODECS:
+        raise ValueError("JSON codec unavailable: {}".format(name))
+    codec = CODECS[name]
+    return codec
+
+
+def dumps(obj):
+    # type: (Any) -> str
+    """Serialize obj to a JSON formatted (ASCII) str"""
+    return codec.dumps(obj)
+
+
+def loads(s):
+    # type: (str) -> Any
+    """Deserialize a JSON document (a UTF-8 str or unicode)"""
+    return codec.loads(s)
+
+
+select()
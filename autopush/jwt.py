@@ -9,10 +9,13 @@ from cryptography.hazmat.primitives.asymmetric import ec, utils
 from cryptography.hazmat.primitives import hashes
 from pyasn1.error import PyAsn1Error
 from twisted.logger import Logger
-from typing import Tuple  # noqa
+from typing import TYPE_CHECKING, Any, Optional, Tuple  # noqa
 
 from autopush.types import JSONDict  # noqa
 
+if TYPE_CHECKING:  # pragma: nocover
+    from autopush.cache import VapidCache  # noqa
+
 # temporarily toggleable for easily enabling on production
 _JWT_MEMORY_PRESSURE = os.environ.get('_JWT_MEMORY_PRESSURE', 0)
 if _JWT_MEMORY_PRESSURE != 0:  # pragma: nocover
@@ -94,8 +97,21 @@ class VerifyJWT(object):
                 repad(token.split('.')[1]).encode('utf8')))
 
     @staticmethod
-    def validate_and_extract_assertion(token, key):
-        # type (str, str) -> JSONDict
+    def load_public_key(key):
+        # type: (str) -> Any
+        """Load a P-256 public key from its raw (uncompressed point) bytes
+
+        :raise ValueError: for invalid keys
+
+        """
+        return ec.EllipticCurvePublicNumbers.from_encoded_point(
+            ec.SECP256R1(),
+            key
+        ).public_key(default_backend())
+
+    @staticmethod
+    def validate_and_extract_assertion(token, key, cache=None):
+        # type (str, str, Optional[VapidCache]) -> JSONDict
         """Decode a web token into a assertion dictionary.
 
         This attempts to rectify both ecdsa and openssl generated
@@ -106,6 +122,8 @@ class VerifyJWT(object):
         :type token: str
         :param key: bitarray containing public key
         :type key: str or bitarray
+        :param cache: Optional cache of loaded public keys
+        :type cache: autopush.cache.VapidCache
 
         :return dict of the VAPID claims
 
@@ -115,10 +133,10 @@ class VerifyJWT(object):
         # convert the signature if needed.
         try:
             sig_material, signature = VerifyJWT.extract_signature(token)
-            pkey = ec.EllipticCurvePublicNumbers.from_encoded_point(
-                ec.SECP256R1(),
-                key
-            ).public_key(default_backend())
+            if cache is not None:
+                pkey = cache.public_key(key, VerifyJWT.load_public_key)
+            else:
+                pkey = VerifyJWT.load_public_key(key)
 
             # cffi issue #320: public_key & verify allocate approx.
             if _JWT_MEMORY_PRESSURE:  # pragma: nocover
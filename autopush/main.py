@@ -10,7 +10,8 @@ from twisted.application.internet import (
 )
 from twisted.application.service import MultiService
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import deferLater
 from twisted.internet.protocol import ServerFactory  # noqa
 from twisted.logger import Logger
 from typing import (  # noqa
@@ -20,7 +21,8 @@ from typing import (  # noqa
     Sequence,
 )
 
-from autopush import constants
+from autopush import constants, jsoncodec
+from autopush.async_dynamodb import AsyncDynamoDBClient
 from autopush.http import (
     InternalRouterHTTPFactory,
     EndpointHTTPFactory,
@@ -34,6 +36,7 @@ from autopush.haproxy import HAProxyServerEndpoint
 from autopush.logging import PushLogger
 from autopush.main_argparse import parse_connection, parse_endpoint
 from autopush.metrics import periodic_reporter
+from autopush.node_transport import NodeTransport, NodeTransportServerFactory
 from autopush.router import routers_from_config
 from autopush.ssl import (
     monkey_patch_ssl_wrap_socket,
@@ -64,8 +67,26 @@ class AutopushMultiService(MultiService):
         # type: (AutopushConfig, DynamoDBResource) -> None
         super(AutopushMultiService, self).__init__()
         self.conf = conf
-        self.db = DatabaseManager.from_config(conf, resource=resource)
+        self.async_client = None  # type: Optional[AsyncDynamoDBClient]
+        if conf.async_dynamodb:
+            self.async_client = AsyncDynamoDBClient(
+                endpoint_url=conf.aws_ddb_endpoint,
+                max_connections=constants.THREAD_POOL_SIZE,
+                connect_timeout=conf.connect_timeout,
+                request_timeout=conf.async_dynamodb_timeout,
+                max_retries=conf.async_dynamodb_retries,
+            )
+        self.db = DatabaseManager.from_config(
+            conf, resource=resource, async_client=self.async_client)
         self.agent = agent_from_config(conf)
+        self.node_transport = None  # type: Optional[NodeTransport]
+        if conf.node_transport_port:
+            self.node_transport = NodeTransport(
+                conf.node_transport_port,
+                self.db.metrics,
+                connect_timeout=conf.connect_timeout,
+                request_timeout=conf.node_transport_timeout,
+            )
 
     @staticmethod
     def parse_args(config_files, args):
@@ -78,6 +99,7 @@ class AutopushMultiService(MultiService):
         """Initialize the services"""
         if not self.conf.no_sslcontext_cache:
             monkey_patch_ssl_wrap_socket()
+        jsoncodec.select(self.conf.json_codec)
 
     def add_maybe_ssl(self, port, factory, ssl_cf):
         # type: (int, ServerFactory, Optional[Any]) -> None
@@ -94,7 +116,7 @@ class AutopushMultiService(MultiService):
 
     def add_memusage(self):
         """Add the memusage Service"""
-        factory = MemUsageHTTPFactory(self.conf, None)
+        factory = MemUsageHTTPFactory(self.conf, self.db)
         self.addService(
             TCPServer(self.conf.memusage_port, factory, reactor=reactor))
 
@@ -104,10 +126,22 @@ class AutopushMultiService(MultiService):
         self.startService()
         reactor.run()
 
+    def flush_writes(self):
+        """Write any queued messages, returning a Deferred firing once
+        they're written"""
+        if self.db.batch_writer is None:
+            return succeed(None)
+        return self.db.batch_writer.drain()
+
     @inlineCallbacks
     def stopService(self):
         yield self.agent._pool.closeCachedConnections()
+        if self.node_transport:
+            self.node_transport.close()
         yield super(AutopushMultiService, self).stopService()
+        yield self.flush_writes()
+        if self.async_client:
+            yield self.async_client.close()
         if not self.conf.no_sslcontext_cache:
             undo_monkey_patch_ssl_wrap_socket()
 
@@ -171,7 +205,8 @@ class EndpointApplication(AutopushMultiService):
     def __init__(self, conf, resource=None):
         # type: (AutopushConfig, DynamoDBResource) -> None
         super(EndpointApplication, self).__init__(conf, resource=resource)
-        self.routers = routers_from_config(conf, self.db, self.agent)
+        self.routers = routers_from_config(
+            conf, self.db, self.agent, node_transport=self.node_transport)
 
     def setup(self, rotate_tables=True):
         super(EndpointApplication, self).setup(rotate_tables)
@@ -218,6 +253,27 @@ class EndpointApplication(AutopushMultiService):
             cors=not ns.no_cors,
             bear_hash_key=ns.auth_key,
             proxy_protocol_port=ns.proxy_protocol_port,
+            http2=ns.http2,
+            http2_max_concurrent_streams=ns.http2_max_concurrent_streams,
+            http2_initial_window_size=ns.http2_initial_window_size,
+            router_cache_size=ns.router_cache_size,
+            router_cache_ttl=ns.router_cache_ttl,
+            channel_cache_size=ns.channel_cache_size,
+            channel_cache_ttl=ns.channel_cache_ttl,
+            channel_cache_max_bytes=ns.channel_cache_max_bytes,
+            vapid_key_cache_size=ns.vapid_key_cache_size,
+            vapid_jwt_cache_size=ns.vapid_jwt_cache_size,
+            vapid_jwt_cache_ttl=ns.vapid_jwt_cache_ttl,
+            endpoint_token_cache_size=ns.endpoint_token_cache_size,
+            dead_token_cache_size=ns.dead_token_cache_size,
+            dead_token_cache_ttl=ns.dead_token_cache_ttl,
+            compact_message_ids=ns.compact_message_ids,
+            preencode_frames=ns.preencode_frames,
+            push_batch_delay=ns.push_batch_delay,
+            push_batch_size=ns.push_batch_size,
+            async_dynamodb=ns.async_dynamodb,
+            async_dynamodb_timeout=ns.async_dynamodb_timeout,
+            async_dynamodb_retries=ns.async_dynamodb_retries,
             aws_ddb_endpoint=ns.aws_ddb_endpoint,
             resource=resource
         )
@@ -270,12 +326,32 @@ class ConnectionApplication(AutopushMultiService):
             self.conf, self.db, self.clients)
         factory.add_health_handlers()
         self.add_maybe_ssl(self.conf.router_port, factory, factory.ssl_cf())
+        if self.conf.node_transport_port:
+            self.add_maybe_ssl(
+                self.conf.node_transport_port,
+                NodeTransportServerFactory(self.conf, self.db, self.clients),
+                factory.ssl_cf())
+
+    @inlineCallbacks
+    def flush_writes(self):
+        """Drop the connected clients (storing their unacked direct
+        notifications) before writing the queued messages"""
+        if self.db.batch_writer is None:
+            # Nothing's queued: their unacked notifications are written
+            # (as usual) when their connections close
+            return
+        for client in list(self.clients.values()):
+            client.transport.abortConnection()
+        # Their onClose runs once their connection's lost, next turn
+        yield deferLater(reactor, 0, lambda: None)
+        yield super(ConnectionApplication, self).flush_writes()
 
     def add_websocket(self):
         """Start the public WebSocket server"""
         conf = self.conf
-        ws_factory = self.websocket_factory(conf, self.db, self.agent,
-                                            self.clients)
+        ws_factory = self.websocket_factory(
+            conf, self.db, self.agent, self.clients,
+            node_transport=self.node_transport)
         site_factory = self.websocket_site_factory(conf, ws_factory)
         self.add_maybe_ssl(conf.port, site_factory, site_factory.ssl_cf())
 
@@ -293,6 +369,12 @@ class ConnectionApplication(AutopushMultiService):
             router_port=ns.router_port,
             env=ns.env,
             hello_timeout=ns.hello_timeout,
+            msg_fetch_size=ns.msg_fetch_size,
+            msg_prefetch_window=ns.msg_prefetch_window,
+            user_agent_cache_size=ns.user_agent_cache_size,
+            hello_admission_rate=ns.hello_admission_rate,
+            hello_admission_burst=ns.hello_admission_burst,
+            hello_admission_max_wait=ns.hello_admission_max_wait,
             router_ssl=dict(
                 key=ns.router_ssl_key,
                 cert=ns.router_ssl_cert,
@@ -302,6 +384,7 @@ class ConnectionApplication(AutopushMultiService):
             auto_ping_timeout=ns.auto_ping_timeout,
             max_connections=ns.max_connections,
             close_handshake_timeout=ns.close_handshake_timeout,
+            timer_wheel_tick=ns.timer_wheel_tick,
             aws_ddb_endpoint=ns.aws_ddb_endpoint,
             resource=resource
         )
@@ -1,6 +1,8 @@
 """autopush/autoendpoint/etc script command line parsing"""
 import configargparse
 
+from autopush.jsoncodec import CODEC_CHOICES
+
 
 def add_shared_args(parser):
     """Add's a large common set of shared arguments"""
@@ -21,6 +23,13 @@ def add_shared_args(parser):
                         action="append")
     parser.add_argument('--key_hash', help="Key to hash IDs for storage",
                         default="", env_var="KEY_HASH", type=str)
+    parser.add_argument('--key_id_tokens',
+                        help="Tag new endpoint tokens and message-ids with "
+                        "the id of the key encrypting them, sparing their "
+                        "decryption with each key in turn. Only enable once "
+                        "every node understands them.",
+                        action="store_true", default=False,
+                        env_var='KEY_ID_TOKENS')
     parser.add_argument('--datadog_api_key', help="DataDog API Key", type=str,
                         default="", env_var="DATADOG_API_KEY")
     parser.add_argument('--datadog_app_key', help="DataDog App Key", type=str,
@@ -89,6 +98,28 @@ def add_shared_args(parser):
                         help="Enable the debug _memusage API on Port",
                         type=int, default=None,
                         env_var='MEMUSAGE_PORT')
+    parser.add_argument('--message_batch_delay',
+                        help="Seconds to buffer notifications being stored, "
+                        "to write them in batches. Set to 0 to disable.",
+                        type=float, default=0, env_var='MESSAGE_BATCH_DELAY')
+    parser.add_argument('--node_transport_port',
+                        help="Port of the persistent internal transport "
+                        "between endpoint and connection nodes, used "
+                        "instead of the internal HTTP router",
+                        type=int, default=None,
+                        env_var='NODE_TRANSPORT_PORT')
+    parser.add_argument('--node_transport_timeout',
+                        help="Seconds to wait for a node's response over "
+                        "the node transport before dropping its "
+                        "connection. Set to 0 to disable.",
+                        type=float, default=5,
+                        env_var='NODE_TRANSPORT_TIMEOUT')
+    parser.add_argument('--json_codec',
+                        help="JSON implementation for WebSocket messages "
+                        "and internal routing ('auto' selects the fastest "
+                        "available)",
+                        choices=CODEC_CHOICES, default="auto",
+                        env_var='JSON_CODEC')
     parser.add_argument('--use_cryptography',
                         help="Use the cryptography library vs. JOSE",
                         action="store_true",
@@ -161,6 +192,18 @@ def _add_external_router_args(parser):
                         env_var="GCM_COLLAPSEKEY")
     parser.add_argument('--senderid_list', help='GCM SenderIDs/auth keys',
                         type=str, default="{}", env_var="SENDERID_LIST")
+    parser.add_argument('--gcm_async',
+                        help="%s Send on the reactor via a persistent "
+                        "connection pool (instead of in threads)" % label,
+                        action="store_true", default=False,
+                        env_var="GCM_ASYNC")
+    parser.add_argument('--gcm_max_connections',
+                        help="%s Maximum concurrent requests (and pooled "
+                        "connections) when sending asynchronously" % label,
+                        type=int, default=50, env_var="GCM_MAX_CONNECTIONS")
+    parser.add_argument('--gcm_timeout',
+                        help="%s Seconds to wait for a response" % label,
+                        type=float, default=10, env_var="GCM_TIMEOUT")
     # FCM
     parser.add_argument('--fcm_enabled', help="Enable FCM Bridge",
                         action="store_true", default=False,
@@ -180,6 +223,19 @@ def _add_external_router_args(parser):
                         type=str, default="", env_var="FCM_AUTH")
     parser.add_argument('--fcm_senderid', help='SenderID for FCM',
                         type=str, default="", env_var="FCM_SENDERID")
+    parser.add_argument('--fcm_async',
+                        help="%s Send on the reactor via a persistent "
+                        "connection pool (instead of in threads)" % label,
+                        action="store_true", default=False,
+                        env_var="FCM_ASYNC")
+    parser.add_argument('--fcm_max_connections',
+                        help="%s Maximum concurrent requests (and pooled "
+                        "connections) when sending asynchronously" % label,
+                        type=int, default=50, env_var="FCM_MAX_CONNECTIONS")
+    parser.add_argument('--fcm_timeout',
+                        help="%s Seconds to wait for a response when "
+                        "sending asynchronously" % label,
+                        type=float, default=10, env_var="FCM_TIMEOUT")
     # Apple Push Notification system (APNs) for iOS
     # credentials consist of JSON struct containing a channel type
     # followed by the settings,
@@ -189,6 +245,29 @@ def _add_external_router_args(parser):
                                              "APNS settings",
                         type=str, default="",
                         env_var="APNS_CREDS")
+    # Limits for all bridges
+    label = "Bridges:"
+    parser.add_argument('--bridge_max_concurrency',
+                        help="%s Max concurrent requests per bridge "
+                        "credential, adapted to the bridge's latency "
+                        "(0 disables)" % label,
+                        type=int, default=0,
+                        env_var="BRIDGE_MAX_CONCURRENCY")
+    parser.add_argument('--bridge_target_latency',
+                        help="%s Seconds above which a bridge's response "
+                        "reduces its concurrency limit" % label,
+                        type=float, default=1.0,
+                        env_var="BRIDGE_TARGET_LATENCY")
+    parser.add_argument('--bridge_failure_threshold',
+                        help="%s Consecutive failures (timeouts, 5xx) "
+                        "opening a bridge's circuit" % label,
+                        type=int, default=5,
+                        env_var="BRIDGE_FAILURE_THRESHOLD")
+    parser.add_argument('--bridge_reset_timeout',
+                        help="%s Seconds a bridge's circuit stays open "
+                        "before retrying it" % label,
+                        type=float, default=30,
+                        env_var="BRIDGE_RESET_TIMEOUT")
 
 
 def parse_connection(config_files, args):
@@ -232,6 +311,35 @@ def parse_connection(config_files, args):
                         help="The client handshake timeout. Set to 0 to"
                         "disable.", default=0, type=int,
                         env_var="HELLO_TIMEOUT")
+    parser.add_argument('--timer_wheel_tick',
+                        help="Resolution in seconds of the timer wheel "
+                        "scheduling connections' hello and idle timeouts. "
+                        "Set to 0 to schedule them individually on the "
+                        "reactor.",
+                        default=0, type=float, env_var="TIMER_WHEEL_TICK")
+    parser.add_argument('--msg_fetch_size',
+                        help="Number of stored messages to fetch per query",
+                        default=10, type=int, env_var="MSG_FETCH_SIZE")
+    parser.add_argument('--msg_prefetch_window',
+                        help="Number of pages of stored messages to read "
+                        "ahead of delivery. Set to 0 to disable.",
+                        default=0, type=int, env_var="MSG_PREFETCH_WINDOW")
+    parser.add_argument('--user_agent_cache_size',
+                        help="Number of parsed User-Agents to cache. Set to "
+                        "0 to disable.", default=10000, type=int,
+                        env_var="USER_AGENT_CACHE_SIZE")
+    parser.add_argument('--hello_admission_rate',
+                        help="Hellos to process per second, pacing their "
+                        "router table calls. Set to 0 to disable.",
+                        default=0, type=float, env_var="HELLO_ADMISSION_RATE")
+    parser.add_argument('--hello_admission_burst',
+                        help="Hellos that may be processed at once, above "
+                        "hello_admission_rate", default=100, type=int,
+                        env_var="HELLO_ADMISSION_BURST")
+    parser.add_argument('--hello_admission_max_wait',
+                        help="Max seconds a hello may wait for admission "
+                        "before it's rejected as overloaded", default=8,
+                        type=float, env_var="HELLO_ADMISSION_MAX_WAIT")
 
     add_shared_args(parser)
     return parser.parse_args(args)
@@ -262,6 +370,110 @@ def parse_endpoint(config_files, args):
                         "Proxy Protocol handling",
                         type=int, default=None,
                         env_var='PROXY_PROTOCOL_PORT')
+    parser.add_argument('--http2',
+                        help="Serve HTTP/2, negotiated via ALPN (or with "
+                        "prior knowledge), alongside HTTP/1.1",
+                        action="store_true", default=False,
+                        env_var='HTTP2')
+    parser.add_argument('--http2_max_concurrent_streams',
+                        help="Max concurrent HTTP/2 streams per connection",
+                        type=int, default=100,
+                        env_var='HTTP2_MAX_CONCURRENT_STREAMS')
+    parser.add_argument('--http2_initial_window_size',
+                        help="Initial HTTP/2 stream flow control window "
+                        "size, in bytes",
+                        type=int, default=65535,
+                        env_var='HTTP2_INITIAL_WINDOW_SIZE')
+    parser.add_argument('--router_cache_size',
+                        help="Max number of router records to cache "
+                        "in process. Set to 0 to disable.",
+                        type=int, default=0, env_var='ROUTER_CACHE_SIZE')
+    parser.add_argument('--router_cache_ttl',
+                        help="Seconds a cached router record is valid",
+                        type=int, default=5, env_var='ROUTER_CACHE_TTL')
+    parser.add_argument('--channel_cache_size',
+                        help="Max number of UAID channel sets to cache "
+                        "in process. Set to 0 to disable.",
+                        type=int, default=0, env_var='CHANNEL_CACHE_SIZE')
+    parser.add_argument('--channel_cache_ttl',
+                        help="Seconds a cached channel set is valid (at "
+                        "most 60). Channels unregistered via other nodes "
+                        "may still accept notifications meanwhile.",
+                        type=int, default=15, env_var='CHANNEL_CACHE_TTL')
+    parser.add_argument('--channel_cache_max_bytes',
+                        help="Approximate memory limit of the channel "
+                        "set cache",
+                        type=int, default=16 * 1024 * 1024,
+                        env_var='CHANNEL_CACHE_MAX_BYTES')
+    parser.add_argument('--vapid_key_cache_size',
+                        help="Max number of loaded VAPID public keys to "
+                        "cache in process. Set to 0 to disable.",
+                        type=int, default=1000,
+                        env_var='VAPID_KEY_CACHE_SIZE')
+    parser.add_argument('--vapid_jwt_cache_size',
+                        help="Max number of verified VAPID JWTs to cache "
+                        "in process. Set to 0 to disable.",
+                        type=int, default=10000,
+                        env_var='VAPID_JWT_CACHE_SIZE')
+    parser.add_argument('--vapid_jwt_cache_ttl',
+                        help="Max seconds a verified VAPID JWT is cached "
+                        "(they're never cached beyond their expiration)",
+                        type=int, default=3600, env_var='VAPID_JWT_CACHE_TTL')
+    parser.add_argument('--endpoint_token_cache_size',
+                        help="Max number of decrypted endpoint tokens to "
+                        "cache in process. Set to 0 to disable.",
+                        type=int, default=10000,
+                        env_var='ENDPOINT_TOKEN_CACHE_SIZE')
+    parser.add_argument('--dead_token_cache_size',
+                        help="Max number of bridge tokens reported as no "
+                        "longer registered to cache in process. Set to 0 "
+                        "to disable.",
+                        type=int, default=10000,
+                        env_var='DEAD_TOKEN_CACHE_SIZE')
+    parser.add_argument('--dead_token_cache_ttl',
+                        help="Seconds notifications for a bridge token "
+                        "reported as no longer registered are rejected "
+                        "without contacting the bridge",
+                        type=int, default=300,
+                        env_var='DEAD_TOKEN_CACHE_TTL')
+    parser.add_argument('--compact_message_ids',
+                        help="Generate smaller, cheaper to encrypt "
+                        "message-ids. Only enable once every endpoint node "
+                        "understands them.",
+                        action="store_true", default=False,
+                        env_var='COMPACT_MESSAGE_IDS')
+    parser.add_argument('--preencode_frames',
+                        help="Also send connection nodes each "
+                        "notification's WebSocket message pre-encoded, "
+                        "sparing them its encoding at the cost of sending "
+                        "its data twice",
+                        action="store_true", default=False,
+                        env_var='PREENCODE_FRAMES')
+    parser.add_argument('--async_dynamodb',
+                        help="Use a non-blocking DynamoDB client (rather "
+                        "than boto3 in a thread pool) when routing "
+                        "notifications",
+                        action="store_true", default=False,
+                        env_var='ASYNC_DYNAMODB')
+    parser.add_argument('--async_dynamodb_timeout',
+                        help="Seconds to wait for each response of the "
+                        "non-blocking DynamoDB client. Set to 0 to disable.",
+                        type=float, default=5,
+                        env_var='ASYNC_DYNAMODB_TIMEOUT')
+    parser.add_argument('--async_dynamodb_retries',
+                        help="Max retries (with backoff) of the non-blocking "
+                        "DynamoDB client's throttled or failed requests",
+                        type=int, default=3,
+                        env_var='ASYNC_DYNAMODB_RETRIES')
+    parser.add_argument('--push_batch_delay',
+                        help="Seconds to buffer notifications bound for the "
+                        "same connection node, to send them in one request. "
+                        "Set to 0 to disable.",
+                        type=float, default=0, env_var='PUSH_BATCH_DELAY')
+    parser.add_argument('--push_batch_size',
+                        help="Max notifications per batched request to a "
+                        "connection node",
+                        type=int, default=100, env_var='PUSH_BATCH_SIZE')
 
     add_shared_args(parser)
     return parser.parse_args(args)
@@ -1,18 +1,25 @@
 """Produces memory usage information"""
 import gc
+import inspect
 import objgraph
 import os
 import resource
 import subprocess
+import sys
 import tempfile
+import uuid
 import zlib
 from StringIO import StringIO
-from typing import Optional  # noqa
+from typing import Any, Optional, Sequence  # noqa
 
 from autopush.gcdump import Stat
 
 from cffi import FFI
 
+# User-Agent of the idle connections sampled by connection_state_usage
+SAMPLE_USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:60.0) "
+                     "Gecko/20100101 Firefox/60.0")
+
 
 # cffi's API mode is preferable but it would assume jemalloc is always
 # available (and we LD_PRELOAD it)
@@ -25,9 +32,14 @@ void malloc_stats_print(void (*write_cb) (void *, const char *),
 lib = ffi.dlopen(None)
 
 
-def memusage(do_dump_rpy_heap=True, do_objgraph=True):
-    # type: (Optional[bool], Optional[bool]) -> str
-    """Returning a str of memory usage stats"""
+def memusage(do_dump_rpy_heap=True, do_objgraph=True, connection_db=None):
+    # type: (Optional[bool], Optional[bool], Optional[Any]) -> str
+    """Returning a str of memory usage stats
+
+    Includes the bytes of state per idle websocket connection when passed
+    a ``connection_db`` (DatabaseManager) to sample connections with.
+
+    """
     def trap_err(func, *args, **kwargs):
         try:
             return func(*args, **kwargs)
@@ -46,6 +58,8 @@ def memusage(do_dump_rpy_heap=True, do_objgraph=True):
         # heap with its heavy workload
         trap_err(dump_rpy_heap, buf)
     trap_err(get_stats_asmmemmgr, buf)
+    if connection_db is not None:
+        trap_err(connection_state_usage, buf, connection_db)
     buf.write('\n\n')
     if do_objgraph:
         trap_err(objgraph.show_most_common_types, limit=0, file=buf)
@@ -135,3 +149,54 @@ def _jemalloc_write_cb(handle, msg):  # pragma: nocover
     """
     stream = ffi.from_handle(handle)
     stream.write(ffi.string(msg))
+
+
+def deep_sizeof(obj, ignore=()):
+    # type: (Any, Sequence[Any]) -> int
+    """Approximate bytes used by obj and the objects it references
+
+    Objects referenced more than once are counted once. Types, modules,
+    functions and the objects in ``ignore`` (and anything only reachable
+    via them) aren't counted.
+
+    """
+    seen = set(id(x) for x in ignore)
+    pending = [obj]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or inspect.isclass(obj) or inspect.ismodule(obj) \
+                or inspect.isroutine(obj):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def connection_state_usage(stream, db, count=1000):
+    """Write the bytes of state per idle websocket connection
+
+    Measured over ``count`` new connections' state (after their hello),
+    so state shared between connections is amortized.
+
+    """
+    from autopush.cache import TTLCache
+    from autopush.websocket import (
+        USER_AGENT_CACHE_TTL,
+        PushState,
+        SessionStatistics,
+    )
+
+    ua_cache = TTLCache(1, USER_AGENT_CACHE_TTL)
+    states = []
+    for _ in range(count):
+        state = PushState(db=db, user_agent=SAMPLE_USER_AGENT,
+                          ua_cache=ua_cache,
+                          stats=SessionStatistics(host="localhost"))
+        state.uaid = uuid.uuid4().hex
+        state.init_connection()
+        states.append(state)
+    size = deep_sizeof(states, ignore=[db, ua_cache]) - sys.getsizeof(states)
+    stream.write("\n\nconnection state: {} bytes per idle connection "
+                 "({} sampled)\n".format(size // count, count))
@@ -2,8 +2,11 @@
 from typing import (  # noqa
     TYPE_CHECKING,
     Any,
+    Dict,
+    Iterable,
     Optional,
-    Sequence
+    Sequence,
+    Tuple,
 )
 
 from twisted.internet import reactor
@@ -87,6 +90,29 @@ def make_tags(base=None, **kwargs):
     return tags
 
 
+# Bound on the distinct tag sets shared via shared_tags (values such as
+# the host may be client supplied)
+MAX_SHARED_TAGS = 1024
+_shared_tags = {}  # type: Dict[Tuple[str, ...], Tuple[str, ...]]
+
+
+def shared_tags(tags):
+    # type: (Iterable[str]) -> Tuple[str, ...]
+    """Return an immutable tag sequence shared by identical tag sets
+
+    Avoids a copy of the same (interned) tag values per holder, e.g. per
+    websocket connection.
+
+    """
+    key = tuple(intern(tag) if type(tag) is str else tag for tag in tags)
+    tags = _shared_tags.get(key)
+    if tags is None:
+        tags = key
+        if len(_shared_tags) < MAX_SHARED_TAGS:
+            _shared_tags[key] = key
+    return tags
+
+
 class DatadogMetrics(object):
     """DataDog Metric backend"""
     def __init__(self, api_key, app_key, hostname, flush_interval=10,
@@ -106,17 +132,25 @@ class DatadogMetrics(object):
         self._client.start(flush_interval=self._flush_interval,
                            roll_up_interval=self._flush_interval)
 
+    def _tags(self, kwargs):
+        # ThreadStats appends its (DATADOG_TAGS) constant tags to a
+        # metric's tags: it can't to a shared_tags tuple
+        tags = kwargs.get("tags")
+        if type(tags) is tuple and self._client.constant_tags:
+            kwargs["tags"] = list(tags)
+        return kwargs
+
     def increment(self, name, count=1, **kwargs):
         self._client.increment(self._prefix_name(name), count, host=self._host,
-                               **kwargs)
+                               **self._tags(kwargs))
 
     def gauge(self, name, count, **kwargs):
         self._client.gauge(self._prefix_name(name), count, host=self._host,
-                           **kwargs)
+                           **self._tags(kwargs))
 
     def timing(self, name, duration, **kwargs):
         self._client.timing(self._prefix_name(name), value=duration,
-                            host=self._host, **kwargs)
+                            host=self._host, **self._tags(kwargs))
 
 
 def from_config(conf):
@@ -0,0 +1,293 @@
+"""Persistent, multiplexed transport between autopush nodes
+
+An alternative to the internal HTTP router (:class:`InternalRouterHTTPFactory`)
+for the hot endpoint -> connection node path. Each frame is a JSON object
+prefixed by its length (a 32-bit unsigned int). Requests carry an ``id``
+which is echoed back in the response, allowing many requests to be
+pipelined over a single long lived connection:
+
+.. code-block:: json
+
+    {"id": 1, "cmd": "push", "uaid": "...", "notification": {...}}
+    {"id": 1, "code": 200}
+
+Commands mirror the internal HTTP router's:
+
+``push``
+    Deliver a notification to a connected client (``PUT /push/<uaid>``)
+
+``notif``
+    Trigger a stored notification check (``PUT /notif/<uaid>``)
+
+``drop``
+    Drop a client connected at ``connected_at`` (``DELETE /notif/...``)
+
+"""
+from urlparse import urlparse
+
+from attr import attrs, attrib
+from typing import (  # noqa
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.endpoints import (
+    TCP4ClientEndpoint,
+    connectProtocol,
+    wrapClientTLS,
+)
+from twisted.internet.error import ConnectionLost
+from twisted.internet.protocol import ServerFactory, connectionDone
+from twisted.internet.ssl import optionsForClientTLS
+from twisted.logger import Logger
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python.failure import Failure
+
+from autopush import jsoncodec
+from autopush.config import AutopushConfig  # noqa
+from autopush.db import DatabaseManager  # noqa
+from autopush.metrics import make_tags
+
+# Comfortably larger than any serialized notification
+MAX_FRAME_SIZE = 256 * 1024
+
+
+@attrs(slots=True)
+class NodeResponse(object):
+    """The status of a command sent to a node
+
+    Codes match those of the equivalent internal HTTP router response.
+
+    """
+    code = attrib()  # type: int
+
+
+class NodeTransportServer(Int32StringReceiver):
+    """Serves commands from other nodes to this node's clients"""
+    MAX_LENGTH = MAX_FRAME_SIZE
+    log = Logger()
+
+    def stringReceived(self, frame):
+        try:
+            msg = jsoncodec.loads(frame)
+            cmd = self.factory.commands[msg["cmd"]]
+            req_id = msg["id"]
+        except (ValueError, KeyError, TypeError):
+            self.log.info("Invalid node transport frame, dropping "
+                          "connection")
+            self.transport.loseConnection()
+            return
+        try:
+            code = cmd(msg)
+        except (KeyError, TypeError, ValueError):
+            code = 400
+        self.sendString(jsoncodec.dumps(dict(id=req_id, code=code)))
+
+    def lengthLimitExceeded(self, length):
+        self.log.info("Node transport frame too large: {length}",
+                      length=length)
+        self.transport.loseConnection()
+
+
+class NodeTransportServerFactory(ServerFactory):
+    """Dispatches node transport commands to connected clients"""
+    protocol = NodeTransportServer
+
+    def __init__(self,
+                 conf,     # type: AutopushConfig
+                 db,       # type: DatabaseManager
+                 clients,  # type: Dict[str, Any]
+                 ):
+        # type: (...) -> None
+        self.conf = conf
+        self.db = db
+        self.clients = clients
+        self.noisy = conf.debug
+        self.commands = dict(
+            push=self.push,
+            notif=self.notif,
+            drop=self.drop,
+        )  # type: Dict[str, Callable[[Dict[str, Any]], int]]
+
+    @property
+    def metrics(self):
+        return self.db.metrics
+
+    def push(self, msg):
+        """Attempt delivery of a notification to a connected client"""
+        client = self.clients.get(msg["uaid"])
+        if not client:
+            return 404
+        if client.paused:
+            return 503
+        client.send_notification(msg["notification"])
+        return 200
+
+    def notif(self, msg):
+        """Notify a connected client to check storage for notifications"""
+        client = self.clients.get(msg["uaid"])
+        if not client:
+            return 404
+        if client.paused:
+            # Client already busy waiting for stuff, flag for check
+            client._check_notifications = True
+            return 202
+        client.process_notifications()
+        self.metrics.increment("ua.notification_check")
+        return 200
+
+    def drop(self, msg):
+        """Drop a client as it has connected to a new node"""
+        client = self.clients.get(msg["uaid"])
+        if client and client.ps.connected_at == int(msg["connected_at"]):
+            client.sendClose()
+        return 200
+
+
+class NodeTransportClient(Int32StringReceiver):
+    """A connection to another node, pipelining requests over it"""
+    MAX_LENGTH = MAX_FRAME_SIZE
+    log = Logger()
+
+    def __init__(self, pool, node_id):
+        # type: (NodeTransport, str) -> None
+        self.pool = pool
+        self.node_id = node_id
+        self._next_id = 0
+        self._pending = {}  # type: Dict[int, Deferred]
+
+    def request(self, msg):
+        # type: (Dict[str, Any]) -> Deferred
+        """Send a command, returning a Deferred firing with its response
+
+        Unanswered within the pool's ``request_timeout``, the node's
+        presumed dead and the connection's dropped, failing all of its
+        pending requests with a :exc:`ConnectionLost`.
+
+        """
+        self._next_id += 1
+        req_id = msg["id"] = self._next_id
+        d = self._pending[req_id] = Deferred(
+            lambda _: self._pending.pop(req_id, None))
+        self.sendString(jsoncodec.dumps(msg))
+        if self.pool.request_timeout:
+            d.addTimeout(self.pool.request_timeout, self.pool._reactor,
+                         onTimeoutCancel=self._timed_out)
+        return d
+
+    def _timed_out(self, result, timeout):
+        self.log.info("Node transport request to {node_id} timed out",
+                      node_id=self.node_id)
+        self.pool.metrics.increment("node_transport.timeout")
+        self.transport.abortConnection()
+        return Failure(ConnectionLost(
+            "No response within {} seconds".format(timeout)))
+
+    def stringReceived(self, frame):
+        resp = jsoncodec.loads(frame)
+        d = self._pending.pop(resp["id"], None)
+        if d is not None:
+            d.callback(NodeResponse(resp["code"]))
+
+    def connectionLost(self, reason=connectionDone):
+        self.pool._lost(self.node_id, self)
+        pending, self._pending = self._pending, {}
+        for d in pending.values():
+            d.errback(reason)
+
+
+class NodeTransport(object):
+    """Pool of persistent node transport connections, one per node
+
+    Nodes are addressed by their ``node_id`` (their internal router URL),
+    connecting to the same host on ``port``, and via TLS for ``https``
+    node_ids. Requests unanswered within ``request_timeout`` seconds drop
+    their connection (0 disables).
+
+    """
+    log = Logger()
+
+    def __init__(self, port, metrics, connect_timeout=1, request_timeout=5,
+                 reactor=reactor):
+        self.port = port
+        self.metrics = metrics
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self._reactor = reactor
+        self._connections = {}  # type: Dict[str, NodeTransportClient]
+        self._connecting = {}  # type: Dict[str, List[Deferred]]
+
+    def push(self, node_id, uaid, notification):
+        # type: (str, str, Dict[str, Any]) -> Deferred
+        """Deliver a serialized notification to a client on node_id"""
+        return self._request(node_id, dict(cmd="push", uaid=uaid,
+                                           notification=notification))
+
+    def notif(self, node_id, uaid):
+        # type: (str, str) -> Deferred
+        """Ask node_id to check for stored notifications for a client"""
+        return self._request(node_id, dict(cmd="notif", uaid=uaid))
+
+    def drop(self, node_id, uaid, connected_at):
+        # type: (str, str, int) -> Deferred
+        """Ask node_id to drop a client's (now duplicate) connection"""
+        return self._request(node_id, dict(cmd="drop", uaid=uaid,
+                                           connected_at=connected_at))
+
+    def close(self):
+        # type: () -> None
+        """Close all connections"""
+        for conn in self._connections.values():
+            conn.transport.loseConnection()
+
+    def _request(self, node_id, msg):
+        d = self._connection(node_id)
+        d.addCallback(lambda conn: conn.request(msg))
+        return d
+
+    def _connection(self, node_id):
+        # type: (str) -> Deferred
+        conn = self._connections.get(node_id)
+        if conn is not None and not conn.transport.disconnecting:
+            return succeed(conn)
+        d = Deferred()
+        waiters = self._connecting.get(node_id)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        self._connecting[node_id] = [d]
+        connecting = connectProtocol(self._endpoint(node_id),
+                                     NodeTransportClient(self, node_id))
+        connecting.addBoth(self._connected, node_id)
+        return d
+
+    def _endpoint(self, node_id):
+        url = urlparse(node_id)
+        endpoint = TCP4ClientEndpoint(self._reactor, url.hostname, self.port,
+                                      timeout=self.connect_timeout)
+        if url.scheme == "https":
+            endpoint = wrapClientTLS(
+                optionsForClientTLS(url.hostname.decode("utf8")), endpoint)
+        return endpoint
+
+    def _connected(self, result, node_id):
+        waiters = self._connecting.pop(node_id, [])
+        failed = isinstance(result, Failure)
+        self.metrics.increment(
+            "node_transport.connect",
+            tags=make_tags(status="fail" if failed else "success"))
+        if not failed:
+            self._connections[node_id] = result
+        for d in waiters:
+            if failed:
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _lost(self, node_id, conn):
+        if self._connections.get(node_id) is conn:
+            del self._connections[node_id]
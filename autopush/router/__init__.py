@@ -4,12 +4,13 @@ This package contains notification routers that handle routing a notification
 through the appropriate system for a given client.
 
 """
-from typing import Dict  # noqa
+from typing import Dict, Optional  # noqa
 
 from twisted.web.client import Agent  # noqa
 
 from autopush.config import AutopushConfig  # noqa
 from autopush.db import DatabaseManager  # noqa
+from autopush.node_transport import NodeTransport  # noqa
 from autopush.router.apnsrouter import APNSRouter
 from autopush.router.gcm import GCMRouter
 from autopush.router.interface import IRouter  # noqa
@@ -19,15 +20,22 @@ from autopush.router.fcm import FCMRouter
 __all__ = ["APNSRouter", "FCMRouter", "GCMRouter", "WebPushRouter"]
 
 
-def routers_from_config(conf, db, agent):
-    # type: (AutopushConfig, DatabaseManager, Agent) -> Dict[str, IRouter]
+def routers_from_config(conf,                 # type: AutopushConfig
+                        db,                   # type: DatabaseManager
+                        agent,                # type: Agent
+                        node_transport=None,  # type: Optional[NodeTransport]
+                        ):
+    # type: (...) -> Dict[str, IRouter]
     """Create a dict of IRouters for the given config"""
     router_conf = conf.router_conf
     routers = dict(
-        webpush=WebPushRouter(conf, None, db, agent)
+        webpush=WebPushRouter(conf, None, db, agent,
+                              node_transport=node_transport)
     )
     if 'apns' in router_conf:
         routers["apns"] = APNSRouter(conf, router_conf["apns"], db.metrics)
     if 'gcm' in router_conf:
         routers["gcm"] = GCMRouter(conf, router_conf["gcm"], db.metrics)
+    if 'fcm' in router_conf:
+        routers["fcm"] = FCMRouter(conf, router_conf["fcm"], db.metrics)
     return routers
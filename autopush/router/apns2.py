@@ -1,4 +1,6 @@
 import json
+import threading
+import time
 from collections import deque
 from decimal import Decimal
 
@@ -7,12 +9,15 @@ from hyper import HTTP20Connection
 from hyper.http20.exceptions import HTTP20Error
 
 from autopush.exceptions import RouterException
+from autopush.metrics import make_tags
 
 
 SANDBOX = 'api.development.push.apple.com'
 SERVER = 'api.push.apple.com'
 
 APNS_MAX_CONNECTIONS = 20
+# Seconds before closing an idle connection
+APNS_IDLE_TIMEOUT = 600
 
 # These values are defined by APNs as header values that should be sent.
 # The hyper library requires that all header values be strings.
@@ -42,7 +47,8 @@ class APNSClient(object):
                  max_connections=APNS_MAX_CONNECTIONS,
                  logger=None, metrics=None,
                  load_connections=True,
-                 max_retry=2):
+                 max_retry=2,
+                 idle_timeout=APNS_IDLE_TIMEOUT):
         """Create the APNS client connector.
 
         The cert_file and key_file can be derived from the exported `.p12`
@@ -79,6 +85,13 @@ class APNSClient(object):
         :type load_connections: bool
         :param max_retry: Number of HTTP2 transmit attempts
         :type max_retry: int
+        :param idle_timeout: Seconds before closing an idle connection
+        :type idle_timeout: float
+
+        Connections are created as needed, up to max_connections. The most
+        recently used are reused first, so those left idle for
+        idle_timeout (which APNs may have silently dropped) are closed
+        rather than sent further requests.
 
         """
         self.server = SANDBOX if use_sandbox else SERVER
@@ -88,15 +101,17 @@ class APNSClient(object):
         self.topic = topic
         self._max_connections = max_connections
         self._max_retry = max_retry
+        self._idle_timeout = idle_timeout
+        # Idle connections, least recently used first
         self.connections = deque(maxlen=max_connections)
+        self._last_used = {}
+        self._connection_count = 0
+        # Guards the pool's bookkeeping, shared by the sending threads
+        self._lock = threading.Lock()
+        self.ssl_context = None
         if load_connections:
             self.ssl_context = hyper.tls.init_context(cert=(cert_file,
                                                             key_file))
-            self.connections.extendleft((HTTP20Connection(
-                self.server,
-                self.port,
-                ssl_context=self.ssl_context,
-                force_proto='h2') for x in range(0, max_connections)))
         if self.log:
             self.log.debug("Starting APNS connection")
 
@@ -134,8 +149,8 @@ class APNSClient(object):
         url = '/3/device/' + router_token
         attempt = 0
         while True:
+            connection = self._get_connection()
             try:
-                connection = self._get_connection()
                 # request auto-opens closed connections, so if a connection
                 # has timed out or failed for other reasons, it's automatically
                 # re-established.
@@ -154,7 +169,8 @@ class APNSClient(object):
                         status_code=502,
                         response_body="APNS could not process "
                                       "your message {}".format(reason),
-                        log_exception=False
+                        log_exception=False,
+                        bridge_status=response.status
                     )
                 break
             except (HTTP20Error, IOError):
@@ -169,16 +185,65 @@ class APNSClient(object):
                 self._return_connection(connection)
 
     def _get_connection(self):
-        try:
-            connection = self.connections.pop()
+        with self._lock:
+            idle = self._retire_idle()
+            try:
+                connection = self.connections.pop()
+            except IndexError:
+                connection = None
+                full = self._connection_count >= self._max_connections
+                if not full:
+                    self._connection_count += 1
+        for conn in idle:
+            conn.close()
+            self._record_pool("retired", reason="idle")
+        if connection is not None:
             return connection
-        except IndexError:
+        if full:
             raise RouterException(
                 "Too many APNS requests, increase pool from {}".format(
                     self._max_connections
                 ),
                 status_code=503,
-                response_body="APNS busy, please retry")
+                response_body="APNS busy, please retry",
+                local=True)
+        self._record_pool("new")
+        return HTTP20Connection(
+            self.server,
+            self.port,
+            ssl_context=self.ssl_context,
+            force_proto='h2')
 
     def _return_connection(self, connection):
-        self.connections.appendleft(connection)
+        with self._lock:
+            self._last_used[connection] = time.time()
+            self.connections.append(connection)
+
+    def _retire_idle(self):
+        """Remove the connections idle for longer than idle_timeout from
+        the pool, returning them to be closed
+
+        Must be called with the lock held.
+
+        """
+        expiry = time.time() - self._idle_timeout
+        idle = []
+        while self.connections:
+            last_used = self._last_used.get(self.connections[0])
+            if last_used is None or last_used >= expiry:
+                break
+            connection = self.connections.popleft()
+            self._last_used.pop(connection, None)
+            self._connection_count -= 1
+            idle.append(connection)
+        return idle
+
+    def _record_pool(self, event, **kwargs):
+        if not self.metrics:
+            return
+        tags = make_tags(["platform:apns"], topic=self.topic)
+        self.metrics.increment(
+            "notification.bridge.apns.connection." + event,
+            tags=make_tags(tags, **kwargs))
+        self.metrics.gauge("notification.bridge.apns.connections",
+                           self._connection_count, tags=tags)
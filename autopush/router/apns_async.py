@@ -0,0 +1,642 @@
+"""Non-blocking APNs client
+
+Sends notifications over HTTP/2 connections on the reactor, multiplexing up
+to the server's ``MAX_CONCURRENT_STREAMS`` requests over each connection.
+
+Connections are opened as needed, up to ``max_connections``, and replaced
+as they're lost. Requests exceeding the available streams wait in a
+(bounded) queue for the next free stream.
+
+Idle connections are kept alive with HTTP/2 PINGs, or closed once idle for
+``idle_timeout`` (keeping one open). Connections failing to answer a PING
+are closed before they're sent further requests. Connections running out
+of stream ids are closed once their last requests complete.
+
+"""
+import json
+from collections import deque
+
+from h2.config import H2Configuration
+from h2.connection import ConnectionState, H2Connection
+from h2.errors import ErrorCodes
+from h2.events import (
+    ConnectionTerminated,
+    DataReceived,
+    PingAcknowledged,
+    RemoteSettingsChanged,
+    ResponseReceived,
+    StreamEnded,
+    StreamReset,
+    WindowUpdated,
+)
+from h2.exceptions import ProtocolError, StreamClosedError
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.endpoints import SSL4ClientEndpoint, connectProtocol
+from twisted.internet.interfaces import IDelayedCall  # noqa
+from twisted.internet.protocol import Protocol, connectionDone
+from twisted.internet.task import LoopingCall
+from twisted.internet.ssl import PrivateCertificate, optionsForClientTLS
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+from typing import Dict, List, Optional, Tuple  # noqa
+
+from autopush.exceptions import RouterException
+from autopush.metrics import SinkMetrics, make_tags
+from autopush.router.apns2 import (
+    APNS_IDLE_TIMEOUT,
+    APNS_MAX_CONNECTIONS,
+    APNS_PRIORITY_IMMEDIATE,
+    APNS_PRIORITY_LOW,
+    ComplexEncoder,
+    SANDBOX,
+    SERVER,
+)
+
+# Requests waiting for a stream, per client
+APNS_MAX_QUEUE = 1000
+# Seconds between health checks (PINGs) of idle connections
+APNS_PING_INTERVAL = 60
+# Seconds before reconnecting after a failed connection attempt, doubled
+# per further consecutive failure (up to the max)
+APNS_RECONNECT_DELAY = 0.5
+APNS_MAX_RECONNECT_DELAY = 30
+# Consecutive failed connection attempts before failing the waiting
+# requests
+APNS_MAX_CONNECT_FAILURES = 3
+
+PING_DATA = b"autopush"
+
+
+class APNSConnectionError(Exception):
+    """The request's connection (or stream) failed before its response"""
+
+
+class APNSStream(object):
+    """A request's HTTP/2 stream"""
+
+    def __init__(self, stream_id, body, canceller):
+        self.stream_id = stream_id
+        self.pending = body
+        self.status = None  # type: Optional[int]
+        self.data = []  # type: List[bytes]
+        self.deferred = Deferred(canceller)
+
+
+class DrainingH2Connection(H2Connection):
+    """An :class:`h2.connection.H2Connection` still accepting frames
+    after a graceful GOAWAY
+
+    h2 2.x closes the connection on receiving any GOAWAY, rejecting the
+    responses that follow it for the streams APNs did accept.
+
+    """
+
+    def _receive_goaway_frame(self, frame):
+        result = super(DrainingH2Connection, self)._receive_goaway_frame(
+            frame)
+        if frame.error_code == ErrorCodes.NO_ERROR:
+            self.state_machine.state = ConnectionState.CLIENT_OPEN
+        return result
+
+
+class APNSProtocol(Protocol):
+    """An HTTP/2 connection to APNs, owned by an :class:`AsyncAPNSClient`
+
+    Ready for requests once APNs' initial settings (including its
+    ``MAX_CONCURRENT_STREAMS``) have arrived.
+
+    """
+    # HTTP/2's largest stream id
+    max_stream_id = 2 ** 31 - 1
+
+    def __init__(self, client):
+        # type: (AsyncAPNSClient) -> None
+        self.client = client
+        self.streams = {}  # type: Dict[int, APNSStream]
+        self.ready = False
+        self.closing = False
+        # Closing once its streams complete
+        self.draining = False
+        self.requests = 0
+        self.connected_at = None  # type: Optional[float]
+        self.last_active = None  # type: Optional[float]
+        self.ping_sent = None  # type: Optional[float]
+        self._h2 = DrainingH2Connection(config=H2Configuration(
+            client_side=True, header_encoding=None))
+
+    @property
+    def capacity(self):
+        # type: () -> int
+        """The number of further concurrent requests allowed"""
+        if not self.ready or self.closing:
+            return 0
+        return (self._h2.remote_settings.max_concurrent_streams -
+                len(self.streams))
+
+    def connectionMade(self):
+        self.connected_at = self.last_active = self.client.clock.seconds()
+        self._h2.initiate_connection()
+        self._send()
+
+    def request(self, headers, body):
+        # type: (List[Tuple[bytes, bytes]], bytes) -> Deferred
+        """Send a request, returning a Deferred firing with its response's
+        (status, body)
+
+        Raises a :exc:`h2.exceptions.ProtocolError` if the request can't be
+        sent, e.g. when out of stream ids.
+
+        """
+        stream_id = self._h2.get_next_available_stream_id()
+        self._h2.send_headers(stream_id, headers, end_stream=not body)
+        stream = self.streams[stream_id] = APNSStream(
+            stream_id, body, lambda d: self._cancel(stream_id))
+        self.requests += 1
+        self.last_active = self.client.clock.seconds()
+        self._flush(stream)
+        self._send()
+        if stream_id + 2 > self.max_stream_id:
+            # Its last stream
+            self.client._retire(self, "stream_ids_exhausted")
+        return stream.deferred
+
+    def dataReceived(self, data):
+        try:
+            events = self._h2.receive_data(data)
+        except ProtocolError as ex:
+            self.client.log.debug("APNs HTTP/2 protocol error: {ex}", ex=ex)
+            self.transport.loseConnection()
+            return
+        for event in events:
+            if isinstance(event, ResponseReceived):
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream.status = int(dict(event.headers)[b":status"])
+            elif isinstance(event, DataReceived):
+                self._h2.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream.data.append(event.data)
+            elif isinstance(event, StreamEnded):
+                self._stream_ended(event.stream_id)
+            elif isinstance(event, StreamReset):
+                self._fail_stream(event.stream_id, "Stream reset")
+            elif isinstance(event, WindowUpdated):
+                for stream in list(self.streams.values()):
+                    self._flush(stream)
+            elif isinstance(event, RemoteSettingsChanged):
+                if not self.ready:
+                    self.ready = True
+                    self.client.connection_ready(self)
+                else:
+                    self.client.dispatch()
+            elif isinstance(event, PingAcknowledged):
+                self._ping_acknowledged()
+            elif isinstance(event, ConnectionTerminated):
+                self._terminated(event)
+        self._send()
+
+    def ping(self):
+        # type: () -> None
+        """Check the connection's health with a PING"""
+        self.ping_sent = self.client.clock.seconds()
+        self._h2.ping(PING_DATA)
+        self._send()
+
+    def retire(self, abort=False):
+        # type: (bool) -> None
+        """Close the connection (with a GOAWAY) once its in-flight
+        requests complete, sending it no further requests
+
+        Aborting closes it immediately, dropping its in-flight requests
+        and any unsent data, e.g. for an unresponsive connection.
+
+        """
+        self.closing = True
+        if abort:
+            self.transport.abortConnection()
+        else:
+            self.draining = True
+            self._close_if_drained()
+
+    def connectionLost(self, reason=connectionDone):
+        self.closing = True
+        streams, self.streams = self.streams, {}
+        for stream in streams.values():
+            stream.deferred.errback(
+                APNSConnectionError(reason.getErrorMessage()))
+        self.client.connection_lost(self)
+
+    def _close_if_drained(self):
+        # type: () -> None
+        if self.draining and not self.streams:
+            self.draining = False
+            self._h2.close_connection()
+            self._send()
+            self.transport.loseConnection()
+
+    def _send(self):
+        data = self._h2.data_to_send()
+        if data:
+            self.transport.write(data)
+
+    def _flush(self, stream):
+        # type: (APNSStream) -> None
+        """Send the stream's body, as flow control allows"""
+        try:
+            while stream.pending:
+                window = min(
+                    self._h2.local_flow_control_window(stream.stream_id),
+                    self._h2.max_outbound_frame_size)
+                if window <= 0:
+                    return
+                chunk = stream.pending[:window]
+                stream.pending = stream.pending[window:]
+                self._h2.send_data(stream.stream_id, chunk,
+                                   end_stream=not stream.pending)
+        except StreamClosedError:
+            self._fail_stream(stream.stream_id, "Stream closed")
+
+    def _stream_ended(self, stream_id):
+        # type: (int) -> None
+        stream = self.streams.pop(stream_id, None)
+        if stream is None:
+            return
+        self.last_active = self.client.clock.seconds()
+        stream.deferred.callback((stream.status, b"".join(stream.data)))
+        self._close_if_drained()
+        self.client.dispatch()
+
+    def _fail_stream(self, stream_id, reason):
+        # type: (int, str) -> None
+        stream = self.streams.pop(stream_id, None)
+        if stream is None:
+            return
+        stream.deferred.errback(APNSConnectionError(reason))
+        self._close_if_drained()
+        self.client.dispatch()
+
+    def _cancel(self, stream_id):
+        # type: (int) -> None
+        """Abandon a stream (e.g. timed out)"""
+        if self.streams.pop(stream_id, None) is None:
+            return
+        try:
+            self._h2.reset_stream(stream_id, ErrorCodes.CANCEL)
+            self._send()
+        except StreamClosedError:
+            pass
+        self._close_if_drained()
+        self.client.dispatch()
+
+    def _ping_acknowledged(self):
+        # type: () -> None
+        if self.ping_sent is None:
+            return
+        self.client.metrics.timing(
+            "notification.bridge.apns.ping",
+            (self.client.clock.seconds() - self.ping_sent) * 1000,
+            tags=self.client._tags)
+        self.ping_sent = None
+
+    def _terminated(self, event):
+        # type: (ConnectionTerminated) -> None
+        """APNs is closing the connection (GOAWAY)
+
+        A graceful GOAWAY drains: the streams APNs accepted still get
+        their responses. Otherwise the connection's dropped.
+
+        """
+        self.closing = True
+        self.client.log.debug(
+            "APNs closing connection: {code} {reason}",
+            code=event.error_code, reason=event.additional_data)
+        # Streams beyond the last processed were never seen by APNs
+        for stream_id in list(self.streams):
+            if stream_id > event.last_stream_id:
+                self._fail_stream(stream_id, "Connection closed by APNs")
+        if event.error_code == ErrorCodes.NO_ERROR:
+            self.client._retire(self, "goaway")
+        else:
+            self.transport.loseConnection()
+
+
+class QueuedRequest(object):
+    """A request awaiting (or sent over) a stream"""
+
+    def __init__(self, headers, body, queued_at):
+        self.headers = headers
+        self.body = body
+        self.queued_at = queued_at
+        self.stream_deferred = None  # type: Optional[Deferred]
+        self.deferred = Deferred(self._cancel)
+
+    def _cancel(self, d):
+        if self.stream_deferred is not None:
+            self.stream_deferred.cancel()
+
+
+class AsyncAPNSClient(object):
+    """APNs client multiplexing requests over HTTP/2 connections on the
+    reactor
+
+    :meth:`send` returns a Deferred. It takes the same arguments as
+    :meth:`autopush.router.apns2.APNSClient.send`.
+
+    """
+
+    def __init__(self, cert_file, key_file, topic,
+                 alt=False, use_sandbox=False,
+                 max_connections=APNS_MAX_CONNECTIONS,
+                 max_queue=APNS_MAX_QUEUE,
+                 timeout=10,
+                 ping_interval=APNS_PING_INTERVAL,
+                 idle_timeout=APNS_IDLE_TIMEOUT,
+                 logger=None, metrics=None,
+                 load_connections=True,
+                 max_retry=2,
+                 clock=reactor):
+        """Create the APNS client connector.
+
+        See :class:`autopush.router.apns2.APNSClient` for the cert_file and
+        key_file.
+
+        :param max_connections: Max number of HTTP/2 connections to open
+        :type max_connections: int
+        :param max_queue: Max number of requests awaiting a stream
+        :type max_queue: int
+        :param timeout: Seconds to wait for (a stream and) a response
+        :type timeout: float
+        :param ping_interval: Seconds between PINGs of idle connections
+        :type ping_interval: float
+        :param idle_timeout: Seconds before closing an idle connection
+        :type idle_timeout: float
+        :param load_connections: Load the TLS credentials (used for
+            testing)
+        :type load_connections: bool
+        :param max_retry: Number of HTTP2 transmit attempts
+        :type max_retry: int
+
+        """
+        self.server = SANDBOX if use_sandbox else SERVER
+        self.port = 2197 if alt else 443
+        self.log = logger or Logger()
+        self.metrics = metrics or SinkMetrics()
+        self.topic = topic
+        self.clock = clock
+        self.connections = []  # type: List[APNSProtocol]
+        self._connecting = 0
+        # Consecutive connection attempts failing before APNs' settings
+        self._connect_failures = 0
+        self._reconnect_call = None  # type: Optional[IDelayedCall]
+        self._queue = deque()  # type: deque
+        self._max_connections = max_connections
+        self._max_queue = max_queue
+        self._max_retry = max_retry
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._health_check = LoopingCall(self._check_connections)
+        self._health_check.clock = clock
+        self._ping_interval = ping_interval
+        self._tags = make_tags(["platform:apns"], topic=topic)
+        self._tls_options = None
+        if load_connections:
+            with open(cert_file) as cert, open(key_file) as key:
+                credentials = PrivateCertificate.loadPEM(
+                    cert.read() + key.read())
+            self._tls_options = optionsForClientTLS(
+                unicode(self.server),
+                clientCertificate=credentials,
+                acceptableProtocols=[b"h2"],
+            )
+        self.log.debug("Starting APNS connection")
+
+    @property
+    def in_flight(self):
+        # type: () -> int
+        return sum(len(conn.streams) for conn in self.connections)
+
+    def send(self, router_token, payload, apns_id,
+             priority=True, topic=None, exp=None):
+        """Send the dict of values to the remote bridge
+
+        :returns: Deferred firing on success, otherwise failing with a
+            :exc:`RouterException` (APNs rejected the request),
+            :exc:`APNSConnectionError` or
+            :exc:`twisted.internet.defer.TimeoutError`
+
+        """
+        body = json.dumps(payload, cls=ComplexEncoder)
+        priority = APNS_PRIORITY_IMMEDIATE if priority else APNS_PRIORITY_LOW
+        headers = [
+            (b":method", b"POST"),
+            (b":scheme", b"https"),
+            (b":authority", self.server),
+            (b":path", b"/3/device/" + router_token),
+            (b"apns-id", apns_id),
+            (b"apns-priority", priority),
+            (b"apns-topic", topic or self.topic),
+        ]
+        if exp:
+            headers.append((b"apns-expiration", str(exp)))
+        return self._send(headers, body, attempt=1)
+
+    def _send(self, headers, body, attempt):
+        d = self.request(headers, body)
+        d.addTimeout(self._timeout, self.clock)
+        d.addCallback(self._check_response)
+        d.addErrback(self._retry, headers, body, attempt)
+        return d
+
+    def _check_response(self, response):
+        status, body = response
+        if status == 200:
+            return
+        try:
+            reason = json.loads(body.decode('utf-8'))['reason']
+        except (ValueError, KeyError, TypeError):
+            reason = "Unknown"
+        raise RouterException(
+            "APNS Transmit Error {}:{}".format(status, reason),
+            status_code=502,
+            response_body="APNS could not process "
+                          "your message {}".format(reason),
+            log_exception=False,
+            bridge_status=status
+        )
+
+    def _retry(self, failure, headers, body, attempt):
+        failure.trap(APNSConnectionError)
+        if attempt < self._max_retry:
+            return self._send(headers, body, attempt + 1)
+        return failure
+
+    def request(self, headers, body):
+        # type: (List[Tuple[bytes, bytes]], bytes) -> Deferred
+        """Send a request over the next available stream, returning a
+        Deferred firing with the response's (status, body)"""
+        if len(self._queue) >= self._max_queue:
+            self.metrics.increment("notification.bridge.apns.queue.full",
+                                   tags=self._tags)
+            return fail(RouterException(
+                "Too many APNS requests, increase queue from {}".format(
+                    self._max_queue),
+                status_code=503,
+                response_body="APNS busy, please retry",
+                local=True))
+        request = QueuedRequest(headers, body, self.clock.seconds())
+        self._queue.append(request)
+        self.dispatch()
+        self._grow()
+        return request.deferred
+
+    def dispatch(self):
+        # type: () -> None
+        """Send queued requests over any available streams"""
+        now = self.clock.seconds()
+        retired = False
+        while self._queue:
+            conn = max(self.connections, key=lambda c: c.capacity)\
+                if self.connections else None
+            if conn is None or conn.capacity <= 0:
+                break
+            request = self._queue.popleft()
+            if request.deferred.called:
+                # Cancelled
+                continue
+            try:
+                request.stream_deferred = conn.request(request.headers,
+                                                       request.body)
+            except ProtocolError as ex:
+                # Unusable (e.g. out of stream ids): retire it, the request
+                # awaits another
+                self.log.debug("APNs request failed: {ex}", ex=ex)
+                self._queue.appendleft(request)
+                self._retire(conn, "protocol_error")
+                retired = True
+                continue
+            self.metrics.timing("notification.bridge.apns.queue_wait",
+                                (now - request.queued_at) * 1000,
+                                tags=self._tags)
+            request.stream_deferred.chainDeferred(request.deferred)
+        self.metrics.gauge("notification.bridge.apns.streams",
+                           self.in_flight, tags=self._tags)
+        if retired:
+            self._grow()
+
+    def connection_ready(self, conn):
+        # type: (APNSProtocol) -> None
+        self._connecting -= 1
+        self._connect_failures = 0
+        self.connections.append(conn)
+        self.metrics.increment("notification.bridge.apns.connection.new",
+                               tags=self._tags)
+        self.metrics.gauge("notification.bridge.apns.connections",
+                           len(self.connections), tags=self._tags)
+        if not self._health_check.running:
+            self._health_check.start(self._ping_interval, now=False)
+        self.dispatch()
+        self._grow()
+
+    def connection_lost(self, conn):
+        # type: (APNSProtocol) -> None
+        if conn in self.connections:
+            self.connections.remove(conn)
+            self.metrics.gauge("notification.bridge.apns.connections",
+                               len(self.connections), tags=self._tags)
+            if not self.connections and self._health_check.running:
+                self._health_check.stop()
+        elif not conn.ready:
+            self._connecting -= 1
+        lifespan = self.clock.seconds() - conn.connected_at
+        self.metrics.increment("notification.bridge.apns.connection.closed",
+                               tags=self._tags)
+        if lifespan > 0:
+            self.metrics.gauge("notification.bridge.apns.connection."
+                               "throughput", conn.requests / lifespan,
+                               tags=self._tags)
+        if not conn.ready:
+            # Failed before APNs' settings (e.g. the TLS handshake)
+            self._connect_failed(Failure(APNSConnectionError(
+                "Connection closed before ready")))
+            return
+        # Reconnect for any waiting requests
+        self._grow()
+
+    def _check_connections(self):
+        # type: () -> None
+        """Retire unresponsive or long idle connections, PINGing the other
+        idle ones"""
+        now = self.clock.seconds()
+        remaining = [conn for conn in self.connections if not conn.closing]
+        for conn in list(remaining):
+            if conn.ping_sent is not None:
+                # Unanswered since the last check
+                remaining.remove(conn)
+                self._retire(conn, "ping_timeout", abort=True)
+            elif conn.streams:
+                continue
+            elif (now - conn.last_active >= self._idle_timeout and
+                    len(remaining) > 1):
+                remaining.remove(conn)
+                self._retire(conn, "idle")
+            elif now - conn.last_active >= self._ping_interval:
+                conn.ping()
+
+    def _retire(self, conn, reason, abort=False):
+        # type: (APNSProtocol, str, bool) -> None
+        self.log.debug("Closing APNs connection: {reason}", reason=reason)
+        self.metrics.increment("notification.bridge.apns.connection.retired",
+                               tags=make_tags(self._tags, reason=reason))
+        conn.retire(abort)
+
+    def _grow(self):
+        # type: () -> None
+        """Open another connection when requests are waiting (and none are
+        already being opened, or awaiting a reconnect)"""
+        if not self._queue or self._connecting:
+            return
+        if self._reconnect_call is not None and \
+                self._reconnect_call.active():
+            return
+        if len(self.connections) >= self._max_connections:
+            return
+        self._connecting += 1
+        d = self._connect()
+        d.addErrback(self._connect_errback)
+
+    def _connect(self):
+        # type: () -> Deferred
+        endpoint = SSL4ClientEndpoint(self.clock, self.server, self.port,
+                                      self._tls_options)
+        return connectProtocol(endpoint, APNSProtocol(self))
+
+    def _connect_errback(self, failure):
+        self._connecting -= 1
+        self._connect_failed(failure)
+
+    def _connect_failed(self, failure):
+        # type: (Failure) -> None
+        """Back off before reconnecting, failing the waiting requests
+        after too many consecutive failures (with nowhere else to send
+        them)"""
+        self._connect_failures += 1
+        self.log.debug("Unable to connect to APNs: {failure}",
+                       failure=failure.getErrorMessage())
+        self.metrics.increment("notification.bridge.connection.error",
+                               tags=make_tags(self._tags,
+                                              reason="connect_failed"))
+        delay = min(APNS_RECONNECT_DELAY * 2 ** (self._connect_failures - 1),
+                    APNS_MAX_RECONNECT_DELAY)
+        self._reconnect_call = self.clock.callLater(delay, self._grow)
+        if (self.connections or
+                self._connect_failures < APNS_MAX_CONNECT_FAILURES):
+            return
+        # Nowhere to send the waiting requests
+        queue, self._queue = self._queue, deque()
+        for request in queue:
+            if not request.deferred.called:
+                request.deferred.errback(
+                    APNSConnectionError(failure.getErrorMessage()))
@@ -4,6 +4,7 @@ import uuid
 from typing import Any  # noqa
 
 from hyper.http20.exceptions import ConnectionError, HTTP20Error
+from twisted.internet.defer import TimeoutError, maybeDeferred
 from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
 
@@ -11,9 +12,17 @@ from autopush.exceptions import RouterException
 from autopush.metrics import make_tags
 from autopush.router.apns2 import (
     APNSClient,
+    APNS_IDLE_TIMEOUT,
     APNS_MAX_CONNECTIONS,
 )
+from autopush.router.apns_async import (
+    APNSConnectionError,
+    APNS_MAX_QUEUE,
+    APNS_PING_INTERVAL,
+    AsyncAPNSClient,
+)
 from autopush.router.interface import RouterResponse
+from autopush.router.limiter import bridge_limiter
 from autopush.types import JSONDict  # noqa
 
 
@@ -37,6 +46,25 @@ class APNSRouter(object):
         """
         default_topic = "com.mozilla.org." + rel_channel
         cert_info = self.router_conf[rel_channel]
+        if cert_info.get("async"):
+            return AsyncAPNSClient(
+                cert_file=cert_info.get("cert"),
+                key_file=cert_info.get("key"),
+                use_sandbox=cert_info.get("sandbox", False),
+                max_connections=cert_info.get("max_connections",
+                                              APNS_MAX_CONNECTIONS),
+                max_queue=cert_info.get("max_queue", APNS_MAX_QUEUE),
+                timeout=cert_info.get("timeout", 10),
+                ping_interval=cert_info.get("ping_interval",
+                                            APNS_PING_INTERVAL),
+                idle_timeout=cert_info.get("idle_timeout",
+                                           APNS_IDLE_TIMEOUT),
+                topic=cert_info.get("topic", default_topic),
+                logger=self.log,
+                metrics=self.metrics,
+                load_connections=load_connections,
+                max_retry=cert_info.get('max_retry', 2)
+            )
         return APNSClient(
             cert_file=cert_info.get("cert"),
             key_file=cert_info.get("key"),
@@ -47,7 +75,8 @@ class APNSRouter(object):
             logger=self.log,
             metrics=self.metrics,
             load_connections=load_connections,
-            max_retry=cert_info.get('max_retry', 2)
+            max_retry=cert_info.get('max_retry', 2),
+            idle_timeout=cert_info.get("idle_timeout", APNS_IDLE_TIMEOUT)
         )
 
     def __init__(self, conf, router_conf, metrics, load_connections=True):
@@ -66,9 +95,15 @@ class APNSRouter(object):
         self.metrics = metrics
         self._base_tags = ["platform:apns"]
         self.apns = dict()
+        self.limiters = dict()
         for rel_channel in router_conf:
             self.apns[rel_channel] = self._connect(rel_channel,
                                                    load_connections)
+            limiter = bridge_limiter(conf, metrics,
+                                     make_tags(self._base_tags,
+                                               application=rel_channel))
+            if limiter:
+                self.limiters[rel_channel] = limiter
         self.log.debug("Starting APNS router...")
 
     def register(self, uaid, router_data, app_id, *args, **kwargs):
@@ -106,21 +141,22 @@ class APNSRouter(object):
 
         """
         router_data = uaid_data["router_data"]
+        limiter = self.limiters.get(router_data["rel_channel"])
+        if limiter:
+            return limiter.run(self._send, notification, router_data)
+        return self._send(notification, router_data)
+
+    def _send(self, notification, router_data):
+        """Route the notification, returns a deferred"""
+        if isinstance(self.apns.get(router_data["rel_channel"]),
+                      AsyncAPNSClient):
+            return maybeDeferred(self._route_async, notification,
+                                 router_data)
         # Kick the entire notification routing off to a thread
         return deferToThread(self._route, notification, router_data)
 
-    def _route(self, notification, router_data):
-        """Blocking APNS call to route the notification
-
-        :param notification: Notification data to send
-        :type notification: dict
-        :param router_data: Pre-initialized data for this connection
-        :type router_data: dict
-
-        """
-        router_token = router_data["token"]
-        rel_channel = router_data["rel_channel"]
-        apns_client = self.apns[rel_channel]
+    def _build_payload(self, notification, router_data):
+        """Build the notification's APNs payload"""
         # chid MUST MATCH THE CHANNELID GENERATED BY THE REGISTRATION SERVICE
         # Currently this value is in hex form.
         payload = {
@@ -143,6 +179,21 @@ class APNSRouter(object):
                     "title-loc-key": "SentTab.NoTabArrivingNotification.title",
                 }
             })
+        return payload
+
+    def _route(self, notification, router_data):
+        """Blocking APNS call to route the notification
+
+        :param notification: Notification data to send
+        :type notification: dict
+        :param router_data: Pre-initialized data for this connection
+        :type router_data: dict
+
+        """
+        router_token = router_data["token"]
+        rel_channel = router_data["rel_channel"]
+        apns_client = self.apns[rel_channel]
+        payload = self._build_payload(notification, router_data)
         apns_id = str(uuid.uuid4()).lower()
         # APNs may force close a connection on us without warning.
         # if that happens, retry the message.
@@ -151,6 +202,10 @@ class APNSRouter(object):
             apns_client.send(router_token=router_token, payload=payload,
                              apns_id=apns_id)
             success = True
+        except RouterException as e:
+            if e.extra.get("bridge_status") == 410:
+                return self._unregistered(rel_channel)
+            raise
         except ConnectionError:
             self.metrics.increment("notification.bridge.connection.error",
                                    tags=make_tags(
@@ -163,12 +218,69 @@ class APNSRouter(object):
                                                   application=rel_channel,
                                                   reason="http2_error"))
         if not success:
-            raise RouterException(
-                "Server error",
-                status_code=502,
-                response_body="APNS returned an error processing request",
-                log_exception=False,
-            )
+            raise self._send_error()
+        return self._sent(notification, router_data)
+
+    def _route_async(self, notification, router_data):
+        """Route the notification on the reactor
+
+        :param notification: Notification data to send
+        :type notification: dict
+        :param router_data: Pre-initialized data for this connection
+        :type router_data: dict
+
+        """
+        rel_channel = router_data["rel_channel"]
+        payload = self._build_payload(notification, router_data)
+        d = self.apns[rel_channel].send(
+            router_token=router_data["token"], payload=payload,
+            apns_id=str(uuid.uuid4()).lower())
+        d.addCallbacks(lambda _: self._sent(notification, router_data),
+                       self._send_failed, errbackArgs=(rel_channel,))
+        return d
+
+    def _send_failed(self, fail, rel_channel):
+        """Convert an AsyncAPNSClient send failure to a RouterException"""
+        if (fail.check(RouterException) and
+                fail.value.extra.get("bridge_status") == 410):
+            return self._unregistered(rel_channel)
+        if fail.check(APNSConnectionError):
+            reason = "connection_error"
+        elif fail.check(TimeoutError):
+            reason = "timeout"
+        else:
+            return fail
+        self.metrics.increment("notification.bridge.connection.error",
+                               tags=make_tags(self._base_tags,
+                                              application=rel_channel,
+                                              reason=reason))
+        raise self._send_error()
+
+    def _unregistered(self, rel_channel):
+        """The token's no longer registered (the app was uninstalled):
+        drop the user"""
+        self.metrics.increment("notification.bridge.error",
+                               tags=make_tags(self._base_tags,
+                                              application=rel_channel,
+                                              reason="unregistered"))
+        return RouterResponse(
+            status_code=410,
+            response_body="Endpoint requires client update",
+            router_data={},
+            errno=103,
+        )
+
+    def _send_error(self):
+        return RouterException(
+            "Server error",
+            status_code=502,
+            response_body="APNS returned an error processing request",
+            log_exception=False,
+        )
+
+    def _sent(self, notification, router_data):
+        """Record the successful send, returning the RouterResponse"""
+        rel_channel = router_data["rel_channel"]
         location = "%s/m/%s" % (self.conf.endpoint_url, notification.version)
         self.metrics.increment("notification.bridge.sent",
                                tags=make_tags(self._base_tags,
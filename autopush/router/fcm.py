@@ -3,12 +3,21 @@ from typing import Any  # noqa
 
 import pyfcm
 from requests.exceptions import ConnectionError
+from twisted.internet.defer import TimeoutError, maybeDeferred
+from twisted.internet.error import ConnectError
 from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
+from twisted.web.client import (
+    RequestTransmissionFailed,
+    ResponseFailed,
+    ResponseNeverReceived,
+)
 
 from autopush.exceptions import RouterException
 from autopush.metrics import make_tags
+from autopush.router.fcmclient import AsyncFCM, FCM_ENDPOINT
 from autopush.router.interface import RouterResponse
+from autopush.router.limiter import bridge_limiter
 from autopush.types import JSONDict  # noqa
 
 
@@ -112,12 +121,25 @@ class FCMRouter(object):
         self.senderID = router_conf.get("senderID")
         self.auth = router_conf.get("auth")
         self._base_tags = ["platform:fcm"]
+        self.use_async = router_conf.get("async", False)
         try:
-            self.fcm = pyfcm.FCMNotification(api_key=self.auth)
+            if self.use_async:
+                self.fcm = AsyncFCM(
+                    self.auth,
+                    endpoint=router_conf.get("endpoint", FCM_ENDPOINT),
+                    max_connections=router_conf.get("max_connections", 50),
+                    timeout=router_conf.get("timeout", 10),
+                    metrics=metrics)
+            else:
+                self.fcm = pyfcm.FCMNotification(api_key=self.auth)
+                if "endpoint" in router_conf:
+                    self.fcm.FCM_END_POINT = router_conf["endpoint"]
         except Exception as e:
             self.log.error("Could not instantiate FCM {ex}",
                            ex=e)
             raise IOError("FCM Bridge not initiated in main")
+        self.limiter = bridge_limiter(
+            conf, metrics, make_tags(self._base_tags, senderid=self.senderID))
         self.log.debug("Starting FCM router...")
 
     def amend_endpoint_response(self, response, router_data):
@@ -149,11 +171,21 @@ class FCMRouter(object):
     def route_notification(self, notification, uaid_data):
         """Start the FCM notification routing, returns a deferred"""
         router_data = uaid_data["router_data"]
+        if self.limiter:
+            return self.limiter.run(self._send, notification, router_data)
+        return self._send(notification, router_data)
+
+    def _send(self, notification, router_data):
+        """Route the notification, returns a deferred"""
+        if self.use_async:
+            return maybeDeferred(self._route_async, notification,
+                                 router_data)
         # Kick the entire notification routing off to a thread
         return deferToThread(self._route, notification, router_data)
 
-    def _route(self, notification, router_data):
-        """Blocking FCM call to route the notification"""
+    def _build_message(self, notification, router_data):
+        """Build the notify_single_device arguments for the
+        notification"""
         # THIS MUST MATCH THE CHANNELID GENERATED BY THE REGISTRATION SERVICE
         # Currently this value is in hex form.
         data = {"chid": notification.channel_id.hex}
@@ -188,30 +220,70 @@ class FCMRouter(object):
         # registration.
         router_ttl = min(self.MAX_TTL,
                          max(self.min_ttl, notification.ttl or 0))
+        return dict(
+            collapse_key=self.collapseKey,
+            data_message=data,
+            dry_run=self.dryRun or ('dryrun' in router_data),
+            registration_id=regid,
+            time_to_live=router_ttl,
+        )
+
+    def _route(self, notification, router_data):
+        """Blocking FCM call to route the notification"""
+        message = self._build_message(notification, router_data)
         try:
-            result = self.fcm.notify_single_device(
-                collapse_key=self.collapseKey,
-                data_message=data,
-                dry_run=self.dryRun or ('dryrun' in router_data),
-                registration_id=regid,
-                time_to_live=router_ttl,
-            )
+            result = self.fcm.notify_single_device(**message)
         except pyfcm.errors.AuthenticationError as e:
             self.log.error("Authentication Error: %s" % e)
             raise RouterException("Server error", status_code=500)
+        except pyfcm.errors.FCMServerError as e:
+            self.log.warn("FCM server error: %s" % e)
+            raise self._unavailable("server_error")
         except ConnectionError as e:
-            self.metrics.increment("notification.bridge.error",
-                                   tags=make_tags(
-                                       self._base_tags,
-                                       reason="connection_unavailable"))
             self.log.warn("Could not connect to FCM server: %s" % e)
-            raise RouterException("Server error", status_code=502,
-                                  log_exception=False)
+            raise self._unavailable("connection_unavailable")
         except Exception as e:
             self.log.error("Unhandled FCM Error: %s" % e)
             raise RouterException("Server error", status_code=500)
         return self._process_reply(result, notification, router_data,
-                                   ttl=router_ttl)
+                                   ttl=message["time_to_live"])
+
+    def _route_async(self, notification, router_data):
+        """Route the notification on the reactor"""
+        message = self._build_message(notification, router_data)
+        d = self.fcm.notify_single_device(**message)
+        d.addErrback(self._send_failed)
+        d.addCallback(self._process_reply, notification, router_data,
+                      ttl=message["time_to_live"])
+        return d
+
+    def _send_failed(self, fail):
+        """Convert an AsyncFCM send failure to a RouterException"""
+        if fail.check(RouterException):
+            return fail
+        if fail.check(pyfcm.errors.AuthenticationError):
+            self.log.error("Authentication Error: %s" % fail.value)
+            raise RouterException("Server error", status_code=500)
+        if fail.check(pyfcm.errors.FCMServerError):
+            self.log.warn("FCM server error: %s" % fail.value)
+            raise self._unavailable("server_error")
+        if fail.check(ConnectError, RequestTransmissionFailed,
+                      ResponseFailed, ResponseNeverReceived):
+            self.log.warn("Could not connect to FCM server: %s" % fail.value)
+            raise self._unavailable("connection_unavailable")
+        if fail.check(TimeoutError):
+            self.log.warn("FCM Timeout: %s" % fail.value)
+            raise self._unavailable("timeout")
+        self.log.error("Unhandled FCM Error: %s" % fail.value)
+        raise RouterException("Server error", status_code=500)
+
+    def _unavailable(self, reason):
+        """Record FCM's unavailability, returning the RouterException"""
+        self.metrics.increment("notification.bridge.error",
+                               tags=make_tags(self._base_tags,
+                                              reason=reason))
+        return RouterException("Server error", status_code=502,
+                               log_exception=False)
 
     def _error(self, err, status, **kwargs):
         """Error handler that raises the RouterException"""
@@ -0,0 +1,159 @@
+"""Non-blocking FCM client
+
+Sends messages via FCM's (legacy) HTTP API on the reactor, through a
+persistent connection pool, as a drop in for :mod:`pyfcm`'s blocking
+:meth:`~pyfcm.FCMNotification.notify_single_device`.
+
+"""
+import json
+from StringIO import StringIO
+
+from pyfcm import FCMNotification
+from pyfcm.errors import (
+    AuthenticationError,
+    FCMServerError,
+    InternalPackageError,
+)
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore, fail
+from twisted.web.client import FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+from autopush.exceptions import RouterException
+from autopush.router.gcmclient import pooled_agent
+
+FCM_ENDPOINT = FCMNotification.FCM_END_POINT
+# Sends awaiting a free request slot
+FCM_MAX_QUEUE = 1000
+
+
+class AsyncFCM(object):
+    """FCM service handler sending on the reactor
+
+    At most max_connections requests are in flight, each over one of up
+    to max_connections persistent connections, with up to max_queue more
+    queued. Sends beyond that fail immediately with a 503
+    :exc:`~autopush.exceptions.RouterException`. The timeout includes the
+    time spent queued.
+
+    """
+
+    def __init__(self,
+                 api_key,
+                 endpoint=FCM_ENDPOINT,
+                 max_connections=50,
+                 timeout=10,
+                 max_queue=FCM_MAX_QUEUE,
+                 agent=None,
+                 metrics=None,
+                 reactor=reactor):
+        """Initialize the FCM client
+
+        :param api_key: The FCM server key
+        :type api_key: str
+        :param endpoint: FCM endpoint override
+        :type endpoint: str
+        :param max_connections: Maximum requests in flight
+        :type max_connections: int
+        :param timeout: Seconds to wait for a response
+        :type timeout: float
+        :param max_queue: Maximum sends awaiting a request slot
+        :type max_queue: int
+        :param agent: Agent for sending requests (defaults to a
+            :func:`~autopush.router.gcmclient.pooled_agent`)
+        :type agent: twisted.web.client.Agent
+        :param metrics: Metric recorder
+        :type metrics: autopush.metrics.IMetric
+
+        """
+        self._api_key = api_key
+        self._endpoint = endpoint
+        self._agent = agent or pooled_agent(max_connections, timeout,
+                                            reactor=reactor)
+        self._semaphore = DeferredSemaphore(max_connections)
+        self._max_queue = max_queue
+        self._timeout = timeout
+        self.metrics = metrics
+        self._reactor = reactor
+
+    def notify_single_device(self,
+                             registration_id,
+                             data_message=None,
+                             collapse_key=None,
+                             time_to_live=None,
+                             dry_run=False):
+        """Send a data message to a single device
+
+        :returns: Deferred firing with pyfcm's response dict (see
+            :meth:`pyfcm.baseapi.BaseAPI.parse_responses`), or failing
+            with pyfcm's errors (or a 503
+            :exc:`~autopush.exceptions.RouterException` when too many
+            sends are queued)
+
+        """
+        payload = {
+            "to": registration_id,
+            "android": {"priority": FCMNotification.FCM_HIGH_PRIORITY},
+        }
+        if collapse_key:
+            payload["collapse_key"] = collapse_key
+        if time_to_live:
+            payload["time_to_live"] = int(time_to_live)
+        if dry_run:
+            payload["dry_run"] = True
+        if data_message:
+            payload["data"] = data_message
+        if len(self._semaphore.waiting) >= self._max_queue:
+            if self.metrics:
+                self.metrics.increment("notification.bridge.fcm.queue.full")
+            return fail(RouterException(
+                "Too many FCM requests, increase queue from {}".format(
+                    self._max_queue),
+                status_code=503,
+                response_body="FCM busy, please retry",
+                log_exception=False,
+                local=True))
+        d = self._semaphore.run(self._request, json.dumps(payload))
+        d.addTimeout(self._timeout, self._reactor)
+        return d
+
+    def _request(self, body):
+        headers = Headers({
+            "Content-Type": ["application/json"],
+            "Authorization": ["key=" + self._api_key],
+        })
+        d = self._agent.request(
+            "POST",
+            self._endpoint,
+            headers,
+            FileBodyProducer(StringIO(body)),
+        )
+        d.addCallback(self._read_response)
+        return d
+
+    def _read_response(self, response):
+        d = readBody(response)
+        d.addCallback(self._parse_response, response.code)
+        return d
+
+    def _parse_response(self, content, code):
+        if code == 401:
+            raise AuthenticationError(
+                "There was an error authenticating the sender account")
+        if code == 400:
+            raise InternalPackageError(content)
+        if code != 200:
+            raise FCMServerError("FCM server is temporarily unavailable")
+        try:
+            reply = json.loads(content)
+        except ValueError:
+            raise FCMServerError("FCM server returned an invalid response")
+        multicast_id = reply.get("multicast_id")
+        return {
+            "multicast_ids": [multicast_id] if multicast_id else [],
+            "success": reply.get("success", 0),
+            "failure": reply.get("failure", 0),
+            "canonical_ids": reply.get("canonical_ids", 0),
+            "results": reply.get("results", []),
+            "topic_message_id": None,
+        }
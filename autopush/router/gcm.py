@@ -2,13 +2,25 @@
 from typing import Any  # noqa
 
 from requests.exceptions import ConnectionError, Timeout
+from twisted.internet.defer import (
+    DeferredSemaphore,
+    TimeoutError,
+    maybeDeferred,
+)
+from twisted.internet.error import ConnectError
 from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
+from twisted.web.client import (
+    RequestTransmissionFailed,
+    ResponseFailed,
+    ResponseNeverReceived,
+)
 
 from autopush.exceptions import RouterException
 from autopush.metrics import make_tags
 from autopush.router import gcmclient
 from autopush.router.interface import RouterResponse
+from autopush.router.limiter import bridge_limiter
 from autopush.types import JSONDict  # noqa
 
 
@@ -28,16 +40,32 @@ class GCMRouter(object):
         self.dryRun = router_conf.get("dryrun", False)
         self.collapseKey = router_conf.get("collapseKey")
         timeout = router_conf.get("timeout", 10)
+        self.use_async = router_conf.get("async", False)
+        if self.use_async:
+            # Shared by all the SenderIDs' clients
+            max_connections = router_conf.get("max_connections", 50)
+            agent = gcmclient.pooled_agent(max_connections, timeout)
+            semaphore = DeferredSemaphore(max_connections)
+        self._base_tags = ["platform:gcm"]
         self.gcm = {}
         self.senderIDs = {}
+        self.limiters = {}
         # Flatten the SenderID list from human readable and init gcmclient
         if not router_conf.get("senderIDs"):
             raise IOError("SenderIDs not configured.")
         for sid in router_conf.get("senderIDs"):
             auth = router_conf.get("senderIDs").get(sid).get("auth")
             self.senderIDs[sid] = auth
-            self.gcm[sid] = gcmclient.GCM(auth, timeout=timeout)
-        self._base_tags = ["platform:gcm"]
+            if self.use_async:
+                self.gcm[sid] = gcmclient.AsyncGCM(
+                    auth, metrics=metrics, agent=agent, semaphore=semaphore,
+                    timeout=timeout)
+            else:
+                self.gcm[sid] = gcmclient.GCM(auth, timeout=timeout)
+            limiter = bridge_limiter(conf, metrics,
+                                     make_tags(self._base_tags, senderid=sid))
+            if limiter:
+                self.limiters[sid] = limiter
         self.log.debug("Starting GCM router...")
 
     def amend_endpoint_response(self, response, router_data):
@@ -68,12 +96,22 @@ class GCMRouter(object):
 
     def route_notification(self, notification, uaid_data):
         """Start the GCM notification routing, returns a deferred"""
+        creds = uaid_data["router_data"].get("creds", {})
+        limiter = self.limiters.get(creds.get("senderID"))
+        if limiter:
+            return limiter.run(self._send, notification, uaid_data)
+        return self._send(notification, uaid_data)
+
+    def _send(self, notification, uaid_data):
+        """Route the notification, returns a deferred"""
+        if self.use_async:
+            return maybeDeferred(self._route_async, notification, uaid_data)
         # Kick the entire notification routing off to a thread
         return deferToThread(self._route, notification, uaid_data)
 
-    def _route(self, notification, uaid_data):
-        """Blocking GCM call to route the notification"""
-        router_data = uaid_data["router_data"]
+    def _build_payload(self, notification, router_data):
+        """Build the notification's GCM payload, returning it and its
+        TTL"""
         # THIS MUST MATCH THE CHANNELID GENERATED BY THE REGISTRATION SERVICE
         # Currently this value is in hex form.
         data = {"chid": notification.channel_id.hex}
@@ -110,6 +148,12 @@ class GCMRouter(object):
             dry_run=self.dryRun or ("dryrun" in router_data),
             data=data,
         )
+        return payload, router_ttl
+
+    def _route(self, notification, uaid_data):
+        """Blocking GCM call to route the notification"""
+        router_data = uaid_data["router_data"]
+        payload, router_ttl = self._build_payload(notification, router_data)
         try:
             gcm = self.gcm[router_data['creds']['senderID']]
             result = gcm.send(payload)
@@ -125,28 +169,59 @@ class GCMRouter(object):
                                   errno=901)
         except ConnectionError as e:
             self.log.warn("GCM Unavailable: %s" % e)
-            self.metrics.increment("notification.bridge.error",
-                                   tags=make_tags(
-                                       self._base_tags,
-                                       reason="connection_unavailable"))
-            raise RouterException("Server error", status_code=502,
-                                  errno=902,
-                                  log_exception=False)
+            raise self._unavailable("connection_unavailable")
         except Timeout as e:
             self.log.warn("GCM Timeout: %s" % e)
-            self.metrics.increment("notification.bridge.error",
-                                   tags=make_tags(
-                                       self._base_tags,
-                                       reason="timeout"))
-            raise RouterException("Server error", status_code=502,
-                                  errno=902,
-                                  log_exception=False)
+            raise self._unavailable("timeout")
         except Exception as e:
             self.log.error("Unhandled exception in GCM Routing: %s" % e)
             raise RouterException("Server error", status_code=500)
         return self._process_reply(result, uaid_data, ttl=router_ttl,
                                    notification=notification)
 
+    def _route_async(self, notification, uaid_data):
+        """Route the notification on the reactor"""
+        router_data = uaid_data["router_data"]
+        payload, router_ttl = self._build_payload(notification, router_data)
+        try:
+            gcm = self.gcm[router_data['creds']['senderID']]
+        except KeyError:
+            self.log.critical("Missing GCM bridge credentials")
+            raise RouterException("Server error", status_code=500,
+                                  errno=900)
+        d = gcm.send(payload)
+        d.addCallbacks(self._process_reply, self._send_failed,
+                       callbackArgs=(uaid_data,),
+                       callbackKeywords=dict(ttl=router_ttl,
+                                             notification=notification))
+        return d
+
+    def _send_failed(self, fail):
+        """Convert an AsyncGCM send failure to a RouterException"""
+        if fail.check(RouterException):
+            return fail
+        if fail.check(gcmclient.GCMAuthenticationError):
+            self.log.error("GCM Authentication Error: %s" % fail.value)
+            raise RouterException("Server error", status_code=500,
+                                  errno=901)
+        if fail.check(ConnectError, RequestTransmissionFailed,
+                      ResponseFailed, ResponseNeverReceived):
+            self.log.warn("GCM Unavailable: %s" % fail.value)
+            raise self._unavailable("connection_unavailable")
+        if fail.check(TimeoutError):
+            self.log.warn("GCM Timeout: %s" % fail.value)
+            raise self._unavailable("timeout")
+        self.log.error("Unhandled exception in GCM Routing: %s" % fail.value)
+        raise RouterException("Server error", status_code=500)
+
+    def _unavailable(self, reason):
+        """Record GCM's unavailability, returning the RouterException"""
+        self.metrics.increment("notification.bridge.error",
+                               tags=make_tags(self._base_tags,
+                                              reason=reason))
+        return RouterException("Server error", status_code=502, errno=902,
+                               log_exception=False)
+
     def _error(self, err, status, **kwargs):
         """Error handler that raises the RouterException"""
         self.log.debug(err, **kwargs)
@@ -207,6 +282,9 @@ class GCMRouter(object):
                                        reply.retry_after
                                   ),
                                   log_exception=False)
+        if reply.retry_message:
+            self.log.warn("GCM server error")
+            raise self._unavailable("server_error")
 
         self.metrics.increment("notification.bridge.sent",
                                tags=self._base_tags)
@@ -1,9 +1,22 @@
 import json
+from StringIO import StringIO
 
 import requests
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore, fail
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    readBody,
+)
+from twisted.web.http_headers import Headers
 
 from autopush.exceptions import RouterException
 
+# Sends awaiting a free request slot, per AsyncGCM semaphore
+GCM_MAX_QUEUE = 1000
+
 
 class GCMAuthenticationError(Exception):
     pass
@@ -121,7 +134,9 @@ class GCM(object):
         :type options: dict
 
         """
-        self._endpoint = "https://{}".format(endpoint)
+        if "://" not in endpoint:
+            endpoint = "https://{}".format(endpoint)
+        self._endpoint = endpoint
         self._api_key = api_key
         self.metrics = metrics
         self.log = logger
@@ -136,18 +151,22 @@ class GCM(object):
         :return: Result
 
         """
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'key={}'.format(self._api_key),
-        }
-
         response = self._sender(
             url=self._endpoint,
-            headers=headers,
+            headers=self._headers(),
             data=json.dumps(payload.payload),
             **self._options
         )
+        return self._process(payload, response)
+
+    def _headers(self):
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': 'key={}'.format(self._api_key),
+        }
 
+    def _process(self, payload, response):
+        """Convert the GCM response into a Result (or exception)"""
         if response.status_code in (400, 404):
             raise RouterException(response.content)
 
@@ -156,3 +175,143 @@ class GCM(object):
 
         if response.status_code == 200 or (500 <= response.status_code <= 599):
             return Result(payload, response)
+
+
+class AgentResponse(object):
+    """The parts of a :class:`requests.Response` read by :class:`Result`,
+    from a Twisted Agent's response"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+def pooled_agent(max_connections=50, connect_timeout=10, reactor=reactor):
+    """Create an Agent keeping up to max_connections persistent
+    connections per host
+
+    """
+    from autopush.http import QuietClientFactory
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = max_connections
+    pool._factory = QuietClientFactory
+    return Agent(reactor, connectTimeout=connect_timeout, pool=pool)
+
+
+class AsyncGCM(GCM):
+    """GCM service handler sending on the reactor
+
+    :meth:`send` returns a Deferred firing with the :class:`Result`. Sends
+    are made via a (typically persistent) connection pool's Agent with at
+    most max_concurrent requests in flight, up to max_queue more queued.
+    Sends beyond that fail immediately with a 503 :exc:`RouterException`.
+    The timeout includes the time spent queued.
+
+    After GCM responds with a ``Retry-After`` header no further requests
+    are made until it has elapsed: sends meanwhile immediately result in a
+    retry with the remaining delay.
+
+    """
+
+    def __init__(self,
+                 api_key=None,
+                 logger=None,
+                 metrics=None,
+                 endpoint="gcm-http.googleapis.com/gcm/send",
+                 agent=None,
+                 max_concurrent=50,
+                 timeout=10,
+                 max_queue=GCM_MAX_QUEUE,
+                 semaphore=None,
+                 reactor=reactor):
+        """Initialize the GCM primitive.
+
+        :param agent: Agent for sending requests (defaults to a
+            :func:`pooled_agent`)
+        :type agent: twisted.web.client.Agent
+        :param max_concurrent: Maximum requests in flight
+        :type max_concurrent: int
+        :param timeout: Seconds to wait for a response
+        :type timeout: float
+        :param max_queue: Maximum sends awaiting a request slot
+        :type max_queue: int
+        :param semaphore: Limits the requests in flight (defaults to a new
+            one for max_concurrent), may be shared between clients
+        :type semaphore: twisted.internet.defer.DeferredSemaphore
+
+        See :class:`GCM` for the remaining parameters.
+
+        """
+        GCM.__init__(self, api_key, logger, metrics, endpoint)
+        self._agent = agent or pooled_agent(max_concurrent, timeout,
+                                            reactor=reactor)
+        self._semaphore = semaphore or DeferredSemaphore(max_concurrent)
+        self._max_queue = max_queue
+        self._timeout = timeout
+        self._reactor = reactor
+        self._retry_until = 0
+
+    def send(self, payload):
+        """Send a payload to GCM
+
+        :param payload: Dictionary of GCM formatted data
+        :type payload: JSONMessage
+        :return: Deferred firing with a Result
+
+        """
+        backoff = int(round(self._retry_until - self._reactor.seconds()))
+        if backoff > 0:
+            # Waiting out GCM's Retry-After: GCM never sees this one
+            if self.metrics:
+                self.metrics.increment("notification.bridge.gcm.backoff")
+            return fail(RouterException(
+                "GCM failure to deliver, retry",
+                status_code=503,
+                headers={"Retry-After": str(backoff)},
+                response_body="Please try request in {} seconds.".format(
+                    backoff),
+                log_exception=False,
+                local=True))
+        if len(self._semaphore.waiting) >= self._max_queue:
+            if self.metrics:
+                self.metrics.increment("notification.bridge.gcm.queue.full")
+            return fail(RouterException(
+                "Too many GCM requests, increase queue from {}".format(
+                    self._max_queue),
+                status_code=503,
+                response_body="GCM busy, please retry",
+                log_exception=False,
+                local=True))
+        d = self._semaphore.run(self._request, payload)
+        d.addTimeout(self._timeout, self._reactor)
+        return d
+
+    def _request(self, payload):
+        headers = Headers({k: [v] for k, v in self._headers().items()})
+        d = self._agent.request(
+            "POST",
+            self._endpoint,
+            headers,
+            FileBodyProducer(StringIO(json.dumps(payload.payload))),
+        )
+        d.addCallback(self._read_response)
+        d.addCallback(self._check_response, payload)
+        return d
+
+    def _read_response(self, response):
+        d = readBody(response)
+        d.addCallback(lambda content: AgentResponse(
+            response.code,
+            {k: v[-1] for k, v in response.headers.getAllRawHeaders()},
+            content,
+        ))
+        return d
+
+    def _check_response(self, response, payload):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            self._retry_until = max(self._retry_until,
+                                    self._reactor.seconds() +
+                                    int(retry_after))
+        return self._process(payload, response)
@@ -0,0 +1,210 @@
+"""Adaptive concurrency limiting and circuit breaking for bridges
+
+A degraded bridge (GCM/FCM/APNs) slows every request routed through it,
+which otherwise holds a thread (or a pooled connection) per request for
+its duration and can starve the rest of the node. Each of a bridge's
+credentials (senderID or release channel) gets its own
+:class:`BridgeLimiter` so one failing credential doesn't limit the
+others.
+
+"""
+import math
+from typing import Any, Callable, List, Optional  # noqa
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail, maybeDeferred  # noqa
+from twisted.python.failure import Failure
+
+from autopush.config import AutopushConfig  # noqa
+from autopush.exceptions import RouterException
+from autopush.metrics import IMetrics, make_tags  # noqa
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def rejected_locally(result):
+    # type: (Any) -> bool
+    """Whether a routing result is the node's own rejection
+
+    Bridge clients reject requests they lack the capacity to send (e.g.
+    a full queue or connection pool) with a ``local`` 503
+    :exc:`RouterException`: the bridge never saw those.
+
+    """
+    return (isinstance(result, Failure) and
+            result.check(RouterException) is not None and
+            result.value.extra.get("local", False))
+
+
+def bridge_failed(result):
+    # type: (Any) -> bool
+    """Whether a routing result indicates the bridge itself failing
+
+    Server errors (e.g. the bridge's timeouts, 5xx responses or
+    connection errors) count, the bridge rejecting the notification
+    itself (a 4xx ``bridge_status``, e.g. for a bad token) or the node
+    rejecting it locally doesn't.
+
+    """
+    if not isinstance(result, Failure):
+        return False
+    if not result.check(RouterException):
+        return True
+    exc = result.value
+    return (exc.status_code >= 500 and
+            not exc.extra.get("local", False) and
+            exc.extra.get("bridge_status", 500) >= 500)
+
+
+class BridgeLimiter(object):
+    """Adaptive concurrency limit and circuit breaker for a bridge
+
+    At most ``limit`` requests are routed at once, the rest are rejected
+    immediately with a 503. The limit adapts to the bridge (AIMD): it
+    grows by one per limit's worth of timely responses while in use,
+    and shrinks by ``backoff`` whenever a response takes longer than
+    ``target_latency`` seconds or the bridge fails.
+
+    After ``failure_threshold`` consecutive failures the circuit opens:
+    every request is rejected (with a Retry-After) for ``reset_timeout``
+    seconds, then a single trial request is let through, closing the
+    circuit again if it succeeds.
+
+    """
+    def __init__(self,
+                 max_limit,               # type: int
+                 metrics,                 # type: IMetrics
+                 tags=None,               # type: Optional[List[str]]
+                 target_latency=1.0,      # type: float
+                 failure_threshold=5,     # type: int
+                 reset_timeout=30,        # type: float
+                 min_limit=1,             # type: int
+                 backoff=0.9,             # type: float
+                 clock=reactor,
+                 ):
+        # type: (...) -> None
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(max_limit)
+        self.metrics = metrics
+        self.tags = tags or []
+        self.target_latency = target_latency
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.backoff = backoff
+        self.clock = clock
+        self.in_flight = 0
+        self.failures = 0
+        self.state = CLOSED
+        self._opened_at = 0.0
+
+    def run(self, f, *args, **kwargs):
+        # type: (Callable[..., Any], *Any, **Any) -> Deferred
+        """Route via f(*args, **kwargs) if the limit allows
+
+        Fails with a 503 :exc:`RouterException` if it doesn't.
+
+        """
+        rejection = self._admit()
+        if rejection:
+            return fail(rejection)
+        self.in_flight += 1
+        started = self.clock.seconds()
+        d = maybeDeferred(f, *args, **kwargs)
+        d.addBoth(self._release, started)
+        return d
+
+    def _admit(self):
+        # type: () -> Optional[RouterException]
+        if self.state == OPEN:
+            remaining = self._opened_at + self.reset_timeout - \
+                self.clock.seconds()
+            if remaining > 0:
+                return self._reject("circuit_open", remaining)
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN and self.in_flight:
+            # Only the trial request until it succeeds
+            return self._reject("circuit_open", 1)
+        if self.in_flight >= int(self.limit):
+            return self._reject("limit", 1)
+        return None
+
+    def _reject(self, reason, retry_after):
+        # type: (str, float) -> RouterException
+        self.metrics.increment("notification.bridge.rejected",
+                               tags=make_tags(self.tags, reason=reason))
+        retry_after = int(math.ceil(retry_after))
+        return RouterException(
+            "Bridge unavailable, retry",
+            status_code=503,
+            errno=201,
+            headers={"Retry-After": str(retry_after)},
+            response_body="Please try request in {} seconds.".format(
+                retry_after),
+            log_exception=False,
+            local=True,
+        )
+
+    def _release(self, result, started):
+        self.in_flight -= 1
+        if rejected_locally(result):
+            # Says nothing of the bridge's health (or latency)
+            return result
+        if bridge_failed(result):
+            self._failed()
+        else:
+            self._succeeded(self.clock.seconds() - started)
+        return result
+
+    def _succeeded(self, latency):
+        # type: (float) -> None
+        self.failures = 0
+        if self.state == HALF_OPEN:
+            self._transition(CLOSED)
+        if latency > self.target_latency:
+            self._set_limit(self.limit * self.backoff)
+        elif (self.in_flight + 1) * 2 >= self.limit:
+            # Only grow a limit that's actually in use
+            self._set_limit(self.limit + 1 / self.limit)
+
+    def _failed(self):
+        self.failures += 1
+        self._set_limit(self.limit * self.backoff)
+        if self.state == HALF_OPEN or (
+                self.state == CLOSED and
+                self.failures >= self.failure_threshold):
+            self._opened_at = self.clock.seconds()
+            self._transition(OPEN)
+
+    def _set_limit(self, limit):
+        # type: (float) -> None
+        previous = int(self.limit)
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+        if int(self.limit) != previous:
+            self.metrics.gauge("notification.bridge.limit", int(self.limit),
+                               tags=self.tags)
+
+    def _transition(self, state):
+        # type: (str) -> None
+        self.state = state
+        self.metrics.increment("notification.bridge.circuit",
+                               tags=make_tags(self.tags, state=state))
+        self.metrics.gauge("notification.bridge.circuit_open",
+                           int(state == OPEN), tags=self.tags)
+
+
+def bridge_limiter(conf, metrics, tags):
+    # type: (AutopushConfig, IMetrics, List[str]) -> Optional[BridgeLimiter]
+    """Create a BridgeLimiter per the conf (None when disabled)"""
+    if not conf.bridge_max_concurrency:
+        return None
+    return BridgeLimiter(
+        conf.bridge_max_concurrency,
+        metrics,
+        tags,
+        target_latency=conf.bridge_target_latency,
+        failure_threshold=conf.bridge_failure_threshold,
+        reset_timeout=conf.bridge_reset_timeout,
+    )
@@ -5,15 +5,17 @@ node, or stores each individual message, along with its data, in a Message
 table for retrieval by the client.
 
 """
-import json
 import time
 from StringIO import StringIO
-from typing import Any  # noqa
+from typing import Any, Dict, List, Optional, Tuple  # noqa
 
+from attr import attrs, attrib
 from botocore.exceptions import ClientError
+from twisted.internet import reactor
 from twisted.internet.threads import deferToThread
-from twisted.web.client import FileBodyProducer
+from twisted.web.client import FileBodyProducer, readBody
 from twisted.internet.defer import (
+    Deferred,
     inlineCallbacks,
     returnValue,
     CancelledError,
@@ -27,8 +29,10 @@ from twisted.logger import Logger
 from twisted.web._newclient import ResponseFailed
 from twisted.web.http import PotentialDataLoss
 
+from autopush import jsoncodec
 from autopush.exceptions import ItemNotFound, RouterException
 from autopush.metrics import make_tags
+from autopush.node_transport import NodeTransport  # noqa
 from autopush.protocol import IgnoreBody
 from autopush.router.interface import RouterResponse
 from autopush.types import JSONDict  # noqa
@@ -36,6 +40,110 @@ from autopush.types import JSONDict  # noqa
 TTL_URL = "https://webpush-wg.github.io/webpush-protocol/#rfc.section.6.2"
 
 
+@attrs(slots=True)
+class BatchedResponse(object):
+    """The status of one notification delivered within a batch"""
+    code = attrib()  # type: int
+
+
+class BatchResponseError(Exception):
+    """A node's push_batch response couldn't be read"""
+
+
+class NotificationBatcher(object):
+    """Coalesces notifications bound for the same connection node
+
+    Notifications queued for a node within ``delay`` seconds of the first
+    are sent to it as one ``PUT /push_batch`` request (or sooner, once
+    ``max_size`` are queued). Each notification's Deferred fires with a
+    :class:`BatchedResponse`, or with None if the node doesn't support
+    batches (the caller should fall back to sending it individually). It
+    fails with a :exc:`BatchResponseError` if the node's response is
+    malformed.
+
+    """
+    log = Logger()
+
+    def __init__(self, agent, metrics, delay, max_size=100, clock=reactor):
+        self.agent = agent
+        self.metrics = metrics
+        self.delay = delay
+        self.max_size = max_size
+        self.clock = clock
+        # node_id -> [(uaid, payload, Deferred), ...]
+        self._pending = {}  # type: Dict[str, List[Tuple[str, Dict, Deferred]]]
+        self._timers = {}  # type: Dict[str, Any]
+
+    def send(self, uaid, node_id, payload):
+        # type: (str, str, Dict) -> Deferred
+        """Queue a serialized notification for delivery to node_id"""
+        d = Deferred()
+        batch = self._pending.setdefault(node_id, [])
+        batch.append((uaid, payload, d))
+        if len(batch) >= self.max_size:
+            self.flush(node_id)
+        elif node_id not in self._timers:
+            self._timers[node_id] = self.clock.callLater(
+                self.delay, self.flush, node_id)
+        return d
+
+    def flush(self, node_id):
+        # type: (str) -> None
+        """Send any notifications queued for node_id"""
+        timer = self._timers.pop(node_id, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        batch = self._pending.pop(node_id, None)
+        if not batch:
+            return
+        self.metrics.increment("updates.batch.sent")
+        self.metrics.increment("updates.batch.notifications", len(batch))
+        body = jsoncodec.dumps([dict(uaid=uaid, notification=payload)
+                                for uaid, payload, _ in batch])
+        url = node_id + "/push_batch"
+        d = self.agent.request(
+            "PUT",
+            url.encode("utf8"),
+            bodyProducer=FileBodyProducer(StringIO(body)),
+        )
+        d.addCallback(self._read_results)
+        d.addCallbacks(self._deliver_results, self._deliver_failure,
+                       callbackArgs=(batch,), errbackArgs=(batch,))
+
+    def _read_results(self, response):
+        if response.code != 200:
+            # Likely a node predating batch support
+            return IgnoreBody.ignore(response).addCallback(lambda _: None)
+        return readBody(response).addCallback(self._parse_results)
+
+    def _parse_results(self, body):
+        # type: (str) -> List[int]
+        try:
+            results = jsoncodec.loads(body)["results"]
+        except (ValueError, KeyError, TypeError) as ex:
+            self.metrics.increment("updates.batch.invalid")
+            raise BatchResponseError("Invalid push_batch response: "
+                                     "{}".format(ex))
+        if not isinstance(results, list):
+            self.metrics.increment("updates.batch.invalid")
+            raise BatchResponseError("Invalid push_batch results")
+        return results
+
+    def _deliver_results(self, results, batch):
+        # type: (Optional[List[int]], List[Tuple[str, Dict, Deferred]]) -> None
+        if results is None or len(results) != len(batch):
+            self.metrics.increment("updates.batch.unsupported")
+            for _, _, d in batch:
+                d.callback(None)
+            return
+        for (_, _, d), code in zip(batch, results):
+            d.callback(BatchedResponse(code))
+
+    def _deliver_failure(self, fail, batch):
+        for _, _, d in batch:
+            d.errback(fail)
+
+
 class WebPushRouter(object):
     """Implements :class: `autopush.router.interface.IRouter` for internal
     routing to an autopush node
@@ -43,12 +151,18 @@ class WebPushRouter(object):
     """
     log = Logger()
 
-    def __init__(self, conf, router_conf, db, agent):
+    def __init__(self, conf, router_conf, db, agent, node_transport=None):
         """Create a new Router"""
         self.conf = conf
         self.router_conf = router_conf
         self.db = db
         self.agent = agent
+        self.node_transport = node_transport  # type: Optional[NodeTransport]
+        self.batcher = None  # type: Optional[NotificationBatcher]
+        if conf.push_batch_delay > 0:
+            self.batcher = NotificationBatcher(
+                agent, db.metrics, conf.push_batch_delay,
+                max_size=conf.push_batch_size)
 
     @property
     def metrics(self):
@@ -119,8 +233,10 @@ class WebPushRouter(object):
         #   - Success (no node): Done, return 202
         #   - Error (db error): Done, return 202
         #   - Error (no client) : Done, return 404
+        # This lookup must see the latest node state, so skip any cached
+        # router record (a fresh one is cached in its place).
         try:
-            uaid_data = yield deferToThread(router.get_uaid, uaid)
+            uaid_data = yield router.get_uaid_async(uaid, use_cache=False)
         except ClientError:
             returnValue(self.stored_response(notification))
         except ItemNotFound:
@@ -187,17 +303,45 @@ class WebPushRouter(object):
         """
         payload = notification.serialize()
         payload["timestamp"] = int(time.time())
+        if self.conf.preencode_frames:
+            # Encoded once here rather than by the connection node
+            payload["frame"] = jsoncodec.dumps(
+                notification.websocket_format())
+        if self.node_transport:
+            return self.node_transport.push(node_id, uaid, payload)
+        if self.batcher:
+            d = self.batcher.send(uaid, node_id, payload)
+            d.addCallback(self._check_batched, uaid, node_id, payload)
+            d.addErrback(self._batch_failed)
+            return d
+        return self._send_payload(uaid, node_id, payload)
+
+    def _check_batched(self, result, uaid, node_id, payload):
+        """Send the payload individually if the node couldn't batch it"""
+        if result is None:
+            return self._send_payload(uaid, node_id, payload)
+        return result
+
+    def _batch_failed(self, fail):
+        """Store the notification if its batch's results were unreadable"""
+        fail.trap(BatchResponseError)
+        self.log.debug("Could not route message: {exc}", exc=fail.value)
+        return None
+
+    def _send_payload(self, uaid, node_id, payload):
         url = node_id + "/push/" + uaid
         request = self.agent.request(
             "PUT",
             url.encode("utf8"),
-            bodyProducer=FileBodyProducer(StringIO(json.dumps(payload))),
+            bodyProducer=FileBodyProducer(StringIO(jsoncodec.dumps(payload))),
         )
         request.addCallback(IgnoreBody.ignore)
         return request
 
     def _send_notification_check(self, uaid, node_id):
         """Send a command to the node to check for notifications"""
+        if self.node_transport:
+            return self.node_transport.notif(node_id, uaid)
         url = node_id + "/notif/" + uaid
         return self.agent.request(
             "PUT",
@@ -233,10 +377,8 @@ class WebPushRouter(object):
                                   headers={"TTL": str(notification.ttl),
                                            "Location": location},
                                   logged_status=204)
-        return deferToThread(
-            self.db.message_table(month_table).store_message,
-            notification=notification,
-        )
+        return self.db.message_table(month_table).store_message_async(
+            notification)
 
     #############################################################
     #                    Error Callbacks
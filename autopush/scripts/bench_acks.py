@@ -0,0 +1,90 @@
+"""Micro-benchmark of a connection's ack bookkeeping
+
+Simulates a client with ``channels`` channels each sent ``backlog``
+stored notifications, then ack'ing them all: as the connection handles
+each ack (checking its direct then stored notifications, whether it was
+the last outstanding, removing it and then whether any remain) with the
+per channel lists previously used vs. :class:`UnackedNotifications`.
+
+"""
+import time
+import uuid
+
+import click
+
+from autopush.utils import WebPushNotification
+from autopush.websocket import UnackedNotifications
+
+
+def make_notifications(channels, backlog):
+    """Return channels * backlog notifications, in the order sent"""
+    uaid = uuid.uuid4()
+    chids = [uuid.uuid4() for _ in range(channels)]
+    return [
+        WebPushNotification(uaid=uaid, channel_id=chid, ttl=60,
+                            message_id=uuid.uuid4().hex)
+        for _ in range(backlog)
+        for chid in chids
+    ]
+
+
+def ack_lists(notifs):
+    """Return the seconds to send and ack notifs with per channel lists"""
+    start = time.time()
+    direct = {}
+    sent = {}
+    for notif in notifs:
+        sent.setdefault(str(notif.channel_id), []).append(notif)
+    for notif in notifs:
+        chid, version = str(notif.channel_id), notif.version
+
+        def ver_filter(n):
+            return n.version == version
+        filter(ver_filter, direct.get(chid, []))
+        msg = filter(ver_filter, sent.get(chid, []))[0]
+        sum(len(s) for s in sent.itervalues()) == 1
+        sent[chid].remove(msg)
+        if not sent[chid]:
+            del sent[chid]
+        any(sent.itervalues())
+    return time.time() - start
+
+
+def ack_indexed(notifs):
+    """Return the seconds to send and ack notifs with
+    UnackedNotifications"""
+    start = time.time()
+    direct = UnackedNotifications()
+    sent = UnackedNotifications()
+    for notif in notifs:
+        sent.add(str(notif.channel_id), notif)
+    for notif in notifs:
+        chid, version = str(notif.channel_id), notif.version
+        direct.get(chid, version)
+        msg = sent.get(chid, version)
+        len(sent) == 1
+        sent.discard(chid, msg)
+        bool(sent)
+    return time.time() - start
+
+
+def run(channels=1000, backlog=10):
+    """Return the per channel lists' and indexed seconds taken"""
+    notifs = make_notifications(channels, backlog)
+    return ack_lists(notifs), ack_indexed(notifs)
+
+
+@click.command()
+@click.option('--channels', default=1000,
+              help="Channels of the client.")
+@click.option('--backlog', default=10,
+              help="Notifications sent (awaiting acks) per channel.")
+def bench_acks(channels, backlog):
+    lists, indexed = run(channels, backlog)
+    count = channels * backlog
+    click.echo("lists:   %.3fs, %.0f acks/s" % (lists, count / lists))
+    click.echo("indexed: %.3fs, %.0f acks/s" % (indexed, count / indexed))
+
+
+if __name__ == '__main__':  # pragma: nocover
+    bench_acks()
@@ -0,0 +1,133 @@
+"""Benchmark of the FCM bridge against a local fake FCM server
+
+Routes ``count`` notifications, ``concurrency`` at a time, through the
+FCMRouter: via pyfcm in the reactor's thread pool and via its async
+(pooled, on the reactor) client. The fake FCM server responds after
+``latency`` seconds.
+
+"""
+import json
+import time
+import uuid
+
+import click
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredList,
+    DeferredSemaphore,
+    inlineCallbacks,
+    returnValue,
+)
+from twisted.internet.task import react
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from autopush.config import AutopushConfig
+from autopush.metrics import SinkMetrics
+from autopush.router.fcm import FCMRouter
+from autopush.utils import WebPushNotification
+
+SENDER_ID = "12345"
+
+
+class FakeFCM(Resource):
+    """A local stand-in for FCM's legacy HTTP API"""
+    isLeaf = True
+
+    def __init__(self, latency=0, clock=reactor):
+        Resource.__init__(self)
+        self.latency = latency
+        self.clock = clock
+        self.requests = []
+
+    def render_POST(self, request):
+        self.requests.append(dict(
+            authorization=request.getHeader("Authorization"),
+            payload=json.loads(request.content.read()),
+        ))
+        body = json.dumps({
+            "multicast_id": len(self.requests),
+            "success": 1,
+            "failure": 0,
+            "canonical_ids": 0,
+            "results": [{"message_id": "0:%d" % len(self.requests)}],
+        })
+        if not self.latency:
+            return body
+        self.clock.callLater(self.latency, self._respond, request, body)
+        return NOT_DONE_YET
+
+    def _respond(self, request, body):
+        request.write(body)
+        request.finish()
+
+
+def make_router(endpoint, use_async=False, max_connections=50):
+    """Create an FCMRouter sending to the endpoint"""
+    conf = AutopushConfig(hostname="localhost", statsd_host=None)
+    return FCMRouter(conf, {
+        "ttl": 60,
+        "senderID": SENDER_ID,
+        "auth": "fake_auth",
+        "endpoint": endpoint,
+        "async": use_async,
+        "max_connections": max_connections,
+    }, SinkMetrics())
+
+
+@inlineCallbacks
+def route(router, count, concurrency):
+    """Route count notifications, returning the seconds taken"""
+    uaid_data = dict(router_data=dict(
+        token="fake_token",
+        creds=dict(senderID=SENDER_ID, auth="fake_auth"),
+    ))
+    notifs = [WebPushNotification(uaid=uuid.uuid4(),
+                                  channel_id=uuid.uuid4(),
+                                  ttl=60)
+              for _ in range(count)]
+    semaphore = DeferredSemaphore(concurrency)
+    start = time.time()
+    yield DeferredList([
+        semaphore.run(router.route_notification, notif, uaid_data)
+        for notif in notifs
+    ], fireOnOneErrback=True, consumeErrors=True)
+    returnValue(time.time() - start)
+
+
+@inlineCallbacks
+def run(count=200, concurrency=50, latency=0.05, reactor=reactor):
+    """Return the threaded and async modes' seconds taken"""
+    port = reactor.listenTCP(0, Site(FakeFCM(latency, reactor)),
+                             interface="127.0.0.1")
+    endpoint = "http://127.0.0.1:%d/fcm/send" % port.getHost().port
+    try:
+        threaded = yield route(make_router(endpoint), count, concurrency)
+        router = make_router(endpoint, use_async=True,
+                             max_connections=concurrency)
+        pooled = yield route(router, count, concurrency)
+        yield router.fcm._agent._pool.closeCachedConnections()
+    finally:
+        yield port.stopListening()
+    returnValue((threaded, pooled))
+
+
+@click.command()
+@click.option('--count', default=200,
+              help="Notifications to route.")
+@click.option('--concurrency', default=50,
+              help="Notifications routed at once.")
+@click.option('--latency', default=0.05,
+              help="Seconds the fake FCM server takes to respond.")
+def bench_fcm(count, concurrency, latency):
+    @inlineCallbacks
+    def main(reactor):
+        threaded, pooled = yield run(count, concurrency, latency, reactor)
+        for name, elapsed in (("threaded", threaded), ("async", pooled)):
+            click.echo("%-8s  %.2fs, %.0f notifications/s" % (
+                name + ":", elapsed, count / elapsed))
+    react(main)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    bench_fcm()
@@ -0,0 +1,116 @@
+"""Benchmark of notification delivery's JSON encoding per codec
+
+Measures the CPU time (so per core) the endpoint takes to serialize
+``count`` notifications for a connection node, and the connection node
+to deliver them to a WebSocket client (then decode the client's ack),
+for each available JSON codec: with the connection node encoding the
+client's message itself (``reencoded``) vs. sending the endpoint's
+pre-encoded ``frame`` (``preencoded``, per ``--preencode_frames``).
+
+"""
+import time
+import uuid
+
+import click
+from typing import Dict, List, Optional, Tuple  # noqa
+
+from autopush import jsoncodec
+from autopush.utils import WebPushNotification
+
+ACK = '{"messageType": "ack", "updates": [{"channelID": "%s", ' \
+      '"version": "%s"}]}'
+
+
+def make_notifications(count, data_length=2048):
+    # type: (int, int) -> List[WebPushNotification]
+    """Create count notifications carrying data_length bytes of data"""
+    uaid = uuid.uuid4()
+    return [
+        WebPushNotification(
+            uaid=uaid,
+            channel_id=uuid.uuid4(),
+            ttl=60,
+            data="A" * data_length if data_length else None,
+            headers=dict(encoding="aes128gcm") if data_length else None,
+            message_id="gAAAAABb" + uuid.uuid4().hex * 4,
+            update_id=None,
+        )
+        for _ in range(count)
+    ]
+
+
+def serialize(notif, preencode):
+    # type: (WebPushNotification, bool) -> str
+    """Serialize notif as the endpoint's WebPushRouter would"""
+    payload = notif.serialize()
+    payload["timestamp"] = int(time.time())
+    if preencode:
+        payload["frame"] = jsoncodec.dumps(notif.websocket_format())
+    return jsoncodec.dumps(payload)
+
+
+def deliver(uaid, body, ack):
+    # type: (uuid.UUID, str, str) -> str
+    """Deliver a serialized notification as the connection node would
+
+    Returns the client's message.
+
+    """
+    update = jsoncodec.loads(body)
+    notif = WebPushNotification.from_serialized(uaid, update)
+    frame = update.get("frame")
+    if frame:
+        message = frame.encode('utf8')
+    else:
+        message = jsoncodec.dumps(notif.websocket_format())
+    jsoncodec.loads(ack)
+    return message
+
+
+def bench(notifs, preencode):
+    # type: (List[WebPushNotification], bool) -> Tuple[float, float]
+    """Return the endpoint's and connection node's CPU seconds taken"""
+    acks = [ACK % (notif.channel_id, notif.version) for notif in notifs]
+    start = time.clock()
+    bodies = [serialize(notif, preencode) for notif in notifs]
+    endpoint = time.clock() - start
+    start = time.clock()
+    for notif, body, ack in zip(notifs, bodies, acks):
+        deliver(notif.uaid, body, ack)
+    return endpoint, time.clock() - start
+
+
+def run(count=20000, data_length=2048, codecs=None):
+    # type: (int, int, Optional[List[str]]) -> Dict[Tuple[str, str], Tuple[float, float]]  # noqa
+    """Return the endpoint's and connection node's notifications/s (per
+    core) for each codec and mode"""
+    notifs = make_notifications(count, data_length)
+    previous = jsoncodec.codec
+    results = {}
+    try:
+        for name in codecs or sorted(jsoncodec.CODECS):
+            jsoncodec.select(name)
+            for mode, preencode in (("reencoded", False),
+                                    ("preencoded", True)):
+                endpoint, node = bench(notifs, preencode)
+                results[name, mode] = (count / endpoint, count / node)
+    finally:
+        jsoncodec.codec = previous
+    return results
+
+
+@click.command()
+@click.option('--count', default=20000,
+              help="Notifications to deliver.")
+@click.option('--data_length', default=2048,
+              help="Bytes of (encrypted, base64) data per notification.")
+def bench_json(count, data_length):
+    results = run(count, data_length)
+    click.echo("%-10s  %-10s  %10s  %10s  (notifications/s per core)" % (
+        "codec", "mode", "endpoint", "connection"))
+    for (name, mode), rates in sorted(results.items()):
+        click.echo("%-10s  %-10s  %10.0f  %10.0f" % ((name, mode) + rates))
+
+
+if __name__ == '__main__':  # pragma: nocover
+    bench_json()
@@ -0,0 +1,68 @@
+"""Micro-benchmark of message-id generation and parsing
+
+Compares the Fernet and compact message-id formats: the cost of generating
+a message-id for each incoming notification, of parsing one back (as
+``DELETE /m/`` does) and the resulting Location header size.
+
+"""
+import time
+import uuid
+
+import click
+from cryptography.fernet import Fernet
+
+from autopush.utils import KeyIdFernet, WebPushNotification
+
+
+def notifications(count, topic_every=10):
+    """Return count notifications, every topic_every'th with a topic"""
+    return [
+        WebPushNotification(
+            uaid=uuid.uuid4(),
+            channel_id=uuid.uuid4(),
+            ttl=60,
+            topic="topic%d" % i if topic_every and not i % topic_every
+            else None,
+        )
+        for i in range(count)
+    ]
+
+
+def message_id_time(notifs, fernet, compact=False):
+    """Return the mean seconds to generate then parse a message-id, and
+    the mean message-id length"""
+    start = time.time()
+    message_ids = [notif.generate_message_id(fernet, compact=compact)
+                   for notif in notifs]
+    for message_id in message_ids:
+        WebPushNotification.from_message_id(message_id, fernet)
+    elapsed = (time.time() - start) / len(notifs)
+    return elapsed, sum(map(len, message_ids)) / float(len(message_ids))
+
+
+def run(count=20000, keys=2):
+    """Return the Fernet and compact formats' (seconds, length)"""
+    fernet = KeyIdFernet([Fernet.generate_key() for _ in range(keys)])
+    notifs = notifications(count)
+    return (message_id_time(notifs, fernet),
+            message_id_time(notifs, fernet, compact=True))
+
+
+@click.command()
+@click.option('--count', default=20000,
+              help="Message-ids to generate and parse.")
+@click.option('--keys', default=2,
+              help="Configured crypto keys.")
+def bench_message_id(count, keys):
+    (fernet_time, fernet_len), (compact_time, compact_len) = run(count, keys)
+    click.echo("fernet:  %.1f us per message-id, %d bytes" % (
+        fernet_time * 1e6, fernet_len))
+    click.echo("compact: %.1f us per message-id, %d bytes" % (
+        compact_time * 1e6, compact_len))
+    click.echo("saved:   %.0f%% CPU, %.0f%% Location header size" % (
+        100 * (1 - compact_time / fernet_time),
+        100 * (1 - compact_len / fernet_len)))
+
+
+if __name__ == '__main__':  # pragma: nocover
+    bench_message_id()
@@ -0,0 +1,76 @@
+"""Micro-benchmark of the memory held by connections' metric tags
+
+Simulates ``connects`` connections' state (:class:`PushState`) built from
+a pool of ``agents`` distinct User-Agents, comparing the bytes of their
+base tags when each connection keeps its own list of tag strings (as
+previously) vs. the :func:`~autopush.metrics.shared_tags` tuples they
+hold now. Also compares a connection's per call cost of copying those
+tags into a new list vs. passing them as is.
+
+"""
+import random
+import sys
+import time
+
+import click
+
+from autopush.scripts.bench_user_agent import _DB, _Request, user_agents
+from autopush.websocket import PushState
+
+
+def tags_size(tag_sets):
+    """Return the bytes of the distinct sequences and tags of tag_sets"""
+    seen = set()
+    total = 0
+    for tags in tag_sets:
+        for obj in [tags] + list(tags):
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+    return total
+
+
+def copy_time(tags, calls):
+    """Return the mean seconds to copy tags into a new list per call"""
+    start = time.time()
+    for _ in range(calls):
+        list(tags)
+    return (time.time() - start) / calls
+
+
+def run(connects=20000, agents=50):
+    """Return the per connection bytes of per connection lists and
+    shared tuples"""
+    pool = [_Request(agent) for agent in user_agents(agents)]
+    db = _DB()
+    states = [PushState.from_request(request=random.choice(pool), db=db)
+              for _ in range(connects)]
+    # Each formatted per connection, as before
+    lists = [[":".join(tag.split(":", 1)) for tag in ps._base_tags]
+             for ps in states]
+    shared = [ps._base_tags for ps in states]
+    return (float(tags_size(lists)) / connects,
+            float(tags_size(shared)) / connects)
+
+
+@click.command()
+@click.option('--connects', default=20000,
+              help="Connections to simulate.")
+@click.option('--agents', default=50,
+              help="Distinct User-Agents between the connections.")
+@click.option('--calls', default=100000,
+              help="Metric calls to time copying the tags for.")
+def bench_tags(connects, agents, calls):
+    lists, shared = run(connects, agents)
+    click.echo("lists:  %.0f bytes per connection" % lists)
+    click.echo("shared: %.1f bytes per connection" % shared)
+    click.echo("saved:  %.1f MB per 100k connections" % (
+        (lists - shared) * 100000 / 1e6))
+    tags = PushState.from_request(request=_Request(user_agents(1)[0]),
+                                  db=_DB())._base_tags
+    click.echo("copying the tags: %.2f us per metric call" % (
+        copy_time(tags, calls) * 1e6))
+
+
+if __name__ == '__main__':  # pragma: nocover
+    bench_tags()
@@ -0,0 +1,84 @@
+"""Micro-benchmark of the connection setup cost of parsing User-Agents
+
+Simulates a reconnect storm: ``connects`` new connections' state
+(:class:`PushState`) built from a pool of ``agents`` distinct User-Agents,
+with and without the parsed User-Agent cache.
+
+"""
+import random
+import time
+
+import click
+
+from autopush.cache import TTLCache
+from autopush.metrics import SinkMetrics
+from autopush.websocket import USER_AGENT_CACHE_TTL, PushState
+
+BASE_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:{}.0) Gecko/20100101 "
+    "Firefox/{}.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.13; rv:{}.0) Gecko/20100101 "
+    "Firefox/{}.0",
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:{}.0) Gecko/20100101 "
+    "Firefox/{}.0",
+    "Mozilla/5.0 (Android 8.0.0; Mobile; rv:{}.0) Gecko/{}.0 Firefox/{}.0",
+]
+
+
+class _Request(object):
+    host = "localhost"
+
+    def __init__(self, agent):
+        self.headers = {"user-agent": agent}
+
+
+class _DB(object):
+    current_msg_month = "message"
+
+
+def user_agents(count):
+    """Return count distinct, realistic User-Agents"""
+    return [
+        BASE_AGENTS[i % len(BASE_AGENTS)].replace(
+            "{}", str(40 + i // len(BASE_AGENTS)))
+        for i in range(count)
+    ]
+
+
+def connect_time(requests, ua_cache=None):
+    """Return the mean seconds to build each request's PushState"""
+    db = _DB()
+    start = time.time()
+    for request in requests:
+        PushState.from_request(request=request, db=db, ua_cache=ua_cache)
+    return (time.time() - start) / len(requests)
+
+
+def run(connects=20000, agents=50, cache_size=10000):
+    """Return the mean per connection seconds uncached and cached"""
+    pool = [_Request(agent) for agent in user_agents(agents)]
+    requests = [random.choice(pool) for _ in range(connects)]
+    cache = TTLCache(cache_size, USER_AGENT_CACHE_TTL, metrics=SinkMetrics(),
+                     name="user_agent")
+    return connect_time(requests), connect_time(requests, ua_cache=cache)
+
+
+@click.command()
+@click.option('--connects', default=20000,
+              help="Connections to simulate.")
+@click.option('--agents', default=50,
+              help="Distinct User-Agents between the connections.")
+@click.option('--cache_size', default=10000,
+              help="Parsed User-Agents to cache.")
+def bench_user_agent(connects, agents, cache_size):
+    uncached, cached = run(connects, agents, cache_size)
+    click.echo("uncached: %.1f us per connect" % (uncached * 1e6))
+    click.echo("cached:   %.1f us per connect" % (cached * 1e6))
+    click.echo("saved:    %.1f us per connect (%.0f%%), %.1fs of CPU per "
+               "million reconnects" % ((uncached - cached) * 1e6,
+                                       100 * (1 - cached / uncached),
+                                       (uncached - cached) * 1e6))
+
+
+if __name__ == '__main__':  # pragma: nocover
+    bench_user_agent()
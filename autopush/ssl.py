@@ -53,12 +53,21 @@ MOZILLA_INTERMEDIATE_CIPHERS = (
 )
 
 
+# Protocols offered via ALPN, in order of preference
+ALPN_PROTOCOLS = (b"h2", b"http/1.1")
+
+# ALPN selection of no protocol, proceeding without ALPN (pyOpenSSL
+# 20.0+, earlier versions treat it as selecting an empty protocol)
+NO_OVERLAPPING_PROTOCOLS = getattr(SSL, "NO_OVERLAPPING_PROTOCOLS", b"")
+
+
 class AutopushSSLContextFactory(DefaultOpenSSLContextFactory):
     """A SSL context factory"""
 
     def __init__(self, *args, **kwargs):
         self.dh_file = kwargs.pop('dh_file', None)
         self.require_peer_certs = kwargs.pop('require_peer_certs', False)
+        self.alpn_protocols = kwargs.pop('alpn_protocols', None)
         DefaultOpenSSLContextFactory.__init__(self, *args, **kwargs)
 
     def cacheContext(self):
@@ -80,6 +89,9 @@ class AutopushSSLContextFactory(DefaultOpenSSLContextFactory):
             if self.dh_file:
                 ctx.load_tmp_dh(self.dh_file)
 
+            if self.alpn_protocols:
+                ctx.set_alpn_select_callback(self._select_alpn)
+
             if self.require_peer_certs:
                 # Require peer certs but only for use by
                 # RequestHandlers
@@ -90,6 +102,14 @@ class AutopushSSLContextFactory(DefaultOpenSSLContextFactory):
 
             self._context = ctx
 
+    def _select_alpn(self, conn, offered):
+        """Select our most preferred protocol the client offers"""
+        for proto in self.alpn_protocols:
+            if proto in offered:
+                return proto
+        # Never select a protocol the client didn't offer (RFC 7301)
+        return NO_OVERLAPPING_PROTOCOLS
+
     def _allow_peer(self, conn, cert, errno, depth, preverify_ok):
         # skip verification: we only care about whitelisted signatures
         # on file
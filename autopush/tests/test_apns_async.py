@@ -0,0 +1,454 @@
+import json
+import os
+
+import pytest
+from h2.config import H2Configuration
+from h2.connection import ConnectionState, H2Connection
+from h2.errors import ErrorCodes
+from h2.events import (
+    DataReceived,
+    RequestReceived,
+    StreamEnded,
+    StreamReset,
+)
+from h2.exceptions import NoAvailableStreamIDError
+from h2.settings import SettingCodes
+from mock import Mock, patch
+from twisted.internet.defer import Deferred, TimeoutError, fail, succeed
+from twisted.internet.error import ConnectionLost, ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from autopush.exceptions import RouterException
+from autopush.metrics import SinkMetrics
+from autopush.router.apns_async import (
+    APNSConnectionError,
+    APNSProtocol,
+    AsyncAPNSClient,
+)
+
+
+class FakeAPNs(object):
+    """The server side of an APNSProtocol's connection"""
+
+    def __init__(self, client, max_streams):
+        self.h2 = H2Connection(config=H2Configuration(
+            client_side=False, header_encoding=None))
+        self.h2.initiate_connection()
+        self.h2.update_settings({
+            SettingCodes.MAX_CONCURRENT_STREAMS: max_streams})
+        self.requests = {}
+        self.resets = []
+        self.transport = StringTransport()
+        self.proto = APNSProtocol(client)
+        self.proto.makeConnection(self.transport)
+
+    def pump(self):
+        """Exchange pending data"""
+        while True:
+            for event in self.h2.receive_data(self.transport.value()):
+                if isinstance(event, RequestReceived):
+                    self.requests[event.stream_id] = dict(
+                        headers=dict(event.headers), body=b"")
+                elif isinstance(event, StreamEnded):
+                    self.requests[event.stream_id]["ended"] = True
+                elif isinstance(event, StreamReset):
+                    self.resets.append(event.stream_id)
+                elif isinstance(event, DataReceived):
+                    self.requests[event.stream_id]["body"] += event.data
+            self.transport.clear()
+            data = self.h2.data_to_send()
+            if not data:
+                break
+            self.proto.dataReceived(data)
+
+    def respond(self, stream_id, status=200, body=b""):
+        headers = [(b":status", str(status))]
+        self.h2.send_headers(stream_id, headers, end_stream=not body)
+        if body:
+            self.h2.send_data(stream_id, body, end_stream=True)
+        self.pump()
+
+    def lose(self, reason=ConnectionLost()):
+        self.proto.connectionLost(Failure(reason))
+
+
+class AsyncAPNSClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Mock(spec=SinkMetrics)
+        self.servers = []
+        self.max_streams = 2
+        self.client = self._client()
+
+    def _client(self, **kwargs):
+        client = AsyncAPNSClient(
+            cert_file=None, key_file=None, topic="com.example.SomeApp",
+            metrics=self.metrics, load_connections=False, clock=self.clock,
+            **kwargs)
+        client._connect = self._connect
+        return client
+
+    def _connect(self):
+        server = FakeAPNs(self.client, self.max_streams)
+        self.servers.append(server)
+        server.pump()
+        return succeed(server.proto)
+
+    def _send(self, token="abcd"):
+        return self.client.send(router_token=token, payload={"chid": "1"},
+                                apns_id="an-apns-id", exp=1234)
+
+    def test_request(self):
+        d = self._send()
+        server = self.servers[0]
+        server.pump()
+        request = server.requests[1]
+        assert request["ended"]
+        assert json.loads(request["body"]) == {"chid": "1"}
+        headers = request["headers"]
+        assert headers[b":path"] == b"/3/device/abcd"
+        assert headers[b":authority"] == b"api.push.apple.com"
+        assert headers[b"apns-id"] == b"an-apns-id"
+        assert headers[b"apns-topic"] == b"com.example.SomeApp"
+        assert headers[b"apns-priority"] == b"10"
+        assert headers[b"apns-expiration"] == b"1234"
+        assert self.client.in_flight == 1
+        server.respond(1)
+        assert self.successResultOf(d) is None
+        assert self.client.in_flight == 0
+
+    def test_multiplexed(self):
+        self.client._max_connections = 1
+        results = [self._send() for _ in range(3)]
+        assert len(self.servers) == 1
+        server = self.servers[0]
+        server.pump()
+        # Queued for the server's MAX_CONCURRENT_STREAMS
+        assert sorted(server.requests) == [1, 3]
+        assert len(self.client._queue) == 1
+        self.clock.advance(1)
+        server.respond(3)
+        self.successResultOf(results[1])
+        server.pump()
+        assert sorted(server.requests) == [1, 3, 5]
+        assert not self.client._queue
+        self.metrics.timing.assert_any_call(
+            "notification.bridge.apns.queue_wait", 1000,
+            tags=self.client._tags)
+        server.respond(1)
+        server.respond(5)
+        self.successResultOf(results[0])
+        self.successResultOf(results[2])
+
+    def test_grow(self):
+        self.max_streams = 1
+        self.client._max_connections = 2
+        results = [self._send() for _ in range(3)]
+        assert len(self.servers) == 2
+        assert len(self.client.connections) == 2
+        for server in self.servers:
+            server.pump()
+            server.respond(1)
+        assert self.successResultOf(results[0]) is None
+        assert self.successResultOf(results[1]) is None
+        # Sent over the first free stream
+        self.servers[0].pump()
+        self.servers[0].respond(3)
+        assert self.successResultOf(results[2]) is None
+
+    def test_queue_full(self):
+        self.client = self._client(max_queue=1)
+        self.client._connect = lambda: Deferred()
+        self._send()
+        d = self._send()
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 503
+        assert exc.response_body == "APNS busy, please retry"
+        assert exc.extra["local"]
+
+    def test_rejected(self):
+        d = self._send()
+        server = self.servers[0]
+        server.pump()
+        server.respond(1, status=400,
+                       body=json.dumps({"reason": "BadDeviceToken"}))
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 502
+        assert exc.message == "APNS Transmit Error 400:BadDeviceToken"
+
+    def test_reconnect(self):
+        d = self._send()
+        self.servers[0].pump()
+        self.servers[0].lose()
+        assert self.client.connections == [self.servers[1].proto]
+        # Retried over the new connection
+        server = self.servers[1]
+        server.pump()
+        server.respond(1)
+        assert self.successResultOf(d) is None
+        self.metrics.increment.assert_any_call(
+            "notification.bridge.apns.connection.closed",
+            tags=self.client._tags)
+
+    def test_retries_exhausted(self):
+        d = self._send()
+        self.servers[0].pump()
+        self.servers[0].lose()
+        self.servers[1].pump()
+        self.servers[1].lose()
+        self.failureResultOf(d, APNSConnectionError)
+        assert len(self.servers) == 2
+
+    def test_goaway(self):
+        first = self._send()
+        second = self._send()
+        server = self.servers[0]
+        server.pump()
+        server.h2.close_connection(last_stream_id=1)
+        server.pump()
+        # Draining stream 1
+        assert not server.transport.disconnecting
+        assert server.proto.capacity == 0
+        # Stream 3 was never processed, so is retried on a new connection
+        retry = self.servers[1]
+        retry.pump()
+        assert list(retry.requests) == [1]
+        retry.respond(1)
+        assert self.successResultOf(second) is None
+        self.assertNoResult(first)
+        # (The fake server's own h2 state stops it responding)
+        server.h2.state_machine.state = ConnectionState.SERVER_OPEN
+        server.respond(1)
+        assert self.successResultOf(first) is None
+        assert server.transport.disconnecting
+        self.metrics.increment.assert_any_call(
+            "notification.bridge.apns.connection.retired",
+            tags=self.client._tags + ["reason:goaway"])
+
+    def test_goaway_error(self):
+        first = self._send()
+        server = self.servers[0]
+        server.pump()
+        server.h2.close_connection(error_code=ErrorCodes.INTERNAL_ERROR,
+                                   last_stream_id=1)
+        server.pump()
+        assert server.transport.disconnecting
+        assert server.proto.capacity == 0
+        self.assertNoResult(first)
+
+    def test_stream_reset(self):
+        self.client._max_retry = 1
+        d = self._send()
+        server = self.servers[0]
+        server.pump()
+        server.h2.reset_stream(1, ErrorCodes.REFUSED_STREAM)
+        server.pump()
+        self.failureResultOf(d, APNSConnectionError)
+
+    def test_timeout(self):
+        d = self._send()
+        server = self.servers[0]
+        server.pump()
+        self.clock.advance(10)
+        self.failureResultOf(d, TimeoutError)
+        server.pump()
+        assert server.resets == [1]
+        assert self.client.in_flight == 0
+
+    def test_cancel_queued(self):
+        self.client._connect = lambda: Deferred()
+        d = self._send()
+        self.clock.advance(10)
+        self.failureResultOf(d, TimeoutError)
+        # Skipped once a stream's available
+        server = FakeAPNs(self.client, 1)
+        server.pump()
+        assert not server.requests
+        assert not self.client._queue
+
+    def test_connect_failed(self):
+        self.client._connect = lambda: fail(ConnectionRefusedError())
+        d = self._send()
+        self.assertNoResult(d)
+        # Backing off between the attempts (of each of its 2 tries)
+        for delay in (0.5, 1, 2):
+            self.clock.advance(delay)
+        self.failureResultOf(d, APNSConnectionError)
+        assert self.client._connecting == 0
+
+    def test_handshake_failed(self):
+        self.client._max_retry = 1
+        servers = []
+
+        def connect():
+            server = FakeAPNs(self.client, self.max_streams)
+            servers.append(server)
+            return succeed(server.proto)
+        self.client._connect = connect
+        d = self._send()
+        # Lost before APNs' settings
+        servers[0].lose()
+        assert len(servers) == 1
+        self.clock.advance(0.5)
+        assert len(servers) == 2
+        servers[1].lose()
+        self.clock.advance(0.5)
+        assert len(servers) == 2
+        self.clock.advance(0.5)
+        assert len(servers) == 3
+        self.assertNoResult(d)
+        servers[2].lose()
+        self.failureResultOf(d, APNSConnectionError)
+        assert self.client._connecting == 0
+        self.metrics.increment.assert_any_call(
+            "notification.bridge.connection.error",
+            tags=self.client._tags + ["reason:connect_failed"])
+
+    def test_handshake_failed_recovers(self):
+        def lost_connect():
+            server = FakeAPNs(self.client, self.max_streams)
+            server.lose()
+            return succeed(server.proto)
+        self.client._connect = lost_connect
+        d = self._send()
+        assert self.client._connect_failures == 1
+        self.client._connect = self._connect
+        self.clock.advance(0.5)
+        assert self.client._connect_failures == 0
+        server = self.servers[0]
+        server.pump()
+        server.respond(1)
+        assert self.successResultOf(d) is None
+
+    def test_protocol_error(self):
+        self._send()
+        server = self.servers[0]
+        server.proto.dataReceived(b"\x00" * 20)
+        assert server.transport.disconnecting
+
+    def test_stream_ids_exhausted(self):
+        self.max_streams = 10
+        with patch.object(APNSProtocol, "max_stream_id", 3):
+            first, second = self._send(), self._send()
+            server = self.servers[0]
+            server.pump()
+            assert sorted(server.requests) == [1, 3]
+            assert server.proto.closing
+            self.metrics.increment.assert_any_call(
+                "notification.bridge.apns.connection.retired",
+                tags=self.client._tags + ["reason:stream_ids_exhausted"])
+            # Sent over a new connection
+            third = self._send()
+            assert len(self.servers) == 2
+            # Closed once its requests complete
+            server.respond(1)
+            assert not server.transport.disconnecting
+            server.respond(3)
+            assert server.transport.disconnecting
+            assert server.h2.state_machine.state == ConnectionState.CLOSED
+            self.successResultOf(first)
+            self.successResultOf(second)
+            self.servers[1].pump()
+            self.servers[1].respond(1)
+            self.successResultOf(third)
+
+    def test_request_protocol_error(self):
+        server = self._idle_connection()
+        server.proto.request = Mock(side_effect=NoAvailableStreamIDError())
+        d = self._send()
+        assert server.proto.closing
+        assert server.transport.disconnecting
+        # Requeued for a new connection
+        retry = self.servers[1]
+        retry.pump()
+        retry.respond(1)
+        assert self.successResultOf(d) is None
+        self.metrics.increment.assert_any_call(
+            "notification.bridge.apns.connection.retired",
+            tags=self.client._tags + ["reason:protocol_error"])
+
+    def test_tls_options(self):
+        pem = os.path.join(os.path.dirname(__file__), "certs", "server.pem")
+        client = AsyncAPNSClient(cert_file=pem, key_file=pem,
+                                 topic="com.example.SomeApp",
+                                 use_sandbox=True)
+        assert client.server == "api.development.push.apple.com"
+        assert client._tls_options is not None
+        with pytest.raises(IOError):
+            AsyncAPNSClient(cert_file="missing.pem", key_file="missing.pem",
+                            topic="com.example.SomeApp")
+
+    def _idle_connection(self):
+        d = self._send()
+        server = self.servers[-1]
+        server.pump()
+        server.respond(1)
+        self.successResultOf(d)
+        return server
+
+    def test_ping(self):
+        server = self._idle_connection()
+        self.clock.advance(60)
+        proto = server.proto
+        assert proto.ping_sent == 60
+        self.clock.advance(0.5)
+        server.pump()
+        assert proto.ping_sent is None
+        self.metrics.timing.assert_called_with(
+            "notification.bridge.apns.ping", 500, tags=self.client._tags)
+        # Still healthy
+        self.clock.advance(60)
+        assert not server.transport.disconnecting
+
+    def test_ping_timeout(self):
+        server = self._idle_connection()
+        self.clock.advance(60)
+        self.clock.advance(60)
+        assert server.proto.closing
+        assert server.transport.disconnecting
+        self.metrics.increment.assert_called_with(
+            "notification.bridge.apns.connection.retired",
+            tags=self.client._tags + ["reason:ping_timeout"])
+        # No further requests are sent over it
+        self._send()
+        assert len(self.servers) == 2
+        server.lose()
+        assert self.client.connections == [self.servers[1].proto]
+
+    def test_idle(self):
+        self.max_streams = 1
+        self.client._max_connections = 2
+        results = [self._send() for _ in range(2)]
+        for server in self.servers:
+            server.pump()
+            server.respond(1)
+        self.successResultOf(results[0])
+        self.successResultOf(results[1])
+        self.metrics.gauge.assert_any_call(
+            "notification.bridge.apns.connections", 2,
+            tags=self.client._tags)
+        for _ in range(10):
+            for server in self.servers:
+                server.pump()
+            self.clock.advance(60)
+        # Only one's retired
+        retired = [server for server in self.servers
+                   if server.transport.disconnecting]
+        assert len(retired) == 1
+        self.metrics.increment.assert_any_call(
+            "notification.bridge.apns.connection.retired",
+            tags=self.client._tags + ["reason:idle"])
+        retired[0].lose()
+        assert len(self.client.connections) == 1
+
+    def test_health_check_stopped(self):
+        server = self._idle_connection()
+        assert self.client._health_check.running
+        self.metrics.increment.assert_any_call(
+            "notification.bridge.apns.connection.new", tags=self.client._tags)
+        server.lose()
+        assert not self.client._health_check.running
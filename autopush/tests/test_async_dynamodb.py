@@ -0,0 +1,287 @@
+import uuid
+from decimal import Decimal
+
+import pytest
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError
+from mock import Mock, patch
+from twisted.internet.defer import (
+    Deferred,
+    TimeoutError,
+    fail,
+    inlineCallbacks,
+    succeed,
+)
+from twisted.internet.error import ConnectError, ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import ResponseNeverReceived
+
+import autopush.tests
+from autopush.async_dynamodb import (
+    AsyncDynamoDBClient,
+    deserialize_item,
+    serialize_item,
+)
+from autopush.config import DDBTableConfig
+from autopush.db import (
+    Message,
+    Router,
+    get_rotating_message_tablename,
+    get_router_table,
+    hasher,
+)
+from autopush.exceptions import InvalidConfig, ItemNotFound
+from autopush.metrics import SinkMetrics
+from autopush.tests.test_db import make_webpush_notification
+
+
+class SerializationTestCase(unittest.TestCase):
+    def test_roundtrip(self):
+        item = dict(
+            uaid="abc",
+            count=Decimal(3),
+            chids={"a", "b"},
+            raw=Binary(b"\x00\x01"),
+            flag=True,
+        )
+        serialized = serialize_item(item)
+        assert serialized["uaid"] == {"S": "abc"}
+        assert serialized["count"] == {"N": "3"}
+        assert serialized["raw"] == {"B": "AAE="}
+        assert deserialize_item(serialized) == item
+
+
+class AsyncDynamoDBClientTestCase(unittest.TestCase):
+    def setUp(self):
+        get_router_table("router_test",
+                         boto_resource=autopush.tests.boto_resource)
+        self.client = AsyncDynamoDBClient()
+        self.table = self.client.table("router_test")
+
+    def tearDown(self):
+        return self.client.close()
+
+    def test_local_endpoint(self):
+        assert self.client.endpoint_url == autopush.tests.boto_resource.conf[
+            "endpoint_url"]
+
+    @inlineCallbacks
+    def test_item_operations(self):
+        uaid = uuid.uuid4().hex
+        result = yield self.table.put_item(
+            Item=dict(uaid=uaid, connected_at=1234, router_type="webpush"))
+        assert result["ResponseMetadata"]["HTTPStatusCode"] == 200
+
+        result = yield self.table.get_item(Key=dict(uaid=uaid),
+                                           ConsistentRead=True)
+        assert result["Item"] == dict(uaid=uaid, connected_at=1234,
+                                      router_type="webpush")
+
+        result = yield self.table.update_item(
+            Key=dict(uaid=uaid),
+            UpdateExpression="SET connected_at = :connected_at",
+            ExpressionAttributeValues={":connected_at": 5678},
+            ReturnValues="ALL_NEW",
+        )
+        assert result["Attributes"]["connected_at"] == 5678
+
+        yield self.table.delete_item(Key=dict(uaid=uaid))
+        result = yield self.table.get_item(Key=dict(uaid=uaid),
+                                           ConsistentRead=True)
+        assert "Item" not in result
+
+    @inlineCallbacks
+    def test_client_error(self):
+        table = self.client.table("no_such_table")
+        with self.assertRaises(ClientError) as cm:
+            yield table.get_item(Key=dict(uaid="abc"))
+        assert cm.exception.response["Error"]["Code"] == (
+            "ResourceNotFoundException")
+
+    @inlineCallbacks
+    def test_conditional_failure(self):
+        uaid = uuid.uuid4().hex
+        with self.assertRaises(ClientError) as cm:
+            yield self.table.update_item(
+                Key=dict(uaid=uaid),
+                UpdateExpression="SET connected_at = :connected_at",
+                ConditionExpression="attribute_exists(uaid)",
+                ExpressionAttributeValues={":connected_at": 1},
+            )
+        assert cm.exception.response["Error"]["Code"] == (
+            "ConditionalCheckFailedException")
+
+
+def client_error(code, status=400):
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": ""},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        },
+        "GetItem"
+    )
+
+
+class AsyncDynamoDBRetryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.client = AsyncDynamoDBClient(reactor=self.clock,
+                                          request_timeout=2, max_retries=2)
+        self.client.agent = Mock()
+        self.client.agent.request.side_effect = lambda *args: succeed(None)
+
+    def _responses(self, *responses):
+        self.client._read_response = Mock(side_effect=[
+            fail(response) if isinstance(response, Exception) else response
+            for response in responses
+        ])
+
+    def test_retry_throttled(self):
+        self._responses(
+            client_error("ProvisionedThroughputExceededException"),
+            client_error("InternalServerError", status=500),
+            dict(Item={}),
+        )
+        d = self.client.call("GetItem")
+        self.assertNoResult(d)
+        # Backs off (for up to 25ms, then 50ms) between attempts
+        self.clock.advance(0.025)
+        assert self.client.agent.request.call_count == 2
+        self.clock.advance(0.05)
+        assert self.successResultOf(d) == dict(Item={})
+        assert self.client.agent.request.call_count == 3
+
+    def test_retries_exhausted(self):
+        self._responses(*[client_error("ThrottlingException")] * 3)
+        d = self.client.call("GetItem")
+        self.clock.pump([0.05] * 4)
+        self.failureResultOf(d, ClientError)
+        assert self.client.agent.request.call_count == 3
+
+    def test_no_retry(self):
+        self._responses(client_error("ConditionalCheckFailedException"))
+        d = self.client.call("GetItem")
+        self.failureResultOf(d, ClientError)
+        assert self.client.agent.request.call_count == 1
+
+    def test_timeout(self):
+        self.client.agent.request.side_effect = lambda *args: Deferred()
+        d = self.client.call("GetItem")
+        self.clock.advance(2)
+        assert self.client.agent.request.call_count == 1
+        # Retried (each attempt timing out after 2s)
+        self.clock.pump([1] * 8)
+        # then failed as boto3 would
+        failure = self.failureResultOf(d, ClientError)
+        assert not failure.check(TimeoutError)
+        assert failure.value.response["Error"]["Code"] == "RequestTimeout"
+        assert self.client.agent.request.call_count == 3
+
+    def test_timeout_then_success(self):
+        responses = [Deferred(), succeed(None)]
+        self.client.agent.request.side_effect = (
+            lambda *args: responses.pop(0))
+        self._responses(dict(Item={}))
+        d = self.client.call("GetItem")
+        self.clock.advance(2)
+        self.clock.advance(0.025)
+        assert self.successResultOf(d) == dict(Item={})
+        assert self.client.agent.request.call_count == 2
+
+    def test_connection_failure(self):
+        self.client.agent.request.side_effect = lambda *args: fail(
+            ResponseNeverReceived([Failure(ConnectionDone())]))
+        d = self.client.call("GetItem")
+        self.clock.pump([0.1] * 2)
+        failure = self.failureResultOf(d, ClientError)
+        assert failure.value.response["Error"]["Code"] == "ConnectionError"
+        assert self.client.agent.request.call_count == 3
+
+    def test_connection_failure_then_success(self):
+        responses = [fail(ConnectError()), succeed(None)]
+        self.client.agent.request.side_effect = (
+            lambda *args: responses.pop(0))
+        self._responses(dict(Item={}))
+        d = self.client.call("GetItem")
+        self.clock.advance(0.025)
+        assert self.successResultOf(d) == dict(Item={})
+
+    def test_no_credentials(self):
+        with patch("botocore.session.get_session") as mock_session:
+            mock_session.return_value.get_credentials.return_value = None
+            with pytest.raises(InvalidConfig):
+                AsyncDynamoDBClient(endpoint_url="http://localhost:8000")
+
+
+class AsyncTableMethodsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = AsyncDynamoDBClient()
+        self.router = Router(DDBTableConfig("router_test"), SinkMetrics(),
+                             resource=autopush.tests.boto_resource,
+                             cache_size=10,
+                             async_client=self.client)
+
+    def tearDown(self):
+        return self.client.close()
+
+    @inlineCallbacks
+    def test_get_uaid_async(self):
+        uaid = str(uuid.uuid4())
+        self.router.register_user(dict(uaid=uaid, router_type="webpush",
+                                       connected_at=1234,
+                                       node_id="http://somewhere"))
+        item = yield self.router.get_uaid_async(uaid, use_cache=False)
+        assert item == self.router.get_uaid(uaid, use_cache=False)
+        assert item["node_id"] == "http://somewhere"
+
+        # Cached copies are served without a request
+        self.router.async_table = Mock()
+        item = yield self.router.get_uaid_async(uaid)
+        assert item["node_id"] == "http://somewhere"
+        assert not self.router.async_table.get_item.called
+
+    @inlineCallbacks
+    def test_get_uaid_async_not_found(self):
+        with self.assertRaises(ItemNotFound):
+            yield self.router.get_uaid_async(str(uuid.uuid4()))
+
+    @inlineCallbacks
+    def test_get_uaid_async_no_table(self):
+        self.router.async_table = self.client.table("no_such_table")
+        with self.assertRaises(ItemNotFound):
+            yield self.router.get_uaid_async(str(uuid.uuid4()))
+
+    @inlineCallbacks
+    def test_get_uaid_async_incomplete(self):
+        uaid = str(uuid.uuid4())
+        self.router.table.put_item(Item=dict(uaid=hasher(uaid)))
+        with self.assertRaises(ItemNotFound):
+            yield self.router.get_uaid_async(uaid)
+        result = self.router.table.get_item(Key=dict(uaid=hasher(uaid)),
+                                            ConsistentRead=True)
+        assert "Item" not in result
+
+    @inlineCallbacks
+    def test_store_message_async(self):
+        uaid = str(uuid.uuid4())
+        chid = str(uuid.uuid4())
+        tablename = get_rotating_message_tablename(
+            boto_resource=autopush.tests.boto_resource)
+        message = Message(tablename,
+                          boto_resource=autopush.tests.boto_resource,
+                          async_client=self.client)
+        message.register_channel(uaid, chid)
+        notif = make_webpush_notification(uaid, chid)
+        notif.data = "some data"
+        yield message.store_message_async(notif)
+        _, messages = message.fetch_timestamp_messages(uuid.UUID(uaid), " ")
+        assert len(messages) == 1
+        assert messages[0].data == "some data"
+
+    @inlineCallbacks
+    def test_fallback_to_thread(self):
+        self.router.async_table = None
+        with self.assertRaises(ItemNotFound):
+            yield self.router.get_uaid_async(str(uuid.uuid4()))
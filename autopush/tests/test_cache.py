@@ -0,0 +1,185 @@
+import unittest
+
+from mock import Mock, call
+
+from autopush.cache import DeadTokenCache, TTLCache, VapidCache
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.metrics = Mock()
+        self.cache = TTLCache(2, 10, metrics=self.metrics, name="test",
+                              timer=lambda: self.now)
+
+    def test_get_set(self):
+        assert self.cache.get("a") is None
+        assert self.cache.get("a", "dflt") == "dflt"
+        self.cache.set("a", 1)
+        assert self.cache.get("a") == 1
+        assert "a" in self.cache
+        assert len(self.cache) == 1
+        self.metrics.increment.assert_has_calls([
+            call("cache.miss", tags=["cache:test"]),
+            call("cache.miss", tags=["cache:test"]),
+            call("cache.hit", tags=["cache:test"]),
+        ])
+
+    def test_expiry(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2, ttl=20)
+        self.now += 10
+        assert self.cache.get("a") is None
+        assert "a" not in self.cache
+        assert self.cache.get("b") == 2
+
+    def test_lru_eviction(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        # Touch a so b is the least recently used
+        assert self.cache.get("a") == 1
+        self.cache.set("c", 3)
+        assert self.cache.get("b") is None
+        assert self.cache.get("a") == 1
+        assert self.cache.get("c") == 3
+        self.metrics.increment.assert_any_call(
+            "cache.eviction", count=1, tags=["cache:test"])
+
+    def test_invalidate(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.invalidate("a")
+        self.cache.invalidate("missing")
+        assert self.cache.get("a") is None
+        assert self.cache.get("b") == 2
+        self.cache.clear()
+        assert len(self.cache) == 0
+
+    def test_generation(self):
+        generation = self.cache.generation()
+        # Invalidated while its value was read
+        self.cache.invalidate("a")
+        self.cache.set("a", 1, generation=generation)
+        assert "a" not in self.cache
+        self.cache.set("b", 2, generation=generation)
+        assert self.cache.get("b") == 2
+        self.cache.set("a", 1, generation=self.cache.generation())
+        assert self.cache.get("a") == 1
+
+        # Invalidations beyond max_size are forgotten, conservatively
+        generation = self.cache.generation()
+        for key in "cde":
+            self.cache.invalidate(key)
+        self.cache.set("c", 3, generation=generation)
+        assert "c" not in self.cache
+
+        generation = self.cache.generation()
+        self.cache.clear()
+        self.cache.set("f", 4, generation=generation)
+        assert "f" not in self.cache
+
+    def test_max_weight(self):
+        cache = TTLCache(10, 10, max_weight=5, weigher=len)
+        cache.set("a", "aa")
+        cache.set("b", "bb")
+        assert cache.weight == 4
+        cache.set("c", "cc")
+        assert "a" not in cache
+        assert cache.weight == 4
+        # Too large to ever fit
+        cache.set("b", "bbbbbb")
+        assert "b" not in cache
+        assert cache.weight == 2
+        cache.invalidate("c")
+        assert cache.weight == 0
+
+    def test_disabled(self):
+        cache = TTLCache(0, 10)
+        cache.set("a", 1)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+
+class VapidCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.metrics = Mock()
+        self.cache = VapidCache(2, 2, 60, metrics=self.metrics,
+                                timer=lambda: self.now)
+
+    def test_public_key(self):
+        loader = Mock(return_value="pkey")
+        assert self.cache.public_key("raw", loader) == "pkey"
+        assert self.cache.public_key("raw", loader) == "pkey"
+        loader.assert_called_once_with("raw")
+        self.metrics.increment.assert_has_calls([
+            call("cache.miss", tags=["cache:vapid_key"]),
+            call("cache.hit", tags=["cache:vapid_key"]),
+        ])
+
+    def test_public_key_invalid(self):
+        loader = Mock(side_effect=ValueError)
+        with self.assertRaises(ValueError):
+            self.cache.public_key("raw", loader)
+        assert len(self.cache.keys) == 0
+
+    def test_claims_until_exp(self):
+        claims = dict(sub="mailto:foo@example.com", exp=1030)
+        self.cache.set_claims("token", "key", claims)
+        cached = self.cache.get_claims("token", "key")
+        assert cached == claims
+        # Callers get their own copy
+        cached["exp"] = 0
+        assert self.cache.get_claims("token", "key")["exp"] == 1030
+        assert self.cache.get_claims("token", "other_key") is None
+        self.now += 30
+        assert self.cache.get_claims("token", "key") is None
+
+    def test_claims_ttl_bound(self):
+        self.cache.set_claims("token", "key", dict(exp=5000))
+        self.now += 59
+        assert self.cache.get_claims("token", "key") is not None
+        self.now += 1
+        assert self.cache.get_claims("token", "key") is None
+
+    def test_claims_not_cached(self):
+        self.cache.set_claims("t1", "key", dict(sub="mailto:foo"))
+        self.cache.set_claims("t2", "key", dict(exp="bogus"))
+        self.cache.set_claims("t3", "key", dict(exp=900))
+        assert len(self.cache.claims) == 0
+
+
+class DeadTokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = DeadTokenCache(10, 60, timer=lambda: self.now)
+        self.user_data = dict(uaid="abad1dea", router_type="fcm",
+                              router_data=dict(token="dead"))
+
+    def test_dead(self):
+        assert self.cache.get(self.user_data) is None
+        self.cache.add(self.user_data, 103)
+        assert self.cache.get(self.user_data) == 103
+        self.now += 60
+        assert self.cache.get(self.user_data) is None
+
+    def test_other_uaid(self):
+        self.cache.add(self.user_data, 103)
+        # The token, registered anew
+        user_data = dict(self.user_data, uaid="decafbad")
+        assert self.cache.get(user_data) is None
+        user_data = dict(self.user_data, router_type="gcm")
+        assert self.cache.get(user_data) is None
+
+    def test_discard(self):
+        self.cache.add(self.user_data, 105)
+        self.cache.discard("fcm", dict(token="dead"))
+        assert self.cache.get(self.user_data) is None
+
+    def test_no_token(self):
+        user_data = dict(uaid="abad1dea", router_type="webpush",
+                         router_data={})
+        self.cache.add(user_data, 103)
+        assert len(self.cache.tokens) == 0
+        assert self.cache.get(user_data) is None
+        self.cache.discard("webpush", {})
@@ -7,7 +7,10 @@ from autopush.websocket import ms_time
 from botocore.exceptions import ClientError
 from mock import Mock, patch
 import pytest
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
 
+from autopush.cache import TTLCache
 from autopush.config import DDBTableConfig
 from autopush.db import (
     get_rotating_message_tablename,
@@ -21,8 +24,11 @@ from autopush.db import (
     create_rotating_message_table,
     _drop_table,
     _make_table,
+    hasher,
     DatabaseManager,
-    DynamoDBResource
+    DynamoDBResource,
+    MessageBatchWriter,
+    MAX_CHANNEL_CACHE_TTL,
     )
 from autopush.exceptions import AutopushException, ItemNotFound
 from autopush.metrics import SinkMetrics
@@ -122,6 +128,48 @@ class DatabaseManagerTest(unittest.TestCase):
             dm.resource._resource.meta.client.delete_table(
                 TableName=fake_conf.message_table.tablename)
 
+    def test_router_cache(self):
+        dm = DatabaseManager(
+            router_conf=DDBTableConfig("router_test"),
+            message_conf=DDBTableConfig("message_int_test"),
+            metrics=SinkMetrics(),
+            resource=autopush.tests.boto_resource,
+            router_cache_size=10,
+            router_cache_ttl=3,
+        )
+        dm.setup_tables()
+        assert dm.router.cache.max_size == 10
+        assert dm.router.cache.ttl == 3
+        assert dm.channel_cache is None
+        assert dm.message.channel_cache is None
+
+    def test_channel_cache(self):
+        dm = DatabaseManager(
+            router_conf=DDBTableConfig("router_test"),
+            message_conf=DDBTableConfig("message_int_test"),
+            metrics=SinkMetrics(),
+            resource=autopush.tests.boto_resource,
+            channel_cache_size=10,
+            channel_cache_ttl=3,
+            channel_cache_max_bytes=1024,
+        )
+        assert dm.channel_cache.max_size == 10
+        assert dm.channel_cache.ttl == 3
+        assert dm.channel_cache.max_weight == 1024
+        msg = dm.message_table(dm.current_msg_month)
+        assert msg.channel_cache is dm.channel_cache
+
+    def test_channel_cache_ttl_capped(self):
+        dm = DatabaseManager(
+            router_conf=DDBTableConfig("router_test"),
+            message_conf=DDBTableConfig("message_int_test"),
+            metrics=SinkMetrics(),
+            resource=autopush.tests.boto_resource,
+            channel_cache_size=10,
+            channel_cache_ttl=3600,
+        )
+        assert dm.channel_cache.ttl == MAX_CHANNEL_CACHE_TTL
+
 
 class DdbResourceTest(unittest.TestCase):
     @patch("boto3.resource")
@@ -242,6 +290,181 @@ class DbCheckTestCase(unittest.TestCase):
         assert db.normalize_id(abnormal.upper()) == normal
 
 
+class MessageBatchWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.client = Mock()
+        self.client.batch_write_item.side_effect = lambda **kw: succeed({})
+        self.metrics = Mock(spec=SinkMetrics)
+        self.writer = MessageBatchWriter(None, self.metrics,
+                                         async_client=self.client,
+                                         delay=0.01, max_retries=2,
+                                         clock=self.clock)
+
+    def _item(self, uaid="uaid", sort_key=None):
+        return dict(uaid=uaid, chidmessageid=sort_key or str(uuid.uuid4()))
+
+    def test_batched(self):
+        results = []
+        items = [self._item() for _ in range(3)]
+        for item in items:
+            self.writer.put("message_a", item).addCallback(results.append)
+        other = self._item()
+        self.writer.put("message_b", other).addCallback(results.append)
+        assert not self.client.batch_write_item.called
+
+        self.clock.advance(0.01)
+        assert self.client.batch_write_item.call_count == 1
+        request_items = self.client.batch_write_item.call_args[1][
+            "RequestItems"]
+        assert request_items == {
+            "message_a": [{"PutRequest": {"Item": x}} for x in items],
+            "message_b": [{"PutRequest": {"Item": other}}],
+        }
+        assert results == [None] * 4
+
+    def test_full_batches(self):
+        for _ in range(60):
+            self.writer.put("message_a", self._item())
+        # Two full batches written immediately, the rest on a timer
+        assert self.client.batch_write_item.call_count == 2
+        self.clock.advance(0.01)
+        assert self.client.batch_write_item.call_count == 3
+        sizes = [len(c[1]["RequestItems"]["message_a"])
+                 for c in self.client.batch_write_item.call_args_list]
+        assert sizes == [25, 25, 10]
+
+    def _written_items(self):
+        return [req["PutRequest"]["Item"]
+                for c in self.client.batch_write_item.call_args_list
+                for reqs in c[1]["RequestItems"].values()
+                for req in reqs]
+
+    def test_duplicate_keys(self):
+        results = []
+        older = self._item(sort_key="01:chid:topic")
+        newer = dict(older, data="newer")
+        self.writer.put("message_a", older).addCallback(results.append)
+        self.writer.put("message_a", newer).addCallback(results.append)
+        self.clock.advance(0.01)
+        assert self._written_items() == [newer]
+        assert results == [None, None]
+
+    def test_duplicate_key_in_flight(self):
+        pending = Deferred()
+        self.client.batch_write_item.side_effect = [
+            pending, succeed({})]
+        older = self._item(sort_key="01:chid:topic")
+        newer = dict(older, data="newer")
+        self.writer.put("message_a", older)
+        self.clock.advance(0.01)
+        self.writer.put("message_a", newer)
+        self.clock.advance(0.01)
+        # Held back until the earlier write completes
+        assert self.client.batch_write_item.call_count == 1
+        pending.callback({})
+        self.clock.advance(0.01)
+        assert self._written_items() == [older, newer]
+
+    def test_duplicate_key_retried(self):
+        older = self._item(sort_key="01:chid:topic")
+        newer = dict(older, data="newer")
+        self.client.batch_write_item.side_effect = [
+            succeed(dict(UnprocessedItems={
+                "message_a": [{"PutRequest": {"Item": older}}]})),
+            succeed({}),
+        ]
+        results = []
+        self.writer.put("message_a", older).addCallback(results.append)
+        self.clock.advance(0.01)
+        self.writer.put("message_a", newer).addCallback(results.append)
+        self.clock.advance(0.01)
+        assert self.client.batch_write_item.call_count == 1
+        self.clock.advance(0.05)
+        self.clock.advance(0.01)
+        # The retry's superseded by the newer write
+        assert self._written_items() == [older, newer]
+        assert results == [None, None]
+
+    def test_drain(self):
+        pending = Deferred()
+        self.client.batch_write_item.side_effect = [
+            pending, succeed({}), succeed({})]
+        item = self._item(sort_key="01:chid:topic")
+        self.writer.put("message_a", item)
+        self.clock.advance(0.01)
+        self.writer.put("message_a", dict(item, data="newer"))
+        self.writer.put("message_a", self._item())
+        drained = []
+        self.writer.drain().addCallback(drained.append)
+        assert self.client.batch_write_item.call_count == 2
+        assert not drained
+        pending.callback({})
+        self.clock.advance(0.01)
+        assert self.client.batch_write_item.call_count == 3
+        assert len(drained) == 1
+        assert all(success for success, _ in drained[0])
+
+    def test_unprocessed_retry(self):
+        item = self._item()
+        processed = self._item()
+        self.client.batch_write_item.side_effect = [
+            succeed(dict(UnprocessedItems={
+                "message_a": [{"PutRequest": {"Item": item}}]})),
+            succeed({}),
+        ]
+        results = []
+        self.writer.put("message_a", item).addCallback(results.append)
+        self.writer.put("message_a", processed).addCallback(results.append)
+        self.clock.advance(0.01)
+        assert results == [None]
+        self.clock.advance(0.05)
+        self.clock.advance(0.01)
+        assert self.client.batch_write_item.call_count == 2
+        assert results == [None, None]
+        self.metrics.increment.assert_any_call(
+            "notification.message.batch_retry", 1)
+
+    def test_unprocessed_gives_up(self):
+        item = self._item()
+        self.client.batch_write_item.side_effect = lambda **kw: succeed(dict(
+            UnprocessedItems={"message_a": [{"PutRequest": {"Item": item}}]}))
+        failures = []
+        self.writer.put("message_a", item).addErrback(failures.append)
+        for _ in range(10):
+            self.clock.advance(1)
+        assert self.client.batch_write_item.call_count == 3
+        assert len(failures) == 1
+        assert failures[0].value.response["Error"]["Code"] == (
+            "ProvisionedThroughputExceededException")
+
+    def test_request_failure(self):
+        self.client.batch_write_item.side_effect = lambda **kw: fail(
+            ClientError({}, "BatchWriteItem"))
+        failures = []
+        for _ in range(2):
+            self.writer.put("message_a", self._item()).addErrback(
+                failures.append)
+        self.clock.advance(0.01)
+        assert len(failures) == 2
+        assert all(f.check(ClientError) for f in failures)
+
+    def test_store_message_async(self):
+        message = Message("message_a", boto_resource=self.resource(),
+                          batch_writer=self.writer)
+        notif = make_webpush_notification(str(uuid.uuid4()),
+                                          str(uuid.uuid4()))
+        message.store_message_async(notif)
+        self.clock.advance(0.01)
+        request_items = self.client.batch_write_item.call_args[1][
+            "RequestItems"]
+        item = request_items["message_a"][0]["PutRequest"]["Item"]
+        assert item["chidmessageid"] == notif.sort_key
+
+    def resource(self):
+        return autopush.tests.boto_resource
+
+
 class MessageTestCase(unittest.TestCase):
     def setUp(self):
         self.resource = autopush.tests.boto_resource
@@ -384,6 +607,77 @@ class MessageTestCase(unittest.TestCase):
         _, new_chans = message.all_channels(new_uaid)
         assert chans == new_chans
 
+    def test_has_channel(self):
+        chid = str(uuid.uuid4())
+        chid2 = str(uuid.uuid4())
+        m = get_rotating_message_tablename(boto_resource=self.resource)
+        cache = TTLCache(10, 60)
+        message = Message(m, boto_resource=self.resource,
+                          channel_cache=cache)
+        assert message.has_channel(self.uaid, chid) is False
+        message.register_channel(self.uaid, chid)
+        assert message.has_channel(self.uaid, uuid.UUID(chid)) is True
+        assert cache.get((m, self.uaid)) == frozenset([chid])
+
+        # A cached positive answer doesn't hit the table
+        message.all_channels = Mock()
+        assert message.has_channel(self.uaid, chid) is True
+        assert not message.all_channels.called
+        # But a channel missing from the cached set is re-read
+        message.all_channels.return_value = (True, {chid, chid2})
+        assert message.has_channel(self.uaid, chid2) is True
+        assert message.all_channels.called
+        del message.all_channels
+
+        message.unregister_channel(self.uaid, chid)
+        assert (m, self.uaid) not in cache
+        message.save_channels(self.uaid, {chid2})
+        assert (m, self.uaid) not in cache
+        assert message.has_channel(self.uaid, chid) is False
+        assert message.has_channel(self.uaid, chid2) is True
+
+    def test_unregister_channel_concurrent_lookup(self):
+        chid = str(uuid.uuid4())
+        m = get_rotating_message_tablename(boto_resource=self.resource)
+        message = Message(m, boto_resource=self.resource,
+                          channel_cache=TTLCache(10, 60))
+        message.register_channel(self.uaid, chid)
+        update_item = message.table.update_item
+
+        def lookup_then_update(**kwargs):
+            # Caches the channel set before the delete lands
+            assert message.has_channel(self.uaid, chid) is True
+            return update_item(**kwargs)
+        message.table.update_item = lookup_then_update
+        message.unregister_channel(self.uaid, chid)
+        assert message.has_channel(self.uaid, chid) is False
+
+    def test_has_channel_unregistered_during_read(self):
+        chid = str(uuid.uuid4())
+        m = get_rotating_message_tablename(boto_resource=self.resource)
+        message = Message(m, boto_resource=self.resource,
+                          channel_cache=TTLCache(10, 60))
+        message.register_channel(self.uaid, chid)
+        all_channels = message.all_channels
+
+        def read_then_unregister(uaid):
+            # Unregistered (on another thread) once the read's under way
+            result = all_channels(uaid)
+            message.unregister_channel(self.uaid, chid)
+            return result
+        message.all_channels = read_then_unregister
+        assert message.has_channel(self.uaid, chid) is True
+        del message.all_channels
+        assert message.has_channel(self.uaid, chid) is False
+
+    def test_has_channel_no_cache(self):
+        chid = str(uuid.uuid4())
+        m = get_rotating_message_tablename(boto_resource=self.resource)
+        message = Message(m, boto_resource=self.resource)
+        message.register_channel(self.uaid, chid)
+        assert message.has_channel(self.uaid, chid) is True
+        assert message.has_channel(self.uaid, str(uuid.uuid4())) is False
+
     def test_all_channels_no_uaid(self):
         m = get_rotating_message_tablename(boto_resource=self.resource)
         message = Message(m, boto_resource=self.resource)
@@ -527,6 +821,46 @@ class RouterTestCase(unittest.TestCase):
         with pytest.raises(ItemNotFound):
             self.router.get_uaid(uaid)
 
+    def test_get_uaids(self):
+        router = Router(self.table_conf, SinkMetrics(),
+                        resource=self.resource, cache_size=10)
+        users = [self._create_minimal_record() for _ in range(3)]
+        uaids = [user["uaid"] for user in users]
+        for user in users:
+            router.register_user(user)
+        incomplete = str(uuid.uuid4())
+        router.table.put_item(Item=dict(uaid=hasher(incomplete)))
+        missing = str(uuid.uuid4())
+
+        records = router.get_uaids(uaids + [incomplete, missing])
+        assert sorted(records) == sorted(uaids)
+        assert records[uaids[0]]["router_type"] == "webupsh"
+        # Incomplete records are dropped
+        with pytest.raises(ItemNotFound):
+            router.get_uaid(incomplete)
+
+        # Found records are cached
+        router._resource = Mock()
+        assert sorted(router.get_uaids(uaids)) == sorted(uaids)
+        assert not router._resource.batch_get_item.called
+
+    def test_get_uaids_unprocessed(self):
+        router = Router(self.table_conf, SinkMetrics(),
+                        resource=self.resource)
+        user = self._create_minimal_record()
+        uaid = user["uaid"]
+        router.register_user(user)
+        router._resource = Mock()
+        router._resource.batch_get_item.return_value = dict(
+            Responses={},
+            UnprocessedKeys={
+                router.table.table_name: dict(Keys=[dict(uaid=hasher(uaid))])
+            },
+        )
+        records = router.get_uaids([uaid, uaid])
+        assert records[uaid]["uaid"] == uaid
+        assert router._resource.batch_get_item.call_count == 1
+
     def test_uaid_provision_failed(self):
         router = Router(self.table_conf,  SinkMetrics(),
                         resource=self.resource)
@@ -758,3 +1092,89 @@ class RouterTestCase(unittest.TestCase):
         # Deleting already deleted record should return false.
         result = router.drop_user(uaid)
         assert result is False
+
+    def test_cached_uaid(self):
+        uaid = str(uuid.uuid4())
+        router = Router(self.table_conf, SinkMetrics(),
+                        resource=self.resource, cache_size=10)
+        router.register_user(dict(uaid=uaid, node_id="asdf",
+                                  router_type="webpush",
+                                  connected_at=1234))
+        user = router.get_uaid(uaid)
+        assert user["node_id"] == "asdf"
+
+        # Served from the cache as an independent copy
+        router.table = Mock()
+        user["node_id"] = "modified"
+        cached = router.get_uaid(uaid)
+        assert cached["node_id"] == "asdf"
+        assert not router.table.get_item.called
+
+        # Bypassing the cache hits the table
+        router.table.get_item.return_value = {
+            "ResponseMetadata": {"HTTPStatusCode": 200},
+            "Item": dict(cached, node_id="fresh"),
+        }
+        assert router.get_uaid(uaid, use_cache=False)["node_id"] == "fresh"
+        assert router.get_uaid(uaid)["node_id"] == "fresh"
+        assert router.table.get_item.call_count == 1
+
+    def test_cache_invalidated_during_read(self):
+        uaid = str(uuid.uuid4())
+        router = Router(self.table_conf, SinkMetrics(),
+                        resource=self.resource, cache_size=10)
+        stale = dict(uaid=uaid, node_id="asdf", router_type="webpush",
+                     connected_at=1234)
+
+        def get_item(**kwargs):
+            # Dropped (on another thread) once the read's under way
+            router._invalidate(uaid)
+            return {
+                "ResponseMetadata": {"HTTPStatusCode": 200},
+                "Item": stale,
+            }
+        router.table = Mock()
+        router.table.get_item.side_effect = get_item
+        assert router.get_uaid(uaid)["node_id"] == "asdf"
+        assert uaid not in router.cache
+
+        router._resource = Mock()
+        router._resource.batch_get_item.side_effect = lambda **kw: dict(
+            get_item(), Responses={router.table.table_name: [stale]})
+        assert uaid in router.get_uaids([uaid])
+        assert uaid not in router.cache
+
+    def test_cache_invalidation(self):
+        uaid = str(uuid.uuid4())
+        router = Router(self.table_conf, SinkMetrics(),
+                        resource=self.resource, cache_size=10)
+        router.register_user(dict(uaid=uaid, node_id="asdf",
+                                  router_type="webpush",
+                                  connected_at=1234))
+        user = router.get_uaid(uaid)
+        assert uaid in router.cache
+
+        router.update_message_month(uaid, "message_2018_06")
+        assert uaid not in router.cache
+        user = router.get_uaid(uaid)
+        assert user["current_month"] == "message_2018_06"
+
+        router.clear_node(user)
+        assert uaid not in router.cache
+        assert router.get_uaid(uaid).get("node_id") is None
+
+        router.register_user(dict(uaid=uaid, node_id="qwer",
+                                  router_type="webpush",
+                                  connected_at=2345))
+        assert uaid not in router.cache
+        assert router.get_uaid(uaid)["node_id"] == "qwer"
+
+        assert router.drop_user(uaid) is True
+        assert uaid not in router.cache
+        with pytest.raises(ItemNotFound):
+            router.get_uaid(uaid)
+
+    def test_cache_disabled(self):
+        router = Router(self.table_conf, SinkMetrics(),
+                        resource=self.resource)
+        assert router.cache is None
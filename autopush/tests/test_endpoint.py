@@ -16,7 +16,7 @@ from autopush.db import (
     has_connected_this_month,
     Router
 )
-from autopush.exceptions import RouterException
+from autopush.exceptions import InvalidTokenException, RouterException
 from autopush.http import EndpointHTTPFactory
 from autopush.metrics import SinkMetrics
 from autopush.router import routers_from_config
@@ -128,6 +128,119 @@ class MessageTestCase(unittest.TestCase):
         assert 204 == resp.get_status()
 
 
+class EndpointTokenTestCase(unittest.TestCase):
+    key1 = 'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA='
+    key2 = 'BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB='
+
+    def test_key_id_tagged(self):
+        fernet = utils.KeyIdFernet([self.key1, self.key2], tag_key_id=True)
+        token = fernet.encrypt("data")
+        assert token.startswith(
+            utils.KEY_ID_TAG + utils.fernet_key_id(self.key1))
+        assert fernet.decrypt(token) == "data"
+        # Tagging preserves the token's Base64 alignment
+        assert len(token) % 4 == len(Fernet(self.key1).encrypt("data")) % 4
+
+        # Rotated in keys decrypt the previous primary's tokens directly
+        rotated = utils.KeyIdFernet([self.key2, self.key1])
+        assert not rotated.encrypt("data").startswith(utils.KEY_ID_TAG)
+        with patch.object(rotated, "_multi") as mock_multi:
+            assert rotated.decrypt(token) == "data"
+        assert not mock_multi.decrypt.called
+
+    def test_legacy_tokens(self):
+        fernet = utils.KeyIdFernet([self.key2, self.key1])
+        assert fernet.decrypt(Fernet(self.key1).encrypt("data")) == "data"
+        with self.assertRaises(InvalidToken):
+            fernet.decrypt(Fernet(Fernet.generate_key()).encrypt("data"))
+
+    def test_untagged_by_default(self):
+        token = utils.KeyIdFernet([self.key1]).encrypt("data")
+        # Decryptable by nodes unaware of key id tags
+        assert Fernet(self.key1).decrypt(token) == "data"
+
+    def test_unknown_key_id(self):
+        token = utils.KeyIdFernet([self.key1], tag_key_id=True).encrypt("data")
+        with self.assertRaises(InvalidToken):
+            utils.KeyIdFernet([self.key2]).decrypt(token)
+        with self.assertRaises(InvalidToken):
+            utils.KeyIdFernet([self.key1]).decrypt(token[:-4] + "AAAA")
+
+    def test_message_id(self):
+        conf = AutopushConfig(crypto_key=[self.key1, self.key2],
+                              key_id_tokens=True)
+        notif = make_webpush_notification(dummy_uaid.hex, str(dummy_chid))
+        message_id = notif.generate_message_id(conf.fernet)
+        assert message_id.startswith(utils.KEY_ID_TAG)
+        parsed = utils.WebPushNotification.from_message_id(
+            message_id, conf.fernet)
+        assert parsed.uaid == notif.uaid
+        assert parsed.channel_id == notif.channel_id
+
+    def test_compact_message_id(self):
+        conf = AutopushConfig(crypto_key=[self.key1, self.key2])
+        for attrs in [dict(topic="mytopic"), dict(legacy=True), {}]:
+            notif = make_webpush_notification(dummy_uaid.hex,
+                                              str(dummy_chid))
+            for name, value in attrs.items():
+                setattr(notif, name, value)
+            message_id = notif.generate_message_id(conf.fernet, compact=True)
+            assert message_id.startswith(
+                utils.COMPACT_TAG + utils.fernet_key_id(self.key1))
+            assert len(message_id) < 100
+            parsed = utils.WebPushNotification.from_message_id(
+                message_id, conf.fernet)
+            assert parsed.uaid == notif.uaid
+            assert parsed.channel_id == notif.channel_id
+            assert parsed.topic == notif.topic
+            assert parsed.sortkey_timestamp == notif.sortkey_timestamp
+
+        # Rotated in keys parse them too
+        rotated = utils.KeyIdFernet([self.key2, self.key1])
+        parsed = utils.WebPushNotification.from_message_id(message_id,
+                                                           rotated)
+        assert parsed.sortkey_timestamp == notif.sortkey_timestamp
+
+    def test_invalid_compact_message_id(self):
+        fernet = utils.KeyIdFernet([self.key1])
+        message_id = fernet.encrypt_compact("\x01" + "a" * 32 + "topic")
+        for bad in [message_id[:-2] + "AA", message_id[:12], "c!!!!",
+                    utils.KeyIdFernet([self.key2]).encrypt_compact("x")]:
+            with self.assertRaises(InvalidToken):
+                fernet.decrypt(bad)
+
+        parse = utils.WebPushNotification.parse_decrypted_message_id
+        for bad in ["\x01" + "a" * 20, "\x01" + "a" * 32,
+                    "\x02" + "a" * 34, "\x00" + "a" * 33]:
+            with self.assertRaises(InvalidTokenException):
+                parse(bad)
+
+    def test_endpoint_token_cache(self):
+        conf = AutopushConfig(crypto_key=self.key1, endpoint_hostname="ep")
+        endpoint = conf.make_endpoint(dummy_uaid.hex, dummy_chid.hex)
+        token = endpoint.rsplit("/", 1)[-1]
+        metrics = Mock()
+        cache = EndpointHTTPFactory(conf, Mock(metrics=metrics),
+                                    {}).endpoint_token_cache
+        with patch.object(conf, "fernet", wraps=conf.fernet) as mock_fernet:
+            for _ in range(2):
+                result = conf.parse_endpoint(metrics, token,
+                                             token_cache=cache)
+                assert result["uaid"] == dummy_uaid.hex
+                assert result["chid"] == dummy_chid.hex
+        mock_fernet.decrypt.assert_called_once()
+        tags = ["cache:endpoint_token"]
+        metrics.increment.assert_any_call("cache.miss", tags=tags)
+        metrics.increment.assert_any_call("cache.hit", tags=tags)
+
+        cache.max_size = 0
+        cache.clear()
+        with patch.object(conf, "fernet", wraps=conf.fernet) as mock_fernet:
+            for _ in range(2):
+                conf.parse_endpoint(metrics, token, token_cache=cache)
+        assert mock_fernet.decrypt.call_count == 2
+
+
 class RegistrationTestCase(unittest.TestCase):
     CORS_HEAD = "POST"
 
@@ -501,6 +614,23 @@ class RegistrationTestCase(unittest.TestCase):
         assert user_data['router_type'] == 'test'
         assert user_data['router_data']['token'] == 'some_token'
 
+    @inlineCallbacks
+    def test_put_clears_dead_token(self):
+        data = dict(token="some_token")
+        self.routers["test"].register = Mock(return_value=data)
+        dead_tokens = self.client.app.dead_token_cache
+        user_data = dict(uaid=dummy_uaid.hex, router_type="test",
+                         router_data=data)
+        dead_tokens.add(user_data, 103)
+
+        resp = yield self.client.put(
+            self.url(router_type='test', uaid=dummy_uaid.hex),
+            headers={"Authorization": self.auth},
+            body=json.dumps(data),
+        )
+        assert resp.get_status() == 200
+        assert dead_tokens.get(user_data) is None
+
     @inlineCallbacks
     def test_put_bad_auth(self, *args):
         self.patch('uuid.uuid4', return_value=dummy_uaid)
@@ -3,7 +3,18 @@ import json
 import pytest
 import requests
 from mock import Mock
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    CancelledError,
+    Deferred,
+    DeferredSemaphore,
+    TimeoutError,
+    inlineCallbacks,
+)
+from twisted.internet.task import Clock
 from twisted.trial import unittest
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 
 from autopush.exceptions import RouterException
 from autopush.router import gcmclient
@@ -175,3 +186,168 @@ class GCMClientTestCase(unittest.TestCase):
         result = self.gcm.send(self.m_payload)
         assert 'some_reg_id' in result.retry_message.registration_ids
         assert result.retry_after == 123
+
+
+class FakeGCM(Resource):
+    """A local stand-in for the GCM HTTP endpoint"""
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+        self.code = 200
+        self.headers = {}
+        self.content = json.dumps({
+            "multicast_id": 5174939174563864884,
+            "success": 1,
+            "failure": 0,
+            "canonical_ids": 0,
+            "results": [
+                {
+                    "message_id": "0:1510011451922224%7a0e7efbaab8b7cc"
+                }
+            ]
+        })
+
+    def render_POST(self, request):
+        self.requests.append(dict(
+            authorization=request.getHeader("Authorization"),
+            payload=json.loads(request.content.read()),
+        ))
+        request.setResponseCode(self.code)
+        for name, value in self.headers.items():
+            request.setHeader(name, value)
+        return self.content
+
+
+class AsyncGCMClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeGCM()
+        self.port = reactor.listenTCP(0, Site(self.fake),
+                                      interface="127.0.0.1")
+        self.gcm = gcmclient.AsyncGCM(
+            api_key="FakeValue",
+            endpoint="http://127.0.0.1:%d/gcm/send" % (
+                self.port.getHost().port),
+            timeout=5,
+        )
+        self.m_payload = gcmclient.JSONMessage(
+            registration_ids="some_reg_id",
+            collapse_key="coll_key",
+            time_to_live=60,
+            dry_run=False,
+            data={"foo": "bar"}
+        )
+
+    def tearDown(self):
+        d = self.gcm._agent._pool.closeCachedConnections()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    @inlineCallbacks
+    def test_send(self):
+        result = yield self.gcm.send(self.m_payload)
+        assert result.success == {
+            "some_reg_id": "0:1510011451922224%7a0e7efbaab8b7cc"}
+        # The connection's reused
+        result = yield self.gcm.send(self.m_payload)
+        assert "some_reg_id" in result.success
+        assert len(self.gcm._agent._pool._connections) == 1
+        assert len(self.fake.requests) == 2
+        assert self.fake.requests[0] == dict(
+            authorization="key=FakeValue",
+            payload=self.m_payload.payload,
+        )
+
+    @inlineCallbacks
+    def test_fail_401(self):
+        self.fake.code = 401
+        with pytest.raises(gcmclient.GCMAuthenticationError):
+            yield self.gcm.send(self.m_payload)
+
+    @inlineCallbacks
+    def test_fail_400(self):
+        self.fake.code = 400
+        self.fake.content = "Bad Request"
+        with pytest.raises(RouterException) as ex:
+            yield self.gcm.send(self.m_payload)
+        assert ex.value.message == "Bad Request"
+
+    @inlineCallbacks
+    def test_retry_after(self):
+        self.fake.code = 503
+        self.fake.headers["Retry-After"] = "30"
+        result = yield self.gcm.send(self.m_payload)
+        assert result.retry_after == "30"
+        assert result.retry_message is self.m_payload
+        # GCM isn't contacted again until Retry-After has elapsed
+        with pytest.raises(RouterException) as ex:
+            yield self.gcm.send(self.m_payload)
+        assert ex.value.status_code == 503
+        assert ex.value.headers == {"Retry-After": "30"}
+        assert ex.value.extra["local"]
+        assert len(self.fake.requests) == 1
+
+
+class AsyncGCMQueueingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.agent = Mock()
+        self.agent.request.side_effect = lambda *args: Deferred()
+        self.gcm = gcmclient.AsyncGCM(api_key="FakeValue", agent=self.agent,
+                                      max_concurrent=2, timeout=3,
+                                      reactor=self.clock)
+        self.m_payload = gcmclient.JSONMessage(
+            registration_ids="some_reg_id",
+            collapse_key="coll_key",
+            time_to_live=60,
+            dry_run=False,
+            data={"foo": "bar"}
+        )
+
+    def test_max_concurrent(self):
+        results = [self.gcm.send(self.m_payload) for _ in range(3)]
+        assert self.agent.request.call_count == 2
+        self.clock.advance(2)
+        self.agent.request.side_effect = None
+        self.agent.request.return_value = Deferred()
+        results[0].cancel()
+        self.failureResultOf(results[0], CancelledError)
+        # The queued send began once a slot was free
+        assert self.agent.request.call_count == 3
+        self.clock.advance(1)
+        self.failureResultOf(results[1], TimeoutError)
+        # Its timeout includes its time queued
+        self.failureResultOf(results[2], TimeoutError)
+        assert not self.gcm._semaphore.waiting
+        assert self.gcm._semaphore.tokens == 2
+
+    def test_queue_full(self):
+        self.gcm = gcmclient.AsyncGCM(api_key="FakeValue", agent=self.agent,
+                                      max_concurrent=1, max_queue=1,
+                                      timeout=3, reactor=self.clock)
+        self.gcm.send(self.m_payload)
+        queued = self.gcm.send(self.m_payload)
+        d = self.gcm.send(self.m_payload)
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 503
+        assert exc.response_body == "GCM busy, please retry"
+        assert exc.extra["local"]
+        self.assertNoResult(queued)
+        assert self.agent.request.call_count == 1
+
+    def test_shared_semaphore(self):
+        semaphore = DeferredSemaphore(1)
+        clients = [gcmclient.AsyncGCM(api_key=key, agent=self.agent,
+                                      semaphore=semaphore, timeout=3,
+                                      reactor=self.clock)
+                   for key in ("FakeValue", "OtherValue")]
+        for gcm in clients:
+            gcm.send(self.m_payload)
+        assert self.agent.request.call_count == 1
+        assert len(semaphore.waiting) == 1
+
+    def test_default_endpoint(self):
+        assert self.gcm._endpoint == "https://gcm-http.googleapis.com/gcm/send"
@@ -0,0 +1,226 @@
+import os
+
+import cyclone.web
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.errors import ErrorCodes
+from h2.events import (
+    DataReceived,
+    ResponseReceived,
+    StreamEnded,
+    StreamReset,
+)
+from h2.settings import SettingCodes
+from twisted.internet.address import IPv4Address
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from autopush.config import AutopushConfig
+from autopush.http import EndpointHTTPFactory
+from autopush.ssl import (
+    ALPN_PROTOCOLS,
+    NO_OVERLAPPING_PROTOCOLS,
+    AutopushSSLContextFactory,
+)
+from autopush.tests.support import test_db
+from autopush.web.h2connection import (
+    NegotiatingHTTPConnection,
+    response_headers,
+)
+from autopush.web.limitedhttpconnection import LimitedHTTPConnection
+
+
+class EchoHandler(cyclone.web.RequestHandler):
+    def post(self):
+        self.set_header("X-Echo", "1")
+        self.write(self.request.body * int(self.get_argument("times", "1")))
+
+
+class H2ConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conf = AutopushConfig(
+            hostname="localhost",
+            statsd_host=None,
+            http2=True,
+            http2_max_concurrent_streams=10,
+        )
+        self.factory = EndpointHTTPFactory(
+            self.conf,
+            db=test_db(),
+            routers={},
+            handlers=[(r"/echo", EchoHandler),
+                      (r"/wpush/batch", EchoHandler)],
+        )
+        self.proto = self.factory.buildProtocol(
+            IPv4Address("TCP", "127.0.0.1", 8082))
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+        self.client = H2Connection(config=H2Configuration(
+            client_side=True, header_encoding=None))
+        self.client.initiate_connection()
+
+    def pump(self):
+        """Exchange pending data, returning the client's events"""
+        self.proto.dataReceived(self.client.data_to_send())
+        events = self.client.receive_data(self.transport.value())
+        self.transport.clear()
+        return events
+
+    def request(self, stream_id, path="/echo", body=b"", headers=()):
+        self.client.send_headers(stream_id, [
+            (b":method", b"POST"),
+            (b":path", path),
+            (b":scheme", b"https"),
+            (b":authority", b"localhost"),
+        ] + list(headers))
+        self.client.send_data(stream_id, body, end_stream=True)
+
+    def responses(self, events):
+        responses = {}
+        for event in events:
+            if isinstance(event, ResponseReceived):
+                responses[event.stream_id] = dict(
+                    headers=dict(event.headers), body=b"", ended=False)
+            elif isinstance(event, DataReceived):
+                responses[event.stream_id]["body"] += event.data
+                self.client.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, StreamEnded):
+                responses[event.stream_id]["ended"] = True
+        return responses
+
+    def test_factory(self):
+        assert self.factory.protocol is NegotiatingHTTPConnection
+        assert self.factory.ssl_cf() is None
+        conf = AutopushConfig(hostname="localhost", statsd_host=None)
+        factory = EndpointHTTPFactory(conf, db=test_db(), routers={})
+        assert factory.protocol is LimitedHTTPConnection
+
+    def test_multiplexed_streams(self):
+        self.request(1, body=b"one")
+        self.request(3, body=b"two")
+        responses = self.responses(self.pump())
+        assert responses[1]["body"] == b"one"
+        assert responses[3]["body"] == b"two"
+        assert responses[1]["ended"] and responses[3]["ended"]
+        headers = responses[1]["headers"]
+        assert headers[b":status"] == b"200"
+        assert headers[b"x-echo"] == b"1"
+        assert b"connection" not in headers
+        assert b"transfer-encoding" not in headers
+        assert not self.proto._h2conn.streams
+
+    def test_flow_control(self):
+        self.client.update_settings({SettingCodes.INITIAL_WINDOW_SIZE: 10})
+        self.pump()
+        self.request(1, path=b"/echo?times=5", body=b"0123456789")
+        responses = self.responses(self.pump())
+        assert responses[1]["body"] == b"0123456789"
+        assert not responses[1]["ended"]
+        # Sent as the client's window opens
+        body = b""
+        while True:
+            events = self.pump()
+            for event in events:
+                if isinstance(event, DataReceived):
+                    body += event.data
+                    self.client.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id)
+            if any(isinstance(event, StreamEnded) for event in events):
+                break
+        assert len(body) == 40
+
+    def test_data_limit(self):
+        self.proto.maxData = 5
+        self.proto.maxBulkData = 10
+        self.request(1, body=b"123456")
+        self.request(3, path=b"/wpush/batch", body=b"123456")
+        events = self.pump()
+        resets = [e for e in events if isinstance(e, StreamReset)]
+        assert [e.stream_id for e in resets] == [1]
+        assert resets[0].error_code == ErrorCodes.ENHANCE_YOUR_CALM
+        assert self.responses(events)[3]["body"] == b"123456"
+
+    def test_header_limit(self):
+        self.proto.maxHeaders = 2
+        self.request(1, headers=[(b"a", b"1"), (b"b", b"2"), (b"c", b"3")])
+        events = self.pump()
+        assert isinstance(events[-1], StreamReset)
+        # The connection remains usable
+        self.request(3, body=b"ok")
+        assert self.responses(self.pump())[3]["body"] == b"ok"
+
+    def test_stream_reset(self):
+        self.client.send_headers(1, [
+            (b":method", b"POST"),
+            (b":path", b"/echo"),
+            (b":scheme", b"https"),
+            (b":authority", b"localhost"),
+        ])
+        self.pump()
+        finished = self.proto._h2conn.streams[1].notifyFinish()
+        self.client.reset_stream(1)
+        self.pump()
+        assert self.successResultOf(finished) == "Stream reset"
+        assert not self.proto._h2conn.streams
+
+    def test_connection_lost(self):
+        self.client.send_headers(1, [
+            (b":method", b"POST"),
+            (b":path", b"/echo"),
+            (b":scheme", b"https"),
+            (b":authority", b"localhost"),
+        ])
+        self.pump()
+        finished = self.proto._h2conn.streams[1].notifyFinish()
+        self.proto.connectionLost(Failure(Exception("gone")))
+        assert self.successResultOf(finished) == "gone"
+
+    def test_protocol_error(self):
+        self.pump()
+        self.proto.dataReceived(b"\x00" * 20)
+        assert self.transport.disconnecting
+
+    def test_partial_preface(self):
+        data = self.client.data_to_send()
+        self.proto.dataReceived(data[:5])
+        assert self.proto._h2conn is None
+        self.proto.dataReceived(data[5:])
+        assert self.proto._h2conn is not None
+
+    def test_alpn_negotiated(self):
+        proto = self.factory.buildProtocol(
+            IPv4Address("TCP", "127.0.0.1", 8082))
+        transport = StringTransport()
+        transport.negotiatedProtocol = b"h2"
+        proto.makeConnection(transport)
+        # Not a valid preface
+        proto.dataReceived(b"GET / HTTP/1.1\r\n\r\n")
+        assert proto._h2conn is not None
+        assert transport.disconnecting
+
+    def test_http11_fallback(self):
+        self.proto.dataReceived(
+            b"POST /echo HTTP/1.1\r\nHost: localhost\r\n"
+            b"Content-Length: 5\r\n\r\nhello")
+        assert self.proto._h2conn is None
+        response = self.transport.value()
+        assert response.startswith(b"HTTP/1.1 200")
+        assert response.endswith(b"hello")
+
+    def test_response_headers(self):
+        headers = response_headers(
+            b"HTTP/2.0 201 Created\r\nLocation: http://x/m/1\r\n"
+            b"Connection: Keep-Alive")
+        assert headers == [(b":status", b"201"),
+                           (b"location", b"http://x/m/1")]
+
+    def test_select_alpn(self):
+        servercert = os.path.join(os.path.dirname(__file__), "certs",
+                                  "server.pem")
+        cf = AutopushSSLContextFactory(servercert, servercert,
+                                       alpn_protocols=ALPN_PROTOCOLS)
+        assert cf._select_alpn(None, [b"http/1.1", b"h2"]) == b"h2"
+        assert cf._select_alpn(None, [b"http/1.1"]) == b"http/1.1"
+        assert cf._select_alpn(None, [b"spdy/3"]) is NO_OVERLAPPING_PROTOCOLS
@@ -2206,6 +2206,17 @@ class TestMemUsage(IntegrationBase):
         if hasattr(sys, 'pypy_version_info'):  # pragma: nocover
             assert 'size: ' not in body
             assert 'rpy_unicode' not in body
+        assert 'bytes per idle connection' not in body
+
+    @inlineCallbacks
+    def test_memusage_connection_state(self):
+        port = self.ep.conf.memusage_port
+        url = ("http://localhost:{}/_memusage?objgraph=false&"
+               "dump_rpy_heap=false&connection_state=true").format(port)
+        response, body = yield _agent('GET', url)
+        assert response.code == 200
+        if not hasattr(sys, 'pypy_version_info'):  # pragma: nocover
+            assert 'bytes per idle connection' in body
 
 
 @inlineCallbacks
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+from twisted.trial import unittest
+
+from autopush import jsoncodec
+from autopush.scripts.bench_json import (
+    deliver,
+    make_notifications,
+    run,
+    serialize,
+)
+
+
+class JSONCodecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, jsoncodec, "codec", jsoncodec.codec)
+
+    def test_select(self):
+        assert jsoncodec.select("json").name == "json"
+        assert jsoncodec.dumps({"a": [1]}) == '{"a": [1]}'
+        codec = jsoncodec.select()
+        assert codec.name in jsoncodec.CODECS
+        assert codec.name != "json"
+        with pytest.raises(ValueError):
+            jsoncodec.select("cjson")
+
+    def test_codecs(self):
+        msg = {"messageType": "ack", "updates": [
+            {"channelID": "0a1b", "version": u"gAAAA\u00e9", "code": 100}]}
+        for name in jsoncodec.CODECS:
+            jsoncodec.select(name)
+            encoded = jsoncodec.dumps(msg)
+            assert isinstance(encoded, str)
+            assert json.loads(encoded) == msg
+            assert jsoncodec.loads(encoded) == msg
+            assert jsoncodec.loads(json.dumps(msg).encode('utf8')) == msg
+            with pytest.raises(ValueError):
+                jsoncodec.loads("{")
+
+    def test_bench(self):
+        results = run(count=10, data_length=16)
+        assert sorted(results) == sorted(
+            (name, mode) for name in jsoncodec.CODECS
+            for mode in ("preencoded", "reencoded"))
+        assert all(endpoint > 0 and node > 0
+                   for endpoint, node in results.values())
+
+    def test_bench_deliver(self):
+        notif = make_notifications(1)[0]
+        ack = jsoncodec.dumps({})
+        assert deliver(notif.uaid, serialize(notif, True), ack) == \
+            deliver(notif.uaid, serialize(notif, False), ack)
@@ -49,3 +49,22 @@ class TestLimitedHttpConnection(unittest.TestCase):
         conn._on_request_body.assert_called()
         conn.rawDataReceived("12345678901")
         mock_transport.loseConnection.assert_called()
+
+    def test_rawDataReceived_bulk(self):
+        mock_transport = Mock()
+        conn = LimitedHTTPConnection()
+        conn.factory = Mock()
+        conn.factory.conf = {}
+        conn.makeConnection(mock_transport)
+        conn._on_request_body = Mock()
+        conn._contentbuffer = BytesIO()
+        conn._request = Mock(path="/wpush/batch")
+
+        conn.maxData = 10
+        conn.maxBulkData = 20
+        conn.content_length = 30
+        # Batch submissions limit their entire body
+        conn.rawDataReceived("123456789012345")
+        eq_(False, mock_transport.loseConnection.called)
+        conn.rawDataReceived("123456")
+        mock_transport.loseConnection.assert_called()
@@ -0,0 +1,200 @@
+from mock import Mock
+from twisted.internet.defer import Deferred, TimeoutError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from autopush.config import AutopushConfig
+from autopush.exceptions import RouterException
+from autopush.metrics import SinkMetrics
+from autopush.router.interface import RouterResponse
+from autopush.router.limiter import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    BridgeLimiter,
+    bridge_failed,
+    bridge_limiter,
+    rejected_locally,
+)
+
+
+class BridgeLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Mock(spec=SinkMetrics)
+        self.tags = ["platform:gcm", "senderid:12345"]
+        self.limiter = BridgeLimiter(4, self.metrics, self.tags,
+                                     target_latency=1, failure_threshold=3,
+                                     reset_timeout=30, clock=self.clock)
+        self.pending = []
+
+    def _send(self):
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+    def _route(self):
+        return self.limiter.run(self._send)
+
+    def _respond(self, result=None):
+        self.pending.pop(0).callback(result)
+
+    def _fail(self, exc):
+        self.pending.pop(0).errback(exc)
+
+    def _route_failed(self, exc):
+        d = self._route()
+        self._fail(exc)
+        self.failureResultOf(d, exc.__class__)
+
+    def test_bridge_failed(self):
+        assert not bridge_failed(RouterResponse(status_code=201))
+        assert not bridge_failed(RouterResponse(status_code=503))
+        assert bridge_failed(Failure(TimeoutError()))
+        assert bridge_failed(Failure(RouterException("x", status_code=502)))
+        assert not bridge_failed(Failure(
+            RouterException("x", status_code=410)))
+        assert not bridge_failed(Failure(
+            RouterException("x", status_code=502, bridge_status=400)))
+        local = Failure(RouterException("x", status_code=503, local=True))
+        assert not bridge_failed(local)
+        assert rejected_locally(local)
+        assert not rejected_locally(Failure(
+            RouterException("x", status_code=503)))
+        assert not rejected_locally(Failure(TimeoutError()))
+        assert not rejected_locally(RouterResponse(status_code=201))
+
+    def test_limit(self):
+        results = [self._route() for _ in range(5)]
+        assert self.limiter.in_flight == 4
+        exc = self.failureResultOf(results[4], RouterException).value
+        assert exc.status_code == 503
+        assert exc.errno == 201
+        assert exc.headers == {"Retry-After": "1"}
+        self.metrics.increment.assert_called_with(
+            "notification.bridge.rejected",
+            tags=self.tags + ["reason:limit"])
+        self._respond("sent")
+        assert self.successResultOf(results[0]) == "sent"
+        assert self.limiter.in_flight == 3
+        self.assertNoResult(self._route())
+
+    def test_slow_responses(self):
+        self._route()
+        self.clock.advance(2)
+        self._respond()
+        assert self.limiter.limit == 3.6
+        self.metrics.gauge.assert_called_with(
+            "notification.bridge.limit", 3, tags=self.tags)
+        # Timely responses grow it back while it's in use
+        for _ in range(20):
+            for _ in range(3):
+                self._route()
+            for _ in range(3):
+                self._respond()
+        assert self.limiter.limit == 4
+
+    def test_unused_limit(self):
+        self.limiter.limit = 3.0
+        self._route()
+        self._respond()
+        assert self.limiter.limit == 3.0
+
+    def test_min_limit(self):
+        for _ in range(50):
+            self._route()
+            self.clock.advance(2)
+            self._respond()
+        assert self.limiter.limit == 1
+        assert self.limiter.state == CLOSED
+        self._route()
+        self.failureResultOf(self._route(), RouterException)
+
+    def test_client_errors(self):
+        for _ in range(5):
+            self._route_failed(RouterException("Gone", status_code=410))
+        assert self.limiter.state == CLOSED
+        assert self.limiter.limit == 4
+
+    def test_local_rejections(self):
+        self._route_failed(TimeoutError())
+        self._route_failed(TimeoutError())
+        limit = self.limiter.limit
+        # The node's own full queue: neither a failure nor a success
+        for _ in range(5):
+            self._route_failed(RouterException(
+                "Too many requests", status_code=503, local=True))
+        assert self.limiter.state == CLOSED
+        assert self.limiter.limit == limit
+        assert self.limiter.failures == 2
+        assert self.limiter.in_flight == 0
+        # Still a failure short of opening the circuit
+        self._route_failed(TimeoutError())
+        assert self.limiter.state == OPEN
+
+    def test_circuit(self):
+        for _ in range(3):
+            self._route_failed(TimeoutError())
+        assert self.limiter.state == OPEN
+        self.metrics.gauge.assert_called_with(
+            "notification.bridge.circuit_open", 1, tags=self.tags)
+        self.clock.advance(10)
+        exc = self.failureResultOf(self._route(), RouterException).value
+        assert exc.status_code == 503
+        assert exc.headers == {"Retry-After": "20"}
+        self.metrics.increment.assert_called_with(
+            "notification.bridge.rejected",
+            tags=self.tags + ["reason:circuit_open"])
+        assert not self.pending
+
+        # A single trial request
+        self.clock.advance(20)
+        trial = self._route()
+        assert self.limiter.state == HALF_OPEN
+        self.failureResultOf(self._route(), RouterException)
+        self._respond()
+        self.successResultOf(trial)
+        assert self.limiter.state == CLOSED
+        self.metrics.increment.assert_called_with(
+            "notification.bridge.circuit", tags=self.tags + ["state:closed"])
+        self.metrics.gauge.assert_called_with(
+            "notification.bridge.circuit_open", 0, tags=self.tags)
+
+    def test_failed_trial(self):
+        self.limiter.state = OPEN
+        self.clock.advance(30)
+        self._route_failed(RouterException("Server error", status_code=502))
+        assert self.limiter.state == OPEN
+        exc = self.failureResultOf(self._route(), RouterException).value
+        assert exc.headers == {"Retry-After": "30"}
+
+    def test_successes_reset_failures(self):
+        for _ in range(2):
+            self._route_failed(TimeoutError())
+        self._route()
+        self._respond()
+        self._route_failed(TimeoutError())
+        assert self.limiter.state == CLOSED
+
+    def test_sync_exception(self):
+        def route():
+            raise RouterException("Too big", status_code=413)
+        self.failureResultOf(self.limiter.run(route), RouterException)
+        assert self.limiter.in_flight == 0
+
+    def test_bridge_limiter(self):
+        conf = AutopushConfig(hostname="localhost", statsd_host=None)
+        assert bridge_limiter(conf, self.metrics, self.tags) is None
+        conf = AutopushConfig(hostname="localhost", statsd_host=None,
+                              bridge_max_concurrency=10,
+                              bridge_target_latency=0.5,
+                              bridge_failure_threshold=2,
+                              bridge_reset_timeout=60)
+        limiter = bridge_limiter(conf, self.metrics, self.tags)
+        assert limiter.limit == 10
+        assert limiter.target_latency == 0.5
+        assert limiter.failure_threshold == 2
+        assert limiter.reset_timeout == 60
+        assert limiter.tags == self.tags
@@ -11,6 +11,7 @@ from autopush.metrics import (
     TwistedMetrics,
     SinkMetrics,
     periodic_reporter,
+    shared_tags,
 )
 
 
@@ -73,6 +74,18 @@ class DatadogMetricsTestCase(unittest.TestCase):
         m._client.timing.assert_called_with("testpush.lifespan", value=113,
                                             host=hostname)
 
+    @patch("autopush.metrics.datadog")
+    def test_shared_tags(self, mock_dog):
+        m = DatadogMetrics("someapikey", "someappkey", hostname="localhost")
+        m._client = Mock(constant_tags=[])
+        tags = shared_tags(["host:example.com"])
+        m.increment("test", tags=tags)
+        assert m._client.increment.call_args[1]["tags"] is tags
+        # A list, for ThreadStats to add its constant tags to
+        m._client.constant_tags = ["env:test"]
+        m.increment("test", tags=tags)
+        assert m._client.increment.call_args[1]["tags"] == list(tags)
+
 
 class PeriodicReporterTestCase(unittest.TestCase):
 
@@ -88,3 +101,16 @@ class PeriodicReporterTestCase(unittest.TestCase):
             call('foo.twisted.threadpool.busyWorkerCount', 0),
             call('foo.twisted.threadpool.backloggedWorkCount', 0),
         ])
+
+
+class SharedTagsTestCase(unittest.TestCase):
+    def test_shared(self):
+        tags = shared_tags(["host:" + "example.com", "use_webpush:True"])
+        assert tags == ("host:example.com", "use_webpush:True")
+        assert shared_tags(list(tags)) is tags
+
+    @patch("autopush.metrics.MAX_SHARED_TAGS", 0)
+    def test_bounded(self):
+        tags = ["host:bounded.example.com"]
+        assert shared_tags(tags) == tuple(tags)
+        assert shared_tags(tags) is not shared_tags(tags)
@@ -0,0 +1,138 @@
+import uuid
+
+from mock import Mock
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.internet.error import ConnectError, ConnectionClosed
+from twisted.trial import unittest
+
+from autopush.config import AutopushConfig
+from autopush.metrics import SinkMetrics
+from autopush.node_transport import (
+    NodeResponse,
+    NodeTransport,
+    NodeTransportServerFactory,
+)
+from autopush.tests.support import test_db
+
+dummy_uaid = uuid.UUID("abad1dea00000000aabbccdd00000000").hex
+
+
+class NodeTransportTestCase(unittest.TestCase):
+    def setUp(self):
+        conf = AutopushConfig(
+            hostname="localhost",
+            statsd_host=None,
+        )
+        self.clients = {}
+        self.factory = NodeTransportServerFactory(conf, test_db(),
+                                                  self.clients)
+        self.port = reactor.listenTCP(0, self.factory, interface="127.0.0.1")
+        self.node_id = "http://127.0.0.1:8081"
+        self.transport = NodeTransport(self.port.getHost().port,
+                                       SinkMetrics())
+
+    @inlineCallbacks
+    def tearDown(self):
+        self.transport.close()
+        yield self.port.stopListening()
+
+    @inlineCallbacks
+    def test_push(self):
+        result = yield self.transport.push(self.node_id, dummy_uaid,
+                                           dict(version="1"))
+        assert result == NodeResponse(404)
+
+        self.clients[dummy_uaid] = client = Mock(paused=True)
+        result = yield self.transport.push(self.node_id, dummy_uaid, {})
+        assert result.code == 503
+
+        client.paused = False
+        result = yield self.transport.push(self.node_id, dummy_uaid,
+                                           dict(version="1"))
+        assert result.code == 200
+        client.send_notification.assert_called_once_with(dict(version="1"))
+
+    @inlineCallbacks
+    def test_notif(self):
+        result = yield self.transport.notif(self.node_id, dummy_uaid)
+        assert result.code == 404
+
+        self.clients[dummy_uaid] = client = Mock(paused=True)
+        result = yield self.transport.notif(self.node_id, dummy_uaid)
+        assert result.code == 202
+        assert client._check_notifications is True
+
+        client.paused = False
+        result = yield self.transport.notif(self.node_id, dummy_uaid)
+        assert result.code == 200
+        client.process_notifications.assert_called_once_with()
+
+    @inlineCallbacks
+    def test_drop(self):
+        self.clients[dummy_uaid] = client = Mock()
+        client.ps.connected_at = 10
+        yield self.transport.drop(self.node_id, dummy_uaid, 9)
+        assert not client.sendClose.called
+        result = yield self.transport.drop(self.node_id, dummy_uaid, 10)
+        assert result.code == 200
+        client.sendClose.assert_called_once_with()
+
+    @inlineCallbacks
+    def test_pipelined(self):
+        self.clients[dummy_uaid] = client = Mock(paused=False)
+        results = yield gatherResults([
+            self.transport.push(self.node_id, dummy_uaid, dict(version=str(i)))
+            for i in range(10)
+        ])
+        assert [r.code for r in results] == [200] * 10
+        assert client.send_notification.call_count == 10
+        assert len(self.transport._connections) == 1
+
+    @inlineCallbacks
+    def test_reconnect(self):
+        yield self.transport.notif(self.node_id, dummy_uaid)
+        conn = self.transport._connections[self.node_id]
+        conn.transport.loseConnection()
+        yield self.transport.notif(self.node_id, dummy_uaid)
+        assert self.transport._connections[self.node_id] is not conn
+
+    @inlineCallbacks
+    def test_connection_lost(self):
+        self.clients[dummy_uaid] = Mock(paused=False)
+        yield self.transport.notif(self.node_id, dummy_uaid)
+        conn = self.transport._connections[self.node_id]
+        # Drop the connection before the node responds
+        conn.sendString = lambda frame: conn.transport.loseConnection()
+        with self.assertRaises(ConnectionClosed):
+            yield self.transport.notif(self.node_id, dummy_uaid)
+        assert self.node_id not in self.transport._connections
+
+    @inlineCallbacks
+    def test_timeout(self):
+        yield self.transport.notif(self.node_id, dummy_uaid)
+        conn = self.transport._connections[self.node_id]
+        # The node stops responding
+        conn.sendString = lambda frame: None
+        pending = conn.request(dict(cmd="notif", uaid=dummy_uaid))
+        self.transport.request_timeout = 0.1
+        with self.assertRaises(ConnectionClosed):
+            yield self.transport.notif(self.node_id, dummy_uaid)
+        # Failing its other pending requests
+        with self.assertRaises(ConnectionClosed):
+            yield pending
+        assert self.node_id not in self.transport._connections
+        assert conn._pending == {}
+
+    @inlineCallbacks
+    def test_invalid_frame(self):
+        yield self.transport.notif(self.node_id, dummy_uaid)
+        conn = self.transport._connections[self.node_id]
+        with self.assertRaises(ConnectionClosed):
+            yield conn.request(dict(cmd="bogus"))
+
+    @inlineCallbacks
+    def test_connect_error(self):
+        yield self.port.stopListening()
+        with self.assertRaises(ConnectError):
+            yield self.transport.push(self.node_id, dummy_uaid, {})
@@ -7,20 +7,33 @@ import decimal
 import requests
 import socket
 import ssl
+import threading
 
 import pytest
+from botocore.credentials import Credentials
 from botocore.exceptions import ClientError
 from mock import Mock, PropertyMock, patch
 from twisted.trial import unittest
 from twisted.internet.error import ConnectionRefusedError
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred,
+    TimeoutError,
+    fail,
+    inlineCallbacks,
+    succeed,
+)
+from twisted.internet.task import Clock
+from twisted.internet.threads import deferToThread
 from twisted.web.client import Agent
+from twisted.web.server import Site
 
 import hyper
 import hyper.tls
 import pyfcm
 from hyper.http20.exceptions import HTTP20Error
 
+from autopush.async_dynamodb import AsyncDynamoDBClient
 from autopush.config import AutopushConfig
 from autopush.db import (
     Message
@@ -33,7 +46,17 @@ from autopush.router import (
     WebPushRouter,
     FCMRouter,
     gcmclient)
+from autopush.router.apns_async import APNSConnectionError, AsyncAPNSClient
+from autopush.router.fcmclient import AsyncFCM
 from autopush.router.interface import RouterResponse, IRouter
+from autopush.router.limiter import BridgeLimiter
+from autopush.node_transport import NodeResponse, NodeTransport
+from autopush.router.webpush import (
+    BatchedResponse,
+    BatchResponseError,
+    NotificationBatcher,
+)
+from autopush.scripts.bench_fcm import FakeFCM, SENDER_ID, make_router, run
 from autopush.tests import MockAssist
 from autopush.tests.support import test_db
 from autopush.utils import WebPushNotification
@@ -155,8 +178,7 @@ class APNSRouterTestCase(unittest.TestCase):
         def raiser(*args, **kwargs):
             raise ConnectionError("oops")
 
-        self.router.apns['firefox'].connections[1].request = Mock(
-            side_effect=raiser)
+        self.mock_connection.request = Mock(side_effect=raiser)
 
         with pytest.raises(RouterException) as ex:
             yield self.router.route_notification(self.notif, self.router_data)
@@ -174,8 +196,7 @@ class APNSRouterTestCase(unittest.TestCase):
             error.errno = socket.errno.EPIPE
             raise error
 
-        self.router.apns['firefox'].connections[1].request = Mock(
-            side_effect=raiser)
+        self.mock_connection.request = Mock(side_effect=raiser)
 
         with pytest.raises(RouterException) as ex:
             yield self.router.route_notification(self.notif, self.router_data)
@@ -262,6 +283,18 @@ class APNSRouterTestCase(unittest.TestCase):
         assert ex.value.message == 'APNS Transmit Error 400:boo'
         assert ex.value.response_body == (
             'APNS could not process your message boo')
+        assert ex.value.extra == {'bridge_status': 400}
+
+    @inlineCallbacks
+    def test_unregistered(self):
+        self.mock_response.status = 410
+        self.mock_response.read.return_value = json.dumps(
+            {'reason': 'Unregistered'})
+        result = yield self.router.route_notification(self.notif,
+                                                      self.router_data)
+        assert result.status_code == 410
+        assert result.errno == 103
+        assert result.router_data == {}
 
     @inlineCallbacks
     def test_fail_send(self):
@@ -313,6 +346,7 @@ class APNSRouterTestCase(unittest.TestCase):
         assert ex.value.message == "Too many APNS requests, " \
                                    "increase pool from 2"
         assert ex.value.response_body == "APNS busy, please retry"
+        assert ex.value.extra["local"]
 
     def test_amend(self):
         resp = {"key": "value"}
@@ -340,11 +374,219 @@ class APNSRouterTestCase(unittest.TestCase):
             assert result.status_code == 201
             assert result.logged_status == 200
             assert "TTL" in result.headers
-            assert self.mock_connection.called
+            assert self.mock_connection.request.called
 
         d.addCallback(check_results)
         return d
 
+    @patch('autopush.router.apns2.HTTP20Connection',
+           spec=hyper.HTTP20Connection)
+    def test_lazy_connections(self, mc):
+        client = self.router._connect("firefox", load_connections=False)
+        assert mc.call_count == 0
+        first = client._get_connection()
+        second = client._get_connection()
+        assert mc.call_count == 2
+        with pytest.raises(RouterException) as ex:
+            client._get_connection()
+        assert ex.value.status_code == 503
+        # The most recently used is reused first
+        client._return_connection(first)
+        client._return_connection(second)
+        assert client._get_connection() is second
+        assert mc.call_count == 2
+        self.metrics.gauge.assert_called_with(
+            "notification.bridge.apns.connections", 2,
+            tags=["platform:apns", "topic:com.example.SomeApp"])
+
+    @patch('autopush.router.apns2.HTTP20Connection',
+           spec=hyper.HTTP20Connection)
+    def test_retire_idle(self, mc):
+        client = self.router._connect("firefox", load_connections=False)
+        idle = client._get_connection()
+        client._return_connection(idle)
+        client._last_used[idle] -= client._idle_timeout + 1
+        client._get_connection()
+        assert idle.close.called
+        assert not client.connections
+        # Replaced by a new connection
+        assert mc.call_count == 2
+        assert client._connection_count == 1
+        self.metrics.increment.assert_any_call(
+            "notification.bridge.apns.connection.retired",
+            tags=["platform:apns", "topic:com.example.SomeApp",
+                  "reason:idle"])
+
+    @patch('autopush.router.apns2.HTTP20Connection',
+           spec=hyper.HTTP20Connection)
+    def test_send_pool_exhausted(self, mc):
+        client = self.router._connect("firefox", load_connections=False)
+        client._get_connection()
+        client._get_connection()
+        with pytest.raises(RouterException) as ex:
+            client.send("token", {}, "apns-id")
+        assert ex.value.status_code == 503
+
+    @patch('autopush.router.apns2.HTTP20Connection',
+           spec=hyper.HTTP20Connection)
+    def test_concurrent_pool(self, mc):
+        client = self.router._connect("firefox", load_connections=False)
+        errors = []
+
+        def churn():
+            for _ in range(500):
+                try:
+                    conn = client._get_connection()
+                except RouterException:
+                    continue
+                except Exception as ex:  # pragma: nocover
+                    errors.append(ex)
+                    return
+                if client._connection_count > 2:  # pragma: nocover
+                    errors.append(client._connection_count)
+                # Expired, for the next to retire it
+                client._return_connection(conn)
+                with client._lock:
+                    client._last_used[conn] = 0
+
+        threads = [threading.Thread(target=churn) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert 0 <= client._connection_count <= 2
+        assert client._connection_count == len(client.connections)
+
+
+class AsyncAPNSRouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        conf = AutopushConfig(
+            hostname="localhost",
+            statsd_host=None,
+        )
+        apns_config = {
+            'firefox':
+                {'cert': 'fake.cert',
+                 'key': 'fake.key',
+                 'topic': 'com.example.SomeApp',
+                 'max_connections': 2,
+                 'max_queue': 10,
+                 'async': True,
+                 }
+        }
+        self.metrics = Mock(spec=SinkMetrics)
+        self.router = APNSRouter(conf, apns_config, self.metrics,
+                                 load_connections=False)
+        self.client = self.router.apns['firefox']
+        self.client.send = Mock(return_value=succeed(None))
+        self.notif = WebPushNotification(
+            uaid=uuid.UUID(dummy_uaid),
+            channel_id=uuid.UUID(dummy_chid),
+            data="q60d6g",
+            headers={"content-encoding": "aesgcm",
+                     "encryption": "test",
+                     "encryption-key": "test"},
+            ttl=200,
+            message_id=10,
+        )
+        self.notif.cleanup_headers()
+        self.router_data = dict(router_data=dict(token="connect_data",
+                                                 rel_channel="firefox"))
+
+    def test_connect(self):
+        assert isinstance(self.client, AsyncAPNSClient)
+        assert self.client._max_connections == 2
+        assert self.client._max_queue == 10
+        assert self.client.topic == "com.example.SomeApp"
+
+    def test_route_notification(self):
+        result = self.successResultOf(
+            self.router.route_notification(self.notif, self.router_data))
+        assert isinstance(result, RouterResponse)
+        assert result.status_code == 201
+        kwargs = self.client.send.call_args[1]
+        assert kwargs["router_token"] == "connect_data"
+        assert kwargs["payload"]["body"] == "q60d6g"
+        self.metrics.increment.assert_any_call(
+            "notification.bridge.sent",
+            tags=["platform:apns", "application:firefox"])
+
+    def test_connection_error(self):
+        self.client.send.return_value = fail(APNSConnectionError("lost"))
+        d = self.router.route_notification(self.notif, self.router_data)
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 502
+        self.metrics.increment.assert_called_with(
+            "notification.bridge.connection.error",
+            tags=["platform:apns", "application:firefox",
+                  "reason:connection_error"])
+
+    def test_timeout(self):
+        self.client.send.return_value = fail(TimeoutError())
+        d = self.router.route_notification(self.notif, self.router_data)
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 502
+        self.metrics.increment.assert_called_with(
+            "notification.bridge.connection.error",
+            tags=["platform:apns", "application:firefox",
+                  "reason:timeout"])
+
+    def test_rejected(self):
+        self.client.send.return_value = fail(RouterException(
+            "APNS Transmit Error 400:BadDeviceToken", status_code=502))
+        d = self.router.route_notification(self.notif, self.router_data)
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.message == "APNS Transmit Error 400:BadDeviceToken"
+
+    def test_unregistered(self):
+        self.client.send.return_value = fail(RouterException(
+            "APNS Transmit Error 410:Unregistered", status_code=502,
+            bridge_status=410))
+        result = self.successResultOf(
+            self.router.route_notification(self.notif, self.router_data))
+        assert result.status_code == 410
+        assert result.errno == 103
+        assert result.router_data == {}
+        self.metrics.increment.assert_called_with(
+            "notification.bridge.error",
+            tags=["platform:apns", "application:firefox",
+                  "reason:unregistered"])
+
+    def test_limiter(self):
+        conf = AutopushConfig(
+            hostname="localhost",
+            statsd_host=None,
+            bridge_max_concurrency=10,
+            bridge_failure_threshold=2,
+        )
+        apns_config = {'firefox': {'cert': 'fake.cert',
+                                   'key': 'fake.key',
+                                   'async': True}}
+        router = APNSRouter(conf, apns_config, self.metrics,
+                            load_connections=False)
+        limiter = router.limiters["firefox"]
+        assert limiter.tags == ["platform:apns", "application:firefox"]
+        client = router.apns["firefox"]
+        # Rejected tokens don't open the circuit
+        client.send = Mock(side_effect=lambda **kwargs: fail(RouterException(
+            "APNS Transmit Error 400:BadDeviceToken", status_code=502,
+            bridge_status=400)))
+        for _ in range(3):
+            d = router.route_notification(self.notif, self.router_data)
+            self.failureResultOf(d, RouterException)
+        assert limiter.state == "closed"
+        client.send.side_effect = lambda **kwargs: fail(
+            APNSConnectionError("lost"))
+        for _ in range(2):
+            d = router.route_notification(self.notif, self.router_data)
+            self.failureResultOf(d, RouterException)
+        assert limiter.state == "open"
+        self.metrics.increment.assert_any_call(
+            "notification.bridge.circuit",
+            tags=["platform:apns", "application:firefox", "state:open"])
+
 
 class GCMRouterTestCase(unittest.TestCase):
 
@@ -702,6 +944,181 @@ class GCMRouterTestCase(unittest.TestCase):
                 app_id="invalid")
 
 
+class AsyncGCMRouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        conf = AutopushConfig(
+            hostname="localhost",
+            statsd_host=None,
+        )
+        self.gcm_config = {'max_data': 32,
+                           'ttl': 60,
+                           'async': True,
+                           'max_connections': 5,
+                           'senderIDs': {'test123':
+                                         {"auth": "12345678abcdefg"}}}
+        self.router = GCMRouter(conf, self.gcm_config, SinkMetrics())
+        self.response = gcmclient.AgentResponse(200, {}, json.dumps({
+            "multicast_id": 5174939174563864884,
+            "success": 1,
+            "failure": 0,
+            "canonical_ids": 0,
+            "results": [
+                {
+                    "message_id": "0:1510011451922224%7a0e7efbaab8b7cc"
+                }
+            ]
+        }))
+        self.gcm = self.router.gcm['test123']
+        self.gcm.send = Mock(
+            side_effect=lambda payload: succeed(
+                gcmclient.Result(payload, self.response)))
+        self.notif = WebPushNotification(
+            uaid=uuid.UUID(dummy_uaid),
+            channel_id=uuid.UUID(dummy_chid),
+            data="q60d6g",
+            headers={"content-encoding": "aesgcm",
+                     "encryption": "test",
+                     "encryption-key": "test"},
+            ttl=200,
+            message_id=10,
+        )
+        self.notif.cleanup_headers()
+        self.router_data = dict(
+            router_data=dict(
+                token="connect_data",
+                creds=dict(senderID="test123", auth="12345678abcdefg")))
+
+    def _check_error(self, d, code, errno=None):
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == code
+        assert exc.errno == errno
+        self.flushLoggedErrors()
+
+    def test_init(self):
+        assert isinstance(self.gcm, gcmclient.AsyncGCM)
+        assert self.gcm._semaphore.limit == 5
+        assert self.gcm._agent._pool.maxPersistentPerHost == 5
+
+    def test_init_shared_semaphore(self):
+        self.gcm_config["senderIDs"]["other"] = {"auth": "abcdefg"}
+        router = GCMRouter(AutopushConfig(hostname="localhost",
+                                          statsd_host=None),
+                           self.gcm_config, SinkMetrics())
+        # The SenderIDs share the max concurrent requests
+        assert (router.gcm["test123"]._semaphore is
+                router.gcm["other"]._semaphore)
+
+    def test_queue_full(self):
+        self.gcm.send.side_effect = lambda payload: fail(RouterException(
+            "Too many GCM requests, increase queue from 1000",
+            status_code=503, response_body="GCM busy, please retry",
+            log_exception=False))
+        d = self.router.route_notification(self.notif, self.router_data)
+        self._check_error(d, 503)
+
+    def test_route_notification(self):
+        result = self.successResultOf(
+            self.router.route_notification(self.notif, self.router_data))
+        assert isinstance(result, RouterResponse)
+        assert result.status_code == 201
+        assert result.headers["TTL"] == 200
+        payload = self.gcm.send.call_args[0][0]
+        assert payload.payload["registration_ids"] == ["connect_data"]
+        assert payload.payload["data"]["body"] == "q60d6g"
+
+    def test_long_data(self):
+        self.notif.data = "\x01abcdefghijklmnopqrstuvwxyz0123456789"
+        d = self.router.route_notification(self.notif, self.router_data)
+        self._check_error(d, 413, errno=104)
+        assert not self.gcm.send.called
+
+    def test_needs_retry(self):
+        self.response = gcmclient.AgentResponse(
+            503, {"Retry-After": "60"}, "")
+        d = self.router.route_notification(self.notif, self.router_data)
+        self._check_error(d, 503)
+
+    def test_no_auth(self):
+        self.router_data["router_data"]["creds"]["senderID"] = "unknown"
+        d = self.router.route_notification(self.notif, self.router_data)
+        self._check_error(d, 500, errno=900)
+
+    def test_auth_error(self):
+        self.gcm.send.side_effect = lambda payload: fail(
+            gcmclient.GCMAuthenticationError())
+        d = self.router.route_notification(self.notif, self.router_data)
+        self._check_error(d, 500, errno=901)
+
+    def test_connection_error(self):
+        self.gcm.send.side_effect = lambda payload: fail(
+            ConnectionRefusedError())
+        d = self.router.route_notification(self.notif, self.router_data)
+        self._check_error(d, 502, errno=902)
+
+    def test_timeout(self):
+        self.gcm.send.side_effect = lambda payload: fail(TimeoutError())
+        d = self.router.route_notification(self.notif, self.router_data)
+        self._check_error(d, 502, errno=902)
+
+    def test_other_error(self):
+        self.gcm.send.side_effect = lambda payload: fail(Exception("oops"))
+        d = self.router.route_notification(self.notif, self.router_data)
+        self._check_error(d, 500)
+
+    def test_server_error(self):
+        self.response = gcmclient.AgentResponse(500, {}, "")
+        d = self.router.route_notification(self.notif, self.router_data)
+        self._check_error(d, 502, errno=902)
+
+    def test_limiter(self):
+        conf = AutopushConfig(
+            hostname="localhost",
+            statsd_host=None,
+            bridge_max_concurrency=2,
+            bridge_failure_threshold=2,
+        )
+        self.gcm_config["senderIDs"]["other"] = {"auth": "abcdefg"}
+        router = GCMRouter(conf, self.gcm_config, SinkMetrics())
+        limiter = router.limiters["test123"]
+        assert limiter.tags == ["platform:gcm", "senderid:test123"]
+        router.gcm["test123"].send = Mock(
+            side_effect=lambda payload: fail(TimeoutError()))
+        for _ in range(2):
+            d = router.route_notification(self.notif, self.router_data)
+            self._check_error(d, 502, errno=902)
+        # Fails fast without another request to GCM
+        d = router.route_notification(self.notif, self.router_data)
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 503
+        assert exc.headers["Retry-After"] == "30"
+        assert router.gcm["test123"].send.call_count == 2
+        # Other SenderIDs are unaffected
+        assert router.limiters["other"].state == "closed"
+
+    def test_limiter_ignores_backoff(self):
+        conf = AutopushConfig(
+            hostname="localhost",
+            statsd_host=None,
+            bridge_max_concurrency=2,
+            bridge_failure_threshold=2,
+        )
+        router = GCMRouter(conf, self.gcm_config, SinkMetrics())
+        gcm = router.gcm["test123"]
+        gcm._agent = Mock()
+        # Waiting out a Retry-After: rejected without contacting GCM
+        gcm._retry_until = reactor.seconds() + 30
+        for _ in range(3):
+            d = router.route_notification(self.notif, self.router_data)
+            exc = self.failureResultOf(d, RouterException).value
+            assert exc.status_code == 503
+            assert "Retry-After" in exc.headers
+        assert not gcm._agent.request.called
+        limiter = router.limiters["test123"]
+        assert limiter.state == "closed"
+        assert limiter.failures == 0
+
+
 class FCMRouterTestCase(unittest.TestCase):
 
     @patch("pyfcm.FCMNotification", spec=pyfcm.FCMNotification)
@@ -925,6 +1342,18 @@ class FCMRouterTestCase(unittest.TestCase):
         d.addBoth(check_results)
         return d
 
+    def test_router_notification_fcm_server_error(self):
+        def throw_server_error(*args, **kwargs):
+            raise pyfcm.errors.FCMServerError("FCM server is unavailable")
+        self.fcm.notify_single_device.side_effect = throw_server_error
+        self.router.fcm = self.fcm
+        d = self.router.route_notification(self.notif, self.router_data)
+
+        def check_results(fail):
+            self._check_error_call(fail.value, 502)
+        d.addBoth(check_results)
+        return d
+
     def test_router_notification_fcm_id_change(self):
         self.mock_result['canonical_ids'] = 1
         self.mock_result['results'][0] = {'registration_id': "new"}
@@ -989,6 +1418,173 @@ class FCMRouterTestCase(unittest.TestCase):
                 app_id="invalid")
 
 
+class AsyncFCMRouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeFCM()
+        self.port = reactor.listenTCP(0, Site(self.fake),
+                                      interface="127.0.0.1")
+        self.router = make_router(
+            "http://127.0.0.1:%d/fcm/send" % self.port.getHost().port,
+            use_async=True, max_connections=5)
+        self.router.min_ttl = 60
+        self.notif = WebPushNotification(
+            uaid=uuid.UUID(dummy_uaid),
+            channel_id=uuid.UUID(dummy_chid),
+            data="q60d6g",
+            headers={"content-encoding": "aesgcm",
+                     "encryption": "test",
+                     "encryption-key": "test"},
+            ttl=200
+        )
+        self.notif.cleanup_headers()
+        self.router_data = dict(
+            router_data=dict(
+                token="connect_data",
+                creds=dict(senderID=SENDER_ID, auth="fake_auth")))
+
+    def tearDown(self):
+        d = self.router.fcm._agent._pool.closeCachedConnections()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    def _fail_with(self, exc):
+        self.router.fcm.notify_single_device = Mock(return_value=fail(exc))
+        return self.router.route_notification(self.notif, self.router_data)
+
+    def test_init(self):
+        assert isinstance(self.router.fcm, AsyncFCM)
+        assert self.router.fcm._semaphore.limit == 5
+        assert self.router.fcm._agent._pool.maxPersistentPerHost == 5
+
+    @inlineCallbacks
+    def test_route_notification(self):
+        result = yield self.router.route_notification(self.notif,
+                                                      self.router_data)
+        assert isinstance(result, RouterResponse)
+        assert result.status_code == 201
+        assert result.headers["TTL"] == 200
+        request = self.fake.requests[0]
+        assert request["authorization"] == "key=fake_auth"
+        assert request["payload"]["to"] == "connect_data"
+        assert request["payload"]["time_to_live"] == 200
+        assert request["payload"]["data"]["body"] == "q60d6g"
+        assert request["payload"]["data"]["chid"] == dummy_chid
+        # The connection's reused
+        yield self.router.route_notification(self.notif, self.router_data)
+        assert len(self.router.fcm._agent._pool._connections) == 1
+
+    @inlineCallbacks
+    def test_reason_table(self):
+        self.fake.render_POST = lambda request: json.dumps(dict(
+            multicast_id=1, success=0, failure=1, canonical_ids=0,
+            results=[dict(error="NotRegistered")]))
+        result = yield self.router.route_notification(self.notif,
+                                                      self.router_data)
+        assert result.status_code == 410
+        assert result.errno == 103
+
+    @inlineCallbacks
+    def test_canonical_id(self):
+        self.fake.render_POST = lambda request: json.dumps(dict(
+            multicast_id=1, success=1, failure=0, canonical_ids=1,
+            results=[dict(message_id="0:1", registration_id="new")]))
+        result = yield self.router.route_notification(self.notif,
+                                                      self.router_data)
+        assert result.status_code == 503
+        assert result.router_data == dict(token="new")
+
+    @inlineCallbacks
+    def test_auth_error(self):
+        def unauthorized(request):
+            request.setResponseCode(401)
+            return ""
+        self.fake.render_POST = unauthorized
+        with pytest.raises(RouterException) as ex:
+            yield self.router.route_notification(self.notif,
+                                                 self.router_data)
+        assert ex.value.status_code == 500
+        self.flushLoggedErrors()
+
+    @inlineCallbacks
+    def test_server_error(self):
+        def unavailable(request):
+            request.setResponseCode(503)
+            return ""
+        self.fake.render_POST = unavailable
+        with pytest.raises(RouterException) as ex:
+            yield self.router.route_notification(self.notif,
+                                                 self.router_data)
+        assert ex.value.status_code == 502
+
+    def test_connection_error(self):
+        d = self._fail_with(ConnectionRefusedError())
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 502
+
+    def test_limiter(self):
+        self.router.limiter = BridgeLimiter(1, SinkMetrics())
+        self.router.fcm.notify_single_device = Mock(return_value=Deferred())
+        d = self.router.route_notification(self.notif, self.router_data)
+        self.assertNoResult(d)
+        d = self.router.route_notification(self.notif, self.router_data)
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 503
+        assert exc.errno == 201
+        assert self.router.fcm.notify_single_device.call_count == 1
+
+    def test_timeout(self):
+        d = self._fail_with(TimeoutError())
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 502
+
+    def test_queue_full(self):
+        clock = Clock()
+        agent = Mock(spec=Agent)
+        agent.request.side_effect = lambda *args: Deferred()
+        fcm = AsyncFCM("fake_auth", max_connections=1, max_queue=1,
+                       timeout=3, agent=agent, reactor=clock)
+        patcher = patch.object(self.router, "fcm", fcm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        first = self.router.route_notification(self.notif, self.router_data)
+        clock.advance(1)
+        queued = self.router.route_notification(self.notif,
+                                                self.router_data)
+        d = self.router.route_notification(self.notif, self.router_data)
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 503
+        assert exc.response_body == "FCM busy, please retry"
+        assert exc.extra["local"]
+        assert agent.request.call_count == 1
+        clock.advance(2)
+        self.failureResultOf(first, RouterException)
+        # The queued send began as the first timed out, its timeout
+        # including its time queued
+        assert agent.request.call_count == 2
+        clock.advance(1)
+        exc = self.failureResultOf(queued, RouterException).value
+        assert exc.status_code == 502
+
+    def test_other_error(self):
+        d = self._fail_with(Exception("oops"))
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 500
+        self.flushLoggedErrors()
+
+    def test_long_data(self):
+        self.router.router_conf["max_data"] = 4
+        d = self.router.route_notification(self.notif, self.router_data)
+        exc = self.failureResultOf(d, RouterException).value
+        assert exc.status_code == 413
+
+    @inlineCallbacks
+    def test_bench(self):
+        threaded, pooled = yield run(count=4, concurrency=2, latency=0.01)
+        assert threaded > 0
+        assert pooled > 0
+
+
 class WebPushRouterTestCase(unittest.TestCase):
     def setUp(self):
         conf = AutopushConfig(
@@ -1021,6 +1617,13 @@ class WebPushRouterTestCase(unittest.TestCase):
         mock_result.retry_after = 1000
         self.router_mock = db.router
         self.message_mock = db._message = Mock(spec=Message)
+        # Without an async client these defer to their blocking versions
+        self.router_mock.get_uaid_async.side_effect = (
+            lambda uaid, use_cache=True: deferToThread(
+                self.router_mock.get_uaid, uaid, use_cache=use_cache))
+        self.message_mock.store_message_async.side_effect = (
+            lambda notification: deferToThread(
+                self.message_mock.store_message, notification=notification))
         self.conf = conf
 
     def test_route_to_busy_node_saves_looks_up_and_sends_check_201(self):
@@ -1029,7 +1632,7 @@ class WebPushRouterTestCase(unittest.TestCase):
         type(response_mock).code = PropertyMock(
             side_effect=MockAssist([202, 200]))
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [dummy_chid])
+        self.message_mock.has_channel.return_value = True
         self.db.message_table = Mock(return_value=self.message_mock)
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
                            current_month=self.db.current_msg_month)
@@ -1054,7 +1657,7 @@ class WebPushRouterTestCase(unittest.TestCase):
     def test_route_failure(self):
         self.agent_mock.request = Mock(side_effect=ConnectionRefusedError)
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [dummy_chid])
+        self.message_mock.has_channel.return_value = True
         self.db.message_table = Mock(return_value=self.message_mock)
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
                            current_month=self.db.current_msg_month)
@@ -1092,7 +1695,7 @@ class WebPushRouterTestCase(unittest.TestCase):
         type(response_mock).code = PropertyMock(
             side_effect=MockAssist([202, 200]))
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [dummy_chid])
+        self.message_mock.has_channel.return_value = True
         self.db.message_table = Mock(return_value=self.message_mock)
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
                            current_month=self.db.current_msg_month)
@@ -1165,6 +1768,53 @@ class WebPushRouterTestCase(unittest.TestCase):
 
         return d
 
+    def _timed_out_call(self, operation):
+        """A Deferred failed by the async client timing out a request"""
+        clock = Clock()
+        client = AsyncDynamoDBClient(reactor=clock, request_timeout=1,
+                                     max_retries=0,
+                                     credentials=Credentials("a", "b"))
+        client.agent = Mock()
+        client.agent.request.side_effect = lambda *args: Deferred()
+        d = client.call(operation)
+        clock.advance(1)
+        return d
+
+    def test_route_to_busy_node_save_times_out(self):
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.code = 202
+        self.message_mock.store_message_async.side_effect = (
+            lambda notification: self._timed_out_call("PutItem"))
+        self.db.message_table = Mock(return_value=self.message_mock)
+        router_data = dict(node_id="http://somewhere",
+                           uaid=dummy_uaid,
+                           current_month=self.db.current_msg_month)
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(fail):
+            exc = fail.value
+            assert isinstance(exc, RouterException)
+            assert exc.status_code == 503
+            assert exc.errno == 201
+        d.addBoth(verify_deliver)
+        return d
+
+    def test_route_lookup_uaid_times_out(self):
+        self.message_mock.store_message.return_value = True
+        self.db.message_table = Mock(return_value=self.message_mock)
+        self.router_mock.get_uaid_async.side_effect = (
+            lambda uaid, use_cache=True: self._timed_out_call("GetItem"))
+        router_data = dict(uaid=dummy_uaid,
+                           current_month=self.db.current_msg_month)
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(status):
+            # Already stored: not an error the app server would retry
+            assert status.status_code == 201
+            assert self.message_mock.store_message.called
+        d.addBoth(verify_deliver)
+        return d
+
     def test_route_lookup_uaid_not_found(self):
 
         def throw():
@@ -1204,7 +1854,7 @@ class WebPushRouterTestCase(unittest.TestCase):
     def test_route_and_clear_failure(self):
         self.agent_mock.request = Mock(side_effect=ConnectionRefusedError)
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [dummy_chid])
+        self.message_mock.has_channel.return_value = True
         self.db.message_table = Mock(return_value=self.message_mock)
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
                            current_month=self.db.current_msg_month)
@@ -1234,3 +1884,158 @@ class WebPushRouterTestCase(unittest.TestCase):
 
         d.addCallback(verify_deliver)
         return d
+
+    def test_send_notification_batched(self):
+        self.conf.preencode_frames = True
+        self.router.batcher = Mock(spec=NotificationBatcher)
+        self.router.batcher.send.return_value = succeed(BatchedResponse(200))
+        d = self.router._send_notification(dummy_uaid, "http://somewhere",
+                                           self.notif)
+
+        def verify(result):
+            assert result.code == 200
+            assert not self.agent_mock.request.called
+            uaid, node_id, payload = self.router.batcher.send.call_args[0]
+            assert node_id == "http://somewhere"
+            assert payload["channelID"] == str(uuid.UUID(dummy_chid))
+            assert json.loads(payload["frame"]) == json.loads(
+                json.dumps(self.notif.websocket_format()))
+
+        d.addCallback(verify)
+        return d
+
+    def test_send_notification_no_frame(self):
+        self.router.batcher = Mock(spec=NotificationBatcher)
+        self.router.batcher.send.return_value = succeed(BatchedResponse(200))
+        d = self.router._send_notification(dummy_uaid, "http://somewhere",
+                                           self.notif)
+
+        def verify(result):
+            uaid, node_id, payload = self.router.batcher.send.call_args[0]
+            assert "frame" not in payload
+            assert payload["data"] == "data"
+
+        d.addCallback(verify)
+        return d
+
+    def test_send_notification_batch_unsupported(self):
+        self.router.batcher = Mock(spec=NotificationBatcher)
+        self.router.batcher.send.return_value = succeed(None)
+        self.agent_mock.request.return_value = Deferred()
+        self.router._send_notification(dummy_uaid, "http://somewhere",
+                                       self.notif)
+        assert self.agent_mock.request.call_args[0][1] == (
+            "http://somewhere/push/" + dummy_uaid)
+
+    def test_send_notification_batch_invalid(self):
+        self.router.batcher = Mock(spec=NotificationBatcher)
+        self.router.batcher.send.return_value = fail(
+            BatchResponseError("Invalid push_batch results"))
+        d = self.router._send_notification(dummy_uaid, "http://somewhere",
+                                           self.notif)
+        # Stored, rather than resent
+        assert self.successResultOf(d) is None
+        assert not self.agent_mock.request.called
+
+    def test_node_transport(self):
+        self.router.node_transport = transport = Mock(spec=NodeTransport)
+        self.router.batcher = Mock(spec=NotificationBatcher)
+        transport.push.return_value = succeed(NodeResponse(200))
+        transport.notif.return_value = succeed(NodeResponse(202))
+        self.router._send_notification(dummy_uaid, "http://somewhere",
+                                       self.notif)
+        self.router._send_notification_check(dummy_uaid, "http://somewhere")
+        assert transport.push.call_args[0][:2] == ("http://somewhere",
+                                                   dummy_uaid)
+        transport.notif.assert_called_once_with("http://somewhere",
+                                                dummy_uaid)
+        assert not self.router.batcher.send.called
+        assert not self.agent_mock.request.called
+
+
+class NotificationBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.agent = Mock(spec=Agent)
+        self.metrics = Mock(spec=SinkMetrics)
+        self.batcher = NotificationBatcher(self.agent, self.metrics, 0.01,
+                                           max_size=3, clock=self.clock)
+
+    def _response(self, code, body):
+        response = Mock(code=code)
+        self.agent.request.return_value = succeed(response)
+        return body
+
+    @patch("autopush.router.webpush.readBody")
+    def test_coalesce(self, mock_read):
+        mock_read.return_value = succeed(json.dumps(dict(results=[200, 404])))
+        self._response(200, None)
+        results = []
+        self.batcher.send("uaid1", "http://node1", dict(a=1)).addCallback(
+            results.append)
+        self.batcher.send("uaid2", "http://node1", dict(b=2)).addCallback(
+            results.append)
+        assert not self.agent.request.called
+
+        self.clock.advance(0.01)
+        assert self.agent.request.call_count == 1
+        args = self.agent.request.call_args[0]
+        assert args == ("PUT", "http://node1/push_batch")
+        assert results == [BatchedResponse(200), BatchedResponse(404)]
+        self.metrics.increment.assert_any_call(
+            "updates.batch.notifications", 2)
+
+    @patch("autopush.router.webpush.readBody")
+    def test_flush_when_full(self, mock_read):
+        mock_read.return_value = succeed(json.dumps(
+            dict(results=[200, 200, 200])))
+        self._response(200, None)
+        for i in range(3):
+            self.batcher.send("uaid%d" % i, "http://node1", {})
+        # The full batch went out without waiting, cancelling the timer
+        assert self.agent.request.call_count == 1
+        assert not self.clock.getDelayedCalls()
+
+    def test_separate_nodes(self):
+        self.agent.request.return_value = Deferred()
+        self.batcher.send("uaid1", "http://node1", {})
+        self.batcher.send("uaid2", "http://node2", {})
+        self.clock.advance(0.01)
+        urls = sorted(c[0][1] for c in self.agent.request.call_args_list)
+        assert urls == ["http://node1/push_batch", "http://node2/push_batch"]
+
+    @patch("autopush.router.webpush.IgnoreBody")
+    def test_unsupported(self, mock_ignore):
+        mock_ignore.ignore.return_value = succeed(None)
+        self._response(404, None)
+        results = []
+        self.batcher.send("uaid1", "http://node1", {}).addCallback(
+            results.append)
+        self.clock.advance(0.01)
+        assert results == [None]
+        self.metrics.increment.assert_any_call("updates.batch.unsupported")
+
+    @patch("autopush.router.webpush.readBody")
+    def test_invalid_results(self, mock_read):
+        for body in ("not json", json.dumps(dict(errors=[])),
+                     json.dumps([200]), json.dumps(dict(results=200))):
+            mock_read.return_value = succeed(body)
+            self._response(200, None)
+            failures = []
+            self.batcher.send("uaid1", "http://node1", {}).addErrback(
+                failures.append)
+            self.clock.advance(0.01)
+            assert len(failures) == 1
+            failures[0].trap(BatchResponseError)
+        self.metrics.increment.assert_any_call("updates.batch.invalid")
+
+    def test_failure(self):
+        self.agent.request.return_value = d = Deferred()
+        failures = []
+        for uaid in ("uaid1", "uaid2"):
+            self.batcher.send(uaid, "http://node1", {}).addErrback(
+                failures.append)
+        self.clock.advance(0.01)
+        d.errback(ConnectionRefusedError())
+        assert len(failures) == 2
+        assert all(f.check(ConnectionRefusedError) for f in failures)
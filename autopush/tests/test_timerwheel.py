@@ -0,0 +1,139 @@
+import pytest
+from mock import Mock
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.metrics import SinkMetrics
+from autopush.timerwheel import TimerWheel
+
+
+class TimerWheelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Mock(spec=SinkMetrics)
+        self.wheel = TimerWheel(tick=1, slots=4, levels=2,
+                                metrics=self.metrics, clock=self.clock)
+        self.fired = []
+
+    def _schedule(self, delay, name=None):
+        return self.wheel.call_later(delay, self.fired.append,
+                                     delay if name is None else name)
+
+    def _advance(self, seconds):
+        for _ in range(int(seconds * 2)):
+            self.clock.advance(0.5)
+
+    def test_expiry(self):
+        self.clock.advance(0.3)
+        for delay in (0.5, 2, 3.5, 7, 15, 40):
+            self._schedule(delay)
+        assert len(self.wheel) == 6
+        self._advance(0.5)
+        assert self.fired == []
+        # Never early, at most two ticks late
+        for delay in (0.5, 2, 3.5, 7, 15, 40):
+            while self.clock.seconds() < delay + 0.3:
+                assert delay not in self.fired
+                self._advance(0.5)
+            self._advance(2)
+            assert delay in self.fired
+        assert len(self.wheel) == 0
+        assert not self.wheel._loop.running
+        self.metrics.gauge.assert_called_with("ua.timer_wheel.timers", 0)
+        self.metrics.increment.assert_any_call("ua.timer_wheel.expired", 1)
+        assert self.metrics.timing.call_args[0][0] == "ua.timer_wheel.tick"
+
+    def test_batch(self):
+        timers = [self._schedule(2, name) for name in range(3)]
+        self._advance(3)
+        assert sorted(self.fired) == [0, 1, 2]
+        assert not any(timer.active() for timer in timers)
+        self.metrics.increment.assert_any_call("ua.timer_wheel.expired", 3)
+
+    def test_cancel(self):
+        timer = self._schedule(2)
+        other = self._schedule(2, "other")
+        timer.cancel()
+        timer.cancel()
+        assert not timer.active()
+        assert len(self.wheel) == 1
+        self._advance(3)
+        assert self.fired == ["other"]
+        # No-op once called
+        other.cancel()
+        with pytest.raises(AlreadyCancelled):
+            timer.reset(1)
+        with pytest.raises(AlreadyCalled):
+            other.reset(1)
+
+    def test_cancel_last(self):
+        self._schedule(2).cancel()
+        assert not self.wheel._loop.running
+
+    def test_cancel_from_timer(self):
+        later = []
+        self.wheel.call_later(1, lambda: later[0].cancel())
+        later.append(self._schedule(1))
+        self._advance(3)
+        assert self.fired in ([], [1])
+        assert len(self.wheel) == 0
+
+    def test_chunked(self):
+        self.wheel.chunk_size = 2
+        turns = []
+        call_later = self.clock.callLater
+
+        def next_turn(delay, func, *args, **kwargs):
+            if delay:
+                return call_later(delay, func, *args, **kwargs)
+            turns.append(func)
+            return Mock()
+        self.clock.callLater = next_turn
+        timers = [self._schedule(1, name) for name in range(5)]
+        self.clock.advance(1)
+        assert len(self.fired) == 2
+        assert len(turns) == 1
+        # Cancelled before its turn
+        cancelled = next(timer for timer in timers if timer.active())
+        cancelled.cancel()
+        turns.pop()()
+        assert len(self.fired) == 4
+        assert cancelled.args[0] not in self.fired
+        assert turns == []
+        assert len(self.wheel) == 0
+
+    def test_reset(self):
+        timer = self._schedule(2)
+        for _ in range(10):
+            self._advance(1)
+            timer.reset(2)
+        assert self.fired == []
+        assert timer.getTime() == 12
+        self._advance(3)
+        assert self.fired == [2]
+
+    def test_reset_sooner(self):
+        timer = self._schedule(30)
+        timer.reset(1)
+        self._advance(2)
+        assert self.fired == [30]
+
+    def test_error(self):
+        def fail():
+            raise Exception("oops")
+        self.wheel.call_later(1, fail)
+        self._schedule(1)
+        self._advance(2)
+        assert self.fired == [1]
+        assert len(self.flushLoggedErrors()) == 1
+
+    def test_idle_restart(self):
+        self._schedule(1)
+        self._advance(2)
+        assert not self.wheel._loop.running
+        self.clock.advance(1000)
+        self._schedule(1, "again")
+        self._advance(2)
+        assert self.fired == [1, "again"]
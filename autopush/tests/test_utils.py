@@ -32,6 +32,47 @@ class TestUserAgentParser(unittest.TestCase):
         assert dd["ua_browser_family"] == "Other"
         assert raw["ua_browser_family"] == "BlackBerry"
 
+    def test_cached(self):
+        from autopush.cache import TTLCache
+        from autopush.utils import FrozenDict
+        agent = 'Mozilla/5.0 (Windows NT 10.0; rv:60.0) Gecko/20100101 Firefox/60.0'  # NOQA
+        cache = TTLCache(10, 60)
+        dd, raw = self._makeFUT(agent, cache)
+        assert (dd, raw) == self._makeFUT(agent)
+        assert isinstance(raw, FrozenDict)
+        with self.assertRaises(TypeError):
+            raw["ua_os_ver"] = "1"
+        with self.assertRaises(TypeError):
+            dd.update(ua_os_family="Other")
+
+        with patch("autopush.utils.user_agent_parser") as parser:
+            cached = self._makeFUT(agent, cache)
+            assert not parser.Parse.called
+        assert cached[1] is raw
+
+    def test_cached_too_long(self):
+        from autopush.cache import TTLCache
+        cache = TTLCache(10, 60)
+        agent = 'Mozilla/5.0 (X11; Linux x86_64) ' + 'x' * 600
+        dd, _ = self._makeFUT(agent, cache)
+        assert dd["ua_os_family"] == "Linux"
+        assert len(cache) == 0
+
+    def test_bench_user_agent(self):
+        from autopush.scripts.bench_user_agent import run, user_agents
+        assert len(set(user_agents(10))) == 10
+        uncached, cached = run(connects=20, agents=2)
+        assert uncached > 0
+        assert cached > 0
+
+    def test_bench_message_id(self):
+        from autopush.scripts.bench_message_id import run
+        (fernet_time, fernet_len), (compact_time, compact_len) = run(
+            count=20)
+        assert fernet_time > 0
+        assert compact_time > 0
+        assert compact_len < fernet_len
+
     def test_trusted_vapid(self):
         from autopush.utils import extract_jwt
         vapid_info = _get_vapid(payload={'sub': 'mailto:foo@example.com'})
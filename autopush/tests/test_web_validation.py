@@ -7,7 +7,7 @@ import ecdsa
 from cryptography.fernet import InvalidToken
 from cryptography.exceptions import InvalidSignature
 from jose import jws
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, post_load
 from mock import Mock, patch
 import pytest
 from twisted.internet.defer import inlineCallbacks
@@ -68,6 +68,9 @@ class TestThreadedValidate(unittest.TestCase):
         vr.metrics = Mock()
         vr.db = Mock()
         vr.routers = Mock()
+        vr.vapid_cache = None
+        vr.dead_token_cache = None
+        vr.endpoint_token_cache = None
         return vr
 
     def _make_full(self, schema=None):
@@ -132,6 +135,73 @@ class TestThreadedValidate(unittest.TestCase):
         resp = yield client.get('/test')
         assert resp.content == "done"
 
+    def test_schema_pool(self):
+        tv, rh = self._make_full()
+        tv._validate_request(rh)
+        schema = tv._pools[tv.schema][0]
+        tv._validate_request(rh)
+        assert tv._pools[tv.schema] == [schema]
+        assert schema.context["db"] is rh.db
+
+    @patch("autopush.web.base.deferToThread")
+    def test_inline(self, mock_thread):
+        class Inline(Schema):
+            blocking = False
+            afield = fields.Integer(required=True)
+
+        def get(rh):  # pragma: nocover
+            pass
+
+        tv, rh = self._make_full(schema=Inline)
+        rh._boto_err = rh._validation_err = rh._response_err = Mock()
+        tv._decorator(get)(rh)
+        self._mock_errors.assert_called()
+        assert not mock_thread.called
+        assert "validation_inline_time" in rh._timings
+        assert "validation_time" in rh._timings
+
+    @patch("autopush.web.base.deferToThread")
+    def test_inline_prefix_rejects(self, mock_thread):
+        class Prefix(Schema):
+            blocking = False
+            afield = fields.Integer(required=True)
+
+        class Full(Prefix):
+            blocking = True
+            inline_schema = Prefix
+
+        def get(rh):  # pragma: nocover
+            pass
+
+        tv, rh = self._make_full(schema=Full)
+        rh._boto_err = rh._validation_err = rh._response_err = Mock()
+        tv._decorator(get)(rh)
+        self._mock_errors.assert_called()
+        assert not mock_thread.called
+
+    @inlineCallbacks
+    def test_inline_prefix_then_thread(self):
+        class Prefix(Schema):
+            blocking = False
+            bfield = fields.Integer(missing=2)
+
+        class Full(Prefix):
+            blocking = True
+            inline_schema = Prefix
+            afield = fields.Integer(missing=1)
+
+            @post_load
+            def inline(self, d):
+                d["inline"] = self.context["inline_result"]
+
+        tv, rh = self._make_full(schema=Full)
+        d = tv._validate(rh, {})
+        result = yield d
+        assert result.data == dict(afield=1, bfield=2,
+                                   inline=dict(bfield=2))
+        assert "validation_inline_time" in rh._timings
+        assert "validation_thread_time" in rh._timings
+
 
 class TestWebPushRequestSchema(unittest.TestCase):
     def _make_fut(self):
@@ -172,6 +242,25 @@ class TestWebPushRequestSchema(unittest.TestCase):
         assert "notification" in result
         assert str(result["subscription"]["uaid"]) == dummy_uaid
 
+    def test_inline_result(self):
+        schema = self._make_fut()
+        schema.context["conf"].parse_endpoint.return_value = dict(
+            uaid=dummy_uaid,
+            chid=dummy_chid,
+            public_key="",
+        )
+        schema.context["db"].router.get_uaid.return_value = dict(
+            router_type="gcm",
+            router_data=dict(creds=dict(senderID="bogus")),
+        )
+        # The headers and body were already validated inline
+        schema.context["inline_result"] = dict(
+            headers=dict(ttl=60, topic=None), crypto_headers={}, body="")
+        result, errors = schema.load(self._make_test_data(
+            headers={"ttl": "invalid"}, body="x" * 8192))
+        assert errors == {}
+        assert result["notification"].ttl == 60
+
     def test_no_headers(self):
         schema = self._make_fut()
         schema.context["conf"].parse_endpoint.return_value = dict(
@@ -728,6 +817,52 @@ class TestWebPushRequestSchemaUsingVapid(unittest.TestCase):
     def test_valid_vapid_crypto_header_webpush_crypto(self):
         self.test_valid_vapid_crypto_header_webpush(use_crypto=True)
 
+    def test_valid_vapid_cached(self, use_crypto=False):
+        from autopush.cache import VapidCache
+        schema = self._make_fut()
+        schema.context["conf"].use_cryptography = use_crypto
+        schema.context["vapid_cache"] = cache = VapidCache(10, 10, 3600)
+
+        header = {"typ": "JWT", "alg": "ES256"}
+        payload = {"aud": "https://pusher_origin.example.com",
+                   "exp": int(time.time()) + 86400,
+                   "sub": "mailto:admin@example.com"}
+
+        token, crypto_key = self._gen_jwt(header, payload)
+        self.fernet_mock.decrypt.return_value = ('a'*32) + \
+            sha256(utils.base64url_decode(crypto_key)).digest()
+        info = self._make_test_data(
+            body="asdfasdfasdfasdf",
+            path_kwargs=dict(
+                api_ver="v2",
+                token="asdfasdf",
+            ),
+            headers={
+                "content-encoding": "aesgcm",
+                "encryption": "salt=stuff",
+                "authorization": "WebPush %s" % token,
+                "crypto-key": 'dh="foo";p256ecdsa="%s"' % crypto_key
+            }
+        )
+
+        result, errors = schema.load(info)
+        assert errors == {}
+        assert result["jwt"]["jwt_data"] == payload
+        assert len(cache.keys) == 1
+        assert len(cache.claims) == 1
+
+        # Verified again from the cache
+        patch_path = ("autopush.jwt.VerifyJWT.validate_and_extract_assertion"
+                      if use_crypto else "autopush.utils.jwt.decode")
+        with patch(patch_path) as mock_verify:
+            result, errors = schema.load(info)
+        assert errors == {}
+        assert result["jwt"]["jwt_data"] == payload
+        assert not mock_verify.called
+
+    def test_valid_vapid_cached_crypto(self):
+        self.test_valid_vapid_cached(use_crypto=True)
+
     def test_valid_vapid_02_crypto_header_webpush(self):
         schema = self._make_fut()
 
@@ -1,13 +1,16 @@
 import base64
+import json
 import uuid
 
+from botocore.exceptions import ClientError
 from cryptography.fernet import Fernet
-from mock import Mock
+from mock import Mock, patch
 from twisted.internet.defer import inlineCallbacks
 from twisted.trial import unittest
 
 from autopush.config import AutopushConfig
 from autopush.db import Message
+from autopush.exceptions import RouterException
 from autopush.http import EndpointHTTPFactory
 from autopush.router.interface import IRouter, RouterResponse
 from autopush.tests.client import Client
@@ -33,7 +36,7 @@ class TestWebpushHandler(unittest.TestCase):
         self.db = db = test_db()
         self.message_mock = db._message = Mock(spec=Message)
         self.db.message_table = Mock(return_value=self.message_mock)
-        self.message_mock.all_channels.return_value = (True, [dummy_chid])
+        self.message_mock.has_channel.return_value = True
 
         app = EndpointHTTPFactory.for_handler(WebPushHandler, conf, db=db)
         self.wp_router_mock = app.routers["webpush"] = Mock(spec=IRouter)
@@ -98,6 +101,40 @@ class TestWebpushHandler(unittest.TestCase):
         assert resp.get_status() == 503
         assert self.db.router.drop_user.called
 
+    @inlineCallbacks
+    def test_dead_token(self):
+        self.conf.parse_endpoint = Mock(return_value=dict(
+            uaid=dummy_uaid,
+            chid=dummy_chid,
+            public_key=None,
+        ))
+        self.db.router.get_uaid.return_value = dict(
+            uaid=dummy_uaid,
+            router_type="fcm",
+            router_data=dict(token="dead_token",
+                             creds=dict(senderID="12345")),
+        )
+        fcm_router_mock = self.client.app.routers["fcm"] = Mock(spec=IRouter)
+        fcm_router_mock.route_notification.return_value = RouterResponse(
+            status_code=410,
+            response_body="device has unregistered with FCM",
+            router_data=dict(),
+            errno=103,
+        )
+
+        resp = yield self.client.post(
+            self.url(api_ver="v1", token=dummy_token),
+        )
+        assert resp.get_status() == 410
+        assert self.db.router.drop_user.called
+        # Rejected without contacting FCM until the drop completes
+        resp = yield self.client.post(
+            self.url(api_ver="v1", token=dummy_token),
+        )
+        assert resp.get_status() == 410
+        assert json.loads(resp.content)["errno"] == 103
+        assert fcm_router_mock.route_notification.call_count == 1
+
     @inlineCallbacks
     def test_request_bad_ckey(self):
         self.fernet_mock.decrypt.return_value = 'invalid key'
@@ -214,3 +251,174 @@ class TestWebpushHandler(unittest.TestCase):
                      'authorization': 'dummy_key'}
         )
         assert resp.get_status() == 401
+
+
+class TestWebPushBatchHandler(unittest.TestCase):
+    def setUp(self):
+        import autopush
+        from autopush.web.webpush import WebPushBatchHandler
+
+        self.conf = conf = AutopushConfig(
+            hostname="localhost",
+            statsd_host=None,
+            use_cryptography=True,
+        )
+        self.db = db = test_db()
+        self.message_mock = db._message = Mock(spec=Message)
+        self.db.message_table = Mock(return_value=self.message_mock)
+        self.message_mock.has_channel.return_value = True
+        self.db.message_tables.append(self.db.current_msg_month)
+
+        app = EndpointHTTPFactory.for_handler(WebPushBatchHandler, conf,
+                                              db=db)
+        self.wp_router_mock = app.routers["webpush"] = Mock(spec=IRouter)
+        self.wp_router_mock.route_notification.return_value = RouterResponse(
+            status_code=201,
+            headers={"Location": "http://localhost/m/123"},
+        )
+        self.db.router = Mock(spec=autopush.db.Router)
+        self.db.router.get_uaids.return_value = {
+            dummy_uaid.replace("-", ""): dict(
+                uaid=dummy_uaid,
+                router_type="webpush",
+                router_data=dict(),
+                current_month=self.db.current_msg_month,
+            )
+        }
+        self.client = Client(app)
+
+    def token(self, uaid=dummy_uaid):
+        endpoint = self.conf.make_endpoint(uaid, dummy_chid)
+        return endpoint.rsplit("/", 1)[-1]
+
+    def post(self, messages, **batch):
+        batch["messages"] = messages
+        return self.client.post("/wpush/batch", body=json.dumps(batch))
+
+    def results(self, resp):
+        results = [json.loads(line) for line in resp.content.splitlines()]
+        return {result.pop("index"): result for result in results}
+
+    @inlineCallbacks
+    def test_batch(self):
+        resp = yield self.post(
+            [
+                dict(token=self.token()),
+                dict(token="invalid"),
+                dict(token=self.token(str(uuid.uuid4()))),
+                dict(token=self.token(), headers={"TTL": "-1"}),
+                dict(token=self.token(), headers={"TTL": "soon"}),
+                dict(token=self.token(), headers={"Topic": 7}),
+            ],
+            headers={"ttl": "60"},
+        )
+        assert resp.get_status() == 200
+        assert resp.headers["Content-Type"] == "application/x-ndjson"
+        results = self.results(resp)
+        assert results[0] == dict(status=201,
+                                  location="http://localhost/m/123")
+        assert results[1]["status"] == 404
+        assert results[1]["errno"] == 102
+        assert results[2]["status"] == 410
+        assert results[2]["errno"] == 103
+        assert results[3]["status"] == 400
+        assert results[3]["errno"] == 114
+        assert results[4]["status"] == 400
+        assert results[4]["errno"] == 112
+        assert results[4]["message"] == "Invalid TTL header value"
+        assert "ttl" in results[4]["errors"]["headers"]
+        assert results[5]["status"] == 400
+        assert results[5]["errno"] == 108
+        assert results[5]["message"] == "Invalid message headers or body"
+        # All the router records are looked up at once
+        assert self.db.router.get_uaids.call_count == 1
+        assert not self.db.router.get_uaid.called
+        assert len(self.db.router.get_uaids.call_args[0][0]) == 2
+        notif = self.wp_router_mock.route_notification.call_args[0][0]
+        assert notif.ttl == 60
+
+    @inlineCallbacks
+    def test_batch_data(self):
+        resp = yield self.post([
+            dict(token=self.token(),
+                 headers={"Content-Encoding": "aes128gcm"},
+                 body=base64.urlsafe_b64encode("encrypted").strip("=")),
+        ])
+        assert self.results(resp)[0]["status"] == 201
+        notif = self.wp_router_mock.route_notification.call_args[0][0]
+        assert notif.data == base64.urlsafe_b64encode("encrypted").strip("=")
+
+    @inlineCallbacks
+    def test_batch_router_errors(self):
+        def route(notification, user_data):
+            if notification.ttl == 1:
+                raise RouterException("Gone", status_code=410, errno=106,
+                                      log_exception=False)
+            if notification.ttl == 2:
+                raise ClientError(
+                    {'Error': {
+                        'Code': 'ProvisionedThroughputExceededException'}},
+                    'mock_update_item')
+            if notification.ttl == 3:
+                raise Exception("oops")
+            return RouterResponse(status_code=503, router_data=dict())
+        self.wp_router_mock.route_notification.side_effect = route
+
+        resp = yield self.post([
+            dict(token=self.token(), headers={"ttl": str(ttl)})
+            for ttl in range(5)
+        ])
+        results = self.results(resp)
+        assert results[0]["status"] == 503
+        assert results[1] == dict(status=410, errno=106, message="Gone")
+        assert results[2]["status"] == 503
+        assert results[2]["errno"] == 201
+        assert results[3]["status"] == 500
+        assert results[3]["errno"] == 999
+        # Empty router data drops the user
+        assert self.db.router.drop_user.call_count == 2
+        self.flushLoggedErrors()
+
+    @inlineCallbacks
+    def test_batch_validation_concurrency(self):
+        from autopush.web import webpush
+        validator = webpush._batch_message_validator
+        validate = validator._validate
+        validating = []
+        most = []
+
+        def counted(*args, **kwargs):
+            validating.append(None)
+            most.append(len(validating))
+
+            def done(result):
+                validating.pop()
+                return result
+            return validate(*args, **kwargs).addBoth(done)
+
+        with patch.object(validator, "_validate", side_effect=counted):
+            resp = yield self.post([dict(token=self.token())] * 20)
+        assert len(self.results(resp)) == 20
+        assert max(most) == webpush.BATCH_VALIDATION_CONCURRENCY
+
+    @inlineCallbacks
+    def test_batch_lookup_error(self):
+        self.db.router.get_uaids.side_effect = ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException'}},
+            'mock_batch_get_item')
+        resp = yield self.post([dict(token=self.token())])
+        assert resp.get_status() == 503
+        assert json.loads(resp.content)["errno"] == 201
+
+    @inlineCallbacks
+    def test_batch_invalid(self):
+        resp = yield self.client.post("/wpush/batch", body="{invalid")
+        assert resp.get_status() == 400
+        assert json.loads(resp.content)["errno"] == 108
+
+        resp = yield self.post([dict(token=self.token(), api_ver="v3")])
+        assert resp.get_status() == 400
+
+        resp = yield self.post([dict(token=self.token())] * 1001)
+        assert resp.get_status() == 413
+        assert json.loads(resp.content)["errno"] == 104
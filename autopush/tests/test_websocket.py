@@ -1,9 +1,10 @@
 import json
+import sys
 import datetime
 import time
 import uuid
 from hashlib import sha256
-from collections import defaultdict
+from StringIO import StringIO
 from urllib3.exceptions import ConnectTimeoutError
 
 import twisted.internet.base
@@ -14,27 +15,35 @@ from mock import Mock, patch
 import pytest
 from twisted.internet import reactor
 from twisted.internet.defer import (
+    fail,
     inlineCallbacks,
     returnValue,
+    succeed,
     Deferred
 )
 from twisted.internet.error import ConnectError
+from twisted.internet.task import Clock
 from twisted.trial import unittest
 from twisted.web.client import Agent
 
 import autopush.db as db
 from autopush.config import AutopushConfig
 from autopush.db import DatabaseManager
+from autopush.exceptions import AdmissionRejectedException
 from autopush.http import InternalRouterHTTPFactory
 from autopush.metrics import SinkMetrics
 from autopush.utils import WebPushNotification
+from autopush.timerwheel import TimerWheel
 from autopush.tests.client import Client
 from autopush.tests.test_db import make_webpush_notification
 from autopush.websocket import (
+    HelloAdmission,
     PushState,
     PushServerFactory,
+    BatchRouterHandler,
     RouterHandler,
     NotificationHandler,
+    UnackedNotifications,
     WebSocketServerProtocol,
 )
 from autopush.utils import base64url_encode, ms_time
@@ -256,6 +265,50 @@ class WebsocketTestCase(unittest.TestCase):
              'ua_browser_family:Firefox',
              'host:example.com:8080'])
 
+    def test_user_agent_cache(self):
+        agent = "Mozilla/5.0 (Windows NT 10.0; rv:60.0) Gecko/20100101 " \
+                "Firefox/60.0"
+        req = ConnectionRequest("localhost", {"user-agent": agent},
+                                "localhost", "/", {}, 1, "localhost",
+                                [], [])
+        self.proto.onConnect(req)
+        raw_agent = self.proto.ps.raw_agent
+        assert raw_agent["ua_browser_family"] == "Firefox"
+        assert self.factory.ua_cache.get(agent)[1] is raw_agent
+
+        self.metrics.increment.reset_mock()
+        self.proto.onConnect(req)
+        assert self.proto.ps.raw_agent is raw_agent
+        self.metrics.increment.assert_called_with(
+            "cache.hit", tags=["cache:user_agent"])
+
+    def test_idle_state(self):
+        req = Mock()
+        req.headers = {'user-agent': "Mozilla/5.0 (Windows NT 10.0; rv:60.0) "
+                                     "Gecko/20100101 Firefox/60.0"}
+        req.host = "example.com:8080"
+        ps = PushState.from_request(request=req, db=self.proto.db)
+        ps.init_connection()
+        other = PushState.from_request(request=req, db=self.proto.db)
+        other.init_connection()
+        # Identical tags are shared, per channel state is created on use
+        assert other._base_tags is ps._base_tags
+        assert "use_webpush:True" in ps._base_tags
+        assert ps._updates_sent is None
+        assert ps._direct_updates is None
+        assert not ps.unacked_stored
+
+        ps.updates_sent.add(dummy_chid_str, dummy_notif())
+        assert ps.unacked_stored
+
+    @pytest.mark.skipif(hasattr(sys, 'pypy_version_info'),
+                        reason="sys.getsizeof is unsupported on PyPy")
+    def test_connection_state_usage(self):
+        from autopush.memusage import connection_state_usage
+        stream = StringIO()
+        connection_state_usage(stream, self.proto.db, count=10)
+        assert "bytes per idle connection (10 sampled)" in stream.getvalue()
+
     def test_handshake_sub(self):
         self.factory.externalPort = 80
 
@@ -367,7 +420,7 @@ class WebsocketTestCase(unittest.TestCase):
         # Stick a mock on
         notif_mock = Mock()
         notif_mock.ttl = 0
-        self.proto.ps.direct_updates = dict(foo=[notif_mock])
+        self.proto.ps.direct_updates.add("foo", notif_mock)
         self.proto.db.router.get_uaid = mock_get = Mock()
         mock_get.return_value = dict(foo="bar")
         self.proto.onClose(True, None, None)
@@ -383,11 +436,11 @@ class WebsocketTestCase(unittest.TestCase):
 
         # Stick an un-acked direct notification in
         notif = make_webpush_notification(self.proto.ps.uaid, chid)
-        self.proto.ps.direct_updates[chid] = [notif]
+        self.proto.ps.direct_updates.add(chid, notif)
 
         # Apply some mocks
         msg_mock = Mock(spec=db.Message)
-        msg_mock.store_message = Mock()
+        msg_mock.store_message_async.return_value = succeed(None)
         self.proto.db.message_table = Mock(return_value=msg_mock)
         self.proto.db.router.get_uaid = mock_get = Mock()
         mock_get.return_value = dict(node_id="localhost:2000")
@@ -404,11 +457,11 @@ class WebsocketTestCase(unittest.TestCase):
         self.factory.clients[dummy_uaid.hex] = self.proto
 
         # Stick an un-acked direct notification in
-        self.proto.ps.direct_updates[dummy_chid_str] = [dummy_notif()]
+        self.proto.ps.direct_updates.add(dummy_chid_str, dummy_notif())
 
         # Apply some mocks
         msg_mock = Mock(spec=db.Message)
-        msg_mock.store_message = Mock()
+        msg_mock.store_message_async.return_value = succeed(None)
         self.proto.db.message_table = Mock(return_value=msg_mock)
         self.proto.db.router.get_uaid = mock_get = Mock()
         mock_get.return_value = dict(node_id="localhost:2000")
@@ -427,11 +480,11 @@ class WebsocketTestCase(unittest.TestCase):
 
         # Stick an un-acked direct notification in
         notif = make_webpush_notification(self.proto.ps.uaid, chid)
-        self.proto.ps.direct_updates[chid] = [notif]
+        self.proto.ps.direct_updates.add(chid, notif)
 
         # Apply some mocks
         msg_mock = Mock(spec=db.Message)
-        msg_mock.store_message = Mock()
+        msg_mock.store_message_async.return_value = succeed(None)
         self.proto.db.message_table = Mock(return_value=msg_mock)
         self.proto.db.router.get_uaid = mock_get = Mock()
         mock_get.return_value = False
@@ -674,7 +727,8 @@ class WebsocketTestCase(unittest.TestCase):
         self._connect()
         self._send_message(dict(messageType="hello", use_webpush=True,
                                 channelIDs=[]))
-        assert self.proto.base_tags == ['use_webpush:True']
+        assert self.proto.base_tags == ('use_webpush:True',)
+        assert self.proto.base_tags is self.proto.ps._base_tags
         msg = yield self.get_response()
         assert msg["status"] == 200
         assert "use_webpush" in msg
@@ -764,6 +818,48 @@ class WebsocketTestCase(unittest.TestCase):
         assert msg["reason"] == "error - overloaded"
         self.flushLoggedErrors()
 
+    @inlineCallbacks
+    def test_hello_admission(self):
+        self._connect()
+        admission = self.factory.hello_admission = Mock(spec=HelloAdmission)
+        admitted = Deferred()
+        admission.admit.return_value = admitted
+        self.proto.db.router.register_user = Mock(return_value=(False, {}))
+
+        self._send_message(dict(messageType="hello", use_webpush=True,
+                                channelIDs=[]))
+        admission.admit.assert_called_with(False)
+        assert not self.proto.db.router.register_user.called
+
+        admitted.callback(None)
+        msg = yield self.get_response()
+        assert msg["reason"] == "already_connected"
+        assert self.proto.db.router.register_user.called
+
+    @inlineCallbacks
+    def test_hello_admission_rejected(self):
+        self._connect()
+        self.proto.randrange = Mock(return_value=0.1)
+        admission = self.factory.hello_admission = Mock(spec=HelloAdmission)
+        admission.admit.return_value = fail(AdmissionRejectedException())
+
+        self._send_message(dict(messageType="hello", use_webpush=True,
+                                channelIDs=[]))
+        msg = yield self.get_response()
+        assert msg["status"] == 503
+        assert msg["reason"] == "error - overloaded"
+
+    def test_hello_admission_cancelled(self):
+        self._connect()
+        admission = self.factory.hello_admission = HelloAdmission(
+            1, 1, 10, self.metrics, clock=Clock())
+        admission.admit()
+        self._send_message(dict(messageType="hello", use_webpush=True,
+                                channelIDs=[]))
+        assert admission.waiting == 1
+        self.proto.cleanUp(True, None, None)
+        assert admission.waiting == 0
+
     @inlineCallbacks
     def test_hello_check_fail(self):
         self._connect()
@@ -804,6 +900,33 @@ class WebsocketTestCase(unittest.TestCase):
         assert len(kwargs) == 0
         assert time.time() - connected >= 3
 
+    def test_timer_wheel(self):
+        self.conf.timer_wheel_tick = 0.2
+        factory = PushServerFactory(self.conf, self.proto.db,
+                                    self.mock_agent, {})
+        wheel = factory.timer_wheel
+        assert isinstance(wheel, TimerWheel)
+        # autobahn's handshake and ping timers stay on its own
+        assert factory._batched_timer is not wheel
+        self.factory.timer_wheel = wheel
+        self.conf.hello_timeout = 3
+        self._connect()
+        assert len(wheel) == 1
+        self._send_message(dict(messageType="hello", use_webpush=True,
+                                channelIDs=[]))
+        assert len(wheel) == 1
+        self.proto.setTimeout(None)
+        assert len(wheel) == 0
+
+    def test_timer_wheel_disabled(self):
+        factory = PushServerFactory(self.conf, self.proto.db,
+                                    self.mock_agent, {})
+        assert factory.timer_wheel is None
+        proto = factory.buildProtocol(('localhost', 8080))
+        with patch("twisted.internet.reactor.callLater") as call_later:
+            proto.callLater(3, proto.timeoutConnection)
+        call_later.assert_called_once_with(3, proto.timeoutConnection)
+
     @inlineCallbacks
     def test_not_hello(self):
         self._connect()
@@ -1229,7 +1352,6 @@ class WebsocketTestCase(unittest.TestCase):
         self.proto.ps.uaid = uuid.uuid4().hex
 
         chid = str(uuid.uuid4())
-        self.proto.ps.direct_updates[chid] = []
 
         # Send ourself a notification
         payload = {"channelID": chid,
@@ -1253,6 +1375,20 @@ class WebsocketTestCase(unittest.TestCase):
             "version": "10",
             "headers": fixed_headers}
 
+    def test_notification_pre_encoded(self):
+        self._connect()
+        self.proto.ps.uaid = uuid.uuid4().hex
+        chid = str(uuid.uuid4())
+        frame = json.dumps(dict(messageType="notification", channelID=chid,
+                                version="10"))
+        self.proto.send_notification(dict(channelID=chid, version=10,
+                                          ttl=20, timestamp=0,
+                                          frame=unicode(frame)))
+        self.send_mock.assert_called_once_with(frame, False)
+        notif = self.proto.ps.direct_updates.get(chid, "10")
+        assert notif.version == "10"
+        assert notif.ttl == 20
+
     @inlineCallbacks
     def test_hello_not_webpush(self):
         self._connect()
@@ -1271,7 +1407,7 @@ class WebsocketTestCase(unittest.TestCase):
 
         # stick a notification to ack in
         notif = make_webpush_notification(self.proto.ps.uaid, chid)
-        self.proto.ps.direct_updates[chid] = [notif]
+        self.proto.ps.direct_updates.add(chid, notif)
         msg = yield self.get_response()
         assert msg["status"] == 200
 
@@ -1281,8 +1417,7 @@ class WebsocketTestCase(unittest.TestCase):
                                           "version": notif.version}]))
 
         # Verify it was cleared out
-        assert len(self.proto.ps.direct_updates.get(
-            str(notif.channel_id))) == 0
+        assert str(notif.channel_id) not in self.proto.ps.direct_updates
         assert len(self.proto.log.debug.mock_calls) == 2
         assert_called_included(self.proto.log.debug,
                                format="Ack",
@@ -1298,10 +1433,9 @@ class WebsocketTestCase(unittest.TestCase):
         self._connect()
         chid = str(uuid.uuid4())
         self.proto.ps.uaid = uuid.uuid4().hex
-        self.proto.ps.direct_updates[chid] = []
         notif = make_webpush_notification(self.proto.ps.uaid, chid)
         notif.message_id = dummy_version
-        self.proto.ps.updates_sent[chid] = [notif]
+        self.proto.ps.updates_sent.add(chid, notif)
 
         mock_defer = Mock()
         self.proto.force_retry = Mock(return_value=mock_defer)
@@ -1340,21 +1474,25 @@ class WebsocketTestCase(unittest.TestCase):
     def test_ack_remove(self):
         self._connect()
         notif = dummy_notif()
-        self.proto.ps.updates_sent[dummy_chid_str] = [notif]
+        self.proto.ps.updates_sent.add(dummy_chid_str, notif)
         self.proto._handle_webpush_update_remove(None, dummy_chid_str, notif)
-        assert self.proto.ps.updates_sent[dummy_chid_str] == []
+        assert dummy_chid_str not in self.proto.ps.updates_sent
 
     def test_ack_remove_not_set(self):
         self._connect()
         notif = dummy_notif()
-        self.proto.ps.updates_sent[dummy_chid_str] = None
         self.proto._handle_webpush_update_remove(None, dummy_chid_str, notif)
 
     def test_ack_remove_missing(self):
         self._connect()
         notif = dummy_notif()
-        self.proto.ps.updates_sent[dummy_chid_str] = []
+        # Since replaced by a resend of the same version
+        resent = dummy_notif()
+        self.proto.ps.updates_sent.add(dummy_chid_str, resent)
         self.proto._handle_webpush_update_remove(None, dummy_chid_str, notif)
+        assert self.proto.ps.updates_sent.get(
+            dummy_chid_str, notif.version) is resent
+        assert self.proto.ps.unacked_stored
 
     def test_ack_missing_updates(self):
         self._connect()
@@ -1477,10 +1615,122 @@ class WebsocketTestCase(unittest.TestCase):
         self.proto.ps._notification_fetch.addErrback(lambda x: d.errback(x))
         return d
 
+    def _prefetch_pages(self, pages):
+        self.conf.msg_fetch_size = 2
+        self.conf.msg_prefetch_window = 2
+        self.proto.ps.scan_timestamps = True
+        msg_mock = Mock(spec=db.Message)
+
+        def fetch(uaid, timestamp, limit):
+            assert limit == 2
+            return pages[timestamp]
+        msg_mock.fetch_timestamp_messages = Mock(side_effect=fetch)
+        self.proto.db.message_table = Mock(return_value=msg_mock)
+        return msg_mock
+
+    def _timestamped_notif(self, timestamp):
+        notif = make_webpush_notification(self.proto.ps.uaid, dummy_chid_str)
+        notif.sortkey_timestamp = timestamp
+        return notif
+
+    @inlineCallbacks
+    def test_process_notifications_prefetch(self):
+        self._connect()
+        self.proto.ps.uaid = uuid.uuid4().hex
+        notifs = [self._timestamped_notif(ts) for ts in range(1, 5)]
+        msg_mock = self._prefetch_pages({
+            None: (2, notifs[:2]),
+            2: (4, notifs[2:]),
+            4: (None, []),
+        })
+        fetch = msg_mock.fetch_timestamp_messages
+
+        self.proto.process_notifications()
+        yield self.proto.ps._notification_fetch
+        assert self.send_mock.call_count == 2
+
+        # The following pages are read ahead, up to the end
+        prefetched = self.proto.ps._prefetched
+        yield self._wait_for(
+            lambda: fetch.call_count == 3 and prefetched[-1].called)
+        assert len(prefetched) == 2
+        assert self.proto.ps._prefetch_timestamp is None
+
+        # Once acked, the next page is delivered without another query
+        self.proto.ps.updates_sent.clear()
+        self.proto.process_notifications()
+        assert self.send_mock.call_count == 4
+        assert self.proto.ps.current_timestamp == 4
+        assert fetch.call_count == 3
+        assert len(prefetched) == 1
+        self.metrics.increment.assert_any_call("ua.notification.prefetch_hit")
+
+    @inlineCallbacks
+    def test_process_notifications_prefetch_stored_since(self):
+        self._connect()
+        self.proto.ps.uaid = uuid.uuid4().hex
+        notifs = [self._timestamped_notif(ts) for ts in range(1, 4)]
+        pages = {
+            None: (2, notifs[:2]),
+            2: (None, []),
+        }
+        msg_mock = self._prefetch_pages(pages)
+        fetch = msg_mock.fetch_timestamp_messages
+
+        self.proto.process_notifications()
+        yield self.proto.ps._notification_fetch
+        prefetched = self.proto.ps._prefetched
+        yield self._wait_for(
+            lambda: fetch.call_count == 2 and prefetched[-1].called)
+
+        # Stored after the (empty) page was read ahead
+        pages[2] = (3, notifs[2:])
+        pages[3] = (None, [])
+        self.proto.ps.updates_sent.clear()
+        self.proto.process_notifications()
+        yield self.proto.ps._notification_fetch
+        # Queried again rather than ending the scan
+        assert fetch.call_args_list[2][0][1] == 2
+        assert self.send_mock.call_count == 3
+        assert self.proto.ps.current_timestamp == 3
+
+    @inlineCallbacks
+    def test_process_notifications_prefetch_stops_at_legacy(self):
+        self._connect()
+        self.proto.ps.uaid = uuid.uuid4().hex
+        legacy = make_webpush_notification(self.proto.ps.uaid,
+                                           dummy_chid_str)
+        msg_mock = self._prefetch_pages({
+            None: (1, [self._timestamped_notif(1), legacy]),
+        })
+        self.proto.process_notifications()
+        yield self.proto.ps._notification_fetch
+        assert self.send_mock.call_count == 2
+        assert not self.proto.ps._prefetched
+        assert msg_mock.fetch_timestamp_messages.call_count == 1
+
+    def test_prefetch_paused(self):
+        self._connect()
+        self.proto.ps.uaid = uuid.uuid4().hex
+        msg_mock = self._prefetch_pages({})
+        self.proto.ps._prefetch_timestamp = 2
+        self.proto.ps.pauseProducing()
+        self.proto.prefetch_notifications()
+        assert not self.proto.ps._prefetched
+        assert not msg_mock.fetch_timestamp_messages.called
+
+    def test_clear_prefetched(self):
+        self._connect()
+        self.proto.ps._prefetched.append(Deferred())
+        self.proto.ps._prefetch_timestamp = 2
+        self.proto.clear_prefetched()
+        assert not self.proto.ps._prefetched
+        assert self.proto.ps._prefetch_timestamp is None
+
     def test_process_notif_doesnt_run_with_webpush_outstanding(self):
         self._connect()
         self.proto.ps.uaid = dummy_uaid.hex
-        self.proto.ps.updates_sent[dummy_chid_str] = [dummy_notif()]
+        self.proto.ps.updates_sent.add(dummy_chid_str, dummy_notif())
         self.proto.deferToLater = Mock()
         self.proto.process_notifications()
         assert self.proto.deferToLater.called
@@ -1535,7 +1785,6 @@ class WebsocketTestCase(unittest.TestCase):
             self.proto.ps.uaid,
             uuid.uuid4().hex,
         )
-        self.proto.ps.updates_sent[str(notif.channel_id)] = []
 
         self.proto.finish_webpush_notifications((None, [notif]))
         assert self.send_mock.called
@@ -1551,7 +1800,6 @@ class WebsocketTestCase(unittest.TestCase):
             ttl=5
         )
         notif.timestamp = 0
-        self.proto.ps.updates_sent[str(notif.channel_id)] = []
 
         self.proto.force_retry = Mock()
         self.proto.finish_webpush_notifications((None, [notif]))
@@ -1573,7 +1821,6 @@ class WebsocketTestCase(unittest.TestCase):
             dummy_chid_str,
             ttl=500
         )
-        self.proto.ps.updates_sent = defaultdict(lambda: [])
         msg_mock.fetch_messages.return_value = (
             None,
             [notif, notif, notif]
@@ -1607,6 +1854,151 @@ class WebsocketTestCase(unittest.TestCase):
         assert fr.call_args[0] == (mm.drop_user, uaid)
 
 
+class UnackedNotificationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.unacked = UnackedNotifications()
+        self.notifs = [dummy_notif(channel_id=chid, message_id=version)
+                       for chid in (uuid.uuid4(), uuid.uuid4())
+                       for version in ("v1", "v2")]
+        for notif in self.notifs:
+            self.unacked.add(str(notif.channel_id), notif)
+
+    def test_ack(self):
+        assert len(self.unacked) == 4
+        notif = self.notifs[1]
+        chid = str(notif.channel_id)
+        assert chid in self.unacked
+        assert self.unacked.get(chid, u"v2") is notif
+        assert self.unacked.get(chid, "v3") is None
+        assert self.unacked.get("missing", "v2") is None
+        self.unacked.discard(chid, notif)
+        self.unacked.discard(chid, notif)
+        assert len(self.unacked) == 3
+        assert self.unacked.get(chid, "v2") is None
+        self.unacked.discard(chid, self.notifs[0])
+        assert chid not in self.unacked
+        assert sorted(self.unacked) == sorted(self.notifs[2:])
+
+    def test_resend(self):
+        notif = self.notifs[0]
+        chid = str(notif.channel_id)
+        resent = dummy_notif(channel_id=notif.channel_id, message_id="v1")
+        self.unacked.add(chid, resent)
+        assert len(self.unacked) == 4
+        self.unacked.discard(chid, notif)
+        assert self.unacked.get(chid, "v1") is resent
+
+    def test_discard_channel(self):
+        self.unacked.discard_channel(str(self.notifs[0].channel_id))
+        self.unacked.discard_channel("missing")
+        assert len(self.unacked) == 2
+        self.unacked.clear()
+        assert not self.unacked
+        assert list(self.unacked) == []
+
+    def test_bench(self):
+        from autopush.scripts.bench_acks import run
+        lists, indexed = run(channels=5, backlog=2)
+        assert lists > 0
+        assert indexed > 0
+
+    def test_bench_tags(self):
+        from autopush.scripts.bench_tags import run
+        lists, shared = run(connects=20, agents=2)
+        assert shared < lists
+
+
+class HelloAdmissionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Mock(spec=SinkMetrics)
+        self.admission = HelloAdmission(10, 2, 1, self.metrics,
+                                        clock=self.clock)
+
+    def test_burst(self):
+        results = []
+        for _ in range(2):
+            self.admission.admit().addCallback(results.append)
+        assert results == [None, None]
+        assert self.admission.waiting == 0
+
+        d = self.admission.admit()
+        assert not d.called
+        assert self.admission.waiting == 1
+
+    def test_paced(self):
+        for _ in range(2):
+            self.admission.admit()
+        order = []
+        for i in range(4):
+            self.admission.admit(returning=False).addCallback(
+                lambda _, i=i: order.append(("new", i)))
+        self.admission.admit(returning=True).addCallback(
+            lambda _: order.append(("returning", 0)))
+        assert self.admission.waiting == 5
+
+        self.clock.advance(0.1)
+        # Returning users are admitted first
+        assert order == [("returning", 0)]
+        self.metrics.timing.assert_called_with(
+            "ua.hello.admission.wait", 100.0)
+        self.metrics.gauge.assert_called_with(
+            "ua.hello.admission.queue_depth", 4)
+
+        self.clock.advance(0.2)
+        assert order == [("returning", 0), ("new", 0), ("new", 1)]
+        self.clock.advance(1)
+        assert len(order) == 5
+        assert self.admission.waiting == 0
+
+    def test_rejected(self):
+        for _ in range(12):
+            self.admission.admit()
+        assert self.admission.waiting == 10
+        failures = []
+        self.admission.admit().addErrback(failures.append)
+        assert failures[0].check(AdmissionRejectedException)
+        self.metrics.increment.assert_called_with(
+            "ua.hello.admission.rejected")
+
+    def test_min_queue(self):
+        admission = HelloAdmission(0.5, 1, 1, self.metrics, clock=self.clock)
+        assert admission.max_queue == 1
+        admission.admit()
+        d = admission.admit()
+        assert not d.called
+        assert admission.waiting == 1
+
+    def test_expired(self):
+        for _ in range(2):
+            self.admission.admit()
+        failures = []
+        self.admission.admit(returning=False).addErrback(failures.append)
+        # A stream of returning users, each admitted ahead of the new one
+        for _ in range(11):
+            self.admission.admit(returning=True)
+            self.clock.advance(0.1)
+        assert len(failures) == 1
+        assert failures[0].check(AdmissionRejectedException)
+        self.metrics.increment.assert_any_call("ua.hello.admission.expired")
+        assert self.admission.waiting == 0
+
+    def test_cancelled(self):
+        for _ in range(2):
+            self.admission.admit()
+        results = []
+        cancelled = self.admission.admit()
+        cancelled.addErrback(lambda fail: None)
+        self.admission.admit().addCallback(results.append)
+        cancelled.cancel()
+        assert self.admission.waiting == 1
+
+        self.clock.advance(0.1)
+        assert results == [None]
+        assert self.admission.waiting == 0
+
+
 class RouterHandlerTestCase(unittest.TestCase):
     def setUp(self):
         twisted.internet.base.DelayedCall.debug = True
@@ -1645,6 +2037,38 @@ class RouterHandlerTestCase(unittest.TestCase):
         assert resp.content == "Client busy."
 
 
+class BatchRouterHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        twisted.internet.base.DelayedCall.debug = True
+
+        self.conf = conf = AutopushConfig(
+            hostname="localhost",
+            statsd_host=None,
+        )
+        self.app = InternalRouterHTTPFactory.for_handler(
+            BatchRouterHandler,
+            conf
+        )
+        self.client = Client(self.app)
+
+    @inlineCallbacks
+    def test_batch(self):
+        connected = str(uuid.uuid4())
+        busy = str(uuid.uuid4())
+        self.app.clients[connected] = client_mock = Mock(paused=False)
+        self.app.clients[busy] = Mock(paused=True)
+        body = json.dumps([
+            dict(uaid=connected, notification=dict(version="1")),
+            dict(uaid=dummy_uaid_str, notification=dict(version="2")),
+            dict(uaid=busy, notification=dict(version="3")),
+        ])
+        resp = yield self.client.put('/push_batch', body=body)
+        assert resp.get_status() == 200
+        assert json.loads(resp.content) == dict(results=[200, 404, 503])
+        client_mock.send_notification.assert_called_once_with(
+            dict(version="1"))
+
+
 class NotificationHandlerTestCase(unittest.TestCase):
     def setUp(self):
         twisted.internet.base.DelayedCall.debug = True
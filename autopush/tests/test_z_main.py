@@ -10,7 +10,8 @@ import json
 
 from mock import Mock, patch
 import pytest
-from twisted.internet.defer import Deferred
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
 from twisted.trial import unittest as trialtest
 import hyper
 import hyper.tls
@@ -255,6 +256,52 @@ class ConnectionMainTestCase(unittest.TestCase):
         assert len(mock_handler.mock_calls) == 0
 
 
+class ConnectionStopTestCase(trialtest.TestCase):
+    def setUp(self):
+        # Undo earlier tests' leaked reactor mock
+        patcher = patch("autopush.main.reactor", reactor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stop_flushes_writes(self):
+        conf = AutopushConfig(hostname="example.com", statsd_host=None,
+                              message_batch_delay=0.01)
+        app = ConnectionApplication(conf,
+                                    resource=autopush.tests.boto_resource)
+        app.async_client = Mock()
+        app.async_client.close.return_value = None
+        client = Mock()
+        app.clients["uaid"] = client
+
+        def drain():
+            # Once the clients' unacked direct notifications are queued,
+            # before the client writing them is closed
+            client.transport.abortConnection.assert_called_once_with()
+            assert not app.async_client.close.called
+            return succeed(None)
+        app.db.batch_writer = Mock()
+        app.db.batch_writer.drain.side_effect = drain
+
+        d = app.stopService()
+        d.addCallback(
+            lambda _: app.async_client.close.assert_called_once_with())
+        return d
+
+    def test_stop_without_batch_writer(self):
+        conf = AutopushConfig(hostname="example.com", statsd_host=None)
+        app = ConnectionApplication(conf,
+                                    resource=autopush.tests.boto_resource)
+        assert app.db.batch_writer is None
+        client = Mock()
+        app.clients["uaid"] = client
+
+        def check(_):
+            assert not client.transport.abortConnection.called
+        d = app.stopService()
+        d.addCallback(check)
+        return d
+
+
 class EndpointMainTestCase(unittest.TestCase):
     class TestArg(AutopushConfig):
         # important stuff
@@ -265,6 +312,9 @@ class EndpointMainTestCase(unittest.TestCase):
         gcm_ttl = 999
         gcm_dryrun = False
         gcm_collapsekey = "collapse"
+        gcm_async = False
+        gcm_max_connections = 50
+        gcm_timeout = 10
         max_data = 4096
         # filler
         crypto_key = 'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA='
@@ -283,6 +333,7 @@ class EndpointMainTestCase(unittest.TestCase):
         message_write_throughput = 0
         senderid_list = '{"12345":{"auth":"abcd"}}'
         key_hash = "supersikkret"
+        key_id_tokens = False
         no_aws = True
         fcm_enabled = True
         fcm_ttl = 999
@@ -290,6 +341,13 @@ class EndpointMainTestCase(unittest.TestCase):
         fcm_collapsekey = "collapse"
         fcm_senderid = '12345'
         fcm_auth = 'abcde'
+        fcm_async = False
+        fcm_max_connections = 50
+        fcm_timeout = 10
+        bridge_max_concurrency = 0
+        bridge_target_latency = 1.0
+        bridge_failure_threshold = 5
+        bridge_reset_timeout = 30
         ssl_key = "keys/server.crt"
         ssl_cert = "keys/server.key"
         ssl_dh_param = None
@@ -302,6 +360,10 @@ class EndpointMainTestCase(unittest.TestCase):
 
         proxy_protocol_port = None
         memusage_port = None
+        node_transport_port = None
+        node_transport_timeout = 5
+        message_batch_delay = 0
+        json_codec = "auto"
         disable_simplepush = True
         use_cryptography = False
         sts_max_age = 1234
@@ -405,6 +467,34 @@ class EndpointMainTestCase(unittest.TestCase):
         assert app.routers["apns"].router_conf['firefox']['cert'] == \
             "cert.file"
         assert app.routers["apns"].router_conf['firefox']['key'] == "key.file"
+        assert app.routers["fcm"].senderID == "12345"
+        assert not app.routers["fcm"].use_async
+
+    @patch('autopush.router.apns2.HTTP20Connection',
+           spec=hyper.HTTP20Connection)
+    @patch('hyper.tls', spec=hyper.tls)
+    def test_conf_fcm_async(self, *args):
+        self.TestArg.fcm_async = True
+        self.addCleanup(setattr, self.TestArg, "fcm_async", False)
+        conf = AutopushConfig.from_argparse(self.TestArg)
+        router = EndpointApplication(
+            conf, resource=autopush.tests.boto_resource).routers["fcm"]
+        assert router.use_async
+        assert router.fcm._timeout == 10
+
+    @patch('autopush.router.apns2.HTTP20Connection',
+           spec=hyper.HTTP20Connection)
+    @patch('hyper.tls', spec=hyper.tls)
+    def test_async_dynamodb(self, *args):
+        endpoint_main([
+            "--async_dynamodb",
+        ], False, resource=autopush.tests.boto_resource)
+        conf = AutopushConfig.from_argparse(self.TestArg,
+                                            async_dynamodb=True)
+        app = EndpointApplication(conf,
+                                  resource=autopush.tests.boto_resource)
+        assert app.async_client is not None
+        assert app.db.async_client is app.async_client
 
     def test_bad_senders(self):
         old_list = self.TestArg.senderid_list
@@ -447,3 +537,21 @@ class EndpointMainTestCase(unittest.TestCase):
         self.TestArg._no_sslcontext_cache = True
         conf = AutopushConfig.from_argparse(self.TestArg)
         assert conf.no_sslcontext_cache
+
+    def test_json_codec(self):
+        conf = AutopushConfig.from_argparse(self.TestArg)
+        assert conf.json_codec == "auto"
+        self.TestArg.json_codec = "json"
+        conf = AutopushConfig.from_argparse(self.TestArg)
+        self.TestArg.json_codec = "auto"
+        assert conf.json_codec == "json"
+
+    def test_key_id_tokens(self):
+        conf = AutopushConfig.from_argparse(self.TestArg)
+        assert not conf.make_endpoint(
+            "deadbeef" * 4, "cafe" * 8).rsplit("/")[-1].startswith("k")
+        self.TestArg.key_id_tokens = True
+        self.addCleanup(setattr, self.TestArg, "key_id_tokens", False)
+        conf = AutopushConfig.from_argparse(self.TestArg)
+        assert conf.make_endpoint(
+            "deadbeef" * 4, "cafe" * 8).rsplit("/")[-1].startswith("k")
@@ -0,0 +1,275 @@
+"""Hierarchical timer wheel for per connection timers
+
+Every WebSocket connection has a hello/idle timeout, rescheduled on every
+message it receives and so mostly reset long before it'd fire. Scheduled
+on the reactor, each reschedule churns its heap of delayed calls, which
+adds up with 100k+ connections per node.
+
+A :class:`TimerWheel` instead buckets timers into coarse ``tick`` slots
+on ``levels`` wheels of ``slots`` slots each (the first wheel's slots
+spanning a tick, each following wheel's slots spanning all of the
+previous wheel), driven by a single reactor timer. Scheduling and
+cancelling a timer are O(1) set operations, and resetting one to later
+(the common case, e.g. on every message) only updates its deadline: it's
+moved once its current slot comes due. Each tick expires its slot's
+timers, cascading the next wheels' due slots down.
+
+Expired timers fire ``chunk_size`` per reactor turn, so a mass of them
+(e.g. the timeouts of clients that all reconnected together) doesn't
+stall the reactor. Timers fire up to two ticks after their deadline
+(plus any turns awaiting their chunk), never before it.
+
+"""
+import math
+import time
+from collections import deque
+
+from typing import Any, Callable, List, Optional, Set  # noqa
+from twisted.internet import reactor
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from autopush.metrics import IMetrics  # noqa
+
+
+class WheelTimer(object):
+    """A timer scheduled on a :class:`TimerWheel`
+
+    Provides the subset of :class:`twisted.internet.interfaces.IDelayedCall`
+    used by :class:`twisted.protocols.policies.TimeoutMixin` and autobahn's
+    batched timers (whose ``cancel`` is a no-op once called).
+
+    """
+    __slots__ = ("wheel", "deadline", "due", "func", "args", "kwargs",
+                 "slot", "called", "cancelled")
+
+    def __init__(self, wheel, deadline, func, args, kwargs):
+        # type: (TimerWheel, float, Callable[..., Any], Any, Any) -> None
+        self.wheel = wheel
+        self.deadline = deadline
+        # The tick of the slot it's in
+        self.due = 0
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.slot = None  # type: Optional[Set[WheelTimer]]
+        self.called = False
+        self.cancelled = False
+
+    def getTime(self):
+        # type: () -> float
+        return self.deadline
+
+    def active(self):
+        # type: () -> bool
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        # type: () -> None
+        if self.active():
+            self.cancelled = True
+            self.wheel._remove(self)
+
+    def reset(self, seconds):
+        # type: (float) -> None
+        """Reschedule to fire seconds from now"""
+        if self.cancelled:
+            raise AlreadyCancelled
+        if self.called:
+            raise AlreadyCalled
+        wheel = self.wheel
+        self.deadline = wheel.clock.seconds() + seconds
+        if self.deadline <= (self.due - 1) * wheel.tick:
+            # Sooner than its slot, move it
+            wheel._move(self)
+        # Otherwise it's reinserted per the new deadline when its slot's
+        # reached
+
+
+class TimerWheel(object):
+    """Coarse grained timers, batched per ``tick`` seconds
+
+    Timers are scheduled via :meth:`call_later` (matching
+    :class:`txaio.IBatchedTimer`, so it may serve as an autobahn
+    factory's ``_batched_timer``). The wheel's reactor timer only runs
+    while it holds timers.
+
+    """
+    log = Logger()
+
+    def __init__(self,
+                 tick=0.2,          # type: float
+                 slots=64,          # type: int
+                 levels=3,          # type: int
+                 chunk_size=1000,   # type: int
+                 metrics=None,      # type: Optional[IMetrics]
+                 clock=reactor,
+                 ):
+        # type: (...) -> None
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.clock = clock
+        self.count = 0
+        self._wheels = [[set() for _ in range(slots)]
+                        for _ in range(levels)]  # type: List[List[Set[WheelTimer]]]  # noqa
+        # Expired timers awaiting their chunk (in order), and the set of
+        # those still to fire (acting as their slot)
+        self._expired = deque()  # type: deque
+        self._firing = set()  # type: Set[WheelTimer]
+        self._fire_call = None
+        self._tick = self._current_tick()
+        self._advancing = False
+        self._loop = LoopingCall(self._advance)
+        self._loop.clock = clock
+
+    def __len__(self):
+        return self.count
+
+    def call_later(self, delay, func, *args, **kwargs):
+        # type: (float, Callable[..., Any], *Any, **Any) -> WheelTimer
+        """Call func(*args, **kwargs) delay seconds from now"""
+        if not self.count:
+            # Nothing scheduled, so no ticks to catch up on
+            self._tick = self._current_tick()
+        timer = WheelTimer(self, self.clock.seconds() + delay, func, args,
+                           kwargs)
+        self._insert(timer, self._tick + 1)
+        self.count += 1
+        if not self._loop.running:
+            self._loop.start(self.tick, now=False)
+        return timer
+
+    def stop(self):
+        # type: () -> None
+        """Stop ticking, no further timers fire (until one's scheduled)"""
+        if self._loop.running:
+            self._loop.stop()
+
+    def _current_tick(self):
+        # type: () -> int
+        return int(self.clock.seconds() / self.tick)
+
+    def _due(self, timer):
+        # type: (WheelTimer) -> int
+        return int(math.ceil(timer.deadline / self.tick))
+
+    def _insert(self, timer, earliest):
+        # type: (WheelTimer, int) -> None
+        """Add timer to the slot of its deadline (or earliest, if later)"""
+        due = max(self._due(timer), earliest)
+        now = self._tick
+        slots = self.slots
+        span = 1
+        level = 0
+        # The first wheel whose slots (of span ticks) reach its deadline
+        while level < self.levels - 1 and due // span - now // span >= slots:
+            span *= slots
+            level += 1
+        if due // span - now // span >= slots:
+            # Beyond the last wheel: wait in its farthest slot, then
+            # reinserted from there
+            due = (now // span + slots - 1) * span
+        slot = self._wheels[level][(due // span) % slots]
+        slot.add(timer)
+        timer.slot = slot
+        timer.due = due
+
+    def _remove(self, timer):
+        # type: (WheelTimer) -> None
+        timer.slot.discard(timer)
+        timer.slot = None
+        self.count -= 1
+        if not self.count and not self._advancing:
+            self.stop()
+
+    def _move(self, timer):
+        # type: (WheelTimer) -> None
+        timer.slot.discard(timer)
+        self._insert(timer, self._tick + 1)
+
+    def _advance(self):
+        """Process every tick up to now"""
+        started = time.time()
+        target = self._current_tick()
+        expired = 0
+        self._advancing = True
+        try:
+            while self._tick < target and self.count:
+                self._tick += 1
+                expired += self._process(self._tick)
+        finally:
+            self._advancing = False
+        self._tick = max(self._tick, target)
+        if self._fire_call is None:
+            self._fire()
+        if self.metrics:
+            self.metrics.timing("ua.timer_wheel.tick",
+                                duration=(time.time() - started) * 1000)
+            self.metrics.gauge("ua.timer_wheel.timers", self.count)
+            if expired:
+                self.metrics.increment("ua.timer_wheel.expired", expired)
+        if not self.count:
+            self.stop()
+
+    def _process(self, tick):
+        # type: (int) -> int
+        """Cascade the wheels' slots due at tick, then expire the first
+        wheel's, returning the number of timers expired"""
+        span = self.slots ** (self.levels - 1)
+        for level in range(self.levels - 1, 0, -1):
+            if tick % span == 0:
+                for timer in self._take(level, (tick // span) % self.slots):
+                    self._insert(timer, tick)
+            span //= self.slots
+
+        expired = 0
+        for timer in self._take(0, tick % self.slots):
+            if self._due(timer) > tick:
+                # Reset since it was slotted
+                self._insert(timer, tick + 1)
+                continue
+            timer.slot = self._firing
+            self._firing.add(timer)
+            self._expired.append(timer)
+            expired += 1
+        return expired
+
+    def _fire(self):
+        # type: () -> None
+        """Fire up to chunk_size expired timers, leaving the rest to the
+        next reactor turn"""
+        self._fire_call = None
+        firing = self._firing
+        fired = 0
+        while self._expired and fired < self.chunk_size:
+            timer = self._expired.popleft()
+            if timer not in firing:
+                # Cancelled (or reset) since it expired
+                continue
+            firing.discard(timer)
+            if self._due(timer) > self._tick:
+                self._insert(timer, self._tick + 1)
+                continue
+            timer.slot = None
+            timer.called = True
+            self.count -= 1
+            fired += 1
+            try:
+                timer.func(*timer.args, **timer.kwargs)
+            except Exception:
+                self.log.failure("Unhandled error in timer")
+        if self._expired:
+            self._fire_call = self.clock.callLater(0, self._fire)
+        elif not self.count:
+            self.stop()
+
+    def _take(self, level, index):
+        # type: (int, int) -> Set[WheelTimer]
+        """Empty a slot, returning its timers"""
+        timers = self._wheels[level][index]
+        self._wheels[level][index] = set()
+        return timers
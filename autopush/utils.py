@@ -1,8 +1,11 @@
 import base64
+import binascii
 import hashlib
 import hmac
+import os
 import re
 import socket
+import struct
 import time
 import uuid
 
@@ -12,10 +15,14 @@ from attr import (
     attrs,
     attrib
 )
-from cryptography.fernet import Fernet  # noqa
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from typing import (  # noqa
+    TYPE_CHECKING,
     Any,
     Dict,
+    List,
     Optional,
     Union,
     Tuple,
@@ -28,6 +35,9 @@ from autopush.exceptions import (InvalidTokenException, VapidAuthException)
 from autopush.jwt import repad, VerifyJWT
 from autopush.web.base import AUTH_SCHEMES
 
+if TYPE_CHECKING:  # pragma: nocover
+    from autopush.cache import TTLCache, VapidCache  # noqa
+
 
 # Remove trailing padding characters from complex header items like
 # Crypto-Key and Encryption
@@ -133,6 +143,102 @@ def base64url_decode(string):
     return base64.urlsafe_b64decode(repad(string))
 
 
+# Prefix of key id tagged Fernet tokens. Untagged (legacy) tokens always
+# begin with "gAAAAA" (Fernet's version byte and a timestamp's high bytes)
+KEY_ID_TAG = "k"
+# Prefix of key id tagged compact (AES-GCM) tokens
+COMPACT_TAG = "c"
+COMPACT_NONCE_SIZE = 12
+
+
+def fernet_key_id(key):
+    # type: (str) -> str
+    """Short identifier of a Fernet key, for tagging its tokens"""
+    return base64.urlsafe_b64encode(hashlib.sha256(key).digest())[:3]
+
+
+class KeyIdFernet(object):
+    """A MultiFernet whose tokens may be tagged with their key's identifier
+
+    Tokens are encrypted with the first key. With ``tag_key_id`` they're
+    prefixed by :data:`KEY_ID_TAG` and its 3 character
+    :func:`fernet_key_id` (which keeps the token's Base64 alignment), so
+    decryption picks the key directly rather than trying each key in turn.
+    Untagged (legacy) tokens still try each key, and are generated by
+    default so nodes unaware of tags can decrypt them.
+
+    :meth:`encrypt_compact` produces smaller, cheaper tokens (prefixed by
+    :data:`COMPACT_TAG` and the key id) lacking Fernet's timestamp: a
+    random nonce, AES-GCM ciphertext and tag under a key derived from the
+    Fernet key. :meth:`decrypt` accepts any of these formats.
+
+    """
+    def __init__(self, keys, tag_key_id=False):
+        # type: (List[str], bool) -> None
+        self._fernets = fernets = [Fernet(key) for key in keys]
+        self._multi = MultiFernet(fernets)
+        self._tag = KEY_ID_TAG + fernet_key_id(keys[0]) if tag_key_id else ""
+        by_id = {}  # type: Dict[str, List[Fernet]]
+        for key, fernet in zip(keys, fernets):
+            by_id.setdefault(fernet_key_id(key), []).append(fernet)
+        # Colliding key ids (unlikely) share a MultiFernet
+        self._by_id = {
+            key_id: group[0] if len(group) == 1 else MultiFernet(group)
+            for key_id, group in by_id.iteritems()
+        }  # type: Dict[str, Union[Fernet, MultiFernet]]
+        self._aeads = {}  # type: Dict[str, List[AESGCM]]
+        for key in keys:
+            aead = AESGCM(hmac.new(base64.urlsafe_b64decode(key),
+                                   b"autopush compact token",
+                                   hashlib.sha256).digest())
+            self._aeads.setdefault(fernet_key_id(key), []).append(aead)
+        self._compact_tag = COMPACT_TAG + fernet_key_id(keys[0])
+        self._aead = self._aeads[fernet_key_id(keys[0])][0]
+
+    def encrypt(self, msg):
+        # type: (str) -> str
+        return self._tag + self._fernets[0].encrypt(msg)
+
+    def encrypt_compact(self, msg):
+        # type: (str) -> str
+        nonce = os.urandom(COMPACT_NONCE_SIZE)
+        return self._compact_tag + base64url_encode(
+            nonce + self._aead.encrypt(nonce, msg, None))
+
+    def decrypt(self, token, ttl=None):
+        # type: (str, Optional[int]) -> str
+        """Decrypt a tagged, compact or legacy token
+
+        :param ttl: Max age of Fernet tokens (ignored for compact tokens)
+
+        :raises cryptography.fernet.InvalidToken: for invalid tokens,
+            including those tagged by an unknown key
+
+        """
+        if token.startswith(COMPACT_TAG):
+            return self._decrypt_compact(token)
+        if not token.startswith(KEY_ID_TAG):
+            return self._multi.decrypt(token, ttl)
+        fernet = self._by_id.get(token[1:4])
+        if fernet is None:
+            raise InvalidToken
+        return fernet.decrypt(token[4:], ttl)
+
+    def _decrypt_compact(self, token):
+        # type: (str) -> str
+        try:
+            raw = base64url_decode(token[4:])
+        except (TypeError, binascii.Error):
+            raise InvalidToken
+        nonce, ciphertext = raw[:COMPACT_NONCE_SIZE], raw[COMPACT_NONCE_SIZE:]
+        for aead in self._aeads.get(token[1:4], []):
+            try:
+                return aead.decrypt(nonce, ciphertext, None)
+            except (InvalidTag, ValueError):
+                continue
+        raise InvalidToken
+
+
 def get_amid():
     # type: () -> Optional[str]
     """Fetch the AMI instance ID
@@ -188,44 +294,92 @@ def decipher_public_key(key_data):
     raise ValueError("Unknown public key format specified")
 
 
-def extract_jwt(token, crypto_key, is_trusted=False, use_crypto=False):
-    # type: (str, str, bool, bool) -> Dict[str, str]
-    """Extract the claims from the validated JWT. """
+def extract_jwt(token, crypto_key, is_trusted=False, use_crypto=False,
+                cache=None):
+    # type: (str, str, bool, bool, Optional[VapidCache]) -> Dict[str, str]
+    """Extract the claims from the validated JWT.
+
+    With a ``cache``, the claims of previously verified tokens are reused
+    (until their expiration) and loaded public keys are shared.
+
+    """
     # first split and convert the jwt.
     if not token or not crypto_key:
         return {}
     if is_trusted:
         return VerifyJWT.extract_assertion(token)
+    if cache is not None:
+        claims = cache.get_claims(token, crypto_key)
+        if claims is not None:
+            return claims
     if use_crypto:
-        return VerifyJWT.validate_and_extract_assertion(
+        claims = VerifyJWT.validate_and_extract_assertion(
             token,
-            decipher_public_key(crypto_key.encode('utf8')))
+            decipher_public_key(crypto_key.encode('utf8')),
+            cache=cache)
     else:
-        key = ecdsa.VerifyingKey.from_string(
-            base64.urlsafe_b64decode(
-                repad(crypto_key.encode('utf8')))[-64:],
-            curve=ecdsa.NIST256p
-        )
-        return jwt.decode(token,
-                          dict(keys=[key]),
-                          options=dict(
-                              verify_aud=False,
-                              verify_sub=False,
-                              verify_exp=False,
-                          ))
+        raw_key = base64.urlsafe_b64decode(
+            repad(crypto_key.encode('utf8')))[-64:]
+        if cache is not None:
+            key = cache.public_key(raw_key, _load_ecdsa_key)
+        else:
+            key = _load_ecdsa_key(raw_key)
+        claims = jwt.decode(token,
+                            dict(keys=[key]),
+                            options=dict(
+                                verify_aud=False,
+                                verify_sub=False,
+                                verify_exp=False,
+                            ))
+    if cache is not None:
+        cache.set_claims(token, crypto_key, claims)
+    return claims
 
 
-def parse_user_agent(agent_string):
-    # type: (str) -> Tuple[Dict[str, str], Dict[str, Any]]
+def _load_ecdsa_key(raw_key):
+    # type: (str) -> ecdsa.VerifyingKey
+    return ecdsa.VerifyingKey.from_string(raw_key, curve=ecdsa.NIST256p)
+
+
+# Longer User-Agents aren't cached by parse_user_agent
+MAX_CACHED_USER_AGENT = 512
+
+
+class FrozenDict(dict):
+    """A dict that can't be modified, for values shared between callers"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenDict is immutable")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+def parse_user_agent(agent_string, cache=None):
+    # type: (str, Optional[TTLCache]) -> Tuple[Dict[str, str], Dict[str, Any]]
     """Extracts user-agent data from a UA string
 
     Parses the user-agent into two forms. A limited one suitable for Datadog
     logging with limited tags, and a full string suitable for complete logging.
 
+    :param cache: Optional cache of results by User-Agent. Cached results
+                  are shared between callers, so are :class:`FrozenDict`s.
     :returns: A tuple of dicts, the first being the Datadog limited and the
               second being the complete info.
 
     """
+    if cache is None or len(agent_string) > MAX_CACHED_USER_AGENT:
+        return _parse_user_agent(agent_string)
+    result = cache.get(agent_string)
+    if result is None:
+        dd_info, raw_info = _parse_user_agent(agent_string)
+        result = FrozenDict(dd_info), FrozenDict(raw_info)
+        cache.set(agent_string, result)
+    return result
+
+
+def _parse_user_agent(agent_string):
+    # type: (str) -> Tuple[Dict[str, str], Dict[str, Any]]
     parsed = user_agent_parser.Parse(agent_string)
     dd_info = {}
     raw_info = {}
@@ -266,6 +420,16 @@ def parse_user_agent(agent_string):
     return dd_info, raw_info
 
 
+# Leading "kind" bytes of compact message-ids, distinct from the leading
+# characters of text message-ids ("01:", "02:" and "m:")
+COMPACT_MESSAGE_ID_LEGACY = "\x00"
+COMPACT_MESSAGE_ID_TOPIC = "\x01"
+COMPACT_MESSAGE_ID_SORTKEY = "\x02"
+COMPACT_MESSAGE_ID_KINDS = (COMPACT_MESSAGE_ID_LEGACY,
+                            COMPACT_MESSAGE_ID_TOPIC,
+                            COMPACT_MESSAGE_ID_SORTKEY)
+
+
 @attrs(slots=True)
 class WebPushNotification(object):
     """WebPush Notification
@@ -299,8 +463,8 @@ class WebPushNotification(object):
     # Whether this notification should follow legacy non-topic rules
     legacy = attrib(default=False)  # type: bool
 
-    def generate_message_id(self, fernet):
-        # type: (Fernet) -> str
+    def generate_message_id(self, fernet, compact=False):
+        # type: (KeyIdFernet, bool) -> str
         """Generate a message-id suitable for accessing the message
 
         For topic messages, a sort_key version of 01 is used, and the topic
@@ -317,9 +481,18 @@ class WebPushNotification(object):
 
             Encrypted('m' : uaid.hex : channel_id.hex)
 
+        Compact message-ids (see :meth:`KeyIdFernet.encrypt_compact`)
+        instead pack the same fields in binary, led by a kind byte of
+        :data:`COMPACT_MESSAGE_ID_TOPIC`, :data:`COMPACT_MESSAGE_ID_SORTKEY`
+        or :data:`COMPACT_MESSAGE_ID_LEGACY`:
+
+            kind : uaid.bytes : channel_id.bytes : (topic|timestamp|'')
+
         This is a blocking call.
 
         """
+        if compact:
+            return self._generate_compact_message_id(fernet)
         if self.topic:
             msg_key = ":".join(["01", self.uaid.hex, self.channel_id.hex,
                                 self.topic])
@@ -333,13 +506,47 @@ class WebPushNotification(object):
         self.update_id = self.message_id
         return self.message_id
 
+    def _generate_compact_message_id(self, fernet):
+        # type: (KeyIdFernet) -> str
+        ids = self.uaid.bytes + self.channel_id.bytes
+        if self.topic:
+            msg_key = COMPACT_MESSAGE_ID_TOPIC + ids + self.topic.encode(
+                'utf8')
+        elif self.legacy:
+            msg_key = COMPACT_MESSAGE_ID_LEGACY + ids
+        else:
+            self.sortkey_timestamp = self.sortkey_timestamp or ns_time()
+            msg_key = COMPACT_MESSAGE_ID_SORTKEY + ids + struct.pack(
+                ">Q", self.sortkey_timestamp)
+        self.message_id = fernet.encrypt_compact(msg_key)
+        self.update_id = self.message_id
+        return self.message_id
+
     @staticmethod
     def parse_decrypted_message_id(decrypted_token):
         # type: (str) -> Dict[str, Any]
-        """Parses a decrypted message-id into component parts"""
+        """Parses a decrypted (text or compact) message-id into component
+        parts"""
         topic = None
         sortkey_timestamp = None
-        if decrypted_token.startswith("01:"):
+        kind = decrypted_token[:1]
+        if kind in COMPACT_MESSAGE_ID_KINDS:
+            if len(decrypted_token) < 33:
+                raise InvalidTokenException("Truncated message-id.")
+            uaid = decrypted_token[1:17].encode('hex')
+            chid = decrypted_token[17:33].encode('hex')
+            rest = decrypted_token[33:]
+            if kind == COMPACT_MESSAGE_ID_TOPIC:
+                if not rest:
+                    raise InvalidTokenException("Missing topic.")
+                topic = rest
+            elif kind == COMPACT_MESSAGE_ID_SORTKEY:
+                if len(rest) != 8:
+                    raise InvalidTokenException("Invalid sortkey timestamp.")
+                sortkey_timestamp, = struct.unpack(">Q", rest)
+            elif rest:
+                raise InvalidTokenException("Incorrect token kind.")
+        elif decrypted_token.startswith("01:"):
             info = decrypted_token.split(":")
             if len(info) != 4:
                 raise InvalidTokenException("Incorrect number of token parts.")
@@ -493,8 +700,13 @@ class WebPushNotification(object):
         return notif
 
     @classmethod
-    def from_webpush_request_schema(cls, data, fernet, legacy=False):
-        # type: (Dict[str, Any], Fernet, bool) -> WebPushNotification
+    def from_webpush_request_schema(cls,
+                                    data,           # type: Dict[str, Any]
+                                    fernet,         # type: KeyIdFernet
+                                    legacy=False,   # type: bool
+                                    compact=False,  # type: bool
+                                    ):
+        # type: (...) -> WebPushNotification
         """Create a WebPushNotification from a validated WebPushRequestSchema
 
         This is a blocking call.
@@ -515,12 +727,12 @@ class WebPushNotification(object):
         else:
             notif.headers = None
 
-        notif.generate_message_id(fernet)
+        notif.generate_message_id(fernet, compact=compact)
         return notif
 
     @classmethod
     def from_message_id(cls, message_id, fernet):
-        # type: (str, Fernet) -> WebPushNotification
+        # type: (str, KeyIdFernet) -> WebPushNotification
         """Create a WebPushNotification from a message_id
 
         This is a blocking call.
@@ -3,12 +3,17 @@ import time
 from functools import wraps
 
 from botocore.exceptions import ClientError
+from marshmallow import Schema  # noqa
 from marshmallow.schema import UnmarshalResult  # noqa
 from typing import (  # noqa
     Any,
     Callable,
+    Dict,
+    List,
+    Optional,
     Sequence
 )
+from twisted.internet.defer import Deferred, maybeDeferred  # noqa
 from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
 
@@ -40,31 +45,122 @@ class ThreadedValidate(object):
     Exposed as a classmethod for running a marshmallow-based validation schema
     in a separate thread for a cyclone request handler.
 
+    Schemas declare whether they block via a ``blocking`` class attribute
+    (defaulting to ``True``). Non-blocking schemas are run synchronously on
+    the reactor. Blocking schemas may declare a non-blocking
+    ``inline_schema`` of their cheap checks: it's run on the reactor first,
+    rejecting invalid requests without a thread handoff. Its output is
+    available to the blocking schema's load as the ``inline_result``
+    context, so it needn't repeat those checks.
+
+    Schema instances are pooled and reused between requests.
+
     """
     log = Logger()
 
     def __init__(self, schema):
         self.schema = schema
+        self.blocking = getattr(schema, "blocking", True)
+        self.inline_schema = getattr(schema, "inline_schema", None)
+        self._pools = {}  # type: Dict[type, List[Schema]]
 
-    def _validate_request(self, request_handler, *args, **kwargs):
-        # type: (BaseWebHandler, *Any, **Any) -> UnmarshalResult
-        """Validates a schema_class against a cyclone request"""
-        data = {
+    def _request_data(self, request_handler, *args, **kwargs):
+        # type: (BaseWebHandler, *Any, **Any) -> Dict[str, Any]
+        return {
             "headers": request_handler.request.headers,
             "body": request_handler.request.body,
             "path_args": args,
             "path_kwargs": kwargs,
             "arguments": request_handler.request.arguments,
         }
-        schema = self.schema()
-        schema.context.update(
-            conf=request_handler.conf,
-            metrics=request_handler.metrics,
-            db=request_handler.db,
-            routers=request_handler.routers,
-            log=self.log
-        )
-        return schema.load(data)
+
+    def _validate_request(self, request_handler, *args, **kwargs):
+        # type: (BaseWebHandler, *Any, **Any) -> UnmarshalResult
+        """Validates a schema_class against a cyclone request"""
+        return self._load(self.schema, request_handler,
+                          self._request_data(request_handler, *args,
+                                             **kwargs))
+
+    def _load(self, schema_class, request_handler, data, context=None):
+        # type: (type, BaseWebHandler, Dict[str, Any], Optional[Dict]) -> UnmarshalResult  # noqa
+        """Load data with a pooled schema_class instance
+
+        list.pop/append are atomic, so this is safe to call from threads.
+
+        :param context: Additional schema context for this load only
+
+        """
+        pool = self._pools.setdefault(schema_class, [])
+        try:
+            schema = pool.pop()
+        except IndexError:
+            schema = schema_class()
+        try:
+            # Updated in place: nested schemas share the context dict
+            schema.context.update(
+                conf=request_handler.conf,
+                metrics=request_handler.metrics,
+                db=request_handler.db,
+                routers=request_handler.routers,
+                vapid_cache=request_handler.vapid_cache,
+                dead_token_cache=request_handler.dead_token_cache,
+                endpoint_token_cache=request_handler.endpoint_token_cache,
+                log=self.log
+            )
+            if context:
+                schema.context.update(context)
+            return schema.load(data)
+        finally:
+            for key in context or ():
+                schema.context.pop(key, None)
+            pool.append(schema)
+
+    def _validate(self, request_handler, data, context=None):
+        # type: (BaseWebHandler, Dict[str, Any], Optional[Dict]) -> Deferred
+        """Validate, inline and/or in a thread, per the schema"""
+        if not self.blocking:
+            return maybeDeferred(self._timed_load, "inline", self.schema,
+                                 request_handler, data, context)
+        if self.inline_schema is None:
+            return self._thread_load(request_handler, data, context)
+        d = maybeDeferred(self._timed_load, "inline", self.inline_schema,
+                          request_handler, dict(data), context)
+        d.addCallback(self._after_inline, request_handler, data, context)
+        return d
+
+    def _after_inline(self, result, request_handler, data, context):
+        # type: (UnmarshalResult, BaseWebHandler, Dict[str, Any], Optional[Dict]) -> Any  # noqa
+        if result.errors:
+            return result
+        context = dict(context or {}, inline_result=result.data)
+        return self._thread_load(request_handler, data, context)
+
+    def _timed_load(self, phase, schema_class, request_handler, data,
+                    context=None):
+        # type: (str, type, BaseWebHandler, Dict[str, Any], Optional[Dict]) -> UnmarshalResult  # noqa
+        start_time = time.time()
+        try:
+            return self._load(schema_class, request_handler, data, context)
+        finally:
+            self._track_phase_timing(None, phase, request_handler,
+                                     start_time)
+
+    def _thread_load(self, request_handler, data, context=None):
+        # type: (BaseWebHandler, Dict[str, Any], Optional[Dict]) -> Deferred
+        d = deferToThread(self._load, self.schema, request_handler, data,
+                          context)
+        d.addBoth(self._track_phase_timing, "thread", request_handler,
+                  time.time())
+        return d
+
+    def _track_phase_timing(self, result, phase, request_handler,
+                            start_time):
+        # type: (Any, str, BaseWebHandler, float) -> Any
+        """Track a validation phase's timing (the thread phase including
+        its handoff)"""
+        request_handler._timings["validation_%s_time" % phase] = (
+            time.time() - start_time)
+        return result
 
     def _call_func(self, result, func, request_handler):
         # type: (UnmarshalResult, Callable, BaseWebHandler) -> Any
@@ -86,8 +182,9 @@ class ThreadedValidate(object):
             start_time = time.time()
             # Wrap the handler in @cyclone.web.synchronous
             request_handler._auto_finish = False
-            d = deferToThread(
-                self._validate_request, request_handler, *args, **kwargs)
+            d = self._validate(
+                request_handler,
+                self._request_data(request_handler, *args, **kwargs))
             d.addBoth(self._track_validation_timing, request_handler,
                       start_time)
             d.addCallback(self._call_func, func, request_handler)
@@ -100,8 +197,8 @@ class ThreadedValidate(object):
 
     @classmethod
     def validate(cls, schema):
-        """Validate a request schema in a separate thread before calling the
-        request handler
+        """Validate a request schema (in a separate thread if it blocks)
+        before calling the request handler
 
         An alias `threaded_validate` should be used from this module.
 
@@ -115,10 +212,13 @@ class ThreadedValidate(object):
         .. code-block:: python
 
             class MySchema(Schema):
+                # Cheap enough to validate on the reactor
+                blocking = False
+
                 uaid = fields.UUID(allow_none=True)
 
             class MyHandler(cyclone.web.RequestHandler):
-                @threaded_validate(MySchema())
+                @threaded_validate(MySchema)
                 def post(self, uaid=None):
                     ...
 
@@ -166,6 +266,18 @@ class BaseWebHandler(BaseHandler):
     def routers(self):
         return self.application.routers
 
+    @property
+    def vapid_cache(self):
+        return self.application.vapid_cache
+
+    @property
+    def dead_token_cache(self):
+        return self.application.dead_token_cache
+
+    @property
+    def endpoint_token_cache(self):
+        return self.application.endpoint_token_cache
+
     def prepare(self):
         """Common request preparation"""
         if self.conf.enable_tls_auth:
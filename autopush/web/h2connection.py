@@ -0,0 +1,359 @@
+"""HTTP/2 support for the endpoint's cyclone application
+
+:class:`NegotiatingHTTPConnection` serves HTTP/2 to clients negotiating it
+via ALPN (``h2``) or beginning their connection with the HTTP/2 connection
+preface (prior knowledge, e.g. behind a TLS terminating proxy), falling back
+to HTTP/1.1 otherwise.
+
+Each HTTP/2 stream is handed to the application as a regular cyclone
+:class:`~cyclone.httpserver.HTTPRequest`, its :class:`H2Stream` standing in
+as the request's ``connection``. The request handlers are unaware of the
+multiplexing.
+
+"""
+import time
+from io import BytesIO
+
+from cyclone import httputil
+from cyclone.httpserver import HTTPRequest
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.errors import ErrorCodes
+from h2.events import (
+    ConnectionTerminated,
+    DataReceived,
+    RemoteSettingsChanged,
+    RequestReceived,
+    StreamEnded,
+    StreamReset,
+    WindowUpdated,
+)
+from h2.exceptions import ProtocolError, StreamClosedError
+from h2.settings import SettingCodes
+from twisted.internet import defer
+from twisted.internet.protocol import connectionDone
+from twisted.logger import Logger
+from typing import Dict, List, Optional, Tuple  # noqa
+
+from autopush.metrics import make_tags
+from autopush.web.limitedhttpconnection import LimitedHTTPConnection
+
+H2_PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+# HTTP/1.1 connection specific headers, invalid in HTTP/2 responses
+CONNECTION_HEADERS = frozenset([
+    b"connection",
+    b"keep-alive",
+    b"proxy-connection",
+    b"transfer-encoding",
+    b"upgrade",
+])
+
+
+def response_headers(head):
+    # type: (bytes) -> List[Tuple[bytes, bytes]]
+    """Convert cyclone's serialized HTTP/1.x response head to HTTP/2
+    headers"""
+    lines = head.split(b"\r\n")
+    headers = [(b":status", lines[0].split(b" ", 2)[1])]
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name and name not in CONNECTION_HEADERS:
+            headers.append((name, value.strip()))
+    return headers
+
+
+class H2Stream(object):
+    """An HTTP/2 stream, standing in for cyclone's HTTPConnection as its
+    request's ``connection``"""
+    xheaders = False
+    no_keep_alive = False
+
+    def __init__(self, conn, stream_id):
+        # type: (H2ServerConnection, int) -> None
+        self.conn = conn
+        self.stream_id = stream_id
+        # Provides the request's ISSLTransport/peer certificate
+        self.transport = conn.transport
+        self.request = None  # type: Optional[HTTPRequest]
+        self.body = BytesIO()
+        self.headers_sent = False
+        self.finished = False
+        self.closed = False
+        # Outbound data awaiting flow control window
+        self.pending = []  # type: List[bytes]
+        self._finish_callback = None  # type: Optional[defer.Deferred]
+
+    def write(self, chunk):
+        # type: (bytes) -> None
+        if self.closed:
+            return
+        if not self.headers_sent:
+            # cyclone's first write begins with the response head
+            head, _, chunk = chunk.partition(b"\r\n\r\n")
+            self.headers_sent = True
+            self.conn.send_headers(self, response_headers(head))
+        if chunk:
+            self.pending.append(chunk)
+            self.conn.flush_stream(self)
+
+    def finish(self):
+        # type: () -> None
+        if self.closed:
+            return
+        self.finished = True
+        self.conn.flush_stream(self)
+
+    def notifyFinish(self):
+        # type: () -> defer.Deferred
+        if self._finish_callback is None:
+            self._finish_callback = defer.Deferred()
+        return self._finish_callback
+
+    def close(self, reason=None):
+        # type: (Optional[str]) -> None
+        """Close the stream, firing notifyFinish with the reason (if any)
+        it closed early"""
+        self.closed = True
+        if self._finish_callback is not None:
+            self._finish_callback.callback(reason)
+            self._finish_callback = None
+
+
+class H2ServerConnection(object):
+    """The HTTP/2 side of a :class:`NegotiatingHTTPConnection`
+
+    Enforces the protocol's per request header/body limits per stream,
+    resetting streams exceeding them.
+
+    """
+    log = Logger()
+
+    def __init__(self, protocol):
+        # type: (NegotiatingHTTPConnection) -> None
+        self.protocol = protocol
+        self.transport = protocol.transport
+        self.metrics = protocol.factory.db.metrics
+        self.streams = {}  # type: Dict[int, H2Stream]
+        self._start_time = time.time()
+        self._h2 = H2Connection(config=H2Configuration(
+            client_side=False, header_encoding=None))
+
+    def start(self):
+        # type: () -> None
+        conf = self.protocol.factory.conf
+        self._h2.initiate_connection()
+        self._h2.update_settings({
+            SettingCodes.MAX_CONCURRENT_STREAMS:
+                conf.http2_max_concurrent_streams,
+            SettingCodes.INITIAL_WINDOW_SIZE: conf.http2_initial_window_size,
+        })
+        self._send()
+        self.metrics.increment("http2.connection.new")
+
+    def dataReceived(self, data):
+        # type: (bytes) -> None
+        try:
+            events = self._h2.receive_data(data)
+        except ProtocolError as ex:
+            self.log.debug("HTTP/2 protocol error: {ex}", ex=ex)
+            self._h2.close_connection(ErrorCodes.PROTOCOL_ERROR)
+            self._send()
+            self.transport.loseConnection()
+            return
+        for event in events:
+            if isinstance(event, RequestReceived):
+                self._request_received(event)
+            elif isinstance(event, DataReceived):
+                self._data_received(event)
+            elif isinstance(event, StreamEnded):
+                self._stream_ended(event)
+            elif isinstance(event, StreamReset):
+                self._stream_reset(event)
+            elif isinstance(event, WindowUpdated):
+                self._window_updated(event)
+            elif isinstance(event, RemoteSettingsChanged):
+                if SettingCodes.INITIAL_WINDOW_SIZE in event.changed_settings:
+                    self._window_updated(None)
+            elif isinstance(event, ConnectionTerminated):
+                self.transport.loseConnection()
+        self._send()
+
+    def connectionLost(self, reason=connectionDone):
+        streams, self.streams = self.streams, {}
+        for stream in streams.values():
+            stream.close(reason.getErrorMessage())
+        self.metrics.timing("http2.connection.lifespan",
+                            duration=time.time() - self._start_time)
+
+    def send_headers(self, stream, headers):
+        # type: (H2Stream, List[Tuple[bytes, bytes]]) -> None
+        try:
+            self._h2.send_headers(stream.stream_id, headers)
+        except StreamClosedError:
+            self._close_stream(stream, "Stream closed")
+
+    def flush_stream(self, stream):
+        # type: (H2Stream) -> None
+        """Send the stream's pending data, as flow control allows, ending
+        the stream once its response has finished"""
+        try:
+            while stream.pending:
+                window = min(
+                    self._h2.local_flow_control_window(stream.stream_id),
+                    self._h2.max_outbound_frame_size)
+                if window <= 0:
+                    break
+                chunk = stream.pending[0]
+                if len(chunk) > window:
+                    stream.pending[0] = chunk[window:]
+                    chunk = chunk[:window]
+                else:
+                    stream.pending.pop(0)
+                self._h2.send_data(stream.stream_id, chunk)
+            if stream.finished and not stream.pending:
+                self._h2.end_stream(stream.stream_id)
+                self._close_stream(stream)
+        except StreamClosedError:
+            self._close_stream(stream, "Stream closed")
+        self._send()
+
+    def _send(self):
+        data = self._h2.data_to_send()
+        if data:
+            self.transport.write(data)
+
+    def _close_stream(self, stream, reason=None):
+        # type: (H2Stream, Optional[str]) -> None
+        self.streams.pop(stream.stream_id, None)
+        stream.close(reason)
+
+    def _reject_stream(self, stream_id, reason):
+        # type: (int, str) -> None
+        self.log.debug("HTTP/2 stream exceeded its {reason} limit",
+                       reason=reason)
+        self.metrics.increment("http2.stream.rejected",
+                               tags=make_tags(reason=reason))
+        stream = self.streams.get(stream_id)
+        if stream is not None:
+            self._close_stream(stream, "Stream rejected")
+        self._h2.reset_stream(stream_id, ErrorCodes.ENHANCE_YOUR_CALM)
+
+    def _request_received(self, event):
+        # type: (RequestReceived) -> None
+        self.metrics.increment("http2.stream.new")
+        pseudo = {}
+        headers = httputil.HTTPHeaders()
+        count = 0
+        for name, value in event.headers:
+            if name.startswith(b":"):
+                pseudo[name] = value
+            else:
+                headers.add(name, value)
+                count += 1
+        if count > self.protocol.maxHeaders:
+            self._reject_stream(event.stream_id, "headers")
+            return
+        if "Host" not in headers and b":authority" in pseudo:
+            headers["Host"] = pseudo[b":authority"]
+        stream = self.streams[event.stream_id] = H2Stream(self,
+                                                          event.stream_id)
+        stream.request = HTTPRequest(
+            method=pseudo.get(b":method"),
+            uri=pseudo.get(b":path"),
+            version="HTTP/2.0",
+            headers=headers,
+            remote_ip=self.protocol._remote_ip,
+            connection=stream,
+        )
+
+    def _data_received(self, event):
+        # type: (DataReceived) -> None
+        # Always restore the connection's window (the data's buffered or
+        # discarded)
+        self._h2.acknowledge_received_data(event.flow_controlled_length,
+                                           event.stream_id)
+        stream = self.streams.get(event.stream_id)
+        if stream is None:
+            return
+        if stream.request.path in self.protocol.bulkPaths:
+            limit = self.protocol.maxBulkData
+        else:
+            limit = self.protocol.maxData
+        if stream.body.tell() + len(event.data) > limit:
+            self._reject_stream(event.stream_id, "data")
+            return
+        stream.body.write(event.data)
+
+    def _stream_ended(self, event):
+        # type: (StreamEnded) -> None
+        stream = self.streams.get(event.stream_id)
+        if stream is None:
+            return
+        stream.request.body = stream.body.getvalue()
+        stream.body = None
+        self.protocol.request_callback(stream.request)
+
+    def _stream_reset(self, event):
+        # type: (StreamReset) -> None
+        self.metrics.increment("http2.stream.reset")
+        stream = self.streams.get(event.stream_id)
+        if stream is not None:
+            self._close_stream(stream, "Stream reset")
+
+    def _window_updated(self, event):
+        # type: (Optional[WindowUpdated]) -> None
+        if event is not None and event.stream_id:
+            stream = self.streams.get(event.stream_id)
+            streams = [stream] if stream is not None else []
+        else:
+            # The connection's (or all streams') window changed
+            streams = list(self.streams.values())
+        for stream in streams:
+            if stream.pending:
+                self.flush_stream(stream)
+
+
+class NegotiatingHTTPConnection(LimitedHTTPConnection):
+    """Serves HTTP/2, when negotiated via ALPN or begun with its connection
+    preface, otherwise HTTP/1.1
+
+    The :class:`LimitedHTTPConnection` header/body limits apply to each
+    HTTP/2 stream.
+
+    """
+
+    def connectionMade(self):
+        LimitedHTTPConnection.connectionMade(self)
+        self._h2conn = None  # type: Optional[H2ServerConnection]
+        self._negotiating = True
+        self._preface = b""
+
+    def dataReceived(self, data):
+        if self._h2conn is not None:
+            self._h2conn.dataReceived(data)
+            return
+        if self._negotiating:
+            data = self._preface + data
+            negotiated = getattr(self.transport, "negotiatedProtocol", None)
+            if negotiated == b"h2" or data.startswith(H2_PREFACE):
+                self._negotiating = False
+                self._preface = b""
+                self._h2conn = H2ServerConnection(self)
+                self._h2conn.start()
+                self._h2conn.dataReceived(data)
+                return
+            if H2_PREFACE.startswith(data):
+                # Possibly a partial preface
+                self._preface = data
+                return
+            self._negotiating = False
+            self._preface = b""
+        LimitedHTTPConnection.dataReceived(self, data)
+
+    def connectionLost(self, reason=connectionDone):
+        if self._h2conn is not None:
+            self._h2conn.connectionLost(reason)
+            return
+        LimitedHTTPConnection.connectionLost(self, reason)
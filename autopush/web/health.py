@@ -120,10 +120,13 @@ class MemUsageHandler(BaseWebHandler):
 
         def enabled(name):
             return self.get_argument(name, u'true').lower() != u'false'
+        measure_connections = self.get_argument(
+            'connection_state', u'false').lower() == u'true'
         d = deferToThread(
             memusage,
             do_dump_rpy_heap=enabled('dump_rpy_heap'),
-            do_objgraph=enabled('objgraph')
+            do_objgraph=enabled('objgraph'),
+            connection_db=self.db if measure_connections else None
         )
         d.addCallback(self.write)
         d.addCallback(self.finish)
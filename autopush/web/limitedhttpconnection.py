@@ -11,9 +11,14 @@ class LimitedHTTPConnection(httpserver.HTTPConnection):
     header lines to 100, and the maximum amount of data for the body
     to be 4K.
 
+    Requests to ``bulkPaths`` (batch submissions) instead have their
+    entire body limited to ``maxBulkData``.
+
     """
     maxHeaders = 100
     maxData = 1024*4
+    bulkPaths = ("/wpush/batch",)
+    maxBulkData = 1024*1024
 
     def lineReceived(self, line):
         """Process a header line of data, ensuring we have not exceeded the
@@ -37,7 +42,13 @@ class LimitedHTTPConnection(httpserver.HTTPConnection):
 
         :param data: raw data block
         """
-        if len(data) > self.maxData:
+        if self._request is not None and \
+                self._request.path in self.bulkPaths:
+            too_much = (self._contentbuffer.tell() + len(data) >
+                        self.maxBulkData)
+        else:
+            too_much = len(data) > self.maxData
+        if too_much:
             Logger().warn("Too much data sent, terminating connection")
             return self.lineLengthExceeded(data)
         if self.content_length is not None:
@@ -7,6 +7,8 @@ from autopush.web.base import threaded_validate, BaseWebHandler
 
 class LogCheckSchema(Schema):
     """Empty schema for log check"""
+    blocking = False
+
     err_type = fields.Str(allow_none=True)
 
     @pre_load
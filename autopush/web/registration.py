@@ -298,6 +298,7 @@ class BaseRegistrationHandler(BaseWebHandler):
         so the record may be incorrectly expired. (Expiry records older than
         5 years are not automatically deleted.)
         """
+        self.dead_token_cache.discard(router_type, router_data)
         self.db.router.register_user(dict(
             uaid=uaid.hex,
             router_type=router_type,
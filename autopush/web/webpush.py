@@ -1,6 +1,8 @@
+import json
 import re
 import time
 
+from botocore.exceptions import ClientError
 from cryptography.fernet import InvalidToken
 from cryptography.exceptions import InvalidSignature
 from marshmallow import (
@@ -15,11 +17,16 @@ from marshmallow_polyfield import PolyField
 from marshmallow.validate import Equal
 from twisted.logger import Logger  # noqa
 from twisted.internet.defer import Deferred  # noqa
-from twisted.internet.defer import maybeDeferred
+from twisted.internet.defer import (
+    DeferredList,
+    DeferredSemaphore,
+    maybeDeferred,
+)
 from twisted.internet.threads import deferToThread
 from typing import (  # noqa
     Any,
     Dict,
+    List,
     Optional
 )
 from jose import JOSEError, JWTError
@@ -32,10 +39,12 @@ from autopush.exceptions import (
     InvalidRequest,
     InvalidTokenException,
     ItemNotFound,
+    RouterException,
     VapidAuthException,
 )
 from autopush.types import JSONDict  # noqa
 from autopush.utils import (
+    base64url_decode,
     base64url_encode,
     extract_jwt,
     ms_time,
@@ -47,10 +56,14 @@ from autopush.web.base import (
     threaded_validate,
     BaseWebHandler,
     PREF_SCHEME,
+    ThreadedValidate,
 )
 
 MAX_TTL = 60 * 60 * 24 * 60
 
+# Max notifications per batch submission
+MAX_BATCH_MESSAGES = 1000
+
 # Base64 URL validation
 VALID_BASE64_URL = re.compile(r'^[0-9A-Za-z\-_]+=*$')
 
@@ -71,6 +84,7 @@ class WebPushSubscriptionSchema(Schema):
                 version=d["api_ver"],
                 ckey_header=d["ckey_header"],
                 auth_header=d["auth_header"],
+                token_cache=self.context.get("endpoint_token_cache"),
             )
         except (VapidAuthException):
             raise InvalidRequest("missing authorization header",
@@ -82,9 +96,16 @@ class WebPushSubscriptionSchema(Schema):
     @validates_schema(skip_on_field_errors=True)
     def validate_uaid_month_and_chid(self, d):
         db = self.context["db"]  # type: DatabaseManager
+        # Router records already looked up for a batch of requests
+        records = self.context.get("router_records")
 
         try:
-            result = db.router.get_uaid(d["uaid"].hex)
+            if records is not None:
+                if d["uaid"].hex not in records:
+                    raise ItemNotFound("uaid not found")
+                result = dict(records[d["uaid"].hex])
+            else:
+                result = db.router.get_uaid(d["uaid"].hex)
         except ItemNotFound:
             raise InvalidRequest("UAID not found", status_code=410, errno=103)
 
@@ -113,6 +134,15 @@ class WebPushSubscriptionSchema(Schema):
                                  result.get("critical_failure"),
                                  status_code=410,
                                  errno=105)
+
+        # The bridge already reported the token as no longer registered
+        # (the record's likely being dropped)
+        dead_tokens = self.context.get("dead_token_cache")
+        errno = dead_tokens and dead_tokens.get(result)
+        if errno:
+            raise InvalidRequest("No such subscription", status_code=410,
+                                 errno=errno)
+
         # Some stored user records are marked as "simplepush".
         # If you encounter one, may need to tweak it a bit to get it as
         # a valid WebPush record.
@@ -150,10 +180,7 @@ class WebPushSubscriptionSchema(Schema):
             raise InvalidRequest("No such subscription", status_code=410,
                                  errno=106)
         msg = db.message_table(month_table)
-        exists, chans = msg.all_channels(uaid=uaid)
-
-        if (not exists or channel_id.lower() not
-                in map(lambda x: normalize_id(x), chans)):
+        if not msg.has_channel(uaid, channel_id):
             log.debug("Unknown subscription: {channel_id}",
                       channel_id=channel_id)
             raise InvalidRequest("No such subscription", status_code=410,
@@ -346,17 +373,21 @@ def conditional_crypto_deserialize(object_dict, parent_object_dict):
         return Schema()
 
 
-class WebPushRequestSchema(Schema):
-    subscription = fields.Nested(WebPushSubscriptionSchema,
-                                 load_from="token_info")
+class WebPushHeaderSchema(Schema):
+    """The cheap header and body checks of a WebPushRequestSchema
+
+    Run on the reactor ahead of the full validation, rejecting malformed
+    requests without a thread handoff.
+
+    """
+    blocking = False
+
     headers = fields.Nested(WebPushBasicHeaderSchema)
     crypto_headers = PolyField(
         load_from="headers",
         deserialization_schema_selector=conditional_crypto_deserialize,
     )
     body = fields.Raw()
-    token_info = fields.Raw()
-    vapid_version = fields.String(required=False, missing=None)
 
     @validates('body')
     def validate_data(self, value):
@@ -367,6 +398,18 @@ class WebPushRequestSchema(Schema):
                 errno=104,
             )
 
+
+class WebPushRequestSchema(WebPushHeaderSchema):
+    # Endpoint decryption, DynamoDB lookups and VAPID verification. The
+    # header checks are skipped when already run by the inline_schema
+    blocking = True
+    inline_schema = WebPushHeaderSchema
+
+    subscription = fields.Nested(WebPushSubscriptionSchema,
+                                 load_from="token_info")
+    token_info = fields.Raw()
+    vapid_version = fields.String(required=False, missing=None)
+
     @pre_load
     def token_prep(self, d):
         d["token_info"] = dict(
@@ -375,6 +418,8 @@ class WebPushRequestSchema(Schema):
             ckey_header=d["headers"].get("crypto-key", ""),
             auth_header=d["headers"].get("authorization", ""),
         )
+        if self.context.get("inline_result") is not None:
+            d = {k: v for k, v in d.items() if k not in ("headers", "body")}
         return d
 
     def validate_auth(self, d):
@@ -403,7 +448,8 @@ class WebPushRequestSchema(Schema):
                 token,
                 public_key,
                 is_trusted=self.context['conf'].enable_tls_auth,
-                use_crypto=self.context['conf'].use_cryptography
+                use_crypto=self.context['conf'].use_cryptography,
+                cache=self.context.get('vapid_cache')
             )
         except tuple(crypto_exceptions):
             raise InvalidRequest("Invalid Authorization Header",
@@ -442,6 +488,7 @@ class WebPushRequestSchema(Schema):
         # Note: This has to be done here, since schema validation takes place
         #       before nested schemas, and in this case we need all the nested
         #       schema logic to run first.
+        d.update(self.context.get("inline_result") or {})
         self.validate_auth(d)
 
         # Merge crypto headers back in
@@ -458,11 +505,72 @@ class WebPushRequestSchema(Schema):
         d["notification"] = WebPushNotification.from_webpush_request_schema(
             data=d, fernet=self.context["conf"].fernet,
             legacy=self.context["conf"]._notification_legacy,
+            compact=self.context["conf"].compact_message_ids,
         )
 
         return d
 
 
+class WebPushBatchSchema(Schema):
+    """Splits a batch submission into its individual notification requests
+
+    The JSON body lists the notifications as ``messages``, each with its
+    endpoint ``token``, optional ``api_ver`` (defaulting to ``v1``),
+    ``headers`` and base64url encoded ``body``. A top level ``headers``
+    object provides defaults for every message's headers (e.g. a shared
+    ``Authorization``).
+
+    Each message is returned in the form of a single request's data for
+    validation by :class:`WebPushRequestSchema`.
+
+    """
+    # JSON decoding only, cheap enough for the reactor
+    blocking = False
+
+    messages = fields.List(fields.Raw(), required=True)
+
+    @pre_load
+    def extract_messages(self, d):
+        try:
+            batch = json.loads(d["body"])
+            defaults = self._lower_keys(batch.get("headers", {}))
+            messages = [self._request_data(msg, defaults)
+                        for msg in batch["messages"]]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise InvalidRequest("Invalid Request body", status_code=400,
+                                 errno=108)
+        if len(messages) > MAX_BATCH_MESSAGES:
+            raise InvalidRequest(
+                "Batch must contain no more than {} messages".format(
+                    MAX_BATCH_MESSAGES),
+                status_code=413,
+                errno=104,
+            )
+        return dict(messages=messages)
+
+    def _request_data(self, msg, defaults):
+        # type: (Dict[str, Any], Dict[str, Any]) -> Dict[str, Any]
+        api_ver = msg.get("api_ver", "v1")
+        if api_ver not in ("v1", "v2"):
+            raise ValueError("Invalid api_ver")
+        headers = dict(defaults)
+        headers.update(self._lower_keys(msg.get("headers", {})))
+        body = msg.get("body")
+        return dict(
+            headers=headers,
+            body=base64url_decode(body.encode("utf8")) if body else "",
+            path_args=(),
+            path_kwargs=dict(api_ver=api_ver, token=msg["token"]),
+            arguments={},
+        )
+
+    @staticmethod
+    def _lower_keys(headers):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        """HTTP header names are case insensitive"""
+        return {k.lower(): v for k, v in headers.items()}
+
+
 class WebPushHandler(BaseWebHandler):
     cors_methods = "POST"
     cors_request_headers = ("content-encoding", "encryption",
@@ -539,6 +647,8 @@ class WebPushHandler(BaseWebHandler):
                                uaid_hash=hasher(uaid_data["uaid"]),
                                uaid_record=repr(uaid_data),
                                client_info=self._client_info)
+                if response.status_code == 410:
+                    self.dead_token_cache.add(uaid_data, response.errno or 103)
                 d = deferToThread(self.db.router.drop_user, uaid_data["uaid"])
                 d.addCallback(lambda x: self._router_response(response,
                                                               router_type,
@@ -572,3 +682,173 @@ class WebPushHandler(BaseWebHandler):
             response.response_body = (
                 response.response_body + " " + warning).strip()
             self._router_response(response, router_type, vapid)
+
+
+# Validates each message of a batch submission
+_batch_message_validator = ThreadedValidate(WebPushRequestSchema)
+
+# Threads validating a batch's messages at once, leaving the rest of the
+# reactor's pool to other requests
+BATCH_VALIDATION_CONCURRENCY = 4
+
+
+class WebPushBatchHandler(BaseWebHandler):
+    """Accepts many notifications in one request
+
+    For application servers sending to many subscriptions at once. The
+    messages' router records are looked up together (via BatchGetItem),
+    the messages are then validated (on up to
+    :data:`BATCH_VALIDATION_CONCURRENCY` threads at once) and routed
+    concurrently.
+
+    Responds with a stream of newline delimited JSON objects, one per
+    message as each completes (in no particular order): its ``index``
+    within the batch, its HTTP ``status`` and either its ``location`` or
+    its ``errno`` and ``message``.
+
+    """
+    cors_methods = "POST"
+    cors_request_headers = ("content-type", "authorization")
+
+    def initialize(self):
+        """Must run on initialization to set ahead of validation"""
+        super(WebPushBatchHandler, self).initialize()
+        self._handling_message = True
+
+    @threaded_validate(WebPushBatchSchema)
+    def post(self, messages):
+        # type: (List[Dict[str, Any]]) -> Deferred
+        self._client_info["batch_size"] = len(messages)
+        self.set_header("Content-Type", "application/x-ndjson")
+        d = deferToThread(self._lookup_routers, messages)
+        d.addCallback(self._route_batch, messages)
+        d.addCallback(self._batch_completed)
+        self._db_error_handling(d)
+        return d
+
+    def _lookup_routers(self, messages):
+        # type: (List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]
+        """Look up the router records of all the messages' UAIDs"""
+        uaids = set()
+        for msg in messages:
+            try:
+                token = self.conf.decrypt_endpoint_token(
+                    msg["path_kwargs"]["token"],
+                    cache=self.endpoint_token_cache)
+            except (InvalidToken, TypeError, ValueError):
+                # Rejected by the message's own validation
+                continue
+            uaids.add(token[:16].encode("hex"))
+        return self.db.router.get_uaids(uaids)
+
+    def _route_batch(self, records, messages):
+        # type: (Dict[str, Dict[str, Any]], List[Dict[str, Any]]) -> Deferred
+        context = dict(router_records=records)
+        validating = DeferredSemaphore(BATCH_VALIDATION_CONCURRENCY)
+        return DeferredList([
+            self._route_message(index, msg, context, validating)
+            for index, msg in enumerate(messages)
+        ])
+
+    def _route_message(self, index, msg, context, validating):
+        # type: (int, Dict[str, Any], Dict[str, Any], DeferredSemaphore) -> Deferred  # noqa
+        d = validating.run(_batch_message_validator._validate, self, msg,
+                           context)
+        d.addCallback(self._validated)
+        d.addErrback(self._message_err)
+        d.addCallback(self._write_message_result, index)
+        return d
+
+    def _validated(self, result):
+        output, errors = result
+        if errors:
+            return self._validation_errors(errors)
+        user_data = output["subscription"]["user_data"]
+        router_type = user_data["router_type"]
+        vapid = output.get("jwt") is not None
+        d = maybeDeferred(self.routers[router_type].route_notification,
+                          output["notification"], user_data)
+        d.addCallback(self._routed, user_data)
+        d.addErrback(self._router_fail)
+        d.addCallback(self._message_response, router_type, vapid)
+        return d
+
+    def _validation_errors(self, errors):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        """A message's validation errors, as its (400) result"""
+        headers = errors.get("headers")
+        if isinstance(headers, dict) and "ttl" in headers:
+            errno, message = 112, "Invalid TTL header value"
+        else:
+            errno, message = 108, "Invalid message headers or body"
+        return dict(status=400, errno=errno, message=message, errors=errors)
+
+    def _routed(self, response, user_data):
+        """Apply any router data updates requested by the bridge system
+        (as :meth:`WebPushHandler._router_completed` does)"""
+        if response.router_data is None:
+            return response
+        if not response.router_data:
+            self.log.debug(format="Dropping User", code=100,
+                           uaid_hash=hasher(user_data["uaid"]),
+                           uaid_record=repr(user_data),
+                           client_info=self._client_info)
+            if response.status_code == 410:
+                self.dead_token_cache.add(user_data, response.errno or 103)
+            d = deferToThread(self.db.router.drop_user, user_data["uaid"])
+        else:
+            user_data["router_data"] = response.router_data
+            user_data["connected_at"] = ms_time()
+            d = deferToThread(self.db.router.register_user, user_data)
+        response.router_data = None
+        d.addCallback(lambda _: response)
+        return d
+
+    def _router_fail(self, fail):
+        """A RouterException is the message's response"""
+        fail.trap(RouterException)
+        return fail.value
+
+    def _message_response(self, response, router_type, vapid):
+        tags = ["router:{}".format(router_type), "vapid:{}".format(vapid)]
+        if 200 <= response.status_code < 300:
+            dest = 'Direct'
+            if response.status_code == 202 or response.logged_status == 202:
+                dest = 'Stored'
+            self.metrics.increment('notification.message.success',
+                                   tags=['destination:{}'.format(dest)] + tags)
+            return dict(status=response.status_code,
+                        location=response.headers.get("Location"))
+        self.metrics.increment(
+            'notification.message.error',
+            tags=["code:{}".format(response.status_code)] + tags)
+        return dict(status=response.status_code,
+                    errno=response.errno or 999,
+                    message=response.response_body)
+
+    def _message_err(self, fail):
+        """Convert a message's failure to its result"""
+        exc = fail.value
+        if fail.check(InvalidRequest):
+            return dict(status=exc.status_code, errno=exc.errno,
+                        message=exc.message)
+        if fail.check(ClientError):
+            if (exc.response['Error']['Code'] ==
+                    "ProvisionedThroughputExceededException"):
+                return dict(status=503, errno=201,
+                            message="Please slow message send rate")
+            return dict(status=503, errno=202, message="Unexpected Error")
+        self.log.failure(format=exc.message or 'Exception', failure=fail,
+                         status_code=500, errno=999,
+                         client_info=self._client_info)
+        return dict(status=500, errno=999,
+                    message="An unexpected server error occurred.")
+
+    def _write_message_result(self, result, index):
+        result["index"] = index
+        self.write(json.dumps(result) + "\n")
+        self.flush()
+
+    def _batch_completed(self, results):
+        self._track_timing()
+        self.finish()
@@ -32,7 +32,7 @@ not be publicly exposed.
 import json
 import time
 import uuid
-from collections import defaultdict
+from collections import deque
 from functools import partial, wraps
 from random import randrange
 
@@ -54,13 +54,15 @@ from twisted.internet import reactor
 from twisted.internet.defer import (
     Deferred,
     DeferredList,
-    CancelledError
+    CancelledError,
+    fail,
+    succeed,
 )
 from twisted.internet.error import (
     ConnectError,
     ConnectionClosed,
     DNSLookupError)
-from twisted.internet.interfaces import IProducer
+from twisted.internet.interfaces import IDelayedCall, IProducer  # noqa
 from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
 from twisted.protocols import policies
@@ -72,6 +74,7 @@ from twisted.web.server import Site
 from typing import (  # noqa
     Any,
     Callable,
+    Deque,
     Dict,
     List,
     Optional,
@@ -81,6 +84,7 @@ from zope.interface import implementer
 
 from autopush import __version__
 from autopush.base import BaseHandler
+from autopush.cache import TTLCache
 from autopush.config import AutopushConfig  # noqa
 from autopush.db import (
     has_connected_this_month,
@@ -88,10 +92,17 @@ from autopush.db import (
     generate_last_connect,
 )
 from autopush.db import DatabaseManager, Message  # noqa
-from autopush.exceptions import MessageOverloadException, ItemNotFound
+from autopush.exceptions import (
+    AdmissionRejectedException,
+    ItemNotFound,
+    MessageOverloadException,
+)
+from autopush import jsoncodec
+from autopush.node_transport import NodeTransport  # noqa
 from autopush.noseplugin import track_object
+from autopush.timerwheel import TimerWheel
 from autopush.protocol import IgnoreBody
-from autopush.metrics import IMetrics, make_tags  # noqa
+from autopush.metrics import IMetrics, make_tags, shared_tags  # noqa
 from autopush.ssl import AutopushSSLContextFactory  # noqa
 from autopush.utils import (
     parse_user_agent,
@@ -106,6 +117,8 @@ DEFAULT_WS_ERR = "http://autopush.readthedocs.io/en/" \
                  "latest/api/websocket.html#private-http-endpoint"
 # codes expected from the client (and emitted as a metric tag)
 NACK_CODES = range(301, 304)
+# Parsed User-Agents don't go stale, entries age out to bound their lifetime
+USER_AGENT_CACHE_TTL = 24 * 60 * 60
 
 
 def extract_code(data):
@@ -166,6 +179,76 @@ class SessionStatistics(object):
         return attr.asdict(self)
 
 
+class UnackedNotifications(object):
+    """Notifications sent to a client that haven't been ack'd
+
+    Indexed by channel and version so adding, finding and removing a
+    notification (i.e. handling its ack) are O(1), with a running count
+    of those outstanding.
+
+    """
+    __slots__ = ("_channels", "count")
+
+    def __init__(self):
+        # chid -> version -> notification
+        self._channels = {}  # type: Dict[str, Dict[str, WebPushNotification]]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, chid):
+        return chid in self._channels
+
+    def __iter__(self):
+        for notifs in self._channels.itervalues():
+            for notif in notifs.itervalues():
+                yield notif
+
+    def add(self, chid, notif):
+        # type: (str, WebPushNotification) -> None
+        """Track a notification sent on a channel
+
+        Replaces any already tracked of the same version.
+
+        """
+        notifs = self._channels.get(chid)
+        if notifs is None:
+            notifs = self._channels[chid] = {}
+        if notif.version not in notifs:
+            self.count += 1
+        notifs[notif.version] = notif
+
+    def get(self, chid, version):
+        # type: (str, str) -> Optional[WebPushNotification]
+        """Return a channel's notification of version, if tracked"""
+        notifs = self._channels.get(chid)
+        return notifs.get(version) if notifs else None
+
+    def discard(self, chid, notif):
+        # type: (str, WebPushNotification) -> None
+        """Stop tracking a notification, if tracked"""
+        notifs = self._channels.get(chid)
+        if not notifs or notifs.get(notif.version) is not notif:
+            return
+        del notifs[notif.version]
+        self.count -= 1
+        if not notifs:
+            del self._channels[chid]
+
+    def discard_channel(self, chid):
+        # type: (str) -> None
+        """Stop tracking all of a channel's notifications"""
+        notifs = self._channels.pop(chid, None)
+        if notifs:
+            self.count -= len(notifs)
+
+    def clear(self):
+        # type: () -> None
+        self._channels.clear()
+        self.count = 0
+
+
 @implementer(IProducer)
 @attrs(slots=True)
 class PushState(object):
@@ -178,7 +261,9 @@ class PushState(object):
         default=Factory(SessionStatistics))  # type: SessionStatistics
 
     _user_agent = attrib(default=None)  # type: Optional[str]
-    _base_tags = attrib(default=Factory(list))  # type: List[str]
+    # Cache of parse_user_agent results shared between connections
+    _ua_cache = attrib(default=None)  # type: Optional[TTLCache]
+    _base_tags = attrib(default=())  # type: Tuple[str, ...]
     raw_agent = attrib(default=Factory(dict))  # type: Optional[Dict[str, str]]
 
     _should_stop = attrib(default=False)  # type: bool
@@ -206,15 +291,23 @@ class PushState(object):
 
     # Hanger for common actions we defer
     _notification_fetch = attrib(default=None)  # type: Optional[Deferred]
+
+    # Timestamped message pages read ahead of delivery (fetched or in
+    # flight), and where the next one starts (None when there's no next
+    # page to read ahead)
+    _prefetched = attrib(default=Factory(deque))  # type: Deque[Deferred]
+    _prefetch_timestamp = attrib(default=None)  # type: Optional[int]
     _register = attrib(default=None)  # type: Optional[Deferred]
 
-    # Reflects Notification's sent that haven't been ack'd This is
-    # simplepush style by default
-    updates_sent = attrib(default=Factory(dict))  # type: Dict
+    # Reflects stored Notification's sent that haven't been ack'd.
+    # Created on first use (most connections are idle)
+    _updates_sent = attrib(
+        default=None)  # type: Optional[UnackedNotifications]
 
-    # Track Notification's we don't need to delete separately This is
-    # simplepush style by default
-    direct_updates = attrib(default=Factory(dict))  # type: Dict
+    # Track Notification's we don't need to delete separately. Created on
+    # first use
+    _direct_updates = attrib(
+        default=None)  # type: Optional[UnackedNotifications]
 
     # Whether this record should be reset after delivering stored
     # messages
@@ -231,15 +324,18 @@ class PushState(object):
 
     def __attrs_post_init__(self):
         """Initialize PushState"""
+        tags = list(self._base_tags)
         if self._user_agent:
-            dd_tags, self.raw_agent = parse_user_agent(self._user_agent)
+            dd_tags, self.raw_agent = parse_user_agent(self._user_agent,
+                                                       cache=self._ua_cache)
             for tag_name, tag_value in dd_tags.items():
                 setattr(self.stats, tag_name, tag_value)
-                self._base_tags.append("%s:%s" % (tag_name, tag_value))
+                tags.append("%s:%s" % (tag_name, tag_value))
             self.stats.ua_os_ver = self.raw_agent["ua_os_ver"]
             self.stats.ua_browser_ver = self.raw_agent["ua_browser_ver"]
         if self.stats.host:
-            self._base_tags.append("host:%s" % self.stats.host)
+            tags.append("host:%s" % self.stats.host)
+        self._base_tags = shared_tags(tags)
 
         # Message table rotation initial settings
         self.message_month = self.db.current_msg_month
@@ -285,15 +381,39 @@ class PushState(object):
         self._uaid_hash = hasher(value) if value else ""
         self.stats.uaid_hash = self._uaid_hash
 
+    @property
+    def updates_sent(self):
+        # type: () -> UnackedNotifications
+        if self._updates_sent is None:
+            self._updates_sent = UnackedNotifications()
+        return self._updates_sent
+
+    @updates_sent.setter
+    def updates_sent(self, value):
+        self._updates_sent = value
+
+    @property
+    def direct_updates(self):
+        # type: () -> UnackedNotifications
+        if self._direct_updates is None:
+            self._direct_updates = UnackedNotifications()
+        return self._direct_updates
+
+    @direct_updates.setter
+    def direct_updates(self, value):
+        self._direct_updates = value
+
+    @property
+    def unacked_stored(self):
+        # type: () -> bool
+        """Whether any stored notifications sent are awaiting an ack"""
+        return bool(self._updates_sent)
+
     def init_connection(self):
         """Set the connection type for the client"""
-        self._base_tags.append("use_webpush:True")
+        self._base_tags = shared_tags(self._base_tags + ("use_webpush:True",))
         self.router_type = self.stats.connection_type = "webpush"
 
-        # Update our message tracking for webpush
-        self.updates_sent = defaultdict(lambda: [])
-        self.direct_updates = defaultdict(lambda: [])
-
     def pauseProducing(self):
         """IProducer implementation tracking if we should pause output"""
         self._paused = True
@@ -337,7 +457,11 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
     def deferToThread(self, func, *args, **kwargs):
         # type (Callable[..., Any], *Any, **Any) -> Deferred
         """deferToThread helper that tracks defers outstanding"""
-        d = deferToThread(func, *args, **kwargs)
+        return self.track_deferred(deferToThread(func, *args, **kwargs))
+
+    def track_deferred(self, d):
+        # type: (Deferred) -> Deferred
+        """Track an outstanding Deferred, cancelled if the client drops"""
         self.ps._callbacks.append(d)
 
         def f(result):
@@ -375,6 +499,13 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
     def trap_cancel(self, fail):
         fail.trap(CancelledError)
 
+    def callLater(self, period, func):
+        """Schedule TimeoutMixin's (hello/idle) timeout, on the timer wheel
+        if enabled"""
+        if self.factory.timer_wheel is None:
+            return policies.TimeoutMixin.callLater(self, period, func)
+        return self.factory.timer_wheel.call_later(period, func)
+
     def trap_connection_err(self, fail):
         fail.trap(ConnectError, ConnectionClosed, ResponseFailed,
                   DNSLookupError)
@@ -406,8 +537,12 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
     @property
     def base_tags(self):
         """Property that uses None if there's no tags due to a DataDog library
-        bug"""
-        return self.ps._base_tags if self.ps._base_tags else None
+        bug
+
+        The connection's shared (immutable) tags, not a copy.
+
+        """
+        return self.ps._base_tags or None
 
     def log_failure(self, failure, **kwargs):
         """Log a twisted failure out through twisted's log.failure"""
@@ -454,7 +589,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
     def onConnect(self, request):
         """autobahn onConnect handler for when a connection has started"""
         track_object(self, msg="onConnect Start")
-        self.ps = PushState.from_request(request=request, db=self.db)
+        self.ps = PushState.from_request(request=request, db=self.db,
+                                         ua_cache=self.factory.ua_cache)
 
         # Setup ourself to handle producing the data
         self.transport.bufferSize = 2 * 1024
@@ -500,7 +636,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         track_object(self, msg="onMessage")
         data = None
         try:
-            data = json.loads(payload.decode('utf8'))
+            data = jsoncodec.loads(payload)
         except (TypeError, ValueError):
             pass
 
@@ -576,25 +712,25 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             del self.factory.clients[self.ps.uaid]
 
         # Cancel any outstanding deferreds that weren't already called
-        for d in self.ps._callbacks:
+        self.clear_prefetched()
+        for d in list(self.ps._callbacks):
             if not d.called:
                 d.cancel()
 
         # Attempt to deliver any notifications not originating from storage
-        if self.ps.direct_updates:
-            defers = []
-            for notifs in self.ps.direct_updates.values():
-                notifs = filter(lambda x: x.ttl != 0, notifs)
-                self.ps.stats.direct_storage += len(notifs)
-                defers.extend(map(self._save_webpush_notif, notifs))
+        if self.ps._direct_updates:
+            notifs = [notif for notif in self.ps._direct_updates
+                      if notif.ttl != 0]
+            self.ps.stats.direct_storage += len(notifs)
+            defers = map(self._save_webpush_notif, notifs)
 
             # Tag on the notifier once everything has been stored
             dl = DeferredList(defers)
             dl.addBoth(self._lookup_node)
 
         # Delete and remove remaining dicts and lists
-        del self.ps.direct_updates
-        del self.ps.updates_sent
+        self.ps.direct_updates = None
+        self.ps.updates_sent = None
 
         # Log out sessions stats
         self.log.info("Session", **self.ps.stats.logging_data())
@@ -602,8 +738,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
     def _save_webpush_notif(self, notif):
         """Save a direct_update webpush style notification"""
         message = self.db.message_table(self.ps.message_month)
-        return deferToThread(message.store_message,
-                             notif).addErrback(self.log_failure)
+        return message.store_message_async(notif).addErrback(
+            self.log_failure)
 
     def _lookup_node(self, results):
         """Looks up the node to send a notify for it to check storage if
@@ -634,11 +770,14 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             return
 
         # Send the notify to the node
-        url = node_id + "/notif/" + self.ps.uaid
-        d = self.factory.agent.request(
-            "PUT",
-            url.encode("utf8"),
-        ).addCallback(IgnoreBody.ignore)
+        if self.factory.node_transport:
+            d = self.factory.node_transport.notif(node_id, self.ps.uaid)
+        else:
+            url = node_id + "/notif/" + self.ps.uaid
+            d = self.factory.agent.request(
+                "PUT",
+                url.encode("utf8"),
+            ).addCallback(IgnoreBody.ignore)
         d.addErrback(self.trap_connection_err)
         d.addErrback(self.trap_boto3_err)
         d.addErrback(self.log_failure, extra="Failed to notify node")
@@ -670,7 +809,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         :param disconnect: Whether the client should be disconnected or not.
 
         """
-        failure.trap(ClientError)
+        failure.trap(ClientError, AdmissionRejectedException)
 
         if disconnect:
             self.transport.pauseProducing()
@@ -692,7 +831,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
     def sendJSON(self, body):
         """Send a Python dict as a JSON string in a websocket message"""
 
-        self.sendMessage(json.dumps(body).encode('utf8'), False)
+        self.sendMessage(jsoncodec.dumps(body), False)
 
     #############################################################
     #                Message Processing Methods
@@ -717,7 +856,14 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         self.ps.stats.existing_uaid = existing_user
         self.transport.pauseProducing()
 
-        d = self.deferToThread(self._register_user, existing_user)
+        admission = self.factory.hello_admission
+        if admission:
+            # Wait, with the transport paused, to be admitted
+            d = self.track_deferred(admission.admit(existing_user))
+            d.addCallback(lambda _: self.deferToThread(self._register_user,
+                                                       existing_user))
+        else:
+            d = self.deferToThread(self._register_user, existing_user)
         d.addCallback(self._check_other_nodes)
         d.addErrback(self.trap_cancel)
         d.addErrback(self.error_overload, "hello")
@@ -843,8 +989,14 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             node_id = previous["node_id"]
             last_connect = previous.get("connected_at")
             if last_connect and node_id != self.conf.router_url:
-                url = "%s/notif/%s/%s" % (node_id, self.ps.uaid, last_connect)
-                d = self.factory.agent.request("DELETE", url.encode("utf8"))
+                if self.factory.node_transport:
+                    d = self.factory.node_transport.drop(
+                        node_id, self.ps.uaid, last_connect)
+                else:
+                    url = "%s/notif/%s/%s" % (node_id, self.ps.uaid,
+                                              last_connect)
+                    d = self.factory.agent.request("DELETE",
+                                                   url.encode("utf8"))
                 d.addErrback(self.trap_connection_err)
                 d.addErrback(self.trap_boto3_err)
                 d.addErrback(self.log_failure,
@@ -882,20 +1034,30 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             return
 
         # Webpush with any outstanding storage-based must all be cleared
-        if any(self.ps.updates_sent.values()):
+        if self.ps.unacked_stored:
             d = self.deferToLater(1, self.process_notifications)
             d.addErrback(self.trap_cancel)
             return
 
         # Are we already running?
         if self.ps._notification_fetch:
-            # Cancel the prior, last one wins
+            # Cancel the prior, last one wins (along with any pages read
+            # ahead of it)
             self.ps._notification_fetch.cancel()
+            self.clear_prefetched()
 
         self.ps._check_notifications = False
         self.ps._more_notifications = True
 
-        d = self.deferToThread(self.webpush_fetch())
+        if self.ps.scan_timestamps and self.ps._prefetched:
+            # Deliver the next page read ahead of time
+            d = self.ps._prefetched.popleft()
+            d.addCallback(self._prefetched_or_fetch)
+            self.metrics.increment("ua.notification.prefetch_hit")
+            self.prefetch_notifications()
+        else:
+            self.clear_prefetched()
+            d = self.deferToThread(self.webpush_fetch())
         d.addCallback(self.finish_notifications)
         d.addErrback(self.error_notification_overload)
         d.addErrback(self.trap_cancel)
@@ -911,10 +1073,76 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         if self.ps.scan_timestamps:
             return partial(message.fetch_timestamp_messages,
                            self.ps.uaid_obj,
-                           self.ps.current_timestamp)
+                           self.ps.current_timestamp,
+                           limit=self.conf.msg_fetch_size)
         else:
             return partial(message.fetch_messages,
-                           self.ps.uaid_obj)
+                           self.ps.uaid_obj,
+                           limit=self.conf.msg_fetch_size)
+
+    def prefetch_notifications(self):
+        """Read ahead the next page of timestamped messages
+
+        Keeps up to ``msg_prefetch_window`` pages fetched (or in flight)
+        ahead of those delivered to the client, so the next page is ready
+        as soon as the current one's acked. Pages are read one at a time,
+        each starting where the last ended, and not while the client's
+        transport is paused.
+
+        """
+        if (self.ps._prefetch_timestamp is None or self.ps._should_stop or
+                self.paused or
+                len(self.ps._prefetched) >= self.conf.msg_prefetch_window):
+            return
+        message = self.db.message_table(self.ps.message_month)
+        d = self.deferToThread(message.fetch_timestamp_messages,
+                               self.ps.uaid_obj,
+                               self.ps._prefetch_timestamp,
+                               limit=self.conf.msg_fetch_size)
+        # In flight: the next page starts where this one ends
+        self.ps._prefetch_timestamp = None
+        d.addCallback(self._prefetched_page)
+        self.ps._prefetched.append(d)
+
+    def _prefetched_page(self, result):
+        # type: (Tuple[Optional[int], List[WebPushNotification]]) -> Tuple
+        timestamp, notifs = result
+        self.ps._prefetch_timestamp = self._next_prefetch(timestamp, notifs)
+        self.prefetch_notifications()
+        return result
+
+    def _prefetched_or_fetch(self, result):
+        # type: (Tuple[Optional[int], List[WebPushNotification]]) -> Any
+        """Deliver a page read ahead, unless it's empty
+
+        An empty page may have been read before a message was stored, so
+        rather than ending the scan on it, query again.
+
+        """
+        timestamp, notifs = result
+        if notifs:
+            return result
+        self.clear_prefetched()
+        return self.deferToThread(self.webpush_fetch())
+
+    @staticmethod
+    def _next_prefetch(timestamp, notifs):
+        # type: (Optional[int], List[WebPushNotification]) -> Optional[int]
+        """Where to read ahead from after a page of timestamped messages"""
+        # Legacy messages are included in every page until they're
+        # deleted (when acked), so reading past them would deliver
+        # duplicates
+        if notifs and all(notif.sortkey_timestamp for notif in notifs):
+            return timestamp
+        return None
+
+    def clear_prefetched(self):
+        """Discard any pages read ahead"""
+        prefetched, self.ps._prefetched = self.ps._prefetched, deque()
+        self.ps._prefetch_timestamp = None
+        for d in prefetched:
+            d.addErrback(lambda fail: None)
+            d.cancel()
 
     def error_notifications(self, fail):
         """errBack for notification check failing"""
@@ -1011,7 +1239,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
                 # for unknown reasons
                 continue  # pragma: nocover
 
-            self.ps.updates_sent[str(notif.channel_id)].append(notif)
+            self.ps.updates_sent.add(str(notif.channel_id), notif)
             msg = notif.websocket_format()
             messages_sent = True
             self.sent_notification_count += 1
@@ -1022,6 +1250,11 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         # Did we send any messages?
         if messages_sent:
+            if self.ps.scan_timestamps and not self.ps._prefetched:
+                # Nothing read ahead yet, start after this page
+                self.ps._prefetch_timestamp = self._next_prefetch(
+                    timestamp, notifs)
+            self.prefetch_notifications()
             return
 
         # No messages sent, update the record if needed
@@ -1185,8 +1418,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         self.log.info(**event)
 
         # Clear out any existing tracked messages for this channel
-        self.ps.direct_updates[chid] = []
-        self.ps.updates_sent[chid] = []
+        self.ps.direct_updates.discard_channel(chid)
+        self.ps.updates_sent.discard_channel(chid)
 
         # Unregister the channel
         message = self.db.message_table(self.ps.message_month)
@@ -1217,14 +1450,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
     def _handle_webpush_ack(self, chid, version, code):
         """Handle clearing out a webpush ack"""
-        def ver_filter(notif):
-            return notif.version == version
-
-        found = filter(
-            ver_filter, self.ps.direct_updates[chid]
-        )  # type: List[WebPushNotification]
-        if found:
-            msg = found[0]
+        msg = self.ps.direct_updates.get(chid, version)
+        if msg is not None:
             size = len(msg.data) if msg.data else 0
             self.log.debug(format="Ack", router_key="webpush", channel_id=chid,
                            message_id=version, message_source="direct",
@@ -1232,14 +1459,11 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
                            user_agent=self.ps.user_agent, code=code,
                            **self.ps.raw_agent)
             self.ps.stats.direct_acked += 1
-            self.ps.direct_updates[chid].remove(msg)
+            self.ps.direct_updates.discard(chid, msg)
             return
 
-        found = filter(
-            ver_filter, self.ps.updates_sent[chid]
-        )  # type: List[WebPushNotification]
-        if found:
-            msg = found[0]
+        msg = self.ps.updates_sent.get(chid, version)
+        if msg is not None:
             size = len(msg.data) if msg.data else 0
             self.log.debug(format="Ack", router_key="webpush", channel_id=chid,
                            message_id=version, message_source="stored",
@@ -1251,9 +1475,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             message = self.db.message_table(self.ps.message_month)
             if msg.sortkey_timestamp:
                 # Is this the last un-acked message we're waiting for?
-                last_unacked = sum(
-                    len(sent) for sent in self.ps.updates_sent.itervalues()
-                ) == 1
+                last_unacked = len(self.ps.updates_sent) == 1
 
                 if (msg.sortkey_timestamp == self.ps.current_timestamp or
                         last_unacked):
@@ -1287,8 +1509,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         """
         try:
-            self.ps.updates_sent[chid].remove(notif)
-        except (AttributeError, ValueError):
+            self.ps.updates_sent.discard(chid, notif)
+        except AttributeError:
             pass
 
     def process_ack(self, data):
@@ -1334,7 +1556,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         # When using webpush, we don't check again if we have outstanding
         # notifications
-        if any(self.ps.updates_sent.values()):
+        if self.ps.unacked_stored:
             return
 
         # Should we check again?
@@ -1366,9 +1588,14 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         # Create the notification
         notif = WebPushNotification.from_serialized(self.ps.uaid_obj, update)
-        self.ps.direct_updates[chid].append(notif)
+        self.ps.direct_updates.add(chid, notif)
         self.emit_send_metrics(notif)
-        self.sendJSON(notif.websocket_format())
+        frame = update.get("frame")
+        if frame:
+            # Already encoded (by the endpoint) as websocket_format
+            self.sendMessage(frame.encode('utf8'), False)
+        else:
+            self.sendJSON(notif.websocket_format())
 
     def emit_send_metrics(self, notif):
         if notif.topic:
@@ -1377,18 +1604,155 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
                                tags=make_tags(source=notif.source))
 
 
+class HelloAdmission(object):
+    """Token bucket admission control of hello processing
+
+    Paces the router table calls made by hellos to ``rate`` per second
+    (with bursts of up to ``burst``), e.g. after a node restart when its
+    clients all reconnect at once. Hellos over the budget wait in a queue,
+    returning users (with a valid uaid) ahead of new ones. Waiting only
+    holds a Deferred: the connection's transport stays paused.
+
+    Hellos that would wait longer than ``max_wait`` seconds are rejected
+    (as a database overload) instead, as are those still waiting after
+    ``max_wait`` (e.g. new users behind a stream of returning ones).
+
+    """
+    def __init__(self,
+                 rate,            # type: float
+                 burst,           # type: int
+                 max_wait,        # type: float
+                 metrics,         # type: IMetrics
+                 clock=reactor,
+                 ):
+        # type: (...) -> None
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+        self.max_queue = max(1, int(rate * max_wait))
+        self.metrics = metrics
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self._updated = clock.seconds()
+        # (Deferred, queued at, expiry) of waiting hellos, cancelled or
+        # expired ones are skipped when dequeued
+        self._returning = deque()  # type: Deque[Tuple[Deferred, float, IDelayedCall]]  # noqa
+        self._new = deque()  # type: Deque[Tuple[Deferred, float, IDelayedCall]]  # noqa
+        self.waiting = 0
+        self._timer = None
+
+    def admit(self, returning=True):
+        # type: (bool) -> Deferred
+        """Return a Deferred firing when a hello may be processed
+
+        Fails with :exc:`AdmissionRejectedException` if the queue's full,
+        or once it's waited ``max_wait`` seconds.
+
+        """
+        self._refill()
+        if not self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            return succeed(None)
+        if self.waiting >= self.max_queue:
+            self.metrics.increment("ua.hello.admission.rejected")
+            return fail(AdmissionRejectedException())
+
+        def cancel(d):
+            self.waiting -= 1
+            expiry.cancel()
+
+        d = Deferred(canceller=cancel)
+        expiry = self.clock.callLater(self.max_wait, self._expire, d)
+        queue = self._returning if returning else self._new
+        queue.append((d, self.clock.seconds(), expiry))
+        self.waiting += 1
+        self.metrics.increment("ua.hello.admission.queued",
+                               tags=make_tags(returning=returning))
+        self._schedule()
+        return d
+
+    def _refill(self):
+        now = self.clock.seconds()
+        # Rounded so a refill timed for the next whole token reaches it
+        # (rather than falling a float error short, rescheduling forever)
+        self.tokens = round(min(self.burst,
+                                self.tokens + (now - self._updated) *
+                                self.rate), 9)
+        self._updated = now
+
+    def _schedule(self):
+        if self._timer is None and self.waiting:
+            delay = max(0, (1 - self.tokens) / self.rate)
+            self._timer = self.clock.callLater(delay, self._drain)
+
+    def _drain(self):
+        self._timer = None
+        self._refill()
+        now = self.clock.seconds()
+        while self.tokens >= 1 and self.waiting:
+            d, queued_at, expiry = self._next()
+            expiry.cancel()
+            self.tokens -= 1
+            self.waiting -= 1
+            self.metrics.timing("ua.hello.admission.wait",
+                                (now - queued_at) * 1000)
+            d.callback(None)
+        self.metrics.gauge("ua.hello.admission.queue_depth", self.waiting)
+        self._schedule()
+
+    def _expire(self, d):
+        # type: (Deferred) -> None
+        self.waiting -= 1
+        self.metrics.increment("ua.hello.admission.expired")
+        d.errback(AdmissionRejectedException())
+
+    def _next(self):
+        # type: () -> Tuple[Deferred, float, IDelayedCall]
+        for queue in (self._returning, self._new):
+            while queue:
+                entry = queue.popleft()
+                if not entry[0].called:
+                    return entry
+        raise IndexError("No hellos waiting")  # pragma: nocover
+
+
 class PushServerFactory(WebSocketServerFactory):
     """PushServerProtocol factory"""
 
     protocol = PushServerProtocol
 
-    def __init__(self, conf, db, agent, clients):
-        # type: (AutopushConfig, DatabaseManager, Agent, Dict) -> None
+    def __init__(self,
+                 conf,                 # type: AutopushConfig
+                 db,                   # type: DatabaseManager
+                 agent,                # type: Agent
+                 clients,              # type: Dict
+                 node_transport=None,  # type: Optional[NodeTransport]
+                 ):
+        # type: (...) -> None
         WebSocketServerFactory.__init__(self, conf.ws_url)
         self.conf = conf
         self.db = db
         self.agent = agent
         self.clients = clients
+        self.node_transport = node_transport
+        self.timer_wheel = None  # type: Optional[TimerWheel]
+        if conf.timer_wheel_tick:
+            self.timer_wheel = TimerWheel(
+                conf.timer_wheel_tick, metrics=db.metrics)
+        self.ua_cache = TTLCache(
+            conf.user_agent_cache_size,
+            USER_AGENT_CACHE_TTL,
+            metrics=db.metrics,
+            name="user_agent",
+        )
+        self.hello_admission = None  # type: Optional[HelloAdmission]
+        if conf.hello_admission_rate:
+            self.hello_admission = HelloAdmission(
+                conf.hello_admission_rate,
+                conf.hello_admission_burst,
+                conf.hello_admission_max_wait,
+                db.metrics,
+            )
         self.setProtocolOptions(
             webStatus=False,
             openHandshakeTimeout=5,
@@ -1424,11 +1788,44 @@ class RouterHandler(BaseHandler):
             self.write("Client busy.")
             return
 
-        update = json.loads(self.request.body)
+        update = jsoncodec.loads(self.request.body)
         client.send_notification(update)
         self.write("Client accepted for delivery")
 
 
+class BatchRouterHandler(BaseHandler):
+    """Batched Router Handler
+
+    Handles routing a batch of notifications, coalesced by an endpoint, to
+    clients connected to this node.
+
+    """
+
+    def put(self):
+        """HTTP Put
+
+        Attempt delivery of each notification in the batch, responding with
+        a per notification status code (in request order) matching those of
+        :class:`RouterHandler`.
+
+        """
+        updates = jsoncodec.loads(self.request.body)
+        results = [self._deliver(item["uaid"], item["notification"])
+                   for item in updates]
+        self.metrics.increment("router.batch.notifications", len(results))
+        self.set_header("Content-Type", "application/json")
+        self.write(jsoncodec.dumps(dict(results=results)))
+
+    def _deliver(self, uaid, update):
+        client = self.application.clients.get(uaid)
+        if not client:
+            return 404
+        if client.paused:
+            return 503
+        client.send_notification(update)
+        return 200
+
+
 class NotificationHandler(BaseHandler):
 
     def put(self, uaid, *args):